@@ -4,6 +4,7 @@ This is a dummy CleanCall class for dry run only, or to be inheritted by casaIma
 
 import numpy as np
 import re
+import functools
 
 import logging
 logger = logging.getLogger(__name__)
@@ -22,6 +23,11 @@ class CleanCall:
         self.infile_list = infile_list
         self.logfile = None
 
+        # Plain (JSON-able) description of the call, e.g. target,
+        # config, product and imaging stage. Identifies the tasks that
+        # take this clean call in the run journal (see utilsJournal).
+        self.journal_key = None
+
         ###################################
         # Initialize the clean parameters #
         ###################################
@@ -228,6 +234,7 @@ class CleanCall:
 
 
 def CleanCallFunctionDecorator(func):
+    @functools.wraps(func)
     def func_wrapper(*args, **kwargs):
         for k in kwargs.keys():
             #print('CleanCallFunctionDecorator', kwargs[k], type(kwargs[k]), isinstance(kwargs[k], CleanCall))
@@ -240,6 +247,9 @@ def CleanCallFunctionDecorator(func):
                     raise Exception('Error! Invalid clean_call! It should be a CleanCall instance!')
                     return
         return func(*args, **kwargs)
+    # ... lets inspect.getcallargs see the task arguments (python 2
+    # functools.wraps does not set this)
+    func_wrapper.__wrapped__ = func
     return func_wrapper
 
 
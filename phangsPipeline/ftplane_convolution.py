@@ -5,21 +5,14 @@ import astropy.units as u
 import astropy.utils.console as console
 import copy
 import warnings
+import scipy.fft
+from collections import OrderedDict
 
-def ftconvolve(ImageIn, major = 1.0, minor = 1.0,
-               angle = 0.0):
-    NanMaskFlag = False
-    nanmask = np.isnan(ImageIn)
-    image = np.copy(ImageIn)
-    if np.any(nanmask):
-        wtimg = np.ones_like(ImageIn)
-        NanMaskFlag = True
-        image[nanmask] = 0.0
-        wtimg[nanmask] = 0.0
-        ftwtimg = np.fft.fftn(wtimg)    
-
-    ftimg = np.fft.fftn(image)
-
+def _ft_coefficients(major, minor, angle):
+    """
+    Coefficients of the Fourier-space quadratic form of a Gaussian
+    with the given sigma (pixels) and position angle (radians).
+    """
     if major == 0.0:
         sigmau = np.inf
     else:
@@ -37,6 +30,23 @@ def ftconvolve(ImageIn, major = 1.0, minor = 1.0,
     c = 0.5 * (np.sin(FTPA)**2 / sigmau**2 +
                np.cos(FTPA)**2 / sigmav**2)
     b = 0.25 * np.sin(2 * FTPA) * (1.0 / sigmav**2 - 1.0 / sigmau**2)
+    return(a, b, c)
+
+def ftconvolve(ImageIn, major = 1.0, minor = 1.0,
+               angle = 0.0):
+    NanMaskFlag = False
+    nanmask = np.isnan(ImageIn)
+    image = np.copy(ImageIn)
+    if np.any(nanmask):
+        wtimg = np.ones_like(ImageIn)
+        NanMaskFlag = True
+        image[nanmask] = 0.0
+        wtimg[nanmask] = 0.0
+        ftwtimg = np.fft.fftn(wtimg)    
+
+    ftimg = np.fft.fftn(image)
+
+    a, b, c = _ft_coefficients(major, minor, angle)
 
     vv, uu = np.meshgrid(np.fft.fftfreq(ftimg.shape[0]),
                          np.fft.fftfreq(ftimg.shape[1]),
@@ -51,9 +61,120 @@ def ftconvolve(ImageIn, major = 1.0, minor = 1.0,
         ConvolvedImage[nanmask] = np.nan
     return(ConvolvedImage)
 
+# Frequency grids for real-to-complex transforms keyed by plane shape,
+# and Fourier kernels keyed by (shape, major, minor, angle). Planes of
+# a cube share a shape and often share a beam delta, so both get
+# reused across channels and blocks.
+_ft_grid_cache = OrderedDict()
+_ft_kernel_cache = OrderedDict()
+_ft_cache_size = 256
+
+def _ft_grid(shape):
+    """
+    Return frequency grids (vv, uu) for an rfftn of a plane of shape
+    (ny, nx), shaped to broadcast to (ny, nx//2+1), together with the
+    grids of the negated frequencies. Nyquist frequencies are -0.5 as
+    in fftfreq and map onto themselves when negated.
+    """
+    key = tuple(shape)
+    if key in _ft_grid_cache:
+        return(_ft_grid_cache[key])
+    vv = np.fft.fftfreq(shape[0])[:, np.newaxis]
+    uu = np.fft.rfftfreq(shape[1])[np.newaxis, :]
+    if shape[1] % 2 == 0:
+        uu[0, -1] = -0.5
+    nvv = np.where(vv == -0.5, vv, -vv)
+    nuu = np.where(uu == -0.5, uu, -uu)
+    _ft_grid_cache[key] = (vv, uu, nvv, nuu)
+    while len(_ft_grid_cache) > _ft_cache_size:
+        _ft_grid_cache.popitem(last=False)
+    return((vv, uu, nvv, nuu))
+
+def _ft_kernel(shape, major=1.0, minor=1.0, angle=0.0):
+    """
+    Fourier-space Gaussian kernel for an rfftn of a plane of shape
+    (ny, nx). Cached on the shape and the (rounded) beam delta.
+
+    The kernel is averaged with its value at the negated frequency.
+    This only changes the Nyquist row and column, where the tilted
+    Gaussian is not symmetric on the discrete grid, and reproduces
+    the real part of the full complex transform used by ftconvolve.
+    """
+    key = (tuple(shape), round(float(major), 10), round(float(minor), 10),
+           round(float(angle), 10))
+    if key in _ft_kernel_cache:
+        _ft_kernel_cache.move_to_end(key)
+        return(_ft_kernel_cache[key])
+    vv, uu, nvv, nuu = _ft_grid(shape)
+    a, b, c = _ft_coefficients(major, minor, angle)
+    FTkernel = 0.5 * (np.exp(-a*(uu)**2 -c*(vv)**2 +2*b*(uu*vv))
+                      + np.exp(-a*(nuu)**2 -c*(nvv)**2 +2*b*(nuu*nvv)))
+    _ft_kernel_cache[key] = FTkernel
+    while len(_ft_kernel_cache) > _ft_cache_size:
+        _ft_kernel_cache.popitem(last=False)
+    return(FTkernel)
+
+def ftconvolve_stack(planes, majors=None, minors=None, angles=None,
+                     workers=None):
+    """
+    Convolve a stack of planes (nplane, ny, nx), each with its own
+    Gaussian kernel, using real-to-complex FFTs over axes (1, 2).
+
+    Gives the same result as calling ftconvolve on each plane: NaNs
+    are replaced by zero and the result is normalized by the
+    convolved weight image, with NaNs restored afterwards. When any
+    plane has NaNs, the data and weights are transformed together in
+    one stacked call.
+
+    Parameters
+    ----------
+    planes : `np.ndarray`
+       Stack of images.
+
+    majors, minors, angles : array-like
+       Per-plane kernel sigma (pixels) and position angle (radians).
+
+    workers : int
+       Number of threads used by scipy.fft.
+    """
+    nplane = planes.shape[0]
+    shape = planes.shape[1:]
+    if majors is None:
+        majors = np.ones(nplane)
+    if minors is None:
+        minors = np.ones(nplane)
+    if angles is None:
+        angles = np.zeros(nplane)
+
+    kernels = np.stack([_ft_kernel(shape, major=majors[ii],
+                                   minor=minors[ii], angle=angles[ii])
+                        for ii in range(nplane)])
+
+    nanmask = np.isnan(planes)
+    image = np.where(nanmask, 0.0, planes)
+    NanMaskFlag = np.any(nanmask)
+    if NanMaskFlag:
+        wtimg = (~nanmask).astype(image.dtype)
+        image = np.concatenate([image, wtimg])
+        kernels = np.concatenate([kernels, kernels])
+
+    ftimg = scipy.fft.rfftn(image, axes=(1, 2), workers=workers)
+    ftimg *= kernels
+    ConvolvedImage = scipy.fft.irfftn(ftimg, s=shape, axes=(1, 2),
+                                      workers=workers)
+
+    if NanMaskFlag:
+        ConvolvedMask = ConvolvedImage[nplane:]
+        ConvolvedImage = ConvolvedImage[:nplane]
+        ConvolvedImage /= ConvolvedMask
+        ConvolvedImage[nanmask] = np.nan
+    return(ConvolvedImage)
+
 def MakeRoundBeam(incube, 
                   outfile=None,
-                  overwrite=True):
+                  overwrite=True,
+                  block_size=16,
+                  workers=None):
 
     '''
     This takes a FITS file or a SpectralCube and outputs 
@@ -62,6 +183,12 @@ def MakeRoundBeam(incube,
     ----------
     filename : `string` or `SpectralCube`
        Input spectral cube
+
+    block_size : `int`
+       Number of channels convolved together (see ftconvolve_stack).
+
+    workers : `int`
+       Number of threads for the FFTs.
     
     Returns
     -------
@@ -84,7 +211,7 @@ def MakeRoundBeam(incube,
     target_beam = Beam(major=target_beamsize*u.deg,
                        minor=target_beamsize*u.deg,
                        pa=0.0*u.deg)
-    print "Target beam is :", target_beam
+    print("Target beam is :", target_beam)
 
     # Let's assume square pixels
     pixsize = cube.wcs.pixel_scale_matrix[1,1]
@@ -92,19 +219,27 @@ def MakeRoundBeam(incube,
 
     output = np.zeros(cube.shape)
 
-    with console.ProgressBar(cube.shape[0]) as bar:
-
-        for ii, plane in enumerate(cube.filled_data[:]):
-            this_beam = beams[ii]
-            conv_beam = target_beam - this_beam
+    # Beam deltas for every channel
+    majors = np.zeros(cube.shape[0])
+    minors = np.zeros(cube.shape[0])
+    angles = np.zeros(cube.shape[0])
+    for ii, this_beam in enumerate(beams):
+        # The widest channel needs no convolution
+        conv_beam = target_beam.deconvolve(this_beam,
+                                           failure_returns_pointlike=True)
+        majors[ii] = conv_beam.major.value / pixsize / fwhm2sigma
+        minors[ii] = conv_beam.minor.value / pixsize / fwhm2sigma
+        angles[ii] = conv_beam.pa.to(u.rad).value
 
-            majpix = conv_beam.major.value / pixsize / fwhm2sigma
-            minpix = conv_beam.minor.value / pixsize / fwhm2sigma
+    nblock = int(np.ceil(cube.shape[0] / float(block_size)))
+    with console.ProgressBar(nblock) as bar:
 
-            output[ii,:,:] = ftconvolve(plane,
-                                        major = majpix,
-                                        minor = minpix,
-                                        angle = conv_beam.pa.value)
+        for start in range(0, cube.shape[0], block_size):
+            block = slice(start, min(start + block_size, cube.shape[0]))
+            output[block] = ftconvolve_stack(
+                np.asarray(cube.filled_data[block].value),
+                majors=majors[block], minors=minors[block],
+                angles=angles[block], workers=workers)
 
             bar.update()
 
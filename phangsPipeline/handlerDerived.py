@@ -22,6 +22,7 @@ Example:
 
 import os, sys, re, shutil
 import glob
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
 from astropy.io import fits
 from astropy.wcs import WCS
@@ -51,14 +52,26 @@ import utilsResolutions
 import utilsFilenames
 import utilsLines
 import handlerTemplate
+import utilsProfile
+import utilsJournal
+import utilsTaskGraph
+import utilsMemory
+from utilsWriter import BackgroundWriter
 
-from scConvolution import smooth_cube
+from scConvolution import smooth_cube, smooth_cube_ladder, write_smoothed
 from scNoiseRoutines import recipe_phangs_noise
-from scMaskingRoutines import recipe_phangs_strict_mask, recipe_phangs_broad_mask
+from scMaskingRoutines import recipe_phangs_strict_mask, recipe_phangs_broad_mask, write_mask
 
 #import scDerivativeRoutines as scderiv
 from scMoments import moment_generator
+from scDerivativeRoutines import channel_correlation_from_header
 
+# Convolution keywords that change how, but not what, is computed. Left
+# out of the manifest so that changing them does not force a rerun.
+_execution_kwargs = ['backend', 'scratch_dir', 'n_workers']
+
+@utilsProfile.profile_tasks
+@utilsJournal.journal_tasks
 class DerivedHandler(handlerTemplate.HandlerTemplate):
     """
     Class to create signal masks based on image cubes, and then apply
@@ -98,12 +111,46 @@ class DerivedHandler(handlerTemplate.HandlerTemplate):
             extra_ext_in='', 
             extra_ext_out='', 
             overwrite=True, 
+            ladder_convolve=False,
+            convolve_cores=1,
+            use_graph=False,
+            n_processes=1,
+            chain=False,
+            memory_budget=None,
         ):
         """
         Loops over the full set of targets, spectral products (note
         the dual definition of "product" here), and configurations to
         do the imaging. Toggle the parts of the loop using the do_XXX
         booleans. Other choices affect algorithms used.
+
+        If ladder_convolve is True, the angular and physical
+        resolutions for each cube are made in one incremental pass
+        (see task_convolve_ladder) instead of each starting from the
+        native cube.
+
+        convolve_cores is the total number of cores for the
+        convolution stage. The resolutions of each cube are then
+        convolved concurrently, with the cores split between them
+        (see task_convolve n_workers). Each concurrent resolution
+        reads the full native cube, so memory grows with the number
+        running at once. With a memory_budget, only as many run at
+        once as fit in it (see estimate_task_memory).
+
+        If use_graph is True the requested steps are expanded into one
+        dependency graph over all targets, products, configurations
+        and resolutions (see build_task_graph) and run on n_processes
+        local processes, instead of stage by stage. With a
+        memory_budget (bytes or e.g. '64 GB') tasks only start when
+        their estimated peak memory (see estimate_task_memory) fits
+        next to the running ones, so large cubes run alone and small
+        ones share the machine.
+
+        If chain is True (and do_convolve), each resolution of each
+        cube is convolved, noise estimated, strict masked and its
+        strict mask moments made in one pass that keeps the cubes in
+        memory (see task_derive_chain). The broad mask and the
+        moments that use it then follow as usual.
         """
         
         if do_all:
@@ -129,6 +176,55 @@ class DerivedHandler(handlerTemplate.HandlerTemplate):
         if make_directories:
             self._kh.make_missing_directories(derived = True)
 
+        # Run all requested steps as one dependency graph
+
+        if use_graph:
+            graph = self.build_task_graph(
+                do_convolve=do_convolve, do_noise=do_noise,
+                do_strictmask=do_strictmask, do_broadmask=do_broadmask,
+                do_moments=do_moments, do_secondary=do_secondary,
+                overwrite=overwrite, ladder_convolve=ladder_convolve)
+            return(graph.run(self, n_workers=n_processes, memory_budget=memory_budget,
+                             estimate=self._estimate_node_memory))
+
+        # Chain convolution, noise, strict masks and strict mask moments
+        # for each resolution in memory.
+
+        first_moment_masks = None
+
+        if chain and do_convolve and not ladder_convolve:
+
+            for this_target, this_product, this_config in \
+                    self.looper(do_targets=True,do_products=True,do_configs=True):
+
+                chain_list = [(None, None, 'ang')]
+                for this_res_type in ['ang', 'phys']:
+                    if this_res_type == 'ang':
+                        res_dict = self._kh.get_ang_res_dict(
+                            config=this_config,product=this_product)
+                    else:
+                        res_dict = self._kh.get_phys_res_dict(
+                            config=this_config,product=this_product)
+                    for this_res_tag in sorted(list(res_dict)):
+                        chain_list.append((this_res_tag, res_dict[this_res_tag], this_res_type))
+
+                for this_res_tag, this_res_value, this_res_type in chain_list:
+                    self.task_derive_chain(
+                        target=this_target, config=this_config, product=this_product,
+                        res_tag=this_res_tag, res_value=this_res_value, res_type=this_res_type,
+                        extra_ext_in=extra_ext_in, extra_ext_out=extra_ext_out,
+                        do_noise=do_noise, do_strictmask=do_strictmask,
+                        do_moments=do_moments, overwrite=overwrite,
+                        n_workers=convolve_cores)
+
+            do_convolve = False
+            do_noise = False
+            do_strictmask = False
+            first_moment_masks = ['broadmask']
+
+        elif chain:
+            logger.warning("Chained mode needs do_convolve and no ladder_convolve. Running step by step.")
+
         # Convolve the data to all requested angular and physical resolutions.
         
         if do_convolve:
@@ -142,7 +238,15 @@ class DerivedHandler(handlerTemplate.HandlerTemplate):
                     target=this_target, config=this_config, product=this_product,
                     just_copy = True, overwrite=overwrite)
 
+                if ladder_convolve:
+                    self.task_convolve_ladder(
+                        target=this_target, config=this_config, product=this_product,
+                        overwrite=overwrite)
+                    continue
+
                 # Loop over all angular and physical resolutions.
+
+                convolve_list = []
                 
                 res_dict = self._kh.get_ang_res_dict(
                     config=this_config,product=this_product)
@@ -150,11 +254,7 @@ class DerivedHandler(handlerTemplate.HandlerTemplate):
                 if len(res_list) > 0:
                     res_list.sort()
                 for this_res_tag in res_list:
-                    this_res_value = res_dict[this_res_tag]
-                    self.task_convolve(
-                        target=this_target, config=this_config, product=this_product,
-                        res_tag=this_res_tag,res_value=this_res_value,res_type='ang', 
-                        overwrite=overwrite)
+                    convolve_list.append((this_res_tag, res_dict[this_res_tag], 'ang'))
 
                 res_dict = self._kh.get_phys_res_dict(
                     config=this_config,product=this_product)
@@ -162,11 +262,38 @@ class DerivedHandler(handlerTemplate.HandlerTemplate):
                 if len(res_list) > 0:
                     res_list.sort()
                 for this_res_tag in res_list:
-                    this_res_value = res_dict[this_res_tag]
+                    convolve_list.append((this_res_tag, res_dict[this_res_tag], 'phys'))
+
+                # Split the core budget between concurrent resolutions.
+                # Each reads the whole native cube, so with a memory
+                # budget only run as many at once as fit.
+
+                n_concurrent = max(min(len(convolve_list), convolve_cores), 1)
+                if n_concurrent > 1 and memory_budget is not None:
+                    indir = self._kh.get_postprocess_dir_for_target(target=this_target, changeto=False)
+                    orig_file = os.path.abspath(indir)+'/'+self._fname_dict(
+                        target=this_target, config=this_config, product=this_product)['orig']
+                    need = self.estimate_task_memory(task='task_convolve', input_files=[orig_file])
+                    n_fit = int(utilsMemory.parse_memory(memory_budget) // need)
+                    if n_fit < n_concurrent:
+                        logger.info("Memory budget fits "+str(max(n_fit, 1))+" concurrent convolutions of "
+                                    +utilsMemory.format_memory(need)+" each.")
+                        n_concurrent = max(n_fit, 1)
+                n_workers = max(convolve_cores // n_concurrent, 1)
+
+                def _convolve_one(this_res):
+                    this_res_tag, this_res_value, this_res_type = this_res
                     self.task_convolve(
                         target=this_target, config=this_config, product=this_product,
-                        res_tag=this_res_tag,res_value=this_res_value,res_type='phys', 
-                        overwrite=overwrite)
+                        res_tag=this_res_tag,res_value=this_res_value,res_type=this_res_type, 
+                        overwrite=overwrite, n_workers=n_workers)
+
+                if n_concurrent > 1:
+                    with ThreadPoolExecutor(max_workers=n_concurrent) as pool:
+                        list(pool.map(_convolve_one, convolve_list))
+                else:
+                    for this_res in convolve_list:
+                        _convolve_one(this_res)
 
         # Estimate the noise for each cube.
         
@@ -258,7 +385,7 @@ class DerivedHandler(handlerTemplate.HandlerTemplate):
 
                 self.task_generate_moments(
                     target=this_target, product=this_product, config=this_config,
-                    res_tag=None, overwrite=overwrite)
+                    res_tag=None, overwrite=overwrite, mask_types=first_moment_masks)
 
                 # Loop over all angular and physical resolutions.
 
@@ -267,14 +394,14 @@ class DerivedHandler(handlerTemplate.HandlerTemplate):
 
                     self.task_generate_moments(
                         target=this_target, product=this_product, config=this_config,
-                        res_tag=this_res, overwrite=overwrite)
+                        res_tag=this_res, overwrite=overwrite, mask_types=first_moment_masks)
 
                 for this_res in self._kh.get_phys_res_dict(
                     config=this_config,product=this_product):
 
                     self.task_generate_moments(
                         target=this_target, product=this_product, config=this_config,
-                        res_tag=this_res, overwrite=overwrite)
+                        res_tag=this_res, overwrite=overwrite, mask_types=first_moment_masks)
 
         if do_secondary:
             for this_target, this_product, this_config in \
@@ -303,6 +430,331 @@ class DerivedHandler(handlerTemplate.HandlerTemplate):
         
 # end of loop
 
+    ###############################################
+    # Dependency graph of the derived-product tasks #
+    ###############################################
+
+    def _res_tags(
+        self,
+        config=None,
+        product=None,
+        ):
+        """
+        Resolution tags for a config and product, native (None) first,
+        then angular and physical in the order of the main loop.
+        """
+        res_tags = [None]
+        for res_dict in [self._kh.get_ang_res_dict(config=config,product=product),
+                         self._kh.get_phys_res_dict(config=config,product=product)]:
+            res_list = list(res_dict)
+            res_list.sort()
+            res_tags += res_list
+        return(res_tags)
+
+    def _moment_files(
+        self,
+        outroot=None,
+        moments=[],
+        ):
+        """
+        Output and error files written for a list of moments.
+        """
+        files = []
+        for this_mom in moments:
+            mom_params = self._kh.get_params_for_moment(this_mom)
+            files.append(outroot+mom_params['ext']+'.fits')
+            files.append(outroot+mom_params['ext_error']+'.fits')
+        return(files)
+
+    def build_task_graph(
+        self,
+        do_all=False,
+        do_convolve=False,
+        do_noise=False,
+        do_strictmask=False,
+        do_broadmask=False,
+        do_moments=False,
+        do_secondary=False,
+        overwrite=True,
+        ladder_convolve=False,
+        ):
+        """
+        Expand the loops of loop_derive_products into a
+        utilsTaskGraph.TaskGraph. Each (step, target, product, config,
+        res_tag) becomes a node with the files it reads and writes, so
+        that, e.g., the broad mask waits for the strict masks of all
+        linked configs at all resolutions and the secondary moments
+        wait for the primary moment maps they use. Steps that are not
+        requested contribute no nodes and their outputs are taken to
+        exist.
+        """
+
+        if do_all:
+            do_convolve = True
+            do_noise = True
+            do_strictmask = True
+            do_broadmask = True
+            do_moments = True
+            do_secondary = True
+
+        graph = utilsTaskGraph.TaskGraph()
+
+        for this_target, this_product, this_config in \
+                self.looper(do_targets=True,do_products=True,do_configs=True):
+
+            indir = self._kh.get_postprocess_dir_for_target(target=this_target, changeto=False)
+            indir = os.path.abspath(indir)+'/'
+            outdir = self._kh.get_derived_dir_for_target(target=this_target, changeto=False)
+            outdir = os.path.abspath(outdir)+'/'
+
+            key = ':'.join([this_target, this_product, this_config])
+            res_tags = self._res_tags(config=this_config, product=this_product)
+            orig_file = indir+self._fname_dict(
+                target=this_target, config=this_config, product=this_product)['orig']
+            base_kwargs = {'target':this_target, 'product':this_product,
+                           'config':this_config, 'overwrite':overwrite}
+
+            fname_dicts = {}
+            for this_res in res_tags:
+                fname_dicts[this_res] = dict(
+                    (k, (outdir+v if k not in ['res_tag','orig'] else v))
+                    for k, v in self._fname_dict(
+                        target=this_target, config=this_config,
+                        product=this_product, res_tag=this_res).items())
+
+            # Convolution
+
+            if do_convolve:
+                graph.add_task(
+                    'convolve:'+key+':native', 'task_convolve',
+                    kwargs=dict(base_kwargs, just_copy=True),
+                    inputs=[orig_file], outputs=[fname_dicts[None]['cube']])
+
+                if ladder_convolve:
+                    outputs = []
+                    for this_res in res_tags[1:]:
+                        outputs += [fname_dicts[this_res][k] for k in
+                                    ['cube', 'coverage', 'coverage2d']]
+                    graph.add_task(
+                        'convolve:'+key+':ladder', 'task_convolve_ladder',
+                        kwargs=base_kwargs, inputs=[orig_file], outputs=outputs)
+                else:
+                    for res_dict, res_type in [
+                            (self._kh.get_ang_res_dict(config=this_config,product=this_product), 'ang'),
+                            (self._kh.get_phys_res_dict(config=this_config,product=this_product), 'phys')]:
+                        for this_res in res_dict:
+                            graph.add_task(
+                                'convolve:'+key+':'+this_res, 'task_convolve',
+                                kwargs=dict(base_kwargs, res_tag=this_res,
+                                            res_value=res_dict[this_res],
+                                            res_type=res_type),
+                                inputs=[orig_file],
+                                outputs=[fname_dicts[this_res][k] for k in
+                                         ['cube', 'coverage', 'coverage2d']])
+
+            # Noise, strict masks
+
+            for this_res in res_tags:
+                files = fname_dicts[this_res]
+                res_name = key+':'+str(this_res if this_res is not None else 'native')
+
+                if do_noise:
+                    graph.add_task(
+                        'noise:'+res_name, 'task_estimate_noise',
+                        kwargs=dict(base_kwargs, res_tag=this_res),
+                        inputs=[files['cube']], outputs=[files['noise']])
+
+                if do_strictmask:
+                    graph.add_task(
+                        'strictmask:'+res_name, 'task_build_strict_mask',
+                        kwargs=dict(base_kwargs, res_tag=this_res),
+                        inputs=[files['cube'], files['noise'], files['coverage']],
+                        outputs=[files['strictmask']])
+
+            # Broad mask, from the strict masks of all linked configs
+
+            if do_broadmask:
+                linked_configs = list(self._kh.get_linked_mask_configs(
+                    config=this_config, product=this_product))
+                if this_config not in linked_configs:
+                    linked_configs.append(this_config)
+                inputs = []
+                for cross_config in linked_configs:
+                    for this_res in self._res_tags(config=cross_config, product=this_product):
+                        inputs.append(outdir+self._fname_dict(
+                            target=this_target, config=cross_config,
+                            product=this_product, res_tag=this_res)['strictmask'])
+                graph.add_task(
+                    'broadmask:'+key, 'task_build_broad_mask',
+                    kwargs=dict(base_kwargs, res_tag=None),
+                    inputs=inputs, outputs=[fname_dicts[None]['broadmask']])
+
+            # Moments, by round
+
+            if not (do_moments or do_secondary):
+                continue
+
+            list_of_moments = self._kh.get_moment_list(config=this_config, product=this_product)
+            rounds = sorted(list(set(
+                [self._kh.get_params_for_moment(this_mom)['round'] for this_mom in list_of_moments])))
+            if len(rounds) == 0:
+                continue
+            first_moments = [this_mom for this_mom in list_of_moments
+                             if self._kh.get_params_for_moment(this_mom)['round'] == rounds[0]]
+            later_moments = [this_mom for this_mom in list_of_moments
+                             if this_mom not in first_moments]
+
+            for this_res in res_tags:
+                files = fname_dicts[this_res]
+                res_name = key+':'+str(this_res if this_res is not None else 'native')
+                outroot = files['momentroot']
+                mask_inputs = [files['cube'], files['noise'], files['strictmask'],
+                               fname_dicts[None]['broadmask']]
+
+                if do_moments:
+                    graph.add_task(
+                        'moments:'+res_name, 'task_generate_moments',
+                        kwargs=dict(base_kwargs, res_tag=this_res),
+                        inputs=mask_inputs,
+                        outputs=self._moment_files(outroot=outroot, moments=first_moments))
+
+                if do_secondary and len(later_moments) > 0:
+                    inputs = list(mask_inputs)
+                    for this_mom in later_moments:
+                        mom_params = self._kh.get_params_for_moment(this_mom)
+                        for map_ext in mom_params['maps_to_pass']:
+                            inputs.append(outroot+'_'+map_ext+'.fits')
+                        for this_ext in mom_params['other_exts'].values():
+                            inputs.append(outdir+str(this_target)+this_ext)
+                    graph.add_task(
+                        'secondary:'+res_name, 'task_generate_secondary_moments',
+                        kwargs=dict(base_kwargs, res_tag=this_res),
+                        inputs=inputs,
+                        outputs=self._moment_files(outroot=outroot, moments=later_moments))
+
+        logger.info("Built "+str(graph))
+        return(graph)
+
+    def _estimate_node_memory(
+        self,
+        node = None,
+        ):
+        """
+        Estimated peak memory of a task graph node from its inputs.
+        """
+        return(self.estimate_task_memory(task=node.method, input_files=node.inputs))
+
+    def enqueue_derive_products(
+        self,
+        queue_dir = None,
+        do_all = False,
+        do_convolve = False,
+        do_noise = False,
+        do_strictmask = False,
+        do_broadmask = False,
+        do_moments = False,
+        do_secondary = False,
+        overwrite = True,
+        **queue_kwargs
+        ):
+        """
+        Put the requested steps into a work queue in queue_dir (see
+        HandlerTemplate.enqueue_loop) as one item per target, product
+        and config in three stages: cubes, noise and strict masks;
+        then broad masks (which combine linked configs) and moments;
+        then the secondary moments (which can use maps of other
+        configs). Run the items with run_queue_worker on any number of
+        nodes.
+
+        Enqueueing is idempotent, so every job of a cluster run can
+        call this and then start working. Each stage is written
+        completely before the next, so a worker never sees a later
+        stage without all of its prerequisites.
+        """
+
+        self._kh.make_missing_directories(derived = True)
+
+        stages = self._derive_stages(
+            do_all=do_all, do_convolve=do_convolve, do_noise=do_noise,
+            do_strictmask=do_strictmask, do_broadmask=do_broadmask,
+            do_moments=do_moments, do_secondary=do_secondary, overwrite=overwrite)
+
+        return(self.enqueue_loop(
+            queue_dir=queue_dir, loop='loop_derive_products', stages=stages,
+            **queue_kwargs))
+
+    def plan_derive_products(
+        self,
+        do_all = False,
+        do_convolve = False,
+        do_noise = False,
+        do_strictmask = False,
+        do_broadmask = False,
+        do_moments = False,
+        do_secondary = False,
+        n_workers = 1,
+        cost_model = None,
+        outfile = None,
+        ):
+        """
+        Estimate the time, I/O and memory of the requested steps on
+        n_workers without running them (see
+        HandlerTemplate.plan_loop). The steps are planned in the same
+        three stages as enqueue_derive_products uses.
+        """
+        stages = self._derive_stages(
+            do_all=do_all, do_convolve=do_convolve, do_noise=do_noise,
+            do_strictmask=do_strictmask, do_broadmask=do_broadmask,
+            do_moments=do_moments, do_secondary=do_secondary)
+
+        return(self.plan_loop(
+            loop='loop_derive_products', stages=stages, n_workers=n_workers,
+            cost_model=cost_model, outfile=outfile))
+
+    def _derive_stages(
+        self,
+        do_all = False,
+        do_convolve = False,
+        do_noise = False,
+        do_strictmask = False,
+        do_broadmask = False,
+        do_moments = False,
+        do_secondary = False,
+        overwrite = True,
+        ):
+        """
+        Split the requested steps into loop_derive_products keywords
+        for three stages: cubes, noise and strict masks; then broad
+        masks (which combine linked configs) and moments; then the
+        secondary moments (which can use maps of other configs).
+        """
+        if do_all:
+            do_convolve = True
+            do_noise = True
+            do_strictmask = True
+            do_broadmask = True
+            do_moments = True
+            do_secondary = True
+
+        base_kwargs = {
+            'do_convolve':False, 'do_noise':False, 'do_strictmask':False,
+            'do_broadmask':False, 'do_moments':False, 'do_secondary':False,
+            'make_directories':False, 'overwrite':overwrite}
+
+        stages = []
+        for these_steps in [
+                {'do_convolve':do_convolve, 'do_noise':do_noise,
+                 'do_strictmask':do_strictmask},
+                {'do_broadmask':do_broadmask, 'do_moments':do_moments},
+                {'do_secondary':do_secondary}]:
+            if not any(these_steps.values()):
+                continue
+            this_stage = dict(base_kwargs)
+            this_stage.update(these_steps)
+            stages.append(this_stage)
+
+        return(stages)
+
 
     ###########################################
     # Defined file names for various products #
@@ -440,6 +892,44 @@ class DerivedHandler(handlerTemplate.HandlerTemplate):
     # Tasks - discrete steps on target, product, config combinations #
     ##################################################################
 
+    def _convolve_params(
+        self,
+        target = None,
+        just_copy = False,
+        res_type = 'ang',
+        res_value = None,
+        tol = 0.1,
+        nan_treatment = 'interpolate',
+        convolve_kwargs = {},
+        ):
+        """
+        Parameters that determine a copied or convolved cube, as
+        recorded in the manifest (see utilsManifest).
+        """
+        params = {
+            'just_copy':just_copy, 'res_type':res_type, 'res_value':res_value,
+            'tol':tol, 'nan_treatment':nan_treatment,
+            'convolve_kw':dict((k, v) for k, v in convolve_kwargs.items()
+                               if k not in _execution_kwargs),
+            }
+        if (not just_copy) and (res_type == 'phys'):
+            params['distance'] = self._kh.get_distance_for_target(target)
+        return(params)
+
+    def _moment_mask_type(
+        self,
+        mom_params = {},
+        ):
+        """
+        Mask used by a moment: 'none', 'strictmask', 'broadmask', or
+        the unrecognized value from the moment key.
+        """
+        if mom_params['mask'] is None:
+            return('none')
+        if mom_params['mask'].strip().lower() == 'none':
+            return('none')
+        return(mom_params['mask'])
+
     def task_convolve(
         self,
         target = None, 
@@ -454,9 +944,13 @@ class DerivedHandler(handlerTemplate.HandlerTemplate):
         overwrite = False, 
         tol=0.1,
         nan_treatment='interpolate',
+        n_workers=1,
         ):
         """
         Convolve data to lower resolutions. Defaults to copying in some cases.
+
+        n_workers sets the number of threads or processes (convolve_kw
+        'backend', default 'thread') used to convolve the channels.
         """
         
         # Parse the input resolution
@@ -509,6 +1003,8 @@ class DerivedHandler(handlerTemplate.HandlerTemplate):
             logger.warning("Missing "+indir+input_file)
             return()
 
+        self._profile_input(indir+input_file)
+
         # Access keywords for mask generation
         
         convolve_kwargs = self._kh.get_derived_kwargs(
@@ -533,6 +1029,25 @@ class DerivedHandler(handlerTemplate.HandlerTemplate):
         logger.info("Target file: "+outfile)
         logger.info("Coverage file: "+coveragefile)
         logger.info("Keywords: "+str(convolve_kwargs))
+
+        # Skip if the output is up to date with the input and keywords
+
+        outputs = [outdir+outfile]
+        if not just_copy:
+            outputs.append(outdir+coveragefile)
+        manifest_params = self._convolve_params(
+            target=target, just_copy=just_copy, res_type=res_type,
+            res_value=res_value, tol=tol, nan_treatment=nan_treatment,
+            convolve_kwargs=convolve_kwargs)
+
+        self._journal_outputs(outputs)
+        if self._is_up_to_date(outputs=outputs, inputs=[indir+input_file],
+                               params=manifest_params):
+            return()
+
+        # ... anything that gets here in incremental mode is out of date
+        if self._incremental:
+            overwrite = True
             
         if (not self._dry_run):
 
@@ -555,6 +1070,18 @@ class DerivedHandler(handlerTemplate.HandlerTemplate):
                 if 'nan_treatment' in convolve_kwargs:
                     nan_treatment = convolve_kwargs['nan_treatment']
 
+                # Optional spectral smoothing or rebinning
+                smooth_kwargs = {}
+                for this_kwarg in ['velocity_resolution', 'spectral_rebin']:
+                    if this_kwarg in convolve_kwargs:
+                        smooth_kwargs[this_kwarg] = convolve_kwargs[this_kwarg]
+
+                # Parallel execution
+                smooth_kwargs['n_workers'] = n_workers
+                for this_kwarg in ['backend', 'scratch_dir']:
+                    if this_kwarg in convolve_kwargs:
+                        smooth_kwargs[this_kwarg] = convolve_kwargs[this_kwarg]
+
                 if res_type == 'ang':
                     input_res_value = res_value*u.arcsec
                     smooth_cube(incube=indir+input_file, outfile=outdir+outfile,
@@ -562,7 +1089,7 @@ class DerivedHandler(handlerTemplate.HandlerTemplate):
                                 tol=tol, nan_treatment=nan_treatment,
                                 make_coverage_cube=True, coveragefile=outdir+coveragefile,
                                 collapse_coverage=True, coverage2dfile=outdir+coverage2dfile,
-                                overwrite=overwrite)
+                                overwrite=overwrite, **smooth_kwargs)
 
                 if res_type == 'phys':
                     this_distance = self._kh.get_distance_for_target(target)
@@ -576,7 +1103,156 @@ class DerivedHandler(handlerTemplate.HandlerTemplate):
                                 tol=tol, nan_treatment=nan_treatment,
                                 make_coverage_cube=True, coveragefile=outdir+coveragefile,
                                 collapse_coverage=True, 
-                                overwrite=overwrite)
+                                overwrite=overwrite, **smooth_kwargs)
+
+            self._record_outputs(outputs=outputs, inputs=[indir+input_file],
+                                 params=manifest_params)
+
+        return()
+
+    def task_convolve_ladder(
+        self,
+        target = None, 
+        config = None, 
+        product = None, 
+        extra_ext_in = '', 
+        extra_ext_out = '', 
+        overwrite = False, 
+        tol=0.1,
+        nan_treatment='interpolate',
+        ):
+        """
+        Convolve data to all angular and physical resolutions for a
+        target, config, and product in one pass. The resolutions are
+        sorted and each is made from the previous one with the
+        residual kernel (see scConvolution.smooth_cube_ladder). A
+        velocity_resolution in convolve_kw is applied to each rung as
+        it is written, as task_convolve does.
+        """
+
+        # Generate file names
+
+        indir = self._kh.get_postprocess_dir_for_target(target=target, changeto=False)
+        indir = os.path.abspath(indir)+'/'
+
+        outdir = self._kh.get_derived_dir_for_target(target=target, changeto=False)
+        outdir = os.path.abspath(outdir)+'/'
+
+        fname_dict_in = self._fname_dict(
+            target=target, config=config, product=product, res_tag=None, 
+            extra_ext_in=extra_ext_in)
+
+        input_file = fname_dict_in['orig']
+
+        # Check input file existence        
+    
+        if not (os.path.isfile(indir+input_file)):
+            logger.warning("Missing "+indir+input_file)
+            return()
+
+        self._profile_input(indir+input_file)
+
+        # Access keywords for convolution
+
+        convolve_kwargs = self._kh.get_derived_kwargs(
+            config=config, product=product, kwarg_type='convolve_kw'
+            )
+
+        if 'tol' in convolve_kwargs:
+            tol = convolve_kwargs['tol']
+
+        if 'nan_treatment' in convolve_kwargs:
+            nan_treatment = convolve_kwargs['nan_treatment']
+
+        ladder_kwargs = {}
+        for this_kwarg in ['downsample', 'pixels_per_beam', 'check_accuracy',
+                           'velocity_resolution', 'spectral_rebin']:
+            if this_kwarg in convolve_kwargs:
+                ladder_kwargs[this_kwarg] = convolve_kwargs[this_kwarg]
+
+        # Build the rungs of the ladder
+
+        rungs = []
+
+        res_dict = self._kh.get_ang_res_dict(
+            config=config,product=product)
+        for this_res_tag in res_dict:
+            fname_dict_out = self._fname_dict(
+                target=target, config=config, product=product, res_tag=this_res_tag, 
+                extra_ext_out=extra_ext_out)
+            rungs.append({
+                'res_tag': this_res_tag,
+                'angular_resolution': res_dict[this_res_tag]*u.arcsec,
+                'outfile': outdir+fname_dict_out['cube'],
+                'coveragefile': outdir+fname_dict_out['coverage'],
+                'coverage2dfile': outdir+fname_dict_out['coverage2d'],
+                })
+
+        res_dict = self._kh.get_phys_res_dict(
+            config=config,product=product)
+        if len(res_dict) > 0:
+            this_distance = self._kh.get_distance_for_target(target)
+            if this_distance is None:
+                logger.error("No distance for target "+target)
+                return()
+            this_distance = this_distance*1e6*u.pc
+        for this_res_tag in res_dict:
+            fname_dict_out = self._fname_dict(
+                target=target, config=config, product=product, res_tag=this_res_tag, 
+                extra_ext_out=extra_ext_out)
+            rungs.append({
+                'res_tag': this_res_tag,
+                'linear_resolution': res_dict[this_res_tag]*u.pc,
+                'distance': this_distance,
+                'outfile': outdir+fname_dict_out['cube'],
+                'coveragefile': outdir+fname_dict_out['coverage'],
+                })
+
+        if len(rungs) == 0:
+            return()
+
+        logger.info("")
+        logger.info("&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&")
+        logger.info("Convolving cube along a resolution ladder for:")
+        logger.info(str(target)+" , "+str(product)+" , "+str(config))
+        logger.info("... resolution tags: "+str([rung['res_tag'] for rung in rungs]))
+        logger.info("&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&")
+        logger.info("")
+
+        logger.info("Input file "+input_file)
+        logger.info("Keywords: "+str(convolve_kwargs))
+
+        # Skip if every rung is up to date with the input and keywords
+
+        outputs = []
+        for rung in rungs:
+            outputs.append(rung['outfile'])
+            outputs.append(rung['coveragefile'])
+        manifest_params = {
+            'rungs':[dict((k, v) for k, v in rung.items() if not k.endswith('file'))
+                     for rung in rungs],
+            'tol':tol, 'nan_treatment':nan_treatment,
+            'convolve_kw':dict((k, v) for k, v in convolve_kwargs.items()
+                               if k not in _execution_kwargs),
+            }
+
+        self._journal_outputs(outputs)
+        if self._is_up_to_date(outputs=outputs, inputs=[indir+input_file],
+                               params=manifest_params):
+            return()
+
+        if self._incremental:
+            overwrite = True
+
+        if (not self._dry_run):
+
+            smooth_cube_ladder(incube=indir+input_file, rungs=rungs,
+                               tol=tol, nan_treatment=nan_treatment,
+                               make_coverage_cube=True, collapse_coverage=True,
+                               overwrite=overwrite, **ladder_kwargs)
+
+            self._record_outputs(outputs=outputs, inputs=[indir+input_file],
+                                 params=manifest_params)
 
         return()
 
@@ -614,6 +1290,8 @@ class DerivedHandler(handlerTemplate.HandlerTemplate):
             logger.warning("Missing "+indir+input_file)
             return()
 
+        self._profile_input(indir+input_file)
+
         # Access keywords for noise generation
         
         noise_kwargs = self._kh.get_derived_kwargs(
@@ -631,6 +1309,15 @@ class DerivedHandler(handlerTemplate.HandlerTemplate):
         logger.info("Input file "+input_file)
         logger.info("Target file: "+outfile)
         logger.info("Keyword arguments: "+str(noise_kwargs))
+
+        manifest_params = {'noise_kw':dict(noise_kwargs)}
+        self._journal_outputs([outdir+outfile])
+        if self._is_up_to_date(outputs=[outdir+outfile], inputs=[indir+input_file],
+                               params=manifest_params):
+            return()
+
+        if self._incremental:
+            overwrite = True
             
         # Call noise routines
     
@@ -643,6 +1330,9 @@ class DerivedHandler(handlerTemplate.HandlerTemplate):
                 return_spectral_cube=False,
                 overwrite=overwrite)
 
+            self._record_outputs(outputs=[outdir+outfile], inputs=[indir+input_file],
+                                 params=manifest_params)
+
     def task_build_strict_mask(
         self,
         target = None, 
@@ -681,6 +1371,8 @@ class DerivedHandler(handlerTemplate.HandlerTemplate):
             logger.warning("Missing cube: "+indir+input_file)
             return()
 
+        self._profile_input(indir+input_file)
+
         if not (os.path.isfile(indir+noise_file)):
             logger.warning("Missing noise estimate: "+indir+noise_file)
             return()
@@ -715,6 +1407,19 @@ class DerivedHandler(handlerTemplate.HandlerTemplate):
             logger.info("Coverage file "+coverage_file)
         logger.info("Target file: "+outfile)
         logger.info("Kwargs: "+str(strictmask_kwargs))
+
+        # ... the coverage is listed even when missing, so that it
+        # showing up later triggers a rerun.
+        manifest_inputs = [indir+input_file, indir+noise_file,
+                           indir+fname_dict['coverage']]
+        manifest_params = {'strictmask_kw':dict(strictmask_kwargs)}
+        self._journal_outputs([outdir+outfile])
+        if self._is_up_to_date(outputs=[outdir+outfile], inputs=manifest_inputs,
+                               params=manifest_params):
+            return()
+
+        if self._incremental:
+            overwrite = True
             
         # &%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%
         # Call the masking routines
@@ -738,6 +1443,9 @@ class DerivedHandler(handlerTemplate.HandlerTemplate):
                 return_spectral_cube=False,
                 overwrite=overwrite)
 
+            self._record_outputs(outputs=[outdir+outfile], inputs=manifest_inputs,
+                                 params=manifest_params)
+
     def task_build_broad_mask(
         self,
         target = None, 
@@ -772,6 +1480,8 @@ class DerivedHandler(handlerTemplate.HandlerTemplate):
             logger.warning("Missing cube: "+indir+input_file)
             return()
 
+        self._profile_input(indir+input_file)
+
         # Access keywords for mask generation
         
         broadmask_kwargs = self._kh.get_derived_kwargs(
@@ -842,6 +1552,16 @@ class DerivedHandler(handlerTemplate.HandlerTemplate):
         logger.info("List of other masks "+str(list_of_masks))
         logger.info("Target file: "+outfile)
         logger.info("Kwargs: "+str(broadmask_kwargs))
+
+        manifest_inputs = [indir+input_file] + list_of_masks
+        manifest_params = {'broadmask_kw':broadmask_kwargs}
+        self._journal_outputs([outdir+outfile])
+        if self._is_up_to_date(outputs=[outdir+outfile], inputs=manifest_inputs,
+                               params=manifest_params):
+            return()
+
+        if self._incremental:
+            overwrite = True
             
         # &%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%
         # Call the mask combining routine
@@ -857,6 +1577,9 @@ class DerivedHandler(handlerTemplate.HandlerTemplate):
                 #return_spectral_cube=False,
                 overwrite=overwrite)
 
+            self._record_outputs(outputs=[outdir+outfile], inputs=manifest_inputs,
+                                 params=manifest_params)
+
     def task_generate_moments(
         self,
         target = None, 
@@ -865,9 +1588,13 @@ class DerivedHandler(handlerTemplate.HandlerTemplate):
         res_tag = None, 
         extra_ext = '', 
         overwrite = False, 
+        mask_types = None,
         ):
         """
         Generate moment maps.
+
+        mask_types optionally restricts the calculation to moments
+        that use the listed masks ('none', 'strictmask', 'broadmask').
         """
         # &%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%
         # Look up filenames, list of moments, etc.
@@ -909,6 +1636,8 @@ class DerivedHandler(handlerTemplate.HandlerTemplate):
             logger.warning("Missing cube: "+indir+input_file)
             return()
 
+        self._profile_input(indir+input_file)
+
         found_broadmask = (os.path.isfile(indir+broadmask_file))
         found_strictmask = (os.path.isfile(indir+strictmask_file))
 
@@ -958,6 +1687,12 @@ class DerivedHandler(handlerTemplate.HandlerTemplate):
         sublist_of_moments = [this_mom for this_mom in list_of_moments
                               if self._kh.get_params_for_moment(this_mom)['round'] == uniqrounds[0]]
 
+        if mask_types is not None:
+            sublist_of_moments = [
+                this_mom for this_mom in sublist_of_moments
+                if self._moment_mask_type(self._kh.get_params_for_moment(this_mom)) in mask_types]
+            logger.info("... restricted to masks "+str(mask_types)+": "+str(sublist_of_moments))
+
         if (not self._dry_run):
             for this_mom in sublist_of_moments:
                 logger.info('... generating moment: '+str(this_mom))
@@ -1005,6 +1740,24 @@ class DerivedHandler(handlerTemplate.HandlerTemplate):
 
                 outfile = outdir+outroot+mom_params['ext']+'.fits'
 
+                # %%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%
+                # Skip if up to date
+                # %%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%
+
+                manifest_outputs = [outfile]
+                if errorfile is not None:
+                    manifest_outputs.append(errorfile)
+                manifest_inputs = [indir+input_file, indir+noise_file]
+                if mask_file is not None:
+                    manifest_inputs.append(mask_file)
+                manifest_params = {'moment':this_mom, 'res_tag':res_tag,
+                                   'mom_params':mom_params}
+
+                self._journal_outputs(manifest_outputs)
+                if self._is_up_to_date(outputs=manifest_outputs, inputs=manifest_inputs,
+                                       params=manifest_params):
+                    continue
+
                 # %%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%
                 # In the first round, just call the moment generator
                 # %%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%
@@ -1012,7 +1765,11 @@ class DerivedHandler(handlerTemplate.HandlerTemplate):
                     indir+input_file, mask=mask_file, noise=noise_in,
                     moment=mom_params['algorithm'], momkwargs=mom_params['kwargs'],
                     outfile=outfile, errorfile=errorfile,
-                    channel_correlation=None)
+                    channel_correlation=channel_correlation_from_header(
+                        fits.getheader(indir+input_file)))
+
+                self._record_outputs(outputs=manifest_outputs, inputs=manifest_inputs,
+                                     params=manifest_params)
 
 
 
@@ -1068,6 +1825,8 @@ class DerivedHandler(handlerTemplate.HandlerTemplate):
             logger.warning("Missing cube: "+indir+input_file)
             return()
 
+        self._profile_input(indir+input_file)
+
         found_broadmask = (os.path.isfile(indir+broadmask_file))
         found_strictmask = (os.path.isfile(indir+strictmask_file))
 
@@ -1183,6 +1942,13 @@ class DerivedHandler(handlerTemplate.HandlerTemplate):
 
                     kwargs_dict = mom_params['kwargs']
 
+                    manifest_outputs = [outfile]
+                    if errorfile is not None:
+                        manifest_outputs.append(errorfile)
+                    manifest_inputs = [indir+input_file, indir+noise_file]
+                    if mask_file is not None:
+                        manifest_inputs.append(mask_file)
+
                     maps_to_pass = mom_params['maps_to_pass']
                     for map_ext in maps_to_pass:
                         
@@ -1196,6 +1962,7 @@ class DerivedHandler(handlerTemplate.HandlerTemplate):
                         
                         # Add as param to kwarg dict
                         kwargs_dict[map_ext] = indir+this_map_file
+                        manifest_inputs.append(indir+this_map_file)
 
                     other_exts = mom_params['other_exts']
                     for param_name in other_exts.keys():
@@ -1213,11 +1980,24 @@ class DerivedHandler(handlerTemplate.HandlerTemplate):
 
                         # Add as param to kwarg dict
                         kwargs_dict[param_name] = indir+this_ext_file
+                        manifest_inputs.append(indir+this_ext_file)
 
                     if proceed == False:
                         logger.warning("Missing some needed information. Skipping this calculation.")
                         continue
 
+                    # %%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%
+                    # Skip if up to date
+                    # %%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%
+
+                    manifest_params = {'moment':this_mom, 'res_tag':res_tag,
+                                       'mom_params':mom_params}
+
+                    self._journal_outputs(manifest_outputs)
+                    if self._is_up_to_date(outputs=manifest_outputs, inputs=manifest_inputs,
+                                           params=manifest_params):
+                        continue
+
                     # %%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%
                     # Call the moment generator
                     # %%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%
@@ -1227,9 +2007,287 @@ class DerivedHandler(handlerTemplate.HandlerTemplate):
                     moment_generator(
                         indir+input_file, mask=mask_file, noise=noise_in,
                         outfile=outfile, errorfile=errorfile,
-                        channel_correlation=None,
+                        channel_correlation=channel_correlation_from_header(
+                            fits.getheader(indir+input_file)),
                         moment=mom_params['algorithm'],
                         momkwargs=kwargs_dict,
                         # Deprecated context
                         )
+
+                    self._record_outputs(outputs=manifest_outputs, inputs=manifest_inputs,
+                                         params=manifest_params)
                     
+
+    def task_derive_chain(
+        self,
+        target = None,
+        config = None,
+        product = None,
+        res_tag = None,
+        res_value = None,
+        res_type = 'ang',
+        extra_ext_in = '',
+        extra_ext_out = '',
+        do_noise = True,
+        do_strictmask = True,
+        do_moments = True,
+        overwrite = False,
+        tol = 0.1,
+        nan_treatment = 'interpolate',
+        n_workers = 1,
+        ):
+        """
+        Copy or convolve a cube, estimate its noise, build its strict
+        mask and make the moments that need only these, passing the
+        cubes along in memory instead of reading each product back
+        from disk. The cube, coverage, noise and mask are still
+        written, but on a background thread (see utilsWriter) while
+        the next step runs.
+
+        This does the work of task_convolve, task_estimate_noise,
+        task_build_strict_mask and the strict mask (or unmasked)
+        moments of task_generate_moments for one resolution (res_tag
+        None copies the native cube). Moments on the broad mask need
+        every resolution and are left to task_generate_moments.
+        Products of steps that are turned off are read from disk if
+        present.
+        """
+
+        just_copy = (res_tag is None)
+        if not just_copy:
+            if res_value is None or res_type.lower() not in ['ang','phys']:
+                logger.warning("Need an angular or physical resolution value. Skipping.")
+                return()
+
+        # &%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%
+        # Look up filenames and keywords
+        # &%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%
+
+        indir = self._kh.get_postprocess_dir_for_target(target=target, changeto=False)
+        indir = os.path.abspath(indir)+'/'
+
+        outdir = self._kh.get_derived_dir_for_target(target=target, changeto=False)
+        outdir = os.path.abspath(outdir)+'/'
+
+        fname_dict_in = self._fname_dict(
+            target=target, config=config, product=product, res_tag=None,
+            extra_ext_in=extra_ext_in)
+
+        fname_dict = self._fname_dict(
+            target=target, config=config, product=product, res_tag=res_tag,
+            extra_ext_out=extra_ext_out)
+
+        input_file = indir+fname_dict_in['orig']
+        cube_file = outdir+fname_dict['cube']
+        coverage_file = outdir+fname_dict['coverage']
+        coverage2d_file = outdir+fname_dict['coverage2d']
+        noise_file = outdir+fname_dict['noise']
+        strictmask_file = outdir+fname_dict['strictmask']
+        outroot = outdir+fname_dict['momentroot']
+
+        if not (os.path.isfile(input_file)):
+            logger.warning("Missing "+input_file)
+            return()
+
+        self._profile_input(input_file)
+
+        convolve_kwargs = self._kh.get_derived_kwargs(
+            config=config, product=product, kwarg_type='convolve_kw')
+        noise_kwargs = self._kh.get_derived_kwargs(
+            config=config, product=product, kwarg_type='noise_kw')
+        strictmask_kwargs = self._kh.get_derived_kwargs(
+            config=config, product=product, kwarg_type='strictmask_kw')
+
+        # Only the first-round moments on the strict mask or no mask
+
+        list_of_moments = []
+        if do_moments:
+            all_moments = self._kh.get_moment_list(config=config, product=product)
+            if len(all_moments) > 0:
+                first_round = min([self._kh.get_params_for_moment(this_mom)['round']
+                                   for this_mom in all_moments])
+                for this_mom in all_moments:
+                    mom_params = self._kh.get_params_for_moment(this_mom)
+                    if mom_params['round'] != first_round:
+                        continue
+                    if self._moment_mask_type(mom_params) not in ['none', 'strictmask']:
+                        continue
+                    list_of_moments.append(this_mom)
+
+        logger.info("")
+        logger.info("&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&")
+        logger.info("Chained derived products for:")
+        logger.info(str(target)+" , "+str(product)+" , "+str(config))
+        if just_copy:
+            logger.info("... at native resolution.")
+        else:
+            logger.info("... at resolution "+str(res_tag)+" ("+res_type+", "+str(res_value)+")")
+        logger.info("... noise: "+str(do_noise)+" , strict mask: "+str(do_strictmask))
+        logger.info("... moments: "+str(list_of_moments))
+        logger.info("&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&")
+        logger.info("")
+
+        # &%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%
+        # Skip if everything is up to date
+        # &%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%
+
+        # The manifest entries are the same as for the separate tasks,
+        # so the two modes can be mixed between runs.
+
+        convolve_params = self._convolve_params(
+            target=target, just_copy=just_copy, res_type=res_type,
+            res_value=res_value, tol=tol, nan_treatment=nan_treatment,
+            convolve_kwargs=convolve_kwargs)
+        convolve_outputs = [cube_file]
+        if not just_copy:
+            convolve_outputs.append(coverage_file)
+        noise_params = {'noise_kw':dict(noise_kwargs)}
+        strictmask_params = {'strictmask_kw':dict(strictmask_kwargs)}
+        strictmask_inputs = [cube_file, noise_file, coverage_file]
+
+        moment_records = []
+        for this_mom in list_of_moments:
+            mom_params = self._kh.get_params_for_moment(this_mom)
+            outputs = [outroot+mom_params['ext']+'.fits',
+                       outroot+mom_params['ext_error']+'.fits']
+            inputs = [cube_file, noise_file]
+            if self._moment_mask_type(mom_params) == 'strictmask':
+                inputs.append(strictmask_file)
+            params = {'moment':this_mom, 'res_tag':res_tag, 'mom_params':mom_params}
+            moment_records.append((this_mom, mom_params, outputs, inputs, params))
+
+        records = [(convolve_outputs, [input_file], convolve_params)]
+        if do_noise:
+            records.append(([noise_file], [cube_file], noise_params))
+        if do_strictmask:
+            records.append(([strictmask_file], strictmask_inputs, strictmask_params))
+        for this_mom, mom_params, outputs, inputs, params in moment_records:
+            records.append((outputs, inputs, params))
+
+        for outputs, inputs, params in records:
+            self._journal_outputs(outputs)
+
+        if self._incremental:
+            if all([self._is_up_to_date(outputs=outputs, inputs=inputs, params=params)
+                    for outputs, inputs, params in records]):
+                return()
+            overwrite = True
+
+        if self._dry_run:
+            return()
+
+        # &%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%
+        # Run the chain
+        # &%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%
+
+        with BackgroundWriter() as writer:
+
+            # Copy or convolve
+
+            coverage = None
+            if just_copy:
+                cube = SpectralCube.read(input_file)
+                if overwrite or not os.path.isfile(cube_file):
+                    writer.submit(shutil.copy, input_file, cube_file)
+                else:
+                    logger.warning("Target file already present "+cube_file)
+            else:
+                if 'tol' in convolve_kwargs:
+                    tol = convolve_kwargs['tol']
+                if 'nan_treatment' in convolve_kwargs:
+                    nan_treatment = convolve_kwargs['nan_treatment']
+
+                smooth_kwargs = {}
+                for this_kwarg in ['velocity_resolution', 'spectral_rebin',
+                                   'backend', 'scratch_dir']:
+                    if this_kwarg in convolve_kwargs:
+                        smooth_kwargs[this_kwarg] = convolve_kwargs[this_kwarg]
+                smooth_kwargs['n_workers'] = n_workers
+
+                if res_type == 'ang':
+                    smooth_kwargs['angular_resolution'] = res_value*u.arcsec
+                else:
+                    this_distance = self._kh.get_distance_for_target(target)
+                    if this_distance is None:
+                        logger.error("No distance for target "+target)
+                        return()
+                    smooth_kwargs['linear_resolution'] = res_value*u.pc
+                    smooth_kwargs['distance'] = this_distance*1e6*u.pc
+
+                result = smooth_cube(incube=input_file, outfile=None,
+                                     tol=tol, nan_treatment=nan_treatment,
+                                     make_coverage_cube=True, return_coverage=True,
+                                     **smooth_kwargs)
+                if result is None:
+                    logger.warning("Could not convolve to "+str(res_tag)+". Stopping chain.")
+                    return()
+                cube, coverage = result
+
+                writer.submit(write_smoothed, cube, outfile=cube_file,
+                              coverage=coverage, coveragefile=coverage_file,
+                              collapse_coverage=True,
+                              coverage2dfile=(coverage2d_file if res_type == 'ang' else None),
+                              overwrite=overwrite)
+
+            # Noise
+
+            if do_noise:
+                rms = recipe_phangs_noise(
+                    incube=cube, noise_kwargs=noise_kwargs,
+                    return_spectral_cube=True)
+                writer.submit(rms.write, noise_file, overwrite=overwrite)
+            elif os.path.isfile(noise_file):
+                rms = SpectralCube.read(noise_file)
+            else:
+                rms = None
+
+            # Strict mask
+
+            if do_strictmask and rms is not None:
+                mask = recipe_phangs_strict_mask(
+                    cube, rms, coverage=coverage, mask_kwargs=strictmask_kwargs,
+                    return_spectral_cube=True)
+                writer.submit(write_mask, mask, strictmask_file, overwrite=overwrite)
+            elif os.path.isfile(strictmask_file):
+                mask = SpectralCube.read(strictmask_file)
+            else:
+                mask = None
+
+            # Moments (two-dimensional, so written directly)
+
+            channel_correlation = channel_correlation_from_header(cube.header)
+            made_moments = []
+            for this_mom, mom_params, outputs, inputs, params in moment_records:
+                if self._moment_mask_type(mom_params) == 'strictmask':
+                    if mask is None:
+                        logger.warning("Strict mask needed but not found. Skipping "+this_mom)
+                        continue
+                    this_mask = mask
+                else:
+                    this_mask = None
+
+                logger.info('... generating moment: '+str(this_mom))
+                moment_generator(
+                    cube, mask=this_mask, noise=rms,
+                    moment=mom_params['algorithm'], momkwargs=mom_params['kwargs'],
+                    outfile=outputs[0],
+                    errorfile=(outputs[1] if rms is not None else None),
+                    channel_correlation=channel_correlation)
+                made_moments.append((outputs, inputs, params))
+
+        # &%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%
+        # Record in the manifest once everything is on disk
+        # &%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%
+
+        self._record_outputs(outputs=convolve_outputs, inputs=[input_file],
+                             params=convolve_params)
+        if do_noise:
+            self._record_outputs(outputs=[noise_file], inputs=[cube_file],
+                                 params=noise_params)
+        if do_strictmask and rms is not None:
+            self._record_outputs(outputs=[strictmask_file], inputs=strictmask_inputs,
+                                 params=strictmask_params)
+        for outputs, inputs, params in made_moments:
+            self._record_outputs(outputs=outputs, inputs=inputs, params=params)
+
+        return()
@@ -79,12 +79,21 @@ from clean_call import CleanCall, CleanCallFunctionDecorator
 
 import utilsLines as lines
 import handlerTemplate
+import utilsProfile
+import utilsJournal
 import utilsFilenames
 
+@utilsProfile.profile_tasks
+@utilsJournal.journal_tasks
 class ImagingHandler(handlerTemplate.HandlerTemplate):
     """
     Class to makes image cubes out of uv data from each spectral line and continuum of each galaxy. 
     """
+
+    # These tasks only set up the clean call in memory, so they run
+    # again when resuming a journaled loop (see utilsJournal).
+
+    _journal_always_run = ['task_assign_multiscales', 'task_singlescale_mask']
     
     ############
     # __init__ #
@@ -139,6 +148,30 @@ class ImagingHandler(handlerTemplate.HandlerTemplate):
             fname_dict['beta'] = imagename+'.beta'
         return fname_dict
     
+    def _imaging_products(
+        self,
+        image_root,
+        fits = False,
+        ):
+        """
+        Names of the clean products with root image_root (as copied by
+        casaImagingRoutines.copy_imaging) or, with fits=True, of their
+        FITS exports. Used to announce task outputs to the journal.
+        """
+        ext_list = ['.alpha', '.alpha.error', '.beta', '.beta.error']
+        for this_ext in ['.image', '.model', '.residual', '.mask', '.pb',
+                         '.psf', '.weight', '.sumwt']:
+            ext_list += [this_ext] + [this_ext+'.tt'+str(ii) for ii in range(3)]
+        if not fits:
+            return([image_root+x for x in ext_list])
+        # ... e.g. .image -> .fits, .model.tt1 -> _model_tt1.fits
+        fits_list = []
+        for this_ext in ext_list:
+            if this_ext.startswith('.sumwt'):
+                continue
+            parts = [x for x in this_ext.split('.') if x not in ['', 'image', 'tt0']]
+            fits_list.append(image_root+''.join(['_'+x for x in parts])+'.fits')
+        return(fits_list)
     
     ################
     # loop_imaging #
@@ -315,6 +348,14 @@ class ImagingHandler(handlerTemplate.HandlerTemplate):
 
         clean_call.set_param('imagename', image_root, nowarning=True)
 
+        # Identify the tasks that take this clean call in the journal
+        # by the plain arguments it was built from.
+
+        clean_call.journal_key = {
+            'target':target, 'config':config, 'product':product,
+            'extra_ext_in':extra_ext_in, 'suffix_in':suffix_in,
+            'extra_ext_out':extra_ext_out, 'stage':stage}
+
         # Get the phase center associated with the target
         rastring, decstring = self._kh.get_phasecenter_for_target(target=target)
         phasecenter = 'J2000 '+rastring+' '+decstring
@@ -453,6 +494,11 @@ class ImagingHandler(handlerTemplate.HandlerTemplate):
         logger.info("&%&%&%&%&%&%&%&%&%&%&%&%&%")
         logger.info("")
             
+        outputs = self._imaging_products(clean_call.get_param('imagename'))
+        if backup:
+            outputs += self._imaging_products(clean_call.get_param('imagename')+'_dirty')
+        self._journal_outputs(outputs)
+            
         if (not self._dry_run) and casa_enabled:
             imr.make_dirty_image(clean_call)
             if backup:
@@ -482,6 +528,7 @@ class ImagingHandler(handlerTemplate.HandlerTemplate):
         logger.info("&%&%&%&%&%&%&%&%&%&%&%&%&%")
         logger.info("")
             
+        self._journal_outputs(self._imaging_products(clean_call.get_param('imagename')))
         if (not self._dry_run) and casa_enabled:
             imr.copy_imaging(
                 input_root=clean_call.get_param('imagename')+'_'+tag,
@@ -541,6 +588,8 @@ class ImagingHandler(handlerTemplate.HandlerTemplate):
         # Get fname dict
         fname_dict = self._fname_dict(product = product, imagename = clean_call.get_param('imagename'))
         
+        self._journal_outputs([fname_dict['mask']])
+
         # import_and_align_mask
         msr.import_and_align_mask(in_file=this_cleanmask, \
                                   out_file=fname_dict['mask'], \
@@ -578,6 +627,14 @@ class ImagingHandler(handlerTemplate.HandlerTemplate):
         logger.info("&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%")
         logger.info("")
             
+        # ... the current imaging is cleaned in place (it holds the
+        # clean mask), so only the record and the backup are new.
+
+        outputs = [clean_call.get_param('imagename')+'_multiscale_record.txt']
+        if backup:
+            outputs += self._imaging_products(clean_call.get_param('imagename')+'_multiscale')
+        self._journal_outputs(outputs)
+
         if self._dry_run:
             return()
         if not casa_enabled:
@@ -656,6 +713,8 @@ class ImagingHandler(handlerTemplate.HandlerTemplate):
         if not casa_enabled:
             return()
         
+        self._journal_outputs([fname_dict['mask']])
+
         # check if line product
         is_line_product = product in self._kh.get_line_products()
         
@@ -722,6 +781,14 @@ class ImagingHandler(handlerTemplate.HandlerTemplate):
         logger.info("&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%")
         logger.info("")
             
+        # ... the current imaging is cleaned in place (it holds the
+        # clean mask), so only the record and the backup are new.
+
+        outputs = [clean_call.get_param('imagename')+'_singlescale_record.txt']
+        if backup:
+            outputs += self._imaging_products(clean_call.get_param('imagename')+'_singlescale')
+        self._journal_outputs(outputs)
+
         if self._dry_run:
             return()
         if not casa_enabled:
@@ -782,6 +849,7 @@ class ImagingHandler(handlerTemplate.HandlerTemplate):
         logger.info("&%&%&%&%&%&%&%&%&%&%&%&%&%")
         logger.info("")
                     
+        self._journal_outputs(self._imaging_products(image_root, fits=True))
         if (not self._dry_run) and casa_enabled:
             imr.export_imaging_to_fits(image_root)
         
@@ -850,6 +918,40 @@ class ImagingHandler(handlerTemplate.HandlerTemplate):
         if clean_call is None:
             logger.warning("I could not make a well-formed clean call.")
             return()
+
+        self._profile_input(self._kh.get_imaging_dir_for_target(target)
+                            +clean_call.get_param('vis'))
+
+        # Skip a full run of the recipe if the image is up to date
+        # with the visibilities, clean mask, and imaging recipes.
+        # Partial reruns (restarting from a step) always run.
+
+        full_run = all([do_dirty_image, do_revert_to_dirty, do_read_clean_mask,
+                        do_multiscale_clean, do_revert_to_multiscale,
+                        do_singlescale_mask, do_singlescale_clean,
+                        do_revert_to_singlescale])
+
+        if full_run:
+            imaging_dir = self._kh.get_imaging_dir_for_target(target)
+            image_dict = self._fname_dict(
+                product = product, imagename = clean_call.get_param('imagename'))
+            manifest_outputs = [imaging_dir+image_dict['image'],
+                                imaging_dir+image_dict['pb']]
+            manifest_inputs = [imaging_dir+clean_call.get_param('vis')]
+            manifest_inputs += self._kh.get_imaging_recipes(config=config, product=product)
+            this_cleanmask = self._kh.get_cleanmask_filename(target=target, product=product)
+            if this_cleanmask is not None:
+                manifest_inputs.append(this_cleanmask)
+            manifest_params = {
+                'phasecenter':clean_call.get_param('phasecenter'),
+                'convergence_fracflux':convergence_fracflux,
+                'dynamic_sizing':dynamic_sizing,
+                'force_square':force_square,
+                }
+
+            if self._is_up_to_date(outputs=manifest_outputs, inputs=manifest_inputs,
+                                   params=manifest_params):
+                return()
         
         if dynamic_sizing:
             if cell is None or imsize is None:
@@ -979,6 +1081,10 @@ class ImagingHandler(handlerTemplate.HandlerTemplate):
         if do_export_to_fits:
 
             self.task_export_to_fits(clean_call=clean_call)
+
+        if full_run and casa_enabled:
+            self._record_outputs(outputs=manifest_outputs, inputs=manifest_inputs,
+                                 params=manifest_params)
         
         # Return
         
@@ -7,6 +7,8 @@ structure, etc. This part is pure python.
 import os, sys, re
 import glob
 import ast
+import pickle
+import hashlib
 import numpy as np
 from math import floor
 
@@ -41,6 +43,9 @@ logger.setLevel(logging.DEBUG)
 
 VALID_IMAGING_STAGES = ['dirty','multiscale','singlescale']
 
+# Bump when the layout of the compiled key cache changes
+KEY_CACHE_VERSION = 2
+
 class KeyHandler:
     """
     Class to handle data files that indicate the names and data sets
@@ -51,9 +56,27 @@ class KeyHandler:
                  master_key = 'key_templates/master_key.txt',
                  quiet=False,
                  dochecks=True,
+                 use_cache=False,
+                 lazy_checks=False,
                  ):
+        """
+        Read the keys linked from the master key.
+
+        quiet skips printing the configurations, products and derived
+        products. With use_cache, the parsed keys are compiled into a
+        cache file next to the master key and later constructions load
+        that instead of parsing the keys again, as long as no key file
+        (or the key reading code) changed. With lazy_checks, the
+        existence of measurement sets, single dish data and directories
+        is not checked up front; each file is checked (once) when it is
+        first used.
+        """
 
         self._dochecks = dochecks
+        self._quiet = quiet
+        self._use_cache = use_cache
+        self._lazy_checks = lazy_checks
+        self._exists_cache = {}
 
         self._master_key = None
 
@@ -71,6 +94,12 @@ class KeyHandler:
         self._dir_for_target = None
         self._override_dict = None
 
+        self._mosaic_assign_dict = None
+        self._ms_index = None
+        self._ms_arraytags_index = None
+        self._config_arraytags_index = None
+        self._line_product_index = None
+
         self.build_key_handler(master_key)
 
 ##############################################################
@@ -94,73 +123,82 @@ class KeyHandler:
             return(False)
 
         self._master_key = os.path.abspath(master_key)
-        self._read_master_key()
 
-        logger.info("")
-        logger.info("&%&%&%&%&%&%&%&%&%&%&%&%&%&%&")
-        logger.info("Reading individual key files.")
-        logger.info("&%&%&%&%&%&%&%&%&%&%&%&%&%&%&")
-        logger.info("")
+        if not (self._use_cache and self._load_key_cache()):
+            self._read_master_key()
 
-        self._read_all_keys()
+            logger.info("")
+            logger.info("&%&%&%&%&%&%&%&%&%&%&%&%&%&%&")
+            logger.info("Reading individual key files.")
+            logger.info("&%&%&%&%&%&%&%&%&%&%&%&%&%&%&")
+            logger.info("")
 
-        logger.info("")
-        logger.info("&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&")
-        logger.info("Running checks and cross-links.")
-        logger.info("&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&")
-        logger.info("")
+            self._read_all_keys()
 
-        if self._dochecks:
-            self.check_ms_existence()
+            logger.info("")
+            logger.info("&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&")
+            logger.info("Building cross-links.")
+            logger.info("&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&")
+            logger.info("")
 
-        if self._dochecks:
-            self.check_sd_existence()
+            self._target_list = []
+            self._missing_targets = []
+            self._build_target_list()
+            self._expand_dir_key()
+            self._build_whole_target_list()
+            self._map_targets_to_mosaics()
+            self._map_configs()
+            self._build_indexes()
 
-        self._target_list = []
-        self._missing_targets = []
-        self._build_target_list()
-        if self._dochecks:
-            self.print_missing_targets()
+            if self._use_cache:
+                self._write_key_cache()
 
-        self._expand_dir_key()
-        if self._dochecks:
+        if self._dochecks and not self._lazy_checks:
+
+            logger.info("")
+            logger.info("&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&")
+            logger.info("Running checks.")
+            logger.info("&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&")
+            logger.info("")
+
+            self.check_ms_existence()
+            self.check_sd_existence()
+            self.print_missing_targets()
             self.check_dir_existence()
 
-        self._build_whole_target_list()
-        self._map_targets_to_mosaics()
-        self._map_configs()
+        if not self._quiet:
 
-        logger.info("")
-        logger.info("&%&%&%&%&%&%&%&%&%&%&%&%")
-        logger.info("Printing configurations.")
-        logger.info("&%&%&%&%&%&%&%&%&%&%&%&%")
-        logger.info("")
+            logger.info("")
+            logger.info("&%&%&%&%&%&%&%&%&%&%&%&%")
+            logger.info("Printing configurations.")
+            logger.info("&%&%&%&%&%&%&%&%&%&%&%&%")
+            logger.info("")
 
-        self.print_configs()
+            self.print_configs()
 
-        logger.info("")
-        logger.info("&%&%&%&%&%&%&%&%&%&%&%&%")
-        logger.info("Printing spectral products.")
-        logger.info("&%&%&%&%&%&%&%&%&%&%&%&%")
-        logger.info("")
+            logger.info("")
+            logger.info("&%&%&%&%&%&%&%&%&%&%&%&%")
+            logger.info("Printing spectral products.")
+            logger.info("&%&%&%&%&%&%&%&%&%&%&%&%")
+            logger.info("")
 
-        self.print_products()
+            self.print_products()
 
-        logger.info("")
-        logger.info("&%&%&%&%&%&%&%&%&%&%&%&%")
-        logger.info("Printing derived data products.")
-        logger.info("&%&%&%&%&%&%&%&%&%&%&%&%")
-        logger.info("")
+            logger.info("")
+            logger.info("&%&%&%&%&%&%&%&%&%&%&%&%")
+            logger.info("Printing derived data products.")
+            logger.info("&%&%&%&%&%&%&%&%&%&%&%&%")
+            logger.info("")
 
-        self.print_derived()
+            self.print_derived()
 
-        logger.info("")
-        logger.info("&%&%&%&%&%&%&%&%&%&%&%&%")
-        logger.info("Printing missing distances.")
-        logger.info("&%&%&%&%&%&%&%&%&%&%&%&%")
-        logger.info("")
+            logger.info("")
+            logger.info("&%&%&%&%&%&%&%&%&%&%&%&%")
+            logger.info("Printing missing distances.")
+            logger.info("&%&%&%&%&%&%&%&%&%&%&%&%")
+            logger.info("")
 
-        self.print_missing_distances()
+            self.print_missing_distances()
 
         logger.info("")
         logger.info("&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&")
@@ -168,6 +206,141 @@ class KeyHandler:
         logger.info("&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&")
         logger.info("")
 
+##############################################################
+# COMPILED KEY CACHE
+##############################################################
+
+# The parsed keys and cross-links are pickled next to the master
+# key. The cache records the modification time, size and checksum of
+# the master key, every key file it links, and the key reading code,
+# and is rebuilt when any of these change.
+
+    # Attributes that hold options of this object rather than key
+    # content, and so are never cached.
+    _uncached_attributes = ['_dochecks', '_quiet', '_use_cache', '_lazy_checks',
+                            '_exists_cache', '_master_key']
+
+    def get_key_cache_filename(self):
+        """
+        Name of the compiled key cache for the master key. The python
+        major version is part of the name, so that CASA (python 2) and
+        python 3 sessions keep separate caches.
+        """
+        master_dir, master_name = os.path.split(self._master_key)
+        return(os.path.join(master_dir, '.'+master_name+'.cache_py'+str(sys.version_info[0])))
+
+    def _key_cache_sources(self):
+        """
+        Files whose content determines the parsed keys: the master key,
+        the keys it links, and the modules that read them.
+        """
+        sources = [self._master_key]
+        all_key_lists = \
+            [self._ms_keys, self._dir_keys, self._target_keys, self._override_keys, self._imaging_keys,
+             self._linmos_keys, self._sd_keys, self._config_keys, self._cleanmask_keys, self._distance_keys,
+             self._derived_keys, self._moment_keys]
+        for this_list in all_key_lists:
+            for this_key in this_list:
+                sources.append(os.path.abspath(self._key_dir + this_key))
+        for this_module in [sys.modules[__name__], key_readers]:
+            this_file = os.path.splitext(os.path.abspath(this_module.__file__))[0]+'.py'
+            if os.path.isfile(this_file):
+                sources.append(this_file)
+        return(sources)
+
+    def _file_signature(self, fname, checksum=True):
+        """
+        (modification time, size, sha1) of a file, or None if it is
+        missing.
+        """
+        try:
+            this_stat = os.stat(fname)
+        except OSError:
+            return(None)
+        this_hash = None
+        if checksum:
+            this_hash = hashlib.sha1()
+            with open(fname, 'rb') as f:
+                this_hash.update(f.read())
+            this_hash = this_hash.hexdigest()
+        return((this_stat.st_mtime, this_stat.st_size, this_hash))
+
+    def _write_key_cache(self):
+        """
+        Pickle the parsed keys and the signatures of their sources.
+        """
+        state = dict((k, v) for k, v in self.__dict__.items()
+                     if k not in self._uncached_attributes)
+        sources = self._key_cache_sources()
+        cache = {
+            'version': KEY_CACHE_VERSION,
+            'key_dir': os.path.abspath(self._key_dir),
+            'sources': [(fname, self._file_signature(fname)) for fname in sources],
+            'state': state,
+            }
+        cache_file = self.get_key_cache_filename()
+        try:
+            # ... write and rename so that readers never see a partial cache
+            with open(cache_file+'.tmp'+str(os.getpid()), 'wb') as f:
+                pickle.dump(cache, f, protocol=2)
+            os.rename(cache_file+'.tmp'+str(os.getpid()), cache_file)
+        except (IOError, OSError) as e:
+            logger.warning("Could not write the key cache "+cache_file+": "+str(e))
+            return(False)
+        logger.info("Wrote the compiled key cache "+cache_file)
+        return(True)
+
+    def _load_key_cache(self):
+        """
+        Load the parsed keys from the compiled cache if it is up to
+        date. Returns True on success.
+        """
+        cache_file = self.get_key_cache_filename()
+        if not os.path.isfile(cache_file):
+            logger.info("No compiled key cache yet.")
+            return(False)
+        try:
+            with open(cache_file, 'rb') as f:
+                cache = pickle.load(f)
+        except Exception as e:
+            logger.warning("Could not read the key cache "+cache_file+": "+str(e))
+            return(False)
+
+        if cache.get('version') != KEY_CACHE_VERSION:
+            logger.info("The key cache has an old format. Rebuilding it.")
+            return(False)
+
+        # A relative key_dir depends on the working directory
+        if os.path.abspath(cache['state']['_key_dir']) != cache['key_dir']:
+            logger.info("The key directory moved. Rebuilding the key cache.")
+            return(False)
+
+        # Compare modification times and sizes. Only if the time
+        # changed (e.g., a copy or checkout), compare the checksum.
+        touched = False
+        for fname, signature in cache['sources']:
+            current = self._file_signature(fname, checksum=False)
+            if current is None or signature is None:
+                logger.info("Key file "+fname+" appeared or vanished. Rebuilding the key cache.")
+                return(False)
+            if current[1] != signature[1]:
+                logger.info("Key file "+fname+" changed. Rebuilding the key cache.")
+                return(False)
+            if current[0] != signature[0]:
+                if self._file_signature(fname)[2] != signature[2]:
+                    logger.info("Key file "+fname+" changed. Rebuilding the key cache.")
+                    return(False)
+                touched = True
+
+        self.__dict__.update(cache['state'])
+        logger.info("Loaded the keys from the compiled cache "+cache_file)
+
+        # Record the new times so the checksums are not needed next time
+        if touched:
+            self._write_key_cache()
+
+        return(True)
+
 ##############################################################
 # READ THE MASTER KEY
 ##############################################################
@@ -987,6 +1160,53 @@ class KeyHandler:
 
         return()
 
+    def _build_indexes(self):
+        """
+        Build the lookup tables behind the measurement set, config and
+        product queries, so that the loops over targets do not walk or
+        re-sort the nested key dictionaries each time:
+
+        _ms_index : target -> sorted list of (project, array_tag, obsnum)
+        _ms_arraytags_index : target -> set of array tags with data
+        _config_arraytags_index : interf config -> list of array tags
+        _line_product_index : line product -> its definition
+
+        The part -> mosaic table is _mosaic_assign_dict (see
+        _map_targets_to_mosaics).
+        """
+
+        logger.info("Indexing measurement sets, configs and products.")
+
+        self._ms_index = {}
+        self._ms_arraytags_index = {}
+        if self._ms_dict is not None:
+            for this_target in self._ms_dict.keys():
+                this_list = []
+                these_tags = set()
+                for this_project in self._ms_dict[this_target].keys():
+                    for this_arraytag in self._ms_dict[this_target][this_project].keys():
+                        these_tags.add(this_arraytag)
+                        for this_obsnum in self._ms_dict[this_target][this_project][this_arraytag].keys():
+                            this_list.append((this_project, this_arraytag, this_obsnum))
+                this_list.sort()
+                self._ms_index[this_target] = this_list
+                self._ms_arraytags_index[this_target] = these_tags
+
+        self._config_arraytags_index = {}
+        if 'interf_config' in self._config_dict:
+            for this_config in self._config_dict['interf_config'].keys():
+                if 'array_tags' in self._config_dict['interf_config'][this_config]:
+                    self._config_arraytags_index[this_config] = \
+                        self._config_dict['interf_config'][this_config]['array_tags']
+
+        self._line_product_index = {}
+        if 'line_product' in self._config_dict:
+            for this_product in self._config_dict['line_product'].keys():
+                self._line_product_index[this_product] = \
+                    self._config_dict['line_product'][this_product]
+
+        return()
+
 ##############################################################
 # Programs to run checks on the keyHandler and the data
 ##############################################################
@@ -998,6 +1218,17 @@ class KeyHandler:
         self._dochecks = dochecks
         return()
 
+    def _path_exists(self, path):
+        """
+        Check if a file or directory exists. With lazy checks, each
+        path is only checked the first time it is used.
+        """
+        if not self._lazy_checks:
+            return(os.path.isfile(path) or os.path.isdir(path))
+        if path not in self._exists_cache:
+            self._exists_cache[path] = os.path.isfile(path) or os.path.isdir(path)
+        return(self._exists_cache[path])
+
     def print_missing_targets(self):
         """
         Print the targets missing a definition in the target list key.
@@ -1296,7 +1527,7 @@ class KeyHandler:
         targets = self._target_list
         targets_with_ms = []
         for target in targets:
-            if target in self._ms_dict.keys():
+            if target in self._ms_dict:
                 targets_with_ms.append(target)
 
         this_target_list = \
@@ -1456,9 +1687,8 @@ class KeyHandler:
             if len(self._linmos_dict) > 0:
                 if self._mosaic_assign_dict is None or len(self._mosaic_assign_dict) == 0:
                     self._map_targets_to_mosaics()
-                if len(self._mosaic_assign_dict) > 0:
-                    if target_part_name in self._mosaic_assign_dict.keys():
-                        return self._mosaic_assign_dict[target_part_name]
+                if target_part_name in self._mosaic_assign_dict:
+                    return self._mosaic_assign_dict[target_part_name]
         return None
 
     def is_target_linmos(self, target=None):
@@ -1474,7 +1704,7 @@ class KeyHandler:
             logging.error("No linear mosaic dictionary defined.")
             return(False)
 
-        if target in self._linmos_dict.keys():
+        if target in self._linmos_dict:
             return(True)
 
         return(False)
@@ -1491,7 +1721,7 @@ class KeyHandler:
             logging.error("No linear mosaic dictionary defined.")
             return(None)
 
-        if target not in self._linmos_dict.keys():
+        if target not in self._linmos_dict:
             logging.error("No linear mosaic defined for "+target)
             return(None)
 
@@ -1501,7 +1731,10 @@ class KeyHandler:
         """
         Return true or false depending on whether the target is in a linear mosaic.
         """
-        if target in self._mosaic_assign_dict.keys():
+        if self._mosaic_assign_dict is None:
+            self._map_targets_to_mosaics()
+
+        if target in self._mosaic_assign_dict:
             if return_target_name:
                 return True, self._mosaic_assign_dict[target]
             else:
@@ -1641,11 +1874,7 @@ class KeyHandler:
             logging.error("Please specify a product.")
             raise Exception("Please specify a product.")
 
-        channel_kms = None
-        if 'line_product' in self._config_dict:
-            if product in self._config_dict['line_product']:
-                if 'channel_kms' in self._config_dict['line_product'][product]:
-                    channel_kms = self._config_dict['line_product'][product]['channel_kms']
+        channel_kms = self._line_product_index.get(product, {}).get('channel_kms')
 
         if channel_kms is None:
             logging.error('No channel_kms value set for line product '+product)
@@ -1663,11 +1892,7 @@ class KeyHandler:
             raise Exception("Please specify a product.")
             return None
 
-        line_tag = None
-        if 'line_product' in self._config_dict:
-            if product in self._config_dict['line_product']:
-                if 'line_tag' in self._config_dict['line_product'][product]:
-                    line_tag = self._config_dict['line_product'][product]['line_tag']
+        line_tag = self._line_product_index.get(product, {}).get('line_tag')
 
         if line_tag is None:
             logging.error('No line_tag value set for the input line product '+product)
@@ -1685,11 +1910,7 @@ class KeyHandler:
             raise Exception("Please specify a product.")
             return None
 
-        statwt_edge = None
-        if 'line_product' in self._config_dict:
-            if product in self._config_dict['line_product']:
-                if 'statwt_edge_kms' in self._config_dict['line_product'][product]:
-                    statwt_edge = self._config_dict['line_product'][product]['statwt_edge_kms']
+        statwt_edge = self._line_product_index.get(product, {}).get('statwt_edge_kms')
 
         if statwt_edge is None:
             logging.info('No statwt_edge found for '+product)
@@ -1706,11 +1927,7 @@ class KeyHandler:
             raise Exception("Please specify a product.")
             return None
 
-        fitorder = None
-        if 'line_product' in self._config_dict:
-            if product in self._config_dict['line_product']:
-                if 'fitorder' in self._config_dict['line_product'][product]:
-                    fitorder = self._config_dict['line_product'][product]['fitorder']
+        fitorder = self._line_product_index.get(product, {}).get('fitorder')
 
         if fitorder is None:
             logging.info('No fitorder found for '+product+' . Defaulting to order zero.')
@@ -1728,11 +1945,7 @@ class KeyHandler:
             raise Exception("Please specify a product.")
             return None
 
-        combinespw = None
-        if 'line_product' in self._config_dict:
-            if product in self._config_dict['line_product']:
-                if 'combinespw' in self._config_dict['line_product'][product]:
-                    combinespw = self._config_dict['line_product'][product]['combinespw']
+        combinespw = self._line_product_index.get(product, {}).get('combinespw')
 
         if combinespw is None:
             logging.info('No combinespw flag found for '+product+' . Defaulting to False.')
@@ -1757,10 +1970,8 @@ class KeyHandler:
                 if 'lines_to_flag' in self._config_dict['cont_product'][product]:
                     lines_to_flag = self._config_dict['cont_product'][product]['lines_to_flag']
 
-        if 'line_product' in self._config_dict.keys():
-            if product in self._config_dict['line_product']:
-                if 'lines_to_flag' in self._config_dict['line_product'][product]:
-                    lines_to_flag = self._config_dict['line_product'][product]['lines_to_flag']
+        if 'lines_to_flag' in self._line_product_index.get(product, {}):
+            lines_to_flag = self._line_product_index[product]['lines_to_flag']
 
         if len(lines_to_flag) == 0:
             logging.warning('No lines to flag for the input product '+product)
@@ -1776,12 +1987,7 @@ class KeyHandler:
             logging.error("Please specify a config.")
             return None
 
-        if 'interf_config' in self._config_dict:
-            if config in self._config_dict['interf_config']:
-                if 'array_tags' in self._config_dict['interf_config'][config]:
-                    return self._config_dict['interf_config'][config]['array_tags']
-
-        return None
+        return self._config_arraytags_index.get(config)
 
     def get_timebin_for_array_tag(self, array_tag=None):
         """
@@ -1881,16 +2087,13 @@ class KeyHandler:
                     if this_tag not in just_arraytags:
                         just_arraytags.append(this_tag)
 
-        # Loop over targets
-        target_list = self._ms_dict.keys()
-        target_list.sort()
+        # Loop over targets, only those requested if there is a list
+        if len(just_targets) > 0:
+            target_list = sorted([x for x in just_targets if x in self._ms_index])
+        else:
+            target_list = sorted(self._ms_index.keys())
         for this_target in target_list:
 
-            # if user has input targets, match it
-            if len(just_targets) > 0:
-                if not (this_target in just_targets):
-                    continue
-
             # If we're being strict, only consider targets that have
             # data associated with the user-supplied configs.
 
@@ -1904,14 +2107,7 @@ class KeyHandler:
                 # configs. Else we loop over all measurement sets.
 
                 if config is not None:
-                    if type(config) == type(''):
-                        input_configs = [config]
-                    elif type(config) == type([]):
-                        input_configs = config
-                    else:
-                        logger.error("Expected list or string.")
-                        raise Exception("Expected list or string.")
-                    
+
                     has_data_for_any_config = False
 
                     # Check if the target has data for that configuration
@@ -1924,40 +2120,28 @@ class KeyHandler:
                             for this_arraytag in self.get_array_tags_for_config(this_config):
                                 if valid_arraytags.count(this_arraytag) == 0:
                                     valid_arraytags.append(this_arraytag)
-                            
+
                     # If there are no valid configurations skip.
                     if not has_data_for_any_config:
                         continue
 
-            # loop over projects
-            project_list = self._ms_dict[this_target].keys()
-            project_list.sort()
-            for this_project in project_list:
+            # loop over projects, array tags and obs nums (sorted in
+            # that order in the index)
+            for this_project, this_arraytag, this_obsnum in self._ms_index[this_target]:
 
                 if len(just_projects) > 0:
                     if not (this_project in just_projects):
                         continue
 
-                # loop over array tags
-                arraytag_list = self._ms_dict[this_target][this_project].keys()
-                arraytag_list.sort()
-                for this_arraytag in arraytag_list:
-
-                    if len(just_arraytags) > 0:
-                        if not (this_arraytag in just_arraytags):
-                            continue
-
-                    if strict_config and config is not None:
-                        if valid_arraytags.count(this_arraytag) == 0:
-                            continue
-
-                    # loop over obs nums
+                if len(just_arraytags) > 0:
+                    if not (this_arraytag in just_arraytags):
+                        continue
 
-                    obsnum_list = self._ms_dict[this_target][this_project][this_arraytag].keys()
-                    obsnum_list.sort()
-                    for this_obsnum in obsnum_list:
+                if strict_config and config is not None:
+                    if valid_arraytags.count(this_arraytag) == 0:
+                        continue
 
-                        yield this_target, this_project, this_arraytag, this_obsnum
+                yield this_target, this_project, this_arraytag, this_obsnum
 
     def get_file_for_input_ms(
         self,
@@ -1989,10 +2173,10 @@ class KeyHandler:
         # Check that the provided input is in the ms_dict
 
         check_valid = False
-        if target in self._ms_dict.keys():
-            if project in self._ms_dict[target].keys():
-                if array_tag in self._ms_dict[target][project].keys():
-                    if obsnum in self._ms_dict[target][project][array_tag].keys():
+        if target in self._ms_dict:
+            if project in self._ms_dict[target]:
+                if array_tag in self._ms_dict[target][project]:
+                    if obsnum in self._ms_dict[target][project][array_tag]:
                         check_valid = True
 
         if not check_valid:
@@ -2007,7 +2191,7 @@ class KeyHandler:
         file_paths = []
         for ms_root in self._ms_roots:
             file_path = ms_root + self._ms_dict[target][project][array_tag][obsnum]['file']
-            if os.path.isdir(file_path):
+            if self._path_exists(file_path):
                 file_paths.append(file_path)
 
         # Error check the results (redundant with read-in checks but good to have)
@@ -2047,34 +2231,20 @@ class KeyHandler:
             return(None)
 
         config_array_tags = self.get_array_tags_for_config(config)
-        
-        arraytags_for_target = []
-
-        for this_target in self._ms_dict.keys():
-
-            if this_target != target:
-                continue
+        if config_array_tags is None:
+            logging.error("No array tags defined for config "+str(config))
+            return(False)
 
-            for this_project in self._ms_dict[this_target].keys():
-                
-                for this_arraytag in self._ms_dict[this_target][this_project].keys():
-                    
-                    arraytags_for_target.append(this_arraytag)
+        arraytags_for_target = self._ms_arraytags_index.get(target, set())
 
         has_any = False
         missing_any = False
 
         for this_config_arraytag in config_array_tags:
 
-            missing_this_one = True
-
-            for this_target_arraytag in arraytags_for_target:
-
-                if this_config_arraytag == this_target_arraytag:
-                    missing_this_one = False
-                    has_any = True
-
-            if missing_this_one:
+            if this_config_arraytag in arraytags_for_target:
+                has_any = True
+            else:
                 missing_any = True
                 
         if strict:
@@ -2120,10 +2290,10 @@ class KeyHandler:
         # Check that the provided input is in the ms_dict
 
         check_valid = False
-        if target in self._ms_dict.keys():
-            if project in self._ms_dict[target].keys():
-                if array_tag in self._ms_dict[target][project].keys():
-                    if obsnum in self._ms_dict[target][project][array_tag].keys():
+        if target in self._ms_dict:
+            if project in self._ms_dict[target]:
+                if array_tag in self._ms_dict[target][project]:
+                    if obsnum in self._ms_dict[target][project][array_tag]:
                         check_valid = True
 
         if not check_valid:
@@ -2202,7 +2372,7 @@ class KeyHandler:
         last_found_file = None
         for this_root in self._sd_roots:
             this_fname = this_root + this_dict[product]
-            if os.path.isfile(this_fname) or os.path.isdir(this_fname):
+            if self._path_exists(this_fname):
                 found = True
                 found_count += 1
                 last_found_file = this_fname
@@ -2255,7 +2425,7 @@ class KeyHandler:
         last_found_file = None
         for this_root in self._cleanmask_roots:
             this_fname = this_root + this_dict[this_product]
-            if os.path.isfile(this_fname) or os.path.isdir(this_fname):
+            if self._path_exists(this_fname):
                 found = True
                 found_count += 1
                 last_found_file = this_fname
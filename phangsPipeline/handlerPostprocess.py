@@ -41,9 +41,13 @@ else:
     sys.path.append(os.path.dirname(os.path.abspath(__file__)))
 
 import handlerTemplate
+import utilsProfile
+import utilsJournal
 import utilsFilenames
 import utilsResolutions
 
+@utilsProfile.profile_tasks
+@utilsJournal.journal_tasks
 class PostProcessHandler(handlerTemplate.HandlerTemplate):
     """
     Class to handle post-processing of ALMA data. Post-processing here
@@ -360,6 +364,9 @@ class PostProcessHandler(handlerTemplate.HandlerTemplate):
                 if not (os.path.isdir(indir+infile)):
                     logger.warning("Missing "+indir+infile)
                     continue
+
+            if this_tag == 'orig':
+                self._profile_input(indir+infile)
     
             logger.info("")
             logger.info("&%&%&%&%&%&%&%&%&%&%&%&%&%&%")
@@ -370,6 +377,7 @@ class PostProcessHandler(handlerTemplate.HandlerTemplate):
             # logger.info("Using ccr.copy_dropdeg.")
             logger.info("Staging "+outfile)
             
+            self._journal_outputs([outdir+outfile])
             if (not self._dry_run) and casa_enabled:
                 os.system('rm -rf ' + outdir + outfile)
                 os.system('cp -r ' + indir + infile + ' ' + outdir + outfile)
@@ -412,6 +420,9 @@ class PostProcessHandler(handlerTemplate.HandlerTemplate):
                     logger.warning("Missing "+file_dir+file_name)
                     continue
 
+            # ... the cube itself is an input here, only the temporary
+            # copy is a new output.
+            self._journal_outputs([file_dir + file_name + '_nodeg'])
             if (not self._dry_run) and casa_enabled:
                 ccr.copy_dropdeg(file_dir + file_name, file_dir + file_name + '_nodeg', overwrite=True)
 
@@ -460,6 +471,8 @@ class PostProcessHandler(handlerTemplate.HandlerTemplate):
                 logger.warning("Missing "+indir+pbfile)
                 return()
 
+        self._profile_input(indir+infile)
+
         # Apply the primary beam correction to the data.
         
         logger.info("")
@@ -474,6 +487,7 @@ class PostProcessHandler(handlerTemplate.HandlerTemplate):
         logger.info("Correcting from "+infile)
         logger.info("Correcting using "+pbfile)
         
+        self._journal_outputs([outdir+outfile])
         if (not self._dry_run) and casa_enabled:
             ccr.primary_beam_correct(
                 infile=indir+infile,
@@ -521,6 +535,8 @@ class PostProcessHandler(handlerTemplate.HandlerTemplate):
                 logger.warning("Missing "+infile)
                 return()
 
+        self._profile_input(indir+infile)
+
         # Convolve the data to have a round beam.
         
         logger.info("")
@@ -536,6 +552,7 @@ class PostProcessHandler(handlerTemplate.HandlerTemplate):
         if force_beam_as is not None:
             logger.info("Forcing beam to "+str(force_beam_as))
         
+        self._journal_outputs([outdir+outfile])
         if (not self._dry_run) and casa_enabled:
             ccr.convolve_to_round_beam(
                 infile=indir+infile,
@@ -586,6 +603,8 @@ class PostProcessHandler(handlerTemplate.HandlerTemplate):
                 logger.warning("Missing "+tempdir+template)
                 return()
 
+        self._profile_input(indir+infile)
+
         # Stage the singledish data for feathering
 
         logger.info("")
@@ -600,6 +619,7 @@ class PostProcessHandler(handlerTemplate.HandlerTemplate):
         logger.info("Original file "+infile)
         logger.info("Using interferometric template "+template)
         
+        self._journal_outputs([outdir+outfile])
         if (not self._dry_run) and casa_enabled:
             cfr.prep_sd_for_feather(
                 sdfile_in=indir+infile,
@@ -657,6 +677,8 @@ class PostProcessHandler(handlerTemplate.HandlerTemplate):
                 logger.warning("Missing "+image_file)
                 return()
 
+        self._profile_input(indir+infile)
+
         # Create a weight image for use linear mosaicking targets that
         # are part of a linear mosaic
 
@@ -672,6 +694,7 @@ class PostProcessHandler(handlerTemplate.HandlerTemplate):
         logger.info("Based off of primary beam file "+infile)
         logger.info("Measuring noise from file "+image_file)
                         
+        self._journal_outputs([indir+outfile])
         if (not self._dry_run) and casa_enabled:
             cmr.generate_weight_file(
                 image_file = indir+image_file,
@@ -733,6 +756,7 @@ class PostProcessHandler(handlerTemplate.HandlerTemplate):
         logger.info("Making weight file "+outfile)
         logger.info("Measuring noise from file "+image_file)
             
+        self._journal_outputs([indir+outfile])
         if (not self._dry_run) and casa_enabled:
             cmr.generate_weight_file(
                 image_file = indir+image_file,
@@ -798,6 +822,24 @@ class PostProcessHandler(handlerTemplate.HandlerTemplate):
         # Error checking
 
         # Check input file existence        
+
+        # Skip if the feathered cube is up to date
+
+        manifest_inputs = [indir+interf_file, indir+sd_file]
+        manifest_outputs = [outdir+outfile]
+        if apodize:
+            manifest_inputs.append(indir+fname_dict_in[apod_ext])
+        if copy_weights:
+            manifest_inputs.append(indir+fname_dict_in['weight'])
+            if os.path.isdir(indir+fname_dict_in['weight']):
+                manifest_outputs.append(outdir+fname_dict_out['weight'])
+        manifest_params = {'feather_config':feather_config, 'apodize':apodize,
+                           'apod_ext':apod_ext, 'copy_weights':copy_weights}
+
+        self._journal_outputs(manifest_outputs)
+        if self._is_up_to_date(outputs=manifest_outputs, inputs=manifest_inputs,
+                               params=manifest_params):
+            return()
     
         # Feather the single dish and interferometer data
                 
@@ -872,6 +914,11 @@ class PostProcessHandler(handlerTemplate.HandlerTemplate):
                     ccr.copy_dropdeg(infile=indir+interf_weight_file, 
                                      outfile=outdir+out_weight_file, 
                                      overwrite=True)
+
+        if casa_enabled:
+            self._record_outputs(outputs=manifest_outputs, inputs=manifest_inputs,
+                                 params=manifest_params)
+
         return()
 
     def task_compress(
@@ -917,6 +964,8 @@ class PostProcessHandler(handlerTemplate.HandlerTemplate):
                 logger.warning("Missing "+infile)
                 return()
 
+        self._profile_input(indir+infile)
+
         # Compress, reducing cube volume.
 
         logger.info("")
@@ -929,6 +978,7 @@ class PostProcessHandler(handlerTemplate.HandlerTemplate):
         logger.info("Producing "+outfile+" using ccr.trim_cube.")
         logger.info("Trimming from original file "+infile)
         
+        self._journal_outputs([outdir+outfile])
         if (not self._dry_run) and casa_enabled:
             ccr.trim_cube(
                 infile=indir+infile,
@@ -966,6 +1016,7 @@ class PostProcessHandler(handlerTemplate.HandlerTemplate):
         logger.info("Aligning to produce output file "+outfile_pb)
         logger.info("Aligning to template "+template)
 
+        self._journal_outputs([outdir+outfile_pb])
         if (not self._dry_run) and casa_enabled:
             ccr.align_to_target(
                 infile=indir+infile_pb,
@@ -1012,6 +1063,8 @@ class PostProcessHandler(handlerTemplate.HandlerTemplate):
                 logger.warning("Missing "+infile)
                 return()
 
+        self._profile_input(indir+infile)
+
         # Change units from Jy/beam to Kelvin.
                         
         logger.info("")
@@ -1025,6 +1078,7 @@ class PostProcessHandler(handlerTemplate.HandlerTemplate):
         logger.info("Creating "+outfile)
         logger.info("Converting from original file "+infile)
         
+        self._journal_outputs([outdir+outfile])
         if (not self._dry_run) and casa_enabled:
             ccr.convert_jytok(
                 infile=indir+infile,
@@ -1073,6 +1127,8 @@ class PostProcessHandler(handlerTemplate.HandlerTemplate):
                 logger.warning("Missing "+infile)
                 return()
 
+        self._profile_input(indir+infile)
+
         # Export to FITS and clean up output
         
         logger.info("")
@@ -1086,6 +1142,7 @@ class PostProcessHandler(handlerTemplate.HandlerTemplate):
         logger.info("Export to "+outfile)
         logger.info("Writing from input cube "+infile)
 
+        self._journal_outputs([outdir+outfile])
         if (not self._dry_run) and casa_enabled:
             ccr.export_and_cleanup(
                 infile=indir+infile,
@@ -1115,6 +1172,7 @@ class PostProcessHandler(handlerTemplate.HandlerTemplate):
         logger.info("Writing from primary beam "+infile_pb)
         logger.info("Writing output primary beam "+outfile_pb)
         
+        self._journal_outputs([outdir+outfile_pb])
         if (not self._dry_run) and casa_enabled:
             ccr.export_and_cleanup(
                 infile=indir+infile_pb,
@@ -1196,6 +1254,7 @@ class PostProcessHandler(handlerTemplate.HandlerTemplate):
         # TBD - check override dict for target
         # resolution and (maybe?) pixel padding.
 
+        self._journal_outputs(outfile_list)
         if (not self._dry_run) and casa_enabled:
             cmr.common_res_for_mosaic(
                 infile_list = infile_list,
@@ -1287,6 +1346,7 @@ class PostProcessHandler(handlerTemplate.HandlerTemplate):
         delta_ra = None 
         delta_dec = None
         
+        self._journal_outputs(outfile_list)
         if (not self._dry_run) and casa_enabled:
             cmr.common_grid_for_mosaic(
                 infile_list = infile_list,
@@ -1364,6 +1424,7 @@ class PostProcessHandler(handlerTemplate.HandlerTemplate):
         logger.info("Mosaicking original files "+str(infile_list))
         logger.info("Weighting by "+str(weightfile_list))
 
+        self._journal_outputs([outdir+outfile])
         if not self._dry_run:
             cmr.mosaic_aligned_data(
                 infile_list = infile_list,
@@ -1410,6 +1471,30 @@ class PostProcessHandler(handlerTemplate.HandlerTemplate):
             logger.warning("No imaging for "+fname_dict['orig']+". Returning.")
             return()
 
+        # Skip if the prepared files are up to date. The recipe as a
+        # whole is checked because some steps (e.g., dropping
+        # degenerate axes) modify their inputs in place.
+
+        postprocess_dir = self._kh.get_postprocess_dir_for_target(target)
+
+        manifest_inputs = [imaging_dir+fname_dict['orig'],
+                           imaging_dir+fname_dict['pb']]
+        manifest_outputs = [postprocess_dir+fname_dict[this_tag] for this_tag in
+                            ['orig', 'pb', 'pbcorr', 'pbcorr_round']]
+        if has_singledish:
+            manifest_inputs.append(fname_dict['orig_sd'])
+            manifest_outputs.append(postprocess_dir+fname_dict['prepped_sd'])
+        if is_part_of_mosaic:
+            manifest_outputs.append(postprocess_dir+fname_dict['weight'])
+        if is_part_of_mosaic and has_singledish:
+            manifest_outputs.append(postprocess_dir+fname_dict['sd_weight'])
+        manifest_params = {'has_singledish':has_singledish,
+                           'is_part_of_mosaic':is_part_of_mosaic}
+
+        if self._is_up_to_date(outputs=manifest_outputs, inputs=manifest_inputs,
+                               params=manifest_params):
+            return()
+
         # Call tasks
 
         self.task_stage_interf_data(
@@ -1450,6 +1535,10 @@ class PostProcessHandler(handlerTemplate.HandlerTemplate):
                 check_files=check_files,
                 )
 
+        if casa_enabled:
+            self._record_outputs(outputs=manifest_outputs, inputs=manifest_inputs,
+                                 params=manifest_params)
+
         return()
 
     def recipe_mosaic_one_target(
@@ -1495,6 +1584,36 @@ class PostProcessHandler(handlerTemplate.HandlerTemplate):
         if config in self.get_feather_configs():
 
             parts_have_singledish = False
+
+        # Skip if the mosaic is up to date with its parts
+
+        postprocess_dir = self._kh.get_postprocess_dir_for_target(target)
+
+        part_tags = ['pbcorr_round', 'weight']
+        out_tags = ['pbcorr_round']
+        if parts_have_singledish:
+            part_tags += ['prepped_sd', 'sd_weight']
+            out_tags += ['prepped_sd']
+
+        manifest_inputs = []
+        for this_part in mosaic_parts:
+            this_part_dict = self._fname_dict(
+                target=this_part, config=config, product=product,
+                extra_ext=extra_ext_in)
+            for this_tag in part_tags:
+                manifest_inputs.append(postprocess_dir+this_part_dict[this_tag])
+
+        fname_dict_out = self._fname_dict(
+            target=target, config=config, product=product,
+            extra_ext=extra_ext_out)
+        manifest_outputs = [postprocess_dir+fname_dict_out[this_tag]
+                            for this_tag in out_tags]
+        manifest_params = {'mosaic_parts':mosaic_parts,
+                           'parts_have_singledish':parts_have_singledish}
+
+        if self._is_up_to_date(outputs=manifest_outputs, inputs=manifest_inputs,
+                               params=manifest_params):
+            return()
     
         self.task_convolve_parts_for_mosaic(
             target = target,
@@ -1552,6 +1671,10 @@ class PostProcessHandler(handlerTemplate.HandlerTemplate):
                 check_files = check_files,
                 )
 
+        if casa_enabled:
+            self._record_outputs(outputs=manifest_outputs, inputs=manifest_inputs,
+                                 params=manifest_params)
+
         return()
  
     def recipe_cleanup_one_target(
@@ -1568,6 +1691,20 @@ class PostProcessHandler(handlerTemplate.HandlerTemplate):
         as a FITS file.
         """
 
+        # Skip if the exported FITS files are up to date
+
+        postprocess_dir = self._kh.get_postprocess_dir_for_target(target)
+        fname_dict = self._fname_dict(
+            target=target, config=config, product=product, extra_ext=ext_ext)
+
+        manifest_inputs = [postprocess_dir+fname_dict['pbcorr_round'],
+                           postprocess_dir+fname_dict['pb']]
+        manifest_outputs = [postprocess_dir+fname_dict['pbcorr_trimmed_k_fits'],
+                            postprocess_dir+fname_dict['trimmed_pb_fits']]
+
+        if self._is_up_to_date(outputs=manifest_outputs, inputs=manifest_inputs):
+            return()
+
         self.task_compress(
             target=target, config=config, product=product,
             check_files=check_files, do_pb_too=True,
@@ -1587,6 +1724,9 @@ class PostProcessHandler(handlerTemplate.HandlerTemplate):
             extra_ext_in=ext_ext, extra_ext_out=ext_ext,
             )
 
+        if casa_enabled:
+            self._record_outputs(outputs=manifest_outputs, inputs=manifest_inputs)
+
         return()
 
     def recipe_convolve_to_scale(
@@ -1616,6 +1756,25 @@ class PostProcessHandler(handlerTemplate.HandlerTemplate):
             res_tag = utilsResolutions.get_tag_for_res(this_res)
             res_arcsec = utilsResolutions.get_angular_resolution_for_res(this_res, distance = self._kh.get_distance_for_target(target_name))
             
+            # Skip if this resolution is up to date
+
+            postprocess_dir = self._kh.get_postprocess_dir_for_target(target)
+            fname_dict_in = self._fname_dict(
+                target=target, config=config, product=product, extra_ext=ext_ext)
+            fname_dict_out = self._fname_dict(
+                target=target, config=config, product=product,
+                extra_ext=ext_ext+'_res'+res_tag)
+
+            manifest_inputs = [postprocess_dir+fname_dict_in['pbcorr_trimmed_k']]
+            manifest_outputs = [postprocess_dir+fname_dict_out['pbcorr_trimmed_k']]
+            if export_to_fits:
+                manifest_outputs.append(postprocess_dir+fname_dict_out['pbcorr_trimmed_k_fits'])
+            manifest_params = {'res_tag':res_tag, 'res_arcsec':res_arcsec}
+
+            if self._is_up_to_date(outputs=manifest_outputs, inputs=manifest_inputs,
+                                   params=manifest_params):
+                continue
+
             # Check if the requested beam is smaller than the current one
 
             self.task_round_beam(
@@ -1633,6 +1792,10 @@ class PostProcessHandler(handlerTemplate.HandlerTemplate):
                     extra_ext_in=ext_ext+'_res'+res_tag, extra_ext_out=ext_ext+'_res'+res_tag,
                     )
 
+            if casa_enabled:
+                self._record_outputs(outputs=manifest_outputs, inputs=manifest_inputs,
+                                     params=manifest_params)
+
 #endregion
 
 #region Loops
@@ -7,12 +7,20 @@ handlers and includes basic list and shared functionality.
 
 import os
 import glob
+import time
 import numpy as np
 
 import logging
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.DEBUG)
 
+import utilsManifest
+import utilsProfile
+import utilsWorkQueue
+import utilsMemory
+import utilsJournal
+import utilsPlanner
+
 class HandlerTemplate:
     """
     Template handler class inherited by specific handler objects.
@@ -71,6 +79,22 @@ class HandlerTemplate:
         # Toggle whether tasks are executed
         self.set_dry_run(dry_run)
 
+        # Toggle whether up to date outputs are skipped
+        self.set_incremental(False)
+
+        # Toggle per-task performance records
+        self._profiler = None
+
+        # Peak memory estimates for scheduling
+        self._memory_estimator = utilsMemory.MemoryEstimator()
+
+        # Run journal for resuming interrupted loops
+        self._journal = None
+        self._journal_state = {}
+        self._resume = False
+        self._max_retries = 2
+        self._retry_backoff = 30.
+
 #region Parameter toggles
 
     ##########################################
@@ -102,6 +126,60 @@ class HandlerTemplate:
         self._dry_run = dry_run
         return(None)
 
+    def set_incremental(
+        self,
+        incremental = False):
+        """
+        Toggle make-style incremental reruns. When True, tasks record
+        their inputs, keywords, and the pipeline version in a manifest
+        next to each output (see utilsManifest). A task is skipped if
+        its outputs are up to date with respect to all of these and
+        rerun, overwriting the old outputs, if anything changed.
+        """
+        self._incremental = incremental
+        return(None)
+
+    def set_profiling(
+        self,
+        profiling = False):
+        """
+        Toggle per-task performance records. When True, every task_*
+        and recipe_* call records its wall and CPU time, peak memory,
+        bytes read and written, and input shape (see
+        utilsProfile). Records already taken are kept when profiling
+        is turned off and on again.
+        """
+        if self._profiler is None:
+            if not profiling:
+                return(None)
+            self._profiler = utilsProfile.TaskProfiler()
+        self._profiler.enabled = profiling
+        return(None)
+
+    def set_journal(
+        self,
+        journal_file = None,
+        max_retries = None,
+        retry_backoff = None,
+        ):
+        """
+        Record every task_* call in a run journal (an append-only
+        JSON-lines file, see utilsJournal) so that loop_* methods called
+        with resume=True skip finished tasks, clean up after
+        interrupted ones, and retry failures. max_retries failed
+        attempts are retried, waiting retry_backoff seconds and then
+        twice as long each time. None turns the journal off.
+        """
+        if journal_file is None:
+            self._journal = None
+        else:
+            self._journal = utilsJournal.RunJournal(journal_file)
+        if max_retries is not None:
+            self._max_retries = max_retries
+        if retry_backoff is not None:
+            self._retry_backoff = retry_backoff
+        return(None)
+
 #endregion
 
 #region List building routines
@@ -523,3 +601,371 @@ class HandlerTemplate:
                 yield this_product
 
 #endregion
+
+#region Manifest
+
+    ##############################################################
+    # Check and record outputs for incremental reruns            #
+    ##############################################################
+
+    def _is_up_to_date(
+        self,
+        outputs = [],
+        inputs = [],
+        params = None,
+        ):
+        """
+        True if incremental reruns are on and the outputs are up to
+        date with the inputs and parameters. Always False otherwise.
+        """
+        if not self._incremental:
+            return(False)
+        if len(outputs) == 0:
+            return(False)
+        if utilsManifest.is_up_to_date(outputs, inputs=inputs, params=params):
+            logger.info("Up to date, skipping: "+str([os.path.basename(
+                x.rstrip(os.sep)) for x in outputs]))
+            return(True)
+        return(False)
+
+    def _record_outputs(
+        self,
+        outputs = [],
+        inputs = [],
+        params = None,
+        ):
+        """
+        Record the outputs of a task that just ran in the manifest
+        when incremental reruns are on.
+        """
+        if (not self._incremental) or self._dry_run:
+            return(None)
+        utilsManifest.record_outputs(outputs, inputs=inputs, params=params)
+        return(None)
+
+#endregion
+
+#region Journal
+
+    ##############################################################
+    # Record task progress for resuming interrupted runs         #
+    ##############################################################
+
+    def _journal_outputs(
+        self,
+        outputs = [],
+        ):
+        """
+        Note the outputs of the running task in the journal, so that
+        they can be removed if the task is interrupted. Each task_*
+        calls this before it writes, listing every file or directory
+        it may leave behind.
+        """
+        if self._journal is None or self._dry_run:
+            return(None)
+        self._journal.outputs(outputs)
+        return(None)
+
+    def _start_resume(self):
+        """
+        Read the journal before a resumed loop, starting a default
+        journal in the working directory if none is set.
+        """
+        if self._journal is None:
+            journal_file = 'run_journal_'+self.__class__.__name__+'.jsonl'
+            logger.info("No journal set. Using "+journal_file)
+            self.set_journal(journal_file)
+        self._journal_state = self._journal.state()
+        logger.info("Resuming from "+self._journal.filename+": "
+                    +str(self._journal.summary()))
+        return(None)
+
+    def get_journal_summary(self):
+        """
+        Number of journaled task calls that are done, failed, or were
+        started and never finished.
+        """
+        if self._journal is None:
+            return({})
+        return(self._journal.summary())
+
+#endregion
+
+#region Profiling
+
+    ##############################################################
+    # Per-task performance records                               #
+    ##############################################################
+
+    def _profile_input(
+        self,
+        input_file = None,
+        ):
+        """
+        Note the main input of the running task, its shape and its
+        size on disk in the profile.
+        """
+        if self._profiler is None or not self._profiler.enabled:
+            return(None)
+        self._profiler.note(input_file=os.path.basename(str(input_file).rstrip(os.sep)),
+                            input_shape=utilsProfile.image_shape(input_file),
+                            input_bytes=utilsProfile.path_bytes(input_file))
+        return(None)
+
+    def get_profile_records(self):
+        """
+        Return the list of task records taken so far.
+        """
+        if self._profiler is None:
+            return([])
+        return(self._profiler.records)
+
+    def write_profile_report(
+        self,
+        outfile = None,
+        ):
+        """
+        Write the task records to a JSON report, or a CSV table if
+        outfile ends in .csv.
+        """
+        if self._profiler is None:
+            logger.warning("Profiling is not on. No report written.")
+            return(None)
+        if outfile is None:
+            outfile = 'task_profile_'+time.strftime('%Y%m%d_%H%M%S')+'.json'
+        self._profiler.write_report(outfile)
+        return(outfile)
+
+    def log_profile_summary(
+        self,
+        n_slowest = 10,
+        ):
+        """
+        Log the tasks that took the most time.
+        """
+        if self._profiler is None:
+            logger.warning("Profiling is not on.")
+            return(None)
+        self._profiler.log_summary(n_slowest=n_slowest)
+        return(None)
+
+#endregion
+
+#region Memory estimates
+
+    ##############################################################
+    # Predict the peak memory of tasks                           #
+    ##############################################################
+
+    def set_memory_calibration(
+        self,
+        calibration = None,
+        ):
+        """
+        Set how task memory is estimated (see utilsMemory). calibration
+        can be a file written by MemoryEstimator.save, a JSON profile
+        report (see write_profile_report), or None for the defaults.
+        """
+        if calibration is None:
+            self._memory_estimator = utilsMemory.MemoryEstimator()
+        else:
+            self._memory_estimator = utilsMemory.MemoryEstimator.load(calibration)
+        return(None)
+
+    def calibrate_memory(
+        self,
+        outfile = None,
+        ):
+        """
+        Tune the memory estimates with the task profile records taken
+        so far (see set_profiling) and optionally save the calibration
+        for later runs.
+        """
+        calibrated = self._memory_estimator.calibrate(self.get_profile_records())
+        if outfile is not None:
+            self._memory_estimator.save(outfile)
+        return(calibrated)
+
+    def estimate_task_memory(
+        self,
+        task = None,
+        input_files = [],
+        ):
+        """
+        Estimated peak memory in bytes of a task_* or recipe_* method
+        run on input_files, from the size of the largest input image.
+        """
+        return(self._memory_estimator.estimate(task, input_files))
+
+#endregion
+
+#region Planning
+
+    ##############################################################
+    # Estimate the cost of a run before launching it             #
+    ##############################################################
+
+    def plan_loop(
+        self,
+        loop = None,
+        stages = None,
+        n_workers = 1,
+        cost_model = None,
+        outfile = None,
+        **loop_kwargs
+        ):
+        """
+        Estimate the time, I/O and memory of a run of a loop method
+        (e.g., 'loop_postprocess') on n_workers without running it,
+        and return the plan (utilsPlanner.RunPlan). The loop is walked
+        in dry-run mode, so the tasks read at most image headers.
+
+        stages is a list of keyword dictionaries for the loop, run one
+        after the other as by enqueue_loop; without stages the loop
+        runs once with loop_kwargs. cost_model is a
+        utilsPlanner.CostModel or the name of a file to load one from
+        (e.g. a profile report). With outfile the plan is also written
+        to a JSON file.
+        """
+        if stages is None:
+            stages = [loop_kwargs]
+        if cost_model is None:
+            cost_model = utilsPlanner.CostModel()
+        elif not isinstance(cost_model, utilsPlanner.CostModel):
+            cost_model = utilsPlanner.CostModel.load(cost_model)
+
+        tasks = []
+        known_sizes = {}
+        saved = (self._dry_run, self._profiler)
+        try:
+            self._dry_run = True
+            for ii, this_stage in enumerate(stages):
+                self._profiler = utilsProfile.TaskProfiler()
+                this_kwargs = {'make_directories': False}
+                this_kwargs.update(this_stage)
+                getattr(self, loop)(**this_kwargs)
+                stage_name = ','.join(sorted([k[3:] for k, v in this_stage.items()
+                                              if k.startswith('do_') and v is True]))
+                tasks += utilsPlanner.plan_tasks(
+                    self._profiler.records, stage=ii, stage_name=stage_name,
+                    cost_model=cost_model, memory_estimator=self._memory_estimator,
+                    known_sizes=known_sizes)
+        finally:
+            (self._dry_run, self._profiler) = saved
+
+        plan = utilsPlanner.RunPlan(tasks, n_workers=n_workers)
+        if outfile is not None:
+            plan.write(outfile)
+        return(plan)
+
+#endregion
+
+#region Distributed execution
+
+    ##############################################################
+    # Run loops through a work queue on a shared file system     #
+    ##############################################################
+
+    def run_work_item(
+        self,
+        loop = None,
+        loop_kwargs = {},
+        target = None,
+        product = None,
+        config = None,
+        ):
+        """
+        Run one loop method (e.g., 'loop_derive_products') restricted
+        to a single target, product and config. The lists are restored
+        afterwards. This is what the work queue items call.
+        """
+        saved = (self._targets_list, self._line_products_list,
+                 self._cont_products_list, self._interf_configs_list,
+                 self._feather_configs_list)
+
+        def _restrict(this_list, value):
+            if value is None or this_list is None:
+                return(this_list)
+            return([x for x in this_list if x == value])
+
+        try:
+            self._targets_list = _restrict(self._targets_list, target)
+            self._line_products_list = _restrict(self._line_products_list, product)
+            self._cont_products_list = _restrict(self._cont_products_list, product)
+            self._interf_configs_list = _restrict(self._interf_configs_list, config)
+            self._feather_configs_list = _restrict(self._feather_configs_list, config)
+            getattr(self, loop)(**loop_kwargs)
+        finally:
+            (self._targets_list, self._line_products_list,
+             self._cont_products_list, self._interf_configs_list,
+             self._feather_configs_list) = saved
+        return(None)
+
+    def enqueue_loop(
+        self,
+        queue_dir = None,
+        loop = None,
+        stages = [],
+        do_targets = True,
+        do_products = True,
+        do_configs = True,
+        **queue_kwargs
+        ):
+        """
+        Coordinator side of distributed execution. Add one work item
+        per stage and selected (target, product, config) combination
+        to the queue in queue_dir and return the queue
+        (utilsWorkQueue.WorkQueue).
+
+        stages is a list of keyword dictionaries for the loop
+        method. Items of a stage are only started once every item of
+        the previous stages has finished, so put steps that combine
+        several combinations (e.g., broad masks over linked configs)
+        in a later stage than the steps making their inputs.
+
+        Workers on any node then run the items with run_queue_worker.
+        """
+        queue = utilsWorkQueue.WorkQueue(queue_dir, **queue_kwargs)
+
+        combos = []
+        for this_combo in self.looper(do_targets=do_targets, do_products=do_products,
+                                      do_configs=do_configs):
+            if not isinstance(this_combo, tuple):
+                this_combo = (this_combo,)
+            combos.append(this_combo)
+
+        names = [name for name, flag in [('target', do_targets), ('product', do_products),
+                                         ('config', do_configs)] if flag]
+        n_added = 0
+        for ii, this_stage in enumerate(stages):
+            for this_combo in combos:
+                kwargs = {'loop': loop, 'loop_kwargs': dict(this_stage)}
+                kwargs.update(dict(zip(names, this_combo)))
+                this_id = utilsWorkQueue.item_id('s%02d' % ii, *this_combo)
+                if queue.add(this_id, 'run_work_item', kwargs=kwargs, stage=ii):
+                    n_added += 1
+
+        logger.info("Added "+str(n_added)+" work items to "+str(queue))
+        return(queue)
+
+    def run_queue_worker(
+        self,
+        queue_dir = None,
+        n_workers = 1,
+        worker_id = None,
+        wait = True,
+        **queue_kwargs
+        ):
+        """
+        Worker side of distributed execution. Claim and run items
+        from the queue in queue_dir until it is finished. With
+        n_workers > 1, start that many worker processes on this node
+        (each with its own copy of the handler).
+        """
+        if n_workers > 1:
+            return(utilsWorkQueue.run_local_workers(
+                self, queue_dir, n_workers=n_workers, **queue_kwargs))
+        queue = utilsWorkQueue.WorkQueue(queue_dir, **queue_kwargs)
+        return(queue.run_worker(self, worker_id=worker_id, wait=wait))
+
+#endregion
@@ -49,6 +49,8 @@ else:
     sys.path.append(os.path.dirname(os.path.abspath(__file__)))
 
 import handlerTemplate
+import utilsProfile
+import utilsJournal
 
 try:
     import utilsFilenames as fnames
@@ -58,6 +60,8 @@ except ImportError:
 # Spectral lines
 import utilsLines as lines
 
+@utilsProfile.profile_tasks
+@utilsJournal.journal_tasks
 class VisHandler(handlerTemplate.HandlerTemplate):
     """
     Class to manipulate calibrated ALMA visibility data (measurement
@@ -78,6 +82,23 @@ class VisHandler(handlerTemplate.HandlerTemplate):
         # Can't use super and keep python2/3 agnostic
         handlerTemplate.HandlerTemplate.__init__(self,key_handler = key_handler, dry_run = dry_run)
 
+    def _journal_ms_outputs(
+            self,
+            ms_list = [],
+            ):
+        """
+        Announce measurement sets written by the running task to the
+        journal, together with the .flagversions and .touch
+        directories that casaVisRoutines makes next to them. Names
+        are relative to the current (imaging) directory.
+        """
+        outputs = []
+        for this_ms in ms_list:
+            for suffix in ['', '.flagversions', '.touch']:
+                outputs.append(this_ms+suffix)
+        self._journal_outputs(outputs)
+        return(None)
+
 
 #region Loops
 
@@ -403,6 +424,7 @@ class VisHandler(handlerTemplate.HandlerTemplate):
 
         this_imaging_dir = self._kh.get_imaging_dir_for_target(target, changeto=True)
 
+        self._journal_ms_outputs([outfile])
         if not self._dry_run and casa_enabled:
 
             cvr.split_science_targets(
@@ -547,6 +569,7 @@ class VisHandler(handlerTemplate.HandlerTemplate):
 
         # Concatenate the measurement sets
 
+        self._journal_ms_outputs([outfile])
         if not self._dry_run and casa_enabled:
 
             cvr.concat_ms(infile_list = staged_ms_list,
@@ -635,6 +658,7 @@ class VisHandler(handlerTemplate.HandlerTemplate):
 
         this_imaging_dir = self._kh.get_imaging_dir_for_target(target, changeto=True)
 
+        self._journal_outputs([infile+'.contsub', infile+'.contsub'+'.touch'])
         if not self._dry_run and casa_enabled:
 
             cvr.contsub(infile = infile,
@@ -816,6 +840,7 @@ class VisHandler(handlerTemplate.HandlerTemplate):
         logger.info("&%&%&%&%&%&%&%&%&%&%&%&%&%")
         logger.info("")
 
+        self._journal_ms_outputs([outfile])
         if not self._dry_run and casa_enabled:
 
             cvr.batch_extract_line(
@@ -932,6 +957,7 @@ class VisHandler(handlerTemplate.HandlerTemplate):
 
         this_imaging_dir = self._kh.get_imaging_dir_for_target(target, changeto=True)
 
+        self._journal_ms_outputs([outfile])
         if not self._dry_run and casa_enabled:
 
             cvr.batch_extract_continuum(
@@ -1,3 +1,4 @@
+import os
 import logging
 import sys
 
@@ -30,7 +31,13 @@ def setup_logger(level='INFO',logfile=None):
     root.addHandler(screen_handler)
 
     if logfile is not None:
-        print("Logging to file not implemented yet.")
+        logdir = os.path.dirname(os.path.abspath(logfile))
+        if not os.path.isdir(logdir):
+            os.makedirs(logdir)
+        file_handler = logging.FileHandler(logfile, mode='a')
+        file_handler.setLevel(level_value)
+        file_handler.setFormatter(logging.Formatter(file_log_format))
+        root.addHandler(file_handler)
 
     return()
     
@@ -1,10 +1,17 @@
-from spectral_cube import SpectralCube, LazyMask
+from spectral_cube import SpectralCube, LazyMask, Projection
 from radio_beam import Beam
 
 import astropy.units as u
 from astropy.io import fits
-from astropy.convolution import Box1DKernel
+from astropy.wcs.utils import proj_plane_pixel_area
+from astropy.convolution import Box1DKernel, Gaussian1DKernel
 from astropy.convolution import convolve, convolve_fft
+from scipy.signal import fftconvolve
+from scipy.ndimage import convolve1d
+
+import os
+import tempfile
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
 
 import logging
 logger = logging.getLogger(__name__)
@@ -12,13 +19,33 @@ logger.setLevel(logging.DEBUG)
 
 import numpy as np
 
+import scDerivativeRoutines as scdr
+
+def _cube_buffer(cube, dtype=None):
+    """
+    Array of cube values (NaN where masked) to write to disk. Cubes
+    from smooth_cube and smooth_cube_ladder wrap the convolution
+    buffers, which are already NaN outside their finite-value mask,
+    so these are returned as they are (no copy if dtype matches).
+    Other cubes go through filled_data.
+    """
+    mask = cube.mask
+    if (isinstance(mask, LazyMask) and mask._function is np.isfinite
+        and mask._data is cube._data):
+        return(np.asarray(cube._data, dtype=dtype))
+    return(np.asarray(cube.filled_data[:].value, dtype=dtype))
+
 def coverage_collapser(coveragecube,
                        coverage2dfile=None,
                        overwrite=False):
-    coverage2d = coveragecube.sum(axis=0)
-    coverage2darray = (np.array(coverage2d, dtype=np.float32)
-                       / coveragecube.shape[0])
-    hdr = coverage2d.header
+    coverage2darray = np.array(
+        np.nansum(_cube_buffer(coveragecube), axis=0, dtype=np.float64)
+        / coveragecube.shape[0], dtype=np.float32)
+    meta = dict(coveragecube.meta)
+    meta['collapse_axis'] = 0
+    hdr = Projection(coverage2darray, wcs=coveragecube.wcs.celestial,
+                     header=coveragecube._nowcs_header, meta=meta,
+                     beam=getattr(coveragecube, 'beam', None)).header
     hdr['DATAMIN'] = np.nanmin(coverage2darray)
     hdr['DATAMAX'] = np.nanmax(coverage2darray)
     hdu = fits.PrimaryHDU(coverage2darray, hdr)
@@ -39,7 +66,13 @@ def smooth_cube(
         coveragefile=None,
         coverage2dfile=None,
         dtype=np.float32,
-        overwrite=True
+        overwrite=True,
+        spectral_rebin=False,
+        channel_correlation=None,
+        n_workers=1,
+        backend='thread',
+        scratch_dir=None,
+        return_coverage=False,
     ):
     """
     Smooth an input cube to coarser angular or spectral
@@ -52,6 +85,24 @@ def smooth_cube(
     Optionally, also calculate a coverage footprint in which original
     (finite) cube coverage starts at 1.0 and the output cube shows the
     fraction of finite pixels.
+
+    By default velocity_resolution applies a boxcar smooth on the
+    native channels. If spectral_rebin is True, blocks of (the nearest
+    integer number of) channels are instead averaged onto a coarser
+    channel grid and the spectral WCS is updated, so the output has
+    fewer channels. In both cases the channel correlation of the
+    output is worked out from channel_correlation (or the CHCORRn
+    keywords of the input, or no correlation) and recorded in the
+    header (see scDerivativeRoutines.channel_correlation_to_header).
+
+    n_workers spreads blocks of channels of the angular convolution
+    over threads (backend='thread') or processes (backend='process',
+    which reads the input file through a memory map and writes into
+    memory-mapped buffers in scratch_dir).
+
+    Returns the smoothed cube, or (cube, coverage) if return_coverage
+    is True (coverage is None unless make_coverage_cube). Returns None
+    if the cube cannot be smoothed to the requested resolution.
     """
 
     # &%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%
@@ -59,10 +110,12 @@ def smooth_cube(
     # &%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%
 
     # Require a valid cube or map input
+    infile = None
     if type(incube) is SpectralCube:
         cube = incube
     elif type(incube) == type("hello"):
         cube = SpectralCube.read(incube)
+        infile = incube
     else:
         logger.error("Input must be a SpectralCube object or a filename.")
 
@@ -98,6 +151,8 @@ def smooth_cube(
     if tol is None:
         tol = 0.0
 
+    coverage = None
+
     # &%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%
     # Convolution to coarser beam
     # &%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%
@@ -115,8 +170,28 @@ def smooth_cube(
 
         logger.info("... fractional change: "+str(delta))
         
+        if delta > tol:
+            logger.info("... proceeding with convolution.")
+
+            # Data and coverage are convolved together (see
+            # _smooth_planes), so each kernel is only built once.
+            smoothed, coverage_array = _smooth_planes(
+                cube, target_beam, nan_treatment=nan_treatment,
+                make_coverage_cube=make_coverage_cube, dtype=dtype,
+                n_workers=n_workers, backend=backend, infile=infile,
+                scratch_dir=scratch_dir)
+            cube = SpectralCube(u.Quantity(smoothed, cube.unit, copy=False),
+                                wcs=cube.wcs, header=cube.header,
+                                beam=target_beam)
+            cube = cube.with_mask(LazyMask(np.isfinite,cube=cube))
+            cube.allow_huge_operations = True
+        else:
+            coverage_array = None
+            if make_coverage_cube:
+                coverage_array = np.isfinite(cube.unmasked_data[:])*1.0
+
         if make_coverage_cube:
-            coverage = SpectralCube(np.isfinite(cube.unmasked_data[:])*1.0,
+            coverage = SpectralCube(coverage_array,
                                     wcs=cube.wcs,
                                     header=cube.header,
                                     meta={'BUNIT': ' ', 'BTYPE': 'Coverage'})
@@ -127,14 +202,6 @@ def smooth_cube(
 
             coverage.allow_huge_operations = True
 
-        if delta > tol:
-            logger.info("... proceeding with convolution.")
-            cube = cube.convolve_to(target_beam,
-                                    nan_treatment=nan_treatment)
-            if make_coverage_cube:
-                coverage = coverage.convolve_to(target_beam,
-                                                nan_treatment=nan_treatment)
-
         if np.abs(delta) < tol:
             logger.info("... current resolution meets tolerance.")
 
@@ -146,40 +213,559 @@ def smooth_cube(
     # Spectral convolution
     # &%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%
 
-    # This is only a boxcar smooth right now and does not downsample
-    # or update the header.
+    # Either a boxcar smooth on the native channels or an average onto
+    # a coarser channel grid (spectral_rebin).
 
     if velocity_resolution is not None:
-        if type(velocity_resolution) is str:
-            velocity_resolution = u.Quantity(velocity_resolution)
-
-        dv = scdr.channel_width(cube)
-        nChan = (velocity_resolution / dv).to(u.dimensionless_unscaled).value
-        if nChan > 1:
-            cube = cube.spectral_smooth(Box1DKernel(nChan))
-            if make_coverage_cube:
-                coverage = coverage.spectral_smooth(Box1DKernel(nChan))
+        cube, coverage = _spectral_smooth(
+            cube, coverage=coverage, make_coverage_cube=make_coverage_cube,
+            velocity_resolution=velocity_resolution,
+            spectral_rebin=spectral_rebin,
+            channel_correlation=channel_correlation)
 
     # &%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%
     # Write or return as requested
     # &%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%
 
     if outfile is not None:
-        # cube.write(outfile, overwrite=overwrite)
-        hdu = fits.PrimaryHDU(np.array(cube.filled_data[:], dtype=dtype),
-                              header=cube.header)
-        hdu.writeto(outfile, overwrite=overwrite)
-        if make_coverage_cube:
-            if coveragefile is not None:
-                hdu = fits.PrimaryHDU(np.array(coverage.filled_data[:], dtype=dtype),
-                                      header=coverage.header)
-                hdu.writeto(coveragefile, overwrite=overwrite)
-            if collapse_coverage:
-                if coveragefile and not coverage2dfile:
-                    coverage2dfile = coveragefile.replace('.fits','2d.fits')
-                coverage_collapser(coverage,
-                                   coverage2dfile=coverage2dfile,
-                                   overwrite=overwrite)
-                # coverage.write(coveragefile, overwrite=overwrite)
+        write_smoothed(cube, outfile=outfile,
+                        coverage=(coverage if make_coverage_cube else None),
+                        coveragefile=coveragefile,
+                        collapse_coverage=collapse_coverage,
+                        coverage2dfile=coverage2dfile,
+                        dtype=dtype, overwrite=overwrite)
+
+    if return_coverage:
+        return(cube, (coverage if make_coverage_cube else None))
 
     return(cube)
+
+def _spectral_smooth(cube, coverage=None, make_coverage_cube=False,
+                     velocity_resolution=None, spectral_rebin=False,
+                     channel_correlation=None):
+    """
+    Spectral step of smooth_cube (and of each smooth_cube_ladder
+    rung): a boxcar smooth on the native channels, or an average onto
+    a coarser channel grid if spectral_rebin is True. The coverage
+    cube (built from the finite pixels of cube if missing and
+    make_coverage_cube is set) gets the same treatment. Returns
+    (cube, coverage).
+    """
+    if type(velocity_resolution) is str:
+        velocity_resolution = u.Quantity(velocity_resolution)
+
+    if channel_correlation is None:
+        channel_correlation = scdr.channel_correlation_from_header(
+            cube.header)
+
+    if make_coverage_cube and coverage is None:
+        coverage = SpectralCube(np.isfinite(cube.unmasked_data[:])*1.0,
+                                wcs=cube.wcs,
+                                header=cube.header,
+                                meta={'BUNIT': ' ', 'BTYPE': 'Coverage'})
+        coverage = coverage.with_mask(LazyMask(np.isfinite,cube=coverage))
+        coverage.allow_huge_operations = True
+
+    dv = scdr.channel_width(cube)
+    nChan = (velocity_resolution / dv).to(u.dimensionless_unscaled).value
+
+    if spectral_rebin and int(np.round(nChan)) > 1:
+        factor = int(np.round(nChan))
+        if np.abs(nChan - factor) > 1e-3:
+            logger.warning("... rebinning by "+str(factor)+" channels to "
+                           +str(factor*dv.to(velocity_resolution.unit))
+                           +" rather than "+str(velocity_resolution))
+        logger.info("... averaging blocks of "+str(factor)+" channels.")
+        cube = cube.downsample_axis(factor, axis=0, truncate=True)
+        if make_coverage_cube:
+            coverage = coverage.downsample_axis(factor, axis=0, truncate=True)
+        channel_correlation = scdr.filtered_channel_correlation(
+            channel_correlation, weights=np.ones(factor)/factor,
+            step=factor)
+        cube._header = scdr.channel_correlation_to_header(
+            cube._header.copy(), channel_correlation)
+    elif (not spectral_rebin) and nChan > 1:
+        kernel = Box1DKernel(nChan)
+        cube = cube.spectral_smooth(kernel)
+        if make_coverage_cube:
+            coverage = coverage.spectral_smooth(kernel)
+        channel_correlation = scdr.filtered_channel_correlation(
+            channel_correlation, weights=kernel.array, step=1)
+        cube._header = scdr.channel_correlation_to_header(
+            cube._header.copy(), channel_correlation)
+
+    return(cube, coverage)
+
+def write_smoothed(cube, outfile=None, coverage=None, coveragefile=None,
+                    collapse_coverage=False, coverage2dfile=None,
+                    dtype=np.float32, overwrite=True):
+    """
+    Write a smoothed cube and, if present, its coverage cube and
+    collapsed two-dimensional coverage. Cubes from smooth_cube and
+    smooth_cube_ladder are written straight from their convolution
+    buffers (see _cube_buffer).
+    """
+    # cube.write(outfile, overwrite=overwrite)
+    hdu = fits.PrimaryHDU(_cube_buffer(cube, dtype=dtype),
+                          header=cube.header)
+    hdu.writeto(outfile, overwrite=overwrite)
+    if coverage is not None:
+        if coveragefile is not None:
+            hdu = fits.PrimaryHDU(_cube_buffer(coverage, dtype=dtype),
+                                  header=coverage.header)
+            hdu.writeto(coveragefile, overwrite=overwrite)
+        if collapse_coverage:
+            if coveragefile and not coverage2dfile:
+                coverage2dfile = coveragefile.replace('.fits','2d.fits')
+            coverage_collapser(coverage,
+                               coverage2dfile=coverage2dfile,
+                               overwrite=overwrite)
+            # coverage.write(coveragefile, overwrite=overwrite)
+
+def _ladder_resolution(rung):
+    """
+    Angular resolution (arcsec Quantity) of one rung of a resolution
+    ladder.
+    """
+    if rung.get('angular_resolution', None) is not None:
+        return(u.Quantity(rung['angular_resolution']).to(u.arcsec))
+    linear_resolution = u.Quantity(rung['linear_resolution'])
+    distance = u.Quantity(rung['distance'])
+    return((linear_resolution / distance * u.rad).to(u.arcsec))
+
+def _downsample_factor(beam, pixscale, pixels_per_beam=5.0):
+    """
+    Largest integer factor by which a pixel grid can be decimated
+    while keeping pixels_per_beam pixels across the beam minor axis.
+    """
+    npix = (beam.minor / pixscale).to(u.dimensionless_unscaled).value
+    return(int(max(np.floor(npix / pixels_per_beam), 1)))
+
+# Round residual kernels up to this many pixels across are applied as
+# two one-dimensional passes. Larger ones are cheaper with FFTs.
+_separable_max_size = 35
+
+def _residual_kernel(target_beam, current_beam, pixscale):
+    """
+    Normalized kernel taking current_beam to target_beam. Small round
+    kernels are returned as the one-dimensional profile to apply along
+    both image axes (the two-dimensional kernel is its outer product),
+    others as a two-dimensional array.
+    """
+    residual = target_beam.deconvolve(current_beam)
+    kernel = np.array(residual.as_kernel(pixscale).array, dtype=np.float32)
+    kernel /= np.sum(kernel)
+    major = float((residual.major / pixscale).to(u.dimensionless_unscaled))
+    minor = float((residual.minor / pixscale).to(u.dimensionless_unscaled))
+    if (np.abs(major - minor) <= 1e-6 * major
+        and kernel.shape[0] == kernel.shape[1]
+        and kernel.shape[0] <= _separable_max_size):
+        profile = kernel[kernel.shape[0] // 2]
+        return(profile / np.sum(profile))
+    return(kernel)
+
+def _convolve_planes(array, kernel):
+    """
+    Convolve each plane of a cube (or a single image) with a kernel
+    from _residual_kernel, treating everything beyond the array as
+    zero. Round kernels are applied as two one-dimensional passes over
+    all planes at once, others with real FFTs of a fast size.
+    """
+    axes = (array.ndim - 2, array.ndim - 1)
+    if kernel.ndim == 1:
+        output = convolve1d(array, kernel, axis=axes[0],
+                            mode='constant', cval=0.0)
+        return(convolve1d(output, kernel, axis=axes[1],
+                          mode='constant', cval=0.0))
+    if array.ndim == 2:
+        return(fftconvolve(array, kernel, mode='same'))
+    return(fftconvolve(array, kernel[np.newaxis], mode='same', axes=axes))
+
+# Number of channels convolved together by _smooth_planes
+_plane_block = 16
+
+def _smooth_block(data, kernel, outside=None, make_coverage_cube=False,
+                  beam_ratio_factor=1.):
+    """
+    Convolve one block of channels and (optionally) its finite-pixel
+    weights with a shared kernel. outside is one minus the smoothed
+    image footprint for nan_treatment='interpolate', None for 'fill'.
+    Returns (data, coverage), coverage None if not requested.
+    """
+    data = np.array(data, dtype=np.float32)
+    finite = np.isfinite(data)
+    data[~finite] = 0.0
+    nplane = data.shape[0]
+
+    if outside is not None or make_coverage_cube:
+        stack = _convolve_planes(
+            np.concatenate([data, finite.astype(np.float32)]), kernel)
+        numer, weight = stack[:nplane], stack[nplane:]
+    else:
+        numer, weight = _convolve_planes(data, kernel), None
+
+    if outside is not None:
+        with np.errstate(invalid='ignore', divide='ignore'):
+            numer /= (weight + outside[np.newaxis])
+    numer *= beam_ratio_factor
+    numer[~finite] = np.nan
+
+    if not make_coverage_cube:
+        weight = None
+    return(numer, weight)
+
+def _smooth_block_from_file(infile, block, shape, kernel, outside,
+                            make_coverage_cube, beam_ratio_factor,
+                            outpath, coveragepath, dtype):
+    """
+    Process-pool worker: read one block of channels from a
+    memory-mapped FITS file and write the result into memory-mapped
+    output buffers.
+    """
+    with fits.open(infile, memmap=True) as hdulist:
+        data = np.array(hdulist[0].data[block], dtype=np.float32)
+    data = data.reshape((-1,) + tuple(shape[1:]))
+    numer, weight = _smooth_block(data, kernel, outside=outside,
+                                  make_coverage_cube=make_coverage_cube,
+                                  beam_ratio_factor=beam_ratio_factor)
+    output = np.memmap(outpath, dtype=dtype, mode='r+', shape=shape)
+    output[block] = numer
+    output.flush()
+    if coveragepath is not None:
+        coverage = np.memmap(coveragepath, dtype=dtype, mode='r+', shape=shape)
+        coverage[block] = weight
+        coverage.flush()
+    return(block)
+
+def _smooth_planes(cube, target_beam, nan_treatment='interpolate',
+                   make_coverage_cube=False, dtype=np.float32,
+                   n_workers=1, backend='thread', infile=None,
+                   scratch_dir=None):
+    """
+    Convolve a cube to target_beam and, if requested, build the
+    convolved coverage cube in the same pass.
+
+    The NaN-interpolation weights are the finite-pixel map, which is
+    also what the coverage cube convolves. So each block of channels
+    is stacked with its weights and the two are convolved together
+    with one kernel. Matches convolve_to, which treats the region
+    beyond the image as valid zeros: the interpolated data are the
+    smoothed data divided by the smoothed weights plus one minus the
+    smoothed image footprint.
+
+    Blocks of channels can be spread over n_workers. With the
+    'thread' backend the workers share the cube and write into the
+    output arrays. With the 'process' backend each worker reads its
+    block from the memory-mapped FITS file infile and writes into
+    memory-mapped output buffers in scratch_dir (default: the system
+    temporary directory). The process backend needs a file on disk,
+    so it falls back to threads if infile is None.
+
+    Returns (data, coverage) arrays of the given dtype. coverage is
+    None unless make_coverage_cube is True.
+    """
+    pixscale = proj_plane_pixel_area(cube.wcs.celestial)**0.5*u.deg
+    kernel = _residual_kernel(target_beam, cube.beam, pixscale)
+
+    # Scale Jy/beam units by the change in beam size
+    if cube.unit.is_equivalent(u.Jy / u.beam):
+        beam_ratio_factor = (target_beam.sr / cube.beam.sr).value
+    else:
+        beam_ratio_factor = 1.
+
+    outside = None
+    if nan_treatment == 'interpolate':
+        outside = 1.0 - _convolve_planes(np.ones(cube.shape[1:]), kernel)
+
+    nchan = cube.shape[0]
+    blocks = [slice(start, min(start + _plane_block, nchan))
+              for start in range(0, nchan, _plane_block)]
+
+    if backend == 'process' and n_workers > 1 and infile is None:
+        logger.warning("Process backend needs the cube on disk. Using threads.")
+        backend = 'thread'
+
+    # &%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%
+    # Processes reading from and writing to memory maps
+    # &%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%
+
+    if backend == 'process' and n_workers > 1:
+        scratch = tempfile.mkdtemp(dir=scratch_dir)
+        outpath = os.path.join(scratch, 'data.dat')
+        output = np.memmap(outpath, dtype=dtype, mode='w+', shape=cube.shape)
+        coveragepath = None
+        coverage = None
+        if make_coverage_cube:
+            coveragepath = os.path.join(scratch, 'coverage.dat')
+            coverage = np.memmap(coveragepath, dtype=dtype, mode='w+',
+                                 shape=cube.shape)
+        with ProcessPoolExecutor(max_workers=n_workers) as pool:
+            futures = [pool.submit(_smooth_block_from_file, infile, block,
+                                   cube.shape, kernel, outside,
+                                   make_coverage_cube, beam_ratio_factor,
+                                   outpath, coveragepath, dtype)
+                       for block in blocks]
+            for future in futures:
+                future.result()
+
+        # The buffers stay valid after their files are unlinked
+        os.remove(outpath)
+        if coveragepath is not None:
+            os.remove(coveragepath)
+        os.rmdir(scratch)
+        return(output, coverage)
+
+    # &%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%
+    # Serial or threads writing into shared arrays
+    # &%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%
+
+    output = np.empty(cube.shape, dtype=dtype)
+    coverage = None
+    if make_coverage_cube:
+        coverage = np.empty(cube.shape, dtype=dtype)
+
+    def _run(block):
+        numer, weight = _smooth_block(
+            cube.filled_data[block].value, kernel, outside=outside,
+            make_coverage_cube=make_coverage_cube,
+            beam_ratio_factor=beam_ratio_factor)
+        output[block] = numer
+        if make_coverage_cube:
+            coverage[block] = weight
+        return(block)
+
+    if n_workers > 1:
+        with ThreadPoolExecutor(max_workers=n_workers) as pool:
+            list(pool.map(_run, blocks))
+    else:
+        for block in blocks:
+            _run(block)
+
+    return(output, coverage)
+
+def smooth_cube_ladder(
+        incube=None,
+        rungs=None,
+        nan_treatment='interpolate', # can also be 'fill'
+        tol=None,
+        make_coverage_cube=False,
+        collapse_coverage=False,
+        dtype=np.float32,
+        overwrite=True,
+        downsample=False,
+        pixels_per_beam=5.0,
+        check_accuracy=False,
+        velocity_resolution=None,
+        spectral_rebin=False,
+        channel_correlation=None,
+    ):
+    """
+    Smooth an input cube to a series of coarser angular resolutions,
+    each rung starting from the previous one rather than the input.
+
+    Gaussian beams add in quadrature, so going 60 pc -> 90 pc -> 120
+    pc one step at a time only needs the (small) residual kernel at
+    each step. Rungs can mix angular and physical resolutions; they
+    are sorted by angular resolution (physical ones converted with
+    their distance).
+
+    To reproduce convolve_to with nan_treatment='interpolate', the
+    ladder carries the unnormalized convolutions of the NaN-filled
+    data, of the finite-pixel weights (the coverage cube), and of the
+    image footprint on a padded grid. Each rung convolves these with
+    the residual kernel and normalizes, which matches convolving the
+    input directly. Small round kernels are applied as two
+    one-dimensional passes.
+
+    rungs is a list of dictionaries, each with either
+    angular_resolution or linear_resolution and distance, plus the
+    optional outfile, coveragefile, and coverage2dfile to write.
+
+    tol is a fraction. When a rung is within tol of the current beam,
+    the current cube is written as is.
+
+    velocity_resolution, spectral_rebin, and channel_correlation are
+    as for smooth_cube. The spectral smoothing is applied to each rung
+    (and its coverage) as it is written, after the angular
+    convolution, so each output matches smooth_cube. The ladder
+    itself carries the native channels.
+
+    If downsample is True, the working grid is decimated by an integer
+    factor after each rung whenever pixels_per_beam pixels still cover
+    the beam minor axis. Later rungs are then written on the coarser
+    grid, which will not match products on the native grid, and are
+    no longer exact at the image edges.
+
+    If check_accuracy is True, the last rung is also convolved directly
+    from the input cube and the maximum difference, relative to the
+    peak of the direct result, is logged.
+
+    Returns a list of (rung, angular resolution, written) tuples in
+    ladder order and, if check_accuracy is set, the accuracy metric.
+    """
+
+    if type(incube) is SpectralCube:
+        cube = incube
+    elif type(incube) == type("hello"):
+        cube = SpectralCube.read(incube)
+    else:
+        logger.error("Input must be a SpectralCube object or a filename.")
+        return(None)
+
+    cube.allow_huge_operations = True
+
+    if tol is None:
+        tol = 0.0
+
+    ladder = sorted(rungs, key=lambda rung: _ladder_resolution(rung).value)
+
+    # Work out which rungs need a convolution and how far their
+    # kernels reach. Signal spread beyond the image by one rung can
+    # only come back within the reach of the later kernels, so the
+    # padding is the reach of all but the first kernel.
+    pixscale = proj_plane_pixel_area(cube.wcs.celestial)**0.5*u.deg
+    beams = []
+    current_beam = cube.beam
+    reach = []
+    for rung in ladder:
+        this_res = _ladder_resolution(rung)
+        new_major = float(this_res.value)
+        old_major = float(current_beam.major.to(u.arcsec).value)
+        delta = (new_major-old_major)/old_major
+        if delta > tol:
+            target_beam = Beam(major=this_res, minor=this_res, pa=0 * u.deg)
+            kernel = _residual_kernel(target_beam, current_beam, pixscale)
+            reach.append(max(kernel.shape) // 2 + 1)
+            current_beam = target_beam
+            beams.append((delta, target_beam))
+        else:
+            beams.append((delta, None))
+    pad = int(np.sum(reach[1:]))
+
+    # Unnormalized data, weights, and image footprint carried up the
+    # ladder on a padded grid. convolve_to treats the region beyond
+    # the image as valid zeros, so the normalization is the smoothed
+    # weights plus one minus the smoothed footprint.
+    data = np.array(cube.unmasked_data[:].value, dtype=np.float32)
+    finite = np.isfinite(data)
+    data[~finite] = 0.0
+    padding = ((0, 0), (pad, pad), (pad, pad))
+    numer = np.pad(data, padding)
+    weight = np.pad(finite.astype(np.float32), padding)
+    inside = np.pad(np.ones(cube.shape[1:]), padding[1:])
+    del data
+
+    wcs = cube.wcs
+    header = cube.header.copy()
+    current_beam = cube.beam
+    results = []
+    current = None
+    for rung, (delta, target_beam) in zip(ladder, beams):
+        this_res = _ladder_resolution(rung)
+        logger.info("... ladder rung: "+str(this_res))
+        logger.info("... fractional change from previous rung: "+str(delta))
+
+        if delta < -1.0*tol:
+            logger.info("... resolution cannot be matched. Skipping.")
+            results.append((rung, this_res, False))
+            continue
+
+        if target_beam is not None:
+            kernel = _residual_kernel(target_beam, current_beam, pixscale)
+
+            # Scale Jy/beam units by the change in beam size
+            if cube.unit.is_equivalent(u.Jy / u.beam):
+                numer *= (target_beam.sr / current_beam.sr).value
+
+            numer = _convolve_planes(numer, kernel)
+            weight = _convolve_planes(weight, kernel)
+            inside = _convolve_planes(inside, kernel)
+            current_beam = target_beam
+        else:
+            logger.info("... current resolution meets tolerance.")
+
+        inner = (slice(None), slice(pad, numer.shape[1]-pad),
+                 slice(pad, numer.shape[2]-pad))
+        if nan_treatment == 'interpolate':
+            with np.errstate(invalid='ignore', divide='ignore'):
+                smoothed = numer[inner] / (weight[inner] + 1.0
+                                           - inside[inner[1:]][np.newaxis])
+        else:
+            smoothed = numer[inner].copy()
+        smoothed[~finite] = np.nan
+
+        # Only physical rungs record the distance used
+        this_header = header.copy()
+        if rung.get('linear_resolution', None) is not None:
+            dist_mpc_val = float(u.Quantity(rung['distance']).to(u.pc).value) / 1e6
+            this_header['DIST_MPC'] = (dist_mpc_val, 'Used in convolution')
+
+        current = SpectralCube(smoothed, wcs=wcs, header=this_header,
+                               beam=current_beam)
+        current._unit = cube.unit
+        current = current.with_mask(LazyMask(np.isfinite, cube=current))
+        current.allow_huge_operations = True
+
+        outfile = rung.get('outfile', None)
+        if outfile is not None:
+            coverage = None
+            if make_coverage_cube:
+                coverage = SpectralCube(weight[inner], wcs=wcs,
+                                        header=this_header,
+                                        meta={'BUNIT': ' ', 'BTYPE': 'Coverage'})
+                coverage = coverage.with_beam(current_beam)
+                coverage = coverage.with_mask(LazyMask(np.isfinite,
+                                                       cube=coverage))
+            output = current
+            if velocity_resolution is not None:
+                output, coverage = _spectral_smooth(
+                    current, coverage=coverage,
+                    make_coverage_cube=make_coverage_cube,
+                    velocity_resolution=velocity_resolution,
+                    spectral_rebin=spectral_rebin,
+                    channel_correlation=channel_correlation)
+            write_smoothed(output, outfile=outfile,
+                            coverage=coverage,
+                            coveragefile=rung.get('coveragefile', None),
+                            collapse_coverage=collapse_coverage,
+                            coverage2dfile=rung.get('coverage2dfile', None),
+                            dtype=dtype, overwrite=overwrite)
+        results.append((rung, this_res, outfile is not None))
+
+        # Decimate the working grid (dropping the padding) if the beam
+        # is oversampled.
+        if downsample and target_beam is not None:
+            factor = _downsample_factor(current_beam, pixscale,
+                                        pixels_per_beam=pixels_per_beam)
+            if factor > 1:
+                logger.info("... downsampling the working grid by "
+                            +str(factor))
+                decimate = (slice(None), slice(None, None, factor),
+                            slice(None, None, factor))
+                numer = numer[inner][decimate]
+                weight = weight[inner][decimate]
+                inside = inside[inner[1:]][decimate[1:]]
+                finite = finite[decimate]
+                current = current[decimate]
+                wcs = current.wcs
+                header = current.header
+                pixscale = pixscale * factor
+                pad = 0
+
+    if not check_accuracy:
+        return(results)
+
+    # Compare the last rung with a direct convolution of the input.
+    accuracy = None
+    if current is not None and not downsample:
+        direct = cube.convolve_to(current.beam, nan_treatment=nan_treatment)
+        direct_data = np.array(direct.filled_data[:].value)
+        ladder_data = np.array(current.filled_data[:].value)
+        both = np.isfinite(direct_data) & np.isfinite(ladder_data)
+        if np.any(both):
+            accuracy = (np.max(np.abs(direct_data[both] - ladder_data[both]))
+                        / np.max(np.abs(direct_data[both])))
+            logger.info("... ladder vs. direct convolution at "
+                        +str(current.beam.major.to(u.arcsec))
+                        +": max relative difference "+str(accuracy))
+    return(results, accuracy)
@@ -2,8 +2,16 @@ from spectral_cube import SpectralCube, Projection
 import astropy.units as u
 import numpy as np
 from astropy.io import fits
+from astropy.wcs import WCSCOMPARE_ANCILLARY
+from astropy.wcs.utils import pixel_to_pixel
+from scipy.ndimage import map_coordinates
+from astropy.convolution import Box1DKernel
+from collections import OrderedDict
 import inspect
+import re
+from astropy.table import Table
 from pipelineVersion import version, tableversion
+from scRayList import RayList, raylist_from_spectra
 
 import logging
 logger = logging.getLogger(__name__)
@@ -21,12 +29,13 @@ def writer(projection, filename, overwrite=True, dtype=np.float32):
     hdu.writeto(filename, overwrite=overwrite)
 
     
-def update_metadata(projection, cube, error=False):
+def update_metadata(projection, cube, error=False, calling_name=None):
 
     keys = ['BMAJ', 'BMIN', 'BPA', 'JYTOK', 'VELREF',
             'TELESCOP', 'INSTRUME', 'ORIGIN', 'OBJECT',
             'TIMESYS','MJDREFI','MJDREFF','DATEREF']
-    calling_name = inspect.getouterframes(inspect.currentframe())[1][3]
+    if calling_name is None:
+        calling_name = inspect.getouterframes(inspect.currentframe())[1][3]
     btype_dict = {'write_moment0':'Moment0',
                   'write_moment1':'Moment1',
                   'write_moment2':'Moment2',
@@ -99,6 +108,45 @@ def update_metadata(projection, cube, error=False):
     projection._header = hdr
     return(projection)
 
+# Approximate number of full-size float64 temporaries that a moment
+# writer holds at once (data, mask, noise, squared terms, ...). Used
+# to turn a memory budget into a tile size.
+_tile_temporaries = 12
+
+def chunk_shape_for_memory(shape, max_memory=None,
+                           ntemp=_tile_temporaries):
+    """
+    Return a (ny, nx) spatial tile shape such that processing one tile
+    with the full spectral axis stays within max_memory.
+
+    shape : tuple
+        Shape (nchan, ny, nx) of the cube.
+
+    max_memory : float or str
+        Memory budget in bytes, or a string understood by
+        astropy.units (e.g., '2 GB').
+    """
+    nchan, ny, nx = shape
+    if type(max_memory) is str:
+        max_memory = u.Quantity(max_memory).to(u.byte).value
+    bytes_per_pixel = float(nchan) * 8.0 * ntemp
+    npix = int(max(max_memory // bytes_per_pixel, 1))
+    side = int(max(np.floor(np.sqrt(npix)), 1))
+    tile_y = min(side, ny)
+    tile_x = int(min(max(npix // tile_y, 1), nx))
+    return((tile_y, tile_x))
+
+def _iter_tiles(shape, chunk_shape):
+    """
+    Yield (y-slice, x-slice) pairs covering the image plane.
+    """
+    ny, nx = shape[1:]
+    tile_y, tile_x = chunk_shape
+    for y0 in range(0, ny, tile_y):
+        for x0 in range(0, nx, tile_x):
+            yield (slice(y0, min(y0 + tile_y, ny)),
+                   slice(x0, min(x0 + tile_x, nx)))
+
 def channel_width(cube):
     dv = np.median(np.abs(cube.spectral_axis[1:] 
                           - cube.spectral_axis[0:-1]))
@@ -147,12 +195,167 @@ def build_covariance(spectrum=None,
                                                               < maxdist]]
     return(covar)    
 
+def filtered_channel_correlation(channel_correlation=None,
+                                 weights=None, step=1):
+    """
+    Channel correlation after filtering a spectrum with weights and
+    keeping every step-th channel (e.g., a boxcar smooth has step 1,
+    averaging blocks of n channels has weights 1/n and step n).
+    
+    Keywords:
+    ---------
+    
+    channel_correlation : np.array
+        One-dimensional array containing the channel-to-channel 
+        normalize correlation coefficients of the input. None means
+        uncorrelated.
+    
+    weights : np.array
+        Filter weights along the spectral axis.
+
+    step : int
+        Decimation factor applied after filtering.
+    """
+    if channel_correlation is None:
+        channel_correlation = np.array([1.0])
+    channel_correlation = np.asarray(channel_correlation, dtype=np.float64)
+    weights = np.asarray(weights, dtype=np.float64)
+
+    # Covariance of the filtered spectrum at each input lag: the
+    # autocorrelation of the weights convolved with the input
+    # correlation (both symmetric in the lag).
+    wcorr = np.correlate(weights, weights, mode='full')
+    rho = np.concatenate([channel_correlation[:0:-1], channel_correlation])
+    covar = np.convolve(wcorr, rho)
+    covar = covar[len(covar) // 2:]
+
+    output = covar[::step] / covar[0]
+    output = output[np.abs(output) > 1e-6 * np.abs(output[0])]
+    return(output)
+
+def channel_correlation_to_header(header, channel_correlation=None):
+    """
+    Record a channel correlation vector in a FITS header as CHCORRn
+    keywords (lag n, lag 0 is always 1). Old keywords are removed.
+    """
+    for key in list(header.keys()):
+        if re.match(r'^CHCORR[0-9]+$', key):
+            del header[key]
+    if channel_correlation is None:
+        return(header)
+    for lag in range(1, len(channel_correlation)):
+        header['CHCORR'+str(lag)] = (float(channel_correlation[lag]),
+                                     'Channel correlation at lag '+str(lag))
+    return(header)
+
+def channel_correlation_from_header(header):
+    """
+    Read a channel correlation vector written by
+    channel_correlation_to_header. Returns None if not present.
+    """
+    if 'CHCORR1' not in header:
+        return(None)
+    channel_correlation = [1.0]
+    lag = 1
+    while 'CHCORR'+str(lag) in header:
+        channel_correlation.append(float(header['CHCORR'+str(lag)]))
+        lag += 1
+    return(np.array(channel_correlation))
+
 def calculate_channel_correlation(cube, length=1):
     """
     TBD - calculate the channel correlation.
     """
     raise NotImplementedError
 
+def write_raylist_moment(
+        raylist, moment=None, channel_correlation=None,
+        outfile=None, errorfile=None,
+        overwrite=True, unit=None,
+        include_limits=False,
+        line_width=10 * u.km / u.s,
+        return_products=True,
+        calling_name=None):
+    """
+    Write a moment map and its error from a RayList (see scRayList)
+    using segmented reductions over the masked voxels. The write_XXX
+    routines below hand off to this when passed a RayList instead of
+    a SpectralCube. The noise, if any, travels inside the RayList.
+
+    Keywords:
+    ---------
+
+    raylist : RayList
+        Masked voxels of the cube, optionally with noise attached.
+
+    moment : str
+        One of 'mom0', 'mom1', 'mom2', 'ew', 'vmax'.
+
+    include_limits : bool
+        Only used for mom0. Lines of sight with data but no masked
+        voxels get a value of 0 and an error of 1sigma over line_width.
+
+    Other keywords as for the write_XXX routines.
+    """
+
+    products = raylist.moments(channel_correlation=channel_correlation)
+    spunit = raylist.spectral_axis.unit
+    dv = raylist.channel_width()
+
+    if moment == 'mom0':
+        map_unit = raylist.unit * spunit
+    elif moment in ['mom1', 'mom2', 'ew', 'vmax']:
+        map_unit = spunit
+    else:
+        logger.error("Moment not supported for a RayList: "+str(moment))
+        raise NotImplementedError
+
+    image = raylist.to_map(products[moment])
+
+    error_image = None
+    if errorfile is not None and raylist.noise is None:
+        logger.error("Error map requested but no noise attached to the RayList")
+    if raylist.noise is not None:
+        error_image = raylist.to_map(products[moment+'err'])
+
+    if moment == 'mom0' and include_limits:
+        observed = raylist.observed
+        limits = np.logical_and(np.isnan(image), observed)
+        image[limits] = 0.0
+        if error_image is not None and raylist.noise_median is not None:
+            error_image[limits] = (
+                raylist.noise_median[limits]
+                * (np.abs(line_width / dv).to(
+                    u.dimensionless_unscaled).value)**0.5
+                * dv.value)
+
+    if calling_name is None:
+        calling_name = inspect.getouterframes(inspect.currentframe())[1][3]
+
+    map_proj = raylist.to_projection(image, unit=map_unit)
+    if unit is not None:
+        map_proj = map_proj.to(unit)
+
+    error_proj = None
+    if error_image is not None:
+        error_proj = raylist.to_projection(error_image, unit=map_unit)
+        if unit is not None:
+            error_proj = error_proj.to(unit)
+        if errorfile is not None:
+            error_proj = update_metadata(error_proj, raylist, error=True,
+                                         calling_name=calling_name)
+            writer(error_proj, errorfile, overwrite=overwrite)
+
+    if outfile is not None:
+        map_proj = update_metadata(map_proj, raylist,
+                                   calling_name=calling_name)
+        writer(map_proj, outfile, overwrite=overwrite)
+
+    if return_products and error_proj is not None:
+        return(map_proj, error_proj)
+    elif return_products and error_proj is None:
+        return(map_proj)
+
 # &%&%&&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%
 # Moment 0
 # &%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%
@@ -207,6 +410,13 @@ def write_moment0(
 
     """
     
+    if isinstance(cube, RayList):
+        return(write_raylist_moment(
+            cube, moment='mom0', channel_correlation=channel_correlation,
+            outfile=outfile, errorfile=errorfile, overwrite=overwrite,
+            unit=unit, include_limits=include_limits, line_width=line_width,
+            return_products=return_products))
+
     # Spectral cube collapse routine. Applies the masked, automatically
     mom0 = cube.moment0()
     valid = np.isfinite(mom0)
@@ -338,6 +548,12 @@ def write_moment1(
         Return products calculated in the map
     """
 
+    if isinstance(cube, RayList):
+        return(write_raylist_moment(
+            cube, moment='mom1', channel_correlation=channel_correlation,
+            outfile=outfile, errorfile=errorfile, overwrite=overwrite,
+            unit=unit, return_products=return_products))
+
     mom1 = cube.moment1()
     mom1err_proj = None
     spaxis = cube.spectral_axis.value
@@ -407,10 +623,92 @@ def write_moment1(
         return(mom1)
 
 
+# Pixel mappings used to reproject maps onto a template grid, keyed
+# by (source WCS, source shape, target WCS, target shape). Secondary
+# moments at every resolution of a target share a grid, so the same
+# mapping gets reused across calls.
+_reprojection_cache = OrderedDict()
+_reprojection_cache_size = 32
+
+def _grid_key(wcs, shape):
+    return((wcs.celestial.to_header_string(relax=True), tuple(shape)))
+
+def same_grid(proj, template):
+    """
+    Test whether two projections share shape and celestial WCS, in
+    which case no reprojection is needed.
+    """
+    if proj.shape != template.shape:
+        return(False)
+    return(proj.wcs.celestial.wcs.compare(
+        template.wcs.celestial.wcs,
+        cmp=WCSCOMPARE_ANCILLARY, tolerance=1e-10))
+
+def reprojection_mapping(wcs_in, shape_in, wcs_out, shape_out):
+    """
+    Return the (cached) input pixel coordinates of every output pixel
+    for a reprojection from (wcs_in, shape_in) to (wcs_out,
+    shape_out), along with a flag of output pixels that fall off the
+    input grid. Follows the edge handling of reproject_interp.
+    """
+
+    key = _grid_key(wcs_in, shape_in) + _grid_key(wcs_out, shape_out)
+    if key in _reprojection_cache:
+        _reprojection_cache.move_to_end(key)
+        return(_reprojection_cache[key])
+
+    yy, xx = np.meshgrid(np.arange(shape_out[0], dtype=float),
+                         np.arange(shape_out[1], dtype=float),
+                         indexing='ij')
+    xin, yin = pixel_to_pixel(wcs_out.celestial, wcs_in.celestial,
+                              xx.ravel(), yy.ravel())
+    coords = np.array([yin, xin])
+
+    # Pixels in the outer half of the edge pixels map onto the edge,
+    # anything further out is off the grid.
+    offgrid = np.zeros(coords.shape[1], dtype=bool)
+    for axis in range(2):
+        this = coords[axis]
+        offgrid |= ~np.isfinite(this)
+        offgrid |= this < -0.5
+        offgrid |= this > shape_in[axis] - 0.5
+        this[(this < 0) & (this >= -0.5)] = 0
+        this[(this < shape_in[axis] - 0.5)
+             & (this >= shape_in[axis] - 1)] = shape_in[axis] - 1
+    coords[:, offgrid] = 0.0
+
+    _reprojection_cache[key] = (coords, offgrid)
+    if len(_reprojection_cache) > _reprojection_cache_size:
+        _reprojection_cache.popitem(last=False)
+    return((coords, offgrid))
+
+def reproject_to_template(data, template, order=1):
+    """
+    Reproject a Projection onto the grid of a template Projection,
+    skipping the calculation when the grids already match and reusing
+    a cached pixel mapping otherwise.
+    """
+    # Copy so callers can modify the result as they would a
+    # reprojected map
+    if same_grid(data, template):
+        return(data.copy())
+
+    coords, offgrid = reprojection_mapping(
+        data.wcs, data.shape, template.wcs, template.shape)
+    values = map_coordinates(np.asarray(data.value, dtype=float), coords,
+                             order=order, cval=np.nan, mode='constant')
+    values[offgrid] = np.nan
+
+    return(Projection(values.reshape(template.shape), unit=data.unit,
+                      wcs=template.wcs, meta=data.meta,
+                      header=template.header, read_beam=True))
+
 def convert_and_reproject(name, template=None, unit=None, order=1):
     """
     Helper for moment1 hybrid routine. Reads in data, makes sure it is
-    a projection, converts units, and reprojects as necessary.
+    a projection, converts units, and reprojects as necessary. Maps
+    already on the template grid are not reprojected, and the pixel
+    mapping between two grids is cached (see reproject_to_template).
     """
 
     # Ensure inputs are Projections
@@ -427,7 +725,7 @@ def convert_and_reproject(name, template=None, unit=None, order=1):
         if unit is not None:
             data = data.to(unit)
         if template is not None:
-            data = data.reproject(template.header, order=order)
+            data = reproject_to_template(data, template, order=order)
     else:
         data = None
         
@@ -669,12 +967,19 @@ def write_moment2(
         Return products calculated in the map
     """
 
+    if isinstance(cube, RayList):
+        return(write_raylist_moment(
+            cube, moment='mom2', channel_correlation=channel_correlation,
+            outfile=outfile, errorfile=errorfile, overwrite=overwrite,
+            unit=unit, return_products=return_products))
+
     mom2 = cube.linewidth_sigma()
     spaxis = cube.spectral_axis.value
 
     if errorfile is not None and rms is None:
         logger.error("Moment 2 error requested but no RMS provided")
-    
+
+    mom2err_proj = None
     if rms is not None:
 
         mom2err = np.empty(mom2.shape)
@@ -785,6 +1090,12 @@ def write_ew(cube,
         Return products calculated in the map
     """
 
+    if isinstance(cube, RayList):
+        return(write_raylist_moment(
+            cube, moment='ew', channel_correlation=channel_correlation,
+            outfile=outfile, errorfile=errorfile, overwrite=overwrite,
+            unit=unit, return_products=return_products))
+
     maxmap = cube.max(axis=0)
     mom0 = cube.moment0()
     sigma_ew = mom0 / maxmap / np.sqrt(2 * np.pi)
@@ -810,7 +1121,7 @@ def write_ew(cube,
             term1 = (np.nansum((rms.filled_data[:].value)**2, axis=0) * dv**2
                      / (2 *np.pi * maxmap.value**2))
             term2 = (sigma_ew.value**2
-                     - sigma_ew.value * dv / np.sqrt(2*np.pi)) * np.squeeze(rms_at_max)**2
+                     - sigma_ew.value * dv / np.sqrt(2*np.pi)) * rms_at_max[0]**2
             sigma_ew_err = (term1 + term2)**0.5
 
         else:
@@ -859,6 +1170,397 @@ def write_ew(cube,
         return(sigma_ew, sigma_ewerr_projection)
     elif return_products and sigma_ewerr_projection is None:
         return(sigma_ew)
+# &%&%&&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%
+# Peak products engine
+# &%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%
+
+def projection_from_array(array, cube, unit=None):
+    """
+    Attach a two-dimensional array to the celestial WCS of a cube in
+    the same way as spectral-cube's collapse operations.
+    """
+    if unit is not None:
+        array = u.Quantity(array, unit, copy=False)
+    return(Projection(array, wcs=cube.wcs.celestial,
+                      header=cube._nowcs_header,
+                      meta={'moment_axis': 0},
+                      beam=getattr(cube, 'beam', None)))
+
+def boxcar_smooth(data, width):
+    """
+    Boxcar smooth a cube along the spectral (first) axis using running
+    sums. Reproduces spectral_smooth(Box1DKernel(width)) with the
+    astropy defaults (NaN values interpolated over, zero padding at the
+    band edges) at a cost independent of the kernel width.
+
+    Keywords:
+    ---------
+
+    data : np.array
+        Array with the spectral axis first. NaNs are treated as missing.
+
+    width : float
+        Width of the boxcar in channels (may be fractional).
+    """
+    kernel = Box1DKernel(width).array
+    half = len(kernel) // 2
+
+    # Box1DKernel is flat with (possibly) fractional weights in the two
+    # outermost entries.
+    edge, centre = kernel[0], kernel[half]
+    nchan = data.shape[0]
+    finite = np.isfinite(data)
+
+    def _boxsum(arr, pad_value):
+        pad = np.full((half,) + arr.shape[1:], pad_value, dtype=np.float64)
+        padded = np.concatenate([pad, arr, pad], axis=0)
+        csum = np.zeros((padded.shape[0] + 1,) + arr.shape[1:])
+        np.cumsum(padded, axis=0, out=csum[1:])
+        inner = csum[2*half:2*half+nchan] - csum[1:1+nchan]
+        outer = padded[0:nchan] + padded[2*half:2*half+nchan]
+        return(centre * inner + edge * outer)
+
+    numer = _boxsum(np.where(finite, data, 0.0), 0.0)
+    denom = _boxsum(finite.astype(np.float64), 1.0)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        smoothed = numer / denom
+    return(smoothed)
+
+def _window_in_channels(cube, window):
+    if window is None:
+        return(None)
+    window = u.Quantity(window)
+    nChan = (window / channel_width(cube)).to(u.dimensionless_unscaled).value
+    if nChan > 1:
+        return(nChan)
+    return(None)
+
+def _peak_products_tile(data, mask, rmsdata, spaxis, dv, nChan=None,
+                        channel_correlation=None, maxshift=0.5):
+    # Peak products for one spatial tile (full spectral axis). See
+    # peak_products.
+
+    nchan = data.shape[0]
+    mask = np.logical_and(mask, np.isfinite(data))
+
+    # Smooth once (or not at all)
+    if nChan is not None:
+        values = boxcar_smooth(np.where(mask, data, np.nan), nChan)
+        rmsfac = 1 / np.sqrt(nChan)
+    else:
+        values = data
+        rmsfac = 1.0
+
+    # Find the peak once
+    argmaxmap = np.argmax(np.where(mask, values, -np.inf), axis=0)
+    index = argmaxmap[np.newaxis, :, :]
+    valid = np.squeeze(np.take_along_axis(mask, index, 0), axis=0)
+    tmax = np.squeeze(np.take_along_axis(values, index, 0), axis=0)
+    tmax = np.where(valid, tmax, np.nan)
+
+    vmax = np.where(valid, spaxis[argmaxmap], np.nan)
+
+    # Quadratic interpolation around the (clipped) peak
+    argclip = np.clip(argmaxmap, 1, nchan - 2)
+    neighbours = argclip[np.newaxis, :, :] + np.array([1, 0, -1])[:, np.newaxis, np.newaxis]
+    near_mask = np.take_along_axis(mask, neighbours, 0)
+    near_vals = np.where(near_mask,
+                         np.take_along_axis(values, neighbours, 0),
+                         np.nan)
+    Tup = np.nan_to_num(near_vals[0])
+    Tup[Tup < 0] = 0
+    Tdown = np.nan_to_num(near_vals[2])
+    Tdown[Tdown < 0] = 0
+
+    denom = (Tup + Tdown - 2 * tmax)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        delta = -1 * ((Tup - Tdown) / denom)
+    if maxshift is not None:
+        delta = np.clip(delta, -maxshift, maxshift)
+    peakchan = argclip + delta
+    vquad = np.full(tmax.shape, np.nan)
+    good = np.isfinite(tmax)
+    vquad[good] = np.interp(peakchan[good], np.arange(nchan), spaxis)
+
+    products = {'argmax': argmaxmap,
+                'tmax': tmax,
+                'vmax': vmax,
+                'vquad': vquad}
+
+    if rmsdata is None:
+        return(products)
+
+    # Noise at the peak (from the same argmax)
+    rms_at_max = np.squeeze(np.take_along_axis(rmsdata, index, 0), axis=0)
+    rms_at_max = np.where(valid, rms_at_max, np.nan)
+    products['tmaxerr'] = rms_at_max * rmsfac
+
+    vmaxerr = np.full(tmax.shape, np.nan)
+    vmaxerr[good] = dv
+    products['vmaxerr'] = vmaxerr
+
+    # Noise at the three channels used in the quadratic fit
+    rmsvec = np.where(near_mask,
+                      np.take_along_axis(rmsdata, neighbours, 0),
+                      np.nan)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        j1 = (1/denom - (Tup - Tdown) / denom**2)
+        j2 = (2 * (Tup - Tdown) / denom**2)
+        j3 = (-1/denom - (Tup - Tdown) / denom**2)
+    jacobian = np.r_[j1[np.newaxis, :, :],
+                     j2[np.newaxis, :, :],
+                     j3[np.newaxis, :, :]]
+    if ((channel_correlation is None)
+        or len(channel_correlation) == 1):
+        error = np.einsum('i...,i...', jacobian**2, rmsvec**2)
+    else:
+        if len(channel_correlation) == 2:
+            ccor = np.r_[channel_correlation,
+                         np.array([0])]
+        else:
+            ccor = channel_correlation[0:3]
+        corrmat = ccor[np.array([[0, 1, 2],
+                                 [1, 0, 1],
+                                 [2, 1, 0]])]
+        covar = np.einsum('ij,ilm,jlm->ijlm', corrmat,
+                          rmsvec, rmsvec)
+        error = np.einsum('ilm,jlm,ijlm->lm',
+                          jacobian, jacobian, covar)
+    if maxshift is not None:
+        error = np.clip(error, -maxshift, maxshift)
+    products['vquaderr'] = error * dv
+
+    return(products)
+
+def peak_products(cube, rms=None, channel_correlation=None,
+                  window=None, maxshift=0.5, span_mask=False,
+                  spectral_range=None, chunk_shape=None, max_memory=None):
+    """
+    Calculate the peak intensity, the velocity at the peak, and the
+    quadratically interpolated velocity of the peak (and their errors)
+    together. The cube is smoothed at most once, with a running-sum
+    boxcar, and the argmax is found once. The neighbouring data and
+    noise values needed for the errors and the quadratic interpolation
+    are gathered from the same tile.
+
+    The cube is processed in spatial tiles with the full spectral
+    axis. Only one tile of the data, mask, and noise is read at a
+    time, so for memory-mapped FITS input the peak memory (including
+    the smoothing temporaries) is set by the tile size.
+
+    Returns a dictionary of two-dimensional arrays in the native units
+    of the cube (tmax, tmaxerr) and spectral axis (vmax, vmaxerr,
+    vquad, vquaderr), along with the argmax map.
+
+    Keywords:
+    ---------
+
+    cube : SpectralCube
+        (Masked) spectral cube.
+
+    rms : SpectralCube
+        Noise cube. Errors are only returned if this is set.
+
+    channel_correlation : np.array
+        Channel-to-channel correlation coefficients (used for vquad).
+
+    window : astropy.Quantity or str
+        Spectral window over which the data should be smoothed.
+
+    maxshift : float
+        Maximum shift (in channels) of the quadratic peak estimate.
+
+    span_mask : bool
+        If True, replace the mask by one that covers the full spectral
+        range spanned by the mask at every position (as write_tmax
+        does).
+
+    spectral_range : tuple
+        (lo, hi) channel range to use in place of the mask, applied
+        as the slice lo:hi (see write_tmax). Overrides span_mask.
+
+    chunk_shape : tuple
+        (ny, nx) shape of the spatial tiles. Defaults to the whole
+        image, or to a shape set by max_memory.
+
+    max_memory : float or str
+        Memory budget in bytes (or a string like '2 GB') used to pick
+        chunk_shape if that is not given.
+    """
+
+    if chunk_shape is None:
+        if max_memory is not None:
+            chunk_shape = chunk_shape_for_memory(cube.shape,
+                                                 max_memory=max_memory)
+        else:
+            chunk_shape = cube.shape[1:]
+
+    # The spanned mask needs the spectral extent of the whole mask
+    # before any tile is processed.
+    if span_mask and spectral_range is None:
+        mask_spec = np.zeros(cube.shape[0], dtype=bool)
+        for yslc, xslc in _iter_tiles(cube.shape, chunk_shape):
+            view = (slice(None), yslc, xslc)
+            mask_spec |= np.any(cube[view].get_mask_array(), axis=(1, 2))
+        if np.any(mask_spec):
+            spectral_range = (np.min(np.where(mask_spec)),
+                              np.max(np.where(mask_spec)))
+        else:
+            spectral_range = (0, 0)
+
+    nChan = _window_in_channels(cube, window)
+    spaxis = cube.spectral_axis.value
+    dv = channel_width(cube).value
+
+    products = {}
+    for yslc, xslc in _iter_tiles(cube.shape, chunk_shape):
+        view = (slice(None), yslc, xslc)
+        subcube = cube[view]
+        data = subcube.unmasked_data[:].value
+        if spectral_range is not None:
+            lo, hi = spectral_range
+            mask = np.zeros(data.shape, dtype=bool)
+            mask[lo:hi, :, :] = True
+        else:
+            mask = subcube.get_mask_array()
+        rmsdata = None
+        if rms is not None:
+            rmsdata = rms.unmasked_data[view].value
+
+        tile = _peak_products_tile(data, mask, rmsdata, spaxis, dv,
+                                   nChan=nChan,
+                                   channel_correlation=channel_correlation,
+                                   maxshift=maxshift)
+        for key in tile:
+            if key not in products:
+                if key == 'argmax':
+                    products[key] = np.zeros(cube.shape[1:], dtype=int)
+                else:
+                    products[key] = np.full(cube.shape[1:], np.nan)
+            products[key][yslc, xslc] = tile[key]
+
+    return(products)
+
+def write_peak_products(cube,
+                        rms=None,
+                        outfiles=None,
+                        errorfiles=None,
+                        channel_correlation=None,
+                        overwrite=True,
+                        unit=None,
+                        window=None,
+                        maxshift=0.5,
+                        span_mask=False,
+                        spectral_range=None,
+                        chunk_shape=None,
+                        max_memory=None,
+                        return_products=True):
+    """
+    Write peak temperature, velocity at peak, and quadratic velocity
+    at peak maps (and errors) for a SpectralCube from one call to
+    peak_products.
+
+    Keywords:
+    ---------
+
+    outfiles : dict
+        File names keyed by 'tpeak', 'vpeak', and/or 'vquad'.
+
+    errorfiles : dict
+        Error file names keyed as outfiles.
+
+    unit : dict
+        Preferred units keyed as outfiles (e.g., {'tpeak': u.K,
+        'vpeak': u.km/u.s}).
+
+    span_mask : bool
+        See peak_products. Note that write_tmax uses span_mask=True
+        while write_vmax and write_vquad use the mask as given.
+
+    spectral_range, chunk_shape, max_memory :
+        See peak_products.
+
+    Other keywords as for write_tmax and write_vquad.
+    """
+
+    if outfiles is None:
+        outfiles = {}
+    if errorfiles is None:
+        errorfiles = {}
+    if unit is None:
+        unit = {}
+
+    products = peak_products(cube, rms=rms,
+                             channel_correlation=channel_correlation,
+                             window=window, maxshift=maxshift,
+                             span_mask=span_mask,
+                             spectral_range=spectral_range,
+                             chunk_shape=chunk_shape,
+                             max_memory=max_memory)
+
+    names = {'tpeak': ('tmax', cube.unit, 'write_tmax'),
+             'vpeak': ('vmax', cube.spectral_axis.unit, 'write_vmax'),
+             'vquad': ('vquad', cube.spectral_axis.unit, 'write_vquad')}
+
+    output = {}
+    for tag in names:
+        key, this_unit, calling_name = names[tag]
+        proj = projection_from_array(products[key], cube, unit=this_unit)
+        if tag in unit:
+            proj = proj.to(unit[tag])
+        errproj = None
+        if key+'err' in products:
+            errproj = projection_from_array(products[key+'err'], cube,
+                                            unit=this_unit)
+            if tag in unit:
+                errproj = errproj.to(unit[tag])
+            if tag in errorfiles:
+                errproj = update_metadata(errproj, cube, error=True,
+                                          calling_name=calling_name)
+                writer(errproj, errorfiles[tag], overwrite=overwrite)
+        if tag in outfiles:
+            proj = update_metadata(proj, cube, calling_name=calling_name)
+            writer(proj, outfiles[tag], overwrite=overwrite)
+        output[tag] = (proj, errproj)
+
+    if return_products:
+        return(output)
+
+def _write_peak_product(cube, tag=None, outfile=None, errorfile=None,
+                        rms=None, channel_correlation=None,
+                        overwrite=True, unit=None, window=None,
+                        maxshift=0.5, span_mask=False,
+                        spectral_range=None, chunk_shape=None,
+                        max_memory=None, return_products=True):
+    """
+    Helper for write_tmax, write_vmax, and write_vquad.
+    """
+    outfiles = {}
+    errorfiles = {}
+    units = {}
+    if outfile is not None:
+        outfiles[tag] = outfile
+    if errorfile is not None:
+        errorfiles[tag] = errorfile
+    if unit is not None:
+        units[tag] = unit
+
+    output = write_peak_products(cube, rms=rms,
+                                 outfiles=outfiles, errorfiles=errorfiles,
+                                 channel_correlation=channel_correlation,
+                                 overwrite=overwrite, unit=units,
+                                 window=window, maxshift=maxshift,
+                                 span_mask=span_mask,
+                                 spectral_range=spectral_range,
+                                 chunk_shape=chunk_shape,
+                                 max_memory=max_memory,
+                                 return_products=True)
+    proj, errproj = output[tag]
+
+    if return_products and errproj is not None:
+        return(proj, errproj)
+    elif return_products and errproj is None:
+        return(proj)
 
 # &%&%&&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%
 # Peak temperature
@@ -872,6 +1574,9 @@ def write_tmax(cubein,
                overwrite=True,
                unit=None,
                window=None,
+               spectral_range=None,
+               chunk_shape=None,
+               max_memory=None,
                return_products=True):
     """
     Write out Tmax map for a SpectralCube
@@ -905,79 +1610,39 @@ def write_tmax(cubein,
         
     window : astropy.Quantity
         Spectral window over which the data should be smoothed
+
+    spectral_range : tuple
+        (lo, hi) channel range to use in place of the range spanned by
+        the mask, applied as the slice lo:hi. With lo and hi the first
+        and last masked channel this matches the span of the mask (see
+        peak_products), which leaves out channel hi. Used when the cube
+        is processed in tiles and by the Monte Carlo errors.
+
+    chunk_shape : tuple
+        (ny, nx) spatial tiles in which to find the peak (see
+        peak_products). Defaults to the whole image.
+
+    max_memory : float or str
+        Memory budget used to pick chunk_shape if that is not given.
             
     return_products : bool
         Return products calculated in the map
     """
 
-    # hack the mask to span the spectral range of the mask but lose spatial information.
-
-    mask = cubein.get_mask_array()
-    mask_spec = np.any(mask, axis=(1,2))    
-    lo = np.min(np.where(mask_spec))
-    hi = np.max(np.where(mask_spec))
-    mask = np.zeros_like(mask,dtype='bool')
-    mask[lo:hi,:,:] = True
-    mask *= np.isfinite(cubein.unmasked_data[:])
-    new_cube = cubein.with_mask(mask, inherit_mask=False)
-
-    # spectral smoothing if desired
-
-    if window is not None:
-        window = u.Quantity(window)
-        
-        from astropy.convolution import Box1DKernel
-        dv = channel_width(new_cube)
-        nChan = (window / dv).to(u.dimensionless_unscaled).value
-        if nChan > 1:
-            cube = new_cube.spectral_smooth(Box1DKernel(nChan))
-            rmsfac = 1/np.sqrt(nChan)
-        else:
-            cube = new_cube
-            rmsfac = 1.0
-    else:
-        cube = new_cube
-        rmsfac = 1.0
-
-    maxmap = cube.max(axis=0)
-
     if errorfile is not None and rms is None:
         logger.error("Tmax error requested but no RMS provided")
 
-    if rms is not None:
-        argmaxmap = cube.argmax(axis=0)
-        rms = rms.with_mask(cube._mask.include(), inherit_mask=False)
+    # hack the mask to span the spectral range of the mask but lose
+    # spatial information. The peak engine does this itself (tile by
+    # tile) unless the range is imposed from outside.
 
-        rms_at_max = np.take_along_axis(
-            rms.filled_data[:],
-            argmaxmap[np.newaxis, :, :], 0).value
-        # rmsfac accounts for smoothing leading to reduction in rms
-        # assuming channels are (nearly) independent
-        rms_at_max = np.squeeze(rms_at_max) * rmsfac 
-        rms_at_max = u.Quantity(rms_at_max, cube.unit, copy=False)
-        if unit is not None:
-            rms_at_max = rms_at_max.to(unit)
-        tmaxerr_projection = Projection(rms_at_max,
-                                        wcs=maxmap.wcs,
-                                        header=maxmap.header,
-                                        meta=maxmap.meta)
-        if errorfile is not None:
-            tmaxerr_projection = update_metadata(tmaxerr_projection, cube,
-                                                 error=True)
-            writer(tmaxerr_projection, errorfile, overwrite=overwrite)
-            # tmaxerr_projection.write(errorfile, overwrite=overwrite)
-
-    if unit is not None:
-        maxmap = maxmap.to(unit)
-    if outfile is not None:
-        maxmap = update_metadata(maxmap, cube)
-        writer(maxmap, outfile, overwrite=overwrite)
-        # maxmap.write(outfile, overwrite=True)
-
-    if return_products and tmaxerr_projection is not None:
-        return(maxmap, tmaxerr_projection)
-    elif return_products and tmaxerr_projection is None:
-        return(maxmap)
+    return(_write_peak_product(
+        cubein, tag='tpeak', outfile=outfile, errorfile=errorfile,
+        rms=rms, channel_correlation=channel_correlation,
+        overwrite=overwrite, unit=unit, window=window,
+        span_mask=True, spectral_range=spectral_range,
+        chunk_shape=chunk_shape, max_memory=max_memory,
+        return_products=return_products))
 
 # &%&%&&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%
 # Velocity at peak
@@ -991,6 +1656,8 @@ def write_vmax(cubein,
                overwrite=True,
                unit=None,
                window=None,
+               chunk_shape=None,
+               max_memory=None,
                return_products=True):
     """
     Write out velocity map at max brightness temp for a SpectralCube
@@ -1024,66 +1691,35 @@ def write_vmax(cubein,
     
     window : astropy.Quantity
         Spectral window over which the data should be smoothed
-                    
+
+    chunk_shape : tuple
+        (ny, nx) spatial tiles in which to find the peak (see
+        peak_products). Defaults to the whole image.
+
+    max_memory : float or str
+        Memory budget used to pick chunk_shape if that is not given.
+
     return_products : bool
         Return products calculated in the map
     """
-    if type(window) is u.Quantity:
-        from astropy.convolution import Box1DKernel
-        dv = channel_width(cube)
-        nChan = (window / dv).to(u.dimensionless_unscaled).value
-        if nChan > 1:
-            cube = cubein.spectral_smooth(Box1DKernel(nChan))
-        else:
-            cube = cubein
-    else:
-        cube = cubein
-    maxmap = cube.max(axis=0)
-    argmaxmap = cube.argmax(axis=0)
-    vmaxmap = np.take_along_axis(cube.spectral_axis[:, np.newaxis, np.newaxis],
-                                 argmaxmap[np.newaxis, :, :], 0)
-    vmaxmap = np.squeeze(vmaxmap)
+    if isinstance(cubein, RayList):
+        if window is not None:
+            logger.warning("Spectral smoothing is not supported for a "
+                           "RayList. Ignoring window.")
+        return(write_raylist_moment(
+            cubein, moment='vmax', channel_correlation=channel_correlation,
+            outfile=outfile, errorfile=errorfile, overwrite=overwrite,
+            unit=unit, return_products=return_products))
 
-    vmaxmap[~np.isfinite(maxmap)] = np.nan
- 
     if errorfile is not None and rms is None:
-        logger.error("Moment 2 error requested but no RMS provided")
+        logger.error("Vmax error requested but no RMS provided")
 
-    if rms is not None:
-        dv = channel_width(cube)
-        vmaxerror = np.empty(maxmap.shape)
-        vmaxerror.fill(np.nan)
-        vmaxerror[np.isfinite(maxmap)] = dv.value
-        vmaxerror = u.Quantity(vmaxerror, dv.unit, copy=False)
-        if unit is not None:
-            vmaxerror = vmaxerror.to(unit)
-        vmaxerr_projection = Projection(vmaxerror,
-                                        wcs=maxmap.wcs,
-                                        header=maxmap.header,
-                                        meta=maxmap.meta)
-        if errorfile is not None:
-            vmaxerr_projection = update_metadata(vmaxerr_projection, cube,
-                                                 error=True)
-            writer(vmaxerr_projection, errorfile, overwrite=overwrite)
-            # vmaxerr_projection.write(errorfile, overwrite=overwrite)
-
-    vmaxmap = u.Quantity(vmaxmap, cube.spectral_axis.unit)        
-    if unit is not None:
-        vmaxmap = vmaxmap.to(unit)
-    vmaxmap_projection = Projection(vmaxmap,
-                                    wcs=maxmap.wcs,
-                                    header=maxmap.header,
-                                    meta=maxmap.meta)
-
-    if outfile is not None:        
-        vmaxmap_projection = update_metadata(vmaxmap_projection, cube)
-        writer(vmaxmap_projection, outfile, overwrite=overwrite)
-        # vmaxmap_projection.write(outfile, overwrite=True)
-        
-    if return_products and vmaxerr_projection is not None:
-        return(vmaxmap_projection, vmaxerr_projection)
-    elif return_products and vmaxerr_projection is None:
-        return(vmaxmap_projection)
+    return(_write_peak_product(
+        cubein, tag='vpeak', outfile=outfile, errorfile=errorfile,
+        rms=rms, channel_correlation=channel_correlation,
+        overwrite=overwrite, unit=unit, window=window,
+        chunk_shape=chunk_shape, max_memory=max_memory,
+        return_products=return_products))
 
 # &%&%&&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%
 # Interpolated velocity at peak
@@ -1098,6 +1734,8 @@ def write_vquad(cubein,
                 unit=None,
                 window=None,
                 maxshift=0.5,
+                chunk_shape=None,
+                max_memory=None,
                 return_products=True):
     """
     Write out velocity map at max brightness temp for a 
@@ -1136,128 +1774,158 @@ def write_vquad(cubein,
     maxshift : np.float
         Maximum number of channels that the algorithm can shift the 
         peak estimator (default = 0.5).  Set to None to suppress clipping.
-    
+
+    chunk_shape : tuple
+        (ny, nx) spatial tiles in which to find the peak (see
+        peak_products). Defaults to the whole image.
+
+    max_memory : float or str
+        Memory budget used to pick chunk_shape if that is not given.
+
     return_products : bool
         Return products calculated in the map
     """
-    
-    from scipy.interpolate import interp1d
-    
-    if type(window) is u.Quantity:
-        from astropy.convolution import Box1DKernel
-        dv = channel_width(cubein)
-        nChan = (window / dv).to(u.dimensionless_unscaled).value
-        if nChan > 1:
-            cube = cubein.spectral_smooth(Box1DKernel(nChan))
-        else:
-            cube = cubein
-    else:
-        cube = cubein
-      
-    spaxis = cube.spectral_axis.value
-    pixinterp = interp1d(np.arange(spaxis.size),
-                         spaxis)
-    maxmap = cube.max(axis=0)
-    argmaxmap = cube.argmax(axis=0)
-    argmaxmap = np.clip(argmaxmap, 1, cube.shape[0]-2)
-    Tup = np.take_along_axis(cube.filled_data[:],
-                             argmaxmap[np.newaxis, :, :]+1, 0).value
-    Tdown = np.take_along_axis(cube.filled_data[:],
-                               argmaxmap[np.newaxis, :, :]-1, 0).value
-    Tup = np.squeeze(np.nan_to_num(Tup))
-    Tup[Tup < 0] = 0
-    Tdown = np.squeeze(np.nan_to_num(Tdown))
-    Tdown[Tdown < 0] = 0
 
-    delta = -1 * ((Tup - Tdown) / (Tup + Tdown - 2 * maxmap.value))
-    if maxshift is not None:
-        delta = np.clip(delta, -maxshift, maxshift)
-    peakchan = argmaxmap + delta
+    if errorfile is not None and rms is None:
+        logger.error("Vquad error requested but no RMS provided")
 
-    vmaxmap = np.empty(maxmap.shape)
-    vmaxmap.fill(np.nan)
-    good = np.isfinite(maxmap)
-    vmaxmap[good] = u.Quantity(pixinterp(peakchan[good]),
-                               unit)
+    return(_write_peak_product(
+        cubein, tag='vquad', outfile=outfile, errorfile=errorfile,
+        rms=rms, channel_correlation=channel_correlation,
+        overwrite=overwrite, unit=unit, window=window,
+        maxshift=maxshift, chunk_shape=chunk_shape,
+        max_memory=max_memory, return_products=return_products))
 
-    vmaxmap[~np.isfinite(maxmap)] = np.nan
+# &%&%&&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%
+# Stacked-line measurements
+# &%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%
 
-    if errorfile is not None and rms is None:
-        logger.error("Vquad error requested but no RMS provided")
+# Table column for each RayList moment product
+stacked_moment_columns = OrderedDict([('mom0', 'mom0'),
+                                      ('mom1', 'mom1'),
+                                      ('mom2', 'mom2'),
+                                      ('ew', 'ew'),
+                                      ('tpeak', 'tmax'),
+                                      ('vpeak', 'vmax')])
+
+def _spectra_from_stacks(stacks, noise=None, unit=None):
+    # Collect dense spectra (Nv x Nspec), noise, units, and the
+    # identifying columns from a BinByLabel list or a (shuffled) cube.
+    columns = OrderedDict()
+    if isinstance(stacks, SpectralCube):
+        nchan, ny, nx = stacks.shape
+        spectra = stacks.filled_data[:].value.reshape(nchan, ny * nx)
+        yy, xx = np.indices((ny, nx))
+        columns['y'] = yy.ravel()
+        columns['x'] = xx.ravel()
+        if noise is not None:
+            noise = noise.filled_data[:].value.reshape(nchan, ny * nx)
+        return(spectra, noise, stacks.spectral_axis, stacks.unit,
+               columns, None)
+
+    spectra = np.stack([entry['spectrum'] for entry in stacks], axis=1)
+    columns['label'] = np.array([entry['label'] for entry in stacks])
+    for key in ['n_spectra', 'n_effective']:
+        if all(key in entry for entry in stacks):
+            columns[key] = np.array([entry[key] for entry in stacks])
+    if noise is None and all('noise' in entry for entry in stacks):
+        noise = np.stack([entry['noise'] for entry in stacks], axis=1)
+    if unit is None:
+        unit = stacks[0].get('unit', u.dimensionless_unscaled)
+    return(spectra, noise, stacks[0]['spectral_axis'], u.Unit(unit),
+           columns, stacks[0].get('channel_correlation'))
+
+def stacked_moments(stacks, noise=None, channel_correlation=None,
+                    line_window=None, mask=None, unit=None,
+                    outfile=None, overwrite=True):
+    """
+    Measure integrated intensity, centroid, line width (second moment
+    and equivalent width), and peak temperature and velocity of many
+    stacked spectra at once. The spectra are gathered into a RayList
+    and measured with its vectorized moments, so thousands of stacks
+    cost one pass. Analytic errors are included when a noise estimate
+    is available.
 
-    if rms is not None:
-        rms = rms.with_mask(cube._mask.include(), inherit_mask=False)
-        
-        dv = channel_width(cube)
-        RMSup = np.take_along_axis(rms.filled_data[:],
-                                   argmaxmap[np.newaxis, :, :]+1,
-                                   0).value
-        RMSdown = np.take_along_axis(rms.filled_data[:],
-                                     argmaxmap[np.newaxis, :, :]-1,
-                                     0).value
-        RMSmax = np.take_along_axis(rms.filled_data[:],
-                                    argmaxmap[np.newaxis, :, :],
-                                    0).value
-        denom = (Tup + Tdown - 2 * maxmap.value)
-        j1 = (1/denom - (Tup - Tdown) / denom**2)
-        j2 = (2 * (Tup - Tdown) / denom**2)
-        j3 = (-1/denom - (Tup - Tdown) / denom**2)
-        jacobian = np.r_[j1[np.newaxis, :, :],
-                         j2[np.newaxis, :, :],
-                         j3[np.newaxis, :, :]]
-        if ((channel_correlation is None) 
-            or len(channel_correlation) == 1):
-            covar = np.r_[RMSup,
-                          RMSmax,
-                          RMSdown]
-            covar = covar**2
-            error = np.einsum('i...,i...', jacobian**2, covar)
-        else:
-            if len(channel_correlation) == 2:
-                ccor = np.r_[channel_correlation,
-                             np.array([0])]
-            else:
-                ccor = channel_correlation[0:3]
-            corrmat = ccor[np.array([[0, 1, 2],
-                                     [1, 0, 1],
-                                     [2, 1, 0]])]
-            rmsvec = np.r_[RMSup,
-                           RMSmax,
-                           RMSdown]
-            # They never should have taught me how to do this.
-            covar  = np.einsum('ij,ilm,jlm->ijlm', corrmat,
-                               rmsvec, rmsvec)
-            error = np.einsum('ilm,jlm,ijlm->lm',
-                              jacobian, jacobian, covar)
-        if maxshift is not None:
-            error = np.clip(error, -maxshift, maxshift)
-        vquaderr = error * dv
-        if unit is not None:
-            vquaderr = vquaderr.to(unit)
-        
-        vquaderr_projection = Projection(vquaderr,
-                                         wcs=maxmap.wcs,
-                                         header=maxmap.header,
-                                         meta=maxmap.meta)
-        if errorfile is not None:
-            vquaderr_projection = update_metadata(vquaderr_projection, cube,
-                                                  error=True)
-            writer(vquaderr_projection, errorfile, overwrite=overwrite)
-            # vquaderr_projection.write(errorfile, overwrite=overwrite)
+    Keywords:
+    ---------
+
+    stacks : list or SpectralCube
+        Output list of scStackingRoutines.BinByLabel (one row per
+        label), or a cube shuffled by scStackingRoutines.ShuffleCube
+        (one row per line of sight, with its x and y).
+
+    noise : SpectralCube or np.array
+        Noise matched to the stacks. For a BinByLabel list the
+        propagated noise of the stacks is used by default.
+
+    channel_correlation : np.array
+        One-dimensional array containing the channel-to-channel
+        normalize correlation coefficients. Defaults to the one
+        carried by a BinByLabel list.
+
+    line_window : astropy.Quantity
+        Full width of the spectral window, centered on zero, over
+        which the line is measured. Default: all channels.
+
+    mask : np.array
+        Boolean mask (True = keep), matched to the spectra (Nv x Nstack)
+        or to the shuffled cube.
+
+    unit : astropy.Unit
+        Unit of the stacked spectra if not recorded with them.
+
+    outfile : str
+        If set, the table is written to this FITS file.
+
+    overwrite : bool
+        Set to True (the default) to overwrite an existing table.
+
+    Returns an astropy Table with one row per stack. Stacks without
+    any valid channel in the window are NaN.
+    """
+
+    spectra, noise, spaxis, unit, columns, stack_correlation = \
+        _spectra_from_stacks(stacks, noise=noise, unit=unit)
+    if channel_correlation is None:
+        channel_correlation = stack_correlation
+    if isinstance(noise, SpectralCube):
+        noise = noise.filled_data[:].value.reshape(spectra.shape)
+
+    include = np.ones(spectra.shape, dtype=bool)
+    if line_window is not None:
+        half_width = 0.5 * np.abs(line_window.to(spaxis.unit).value)
+        include &= (np.abs(spaxis.value) <= half_width)[:, np.newaxis]
+    if mask is not None:
+        include &= np.asarray(mask, dtype=bool).reshape(spectra.shape)
+
+    raylist = raylist_from_spectra(spectra, spaxis, noise=noise,
+                                   include=include, unit=unit)
+    products = raylist.moments(channel_correlation=channel_correlation)
+
+    table = Table()
+    for key in columns:
+        table[key] = columns[key]
+    spunit = spaxis.unit
+    units = {'mom0': unit * spunit, 'tpeak': unit}
+    for column, product in stacked_moment_columns.items():
+        names = [(column, product)]
+        if raylist.noise is not None:
+            names += [(column + '_err', product + 'err')]
+        for name, key in names:
+            values = np.full(spectra.shape[1], np.nan)
+            values[raylist.x] = products[key]
+            table[name] = u.Quantity(values, units.get(column, spunit))
+
+    table.meta['comments'] = [
+        'Produced with PHANGS-ALMA pipeline version ' + version,
+        'Moments of stacked spectra over the '
+        + ('full band' if line_window is None else
+           'window |v| <= {0}'.format(0.5 * np.abs(line_window)))]
+    if tableversion:
+        table.meta['comments'] += [
+            'Galaxy properties from PHANGS sample table version '
+            + tableversion]
 
-    vmaxmap = u.Quantity(vmaxmap, cube.spectral_axis.unit)
-    if unit is not None:
-        vmaxmap = vmaxmap.to(unit)
-    vmaxmap_projection = Projection(vmaxmap,
-                                    wcs=maxmap.wcs,
-                                    header=maxmap.header,
-                                    meta=maxmap.meta)
     if outfile is not None:
-        vmaxmap_projection = update_metadata(vmaxmap_projection, cube)
-        writer(vmaxmap_projection, outfile, overwrite=overwrite)
-        # vmaxmap_projection.write(outfile, overwrite=overwrite)
-
-    if return_products and vquaderr_projection is not None:
-        return(vmaxmap_projection, vquaderr_projection)
-    elif return_products and vquaderr_projection is None:
-        return(vmaxmap_projection)
+        table.write(outfile, format='fits', overwrite=overwrite)
+    return(table)
@@ -490,6 +490,18 @@ def join_masks(orig_mask_in, new_mask_in,
 
     return(mask)
 
+def write_mask(mask, outfile, overwrite=False):
+    """
+    Write a mask SpectralCube to disk as unsigned 8-bit integers.
+    """
+    header = mask.header
+    header['DATAMAX'] = 1
+    header['DATAMIN'] = 0
+    hdu = fits.PrimaryHDU(np.array(mask.filled_data[:], dtype=np.uint8),
+                          header=header)
+    hdu.writeto(outfile, overwrite=overwrite)
+    return(None)
+
 def recipe_phangs_strict_mask(
     incube, innoise, outfile=None, 
     coverage=None, coverage_thresh=0.95,
@@ -625,12 +637,7 @@ def recipe_phangs_strict_mask(
     
     # Write to disk, if desired
     if outfile is not None:
-        header = mask.header
-        header['DATAMAX'] = 1
-        header['DATAMIN'] = 0
-        hdu = fits.PrimaryHDU(np.array(mask.filled_data[:], dtype=np.uint8),
-                              header=header)
-        hdu.writeto(outfile, overwrite=overwrite)
+        write_mask(mask, outfile, overwrite=overwrite)
 
         
     if return_spectral_cube:
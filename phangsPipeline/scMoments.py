@@ -1,8 +1,13 @@
 import scDerivativeRoutines as scdr
+from scDerivativeRoutines import (chunk_shape_for_memory, _iter_tiles,
+                                  _tile_temporaries)
+from scRayList import build_raylist
+from scMonteCarlo import montecarlo_error, montecarlo_moments
 from spectral_cube import SpectralCube
 import astropy.units as u
 import numpy as np
 import inspect
+import logging
 import warnings
 warnings.filterwarnings("ignore")
 
@@ -49,6 +54,151 @@ def _func_and_kwargs_for_moment(moment_tag=None):
 
     return(func, kwargs)
 
+# Moments that can be calculated directly from a RayList
+_raylist_moments = ['mom0', 'mom1', 'mom2', 'ew', 'vpeak']
+
+# Moments that do not read the cube and so are never tiled
+_untiled_moments = ['mom1wprior']
+
+def _mask_spectral_range(maskcube, chunk_shape):
+    """
+    Return the (first, last) channel included anywhere in a mask cube,
+    reading it one tile at a time, or None for an empty mask. This is
+    the spectral_range of write_tmax and montecarlo_error, which use
+    it as the slice first:last, like the mask span of peak_products.
+    """
+    mask_spec = np.zeros(maskcube.shape[0], dtype=bool)
+    for yslc, xslc in _iter_tiles(maskcube.shape, chunk_shape):
+        view = (slice(None), yslc, xslc)
+        mask_spec |= np.any(maskcube.unmasked_data[view].value > 0,
+                            axis=(1, 2))
+    if not np.any(mask_spec):
+        return(None)
+    return((np.min(np.where(mask_spec)), np.max(np.where(mask_spec))))
+
+def _tiled_moment(func, cube, maskcube=None, noisecube=None,
+                  chunk_shape=None, outfile=None, errorfile=None,
+                  channel_correlation=None, overwrite=True, **kwargs):
+    """
+    Run a moment writer over spatial tiles (full spectral axis) of a
+    cube, mask, and noise and assemble the output maps. Only one tile
+    of each cube is read at a time, so for memory-mapped FITS input
+    the peak memory is set by the tile size and not the cube size.
+    """
+
+    kwargs.pop('return_products', None)
+
+    # write_tmax spans the spectral range of the whole mask. Work that
+    # out once so each tile uses the same range.
+    if func is scdr.write_tmax and maskcube is not None:
+        spectral_range = _mask_spectral_range(maskcube, chunk_shape)
+        if spectral_range is not None:
+            kwargs['spectral_range'] = spectral_range
+
+    moment_array = np.full(cube.shape[1:], np.nan)
+    error_array = None
+    moment_unit = None
+    error_unit = None
+
+    for yslc, xslc in _iter_tiles(cube.shape, chunk_shape):
+        view = (slice(None), yslc, xslc)
+        subcube = cube[view].to(u.K)
+        if maskcube is not None:
+            submask = np.array(maskcube.unmasked_data[view].value > 0)
+            subcube = subcube.with_mask(submask, inherit_mask=False)
+        subnoise = None
+        if noisecube is not None:
+            subnoise = noisecube[view]
+
+        products = func(subcube, rms=subnoise,
+                        outfile=None, errorfile=None,
+                        channel_correlation=channel_correlation,
+                        return_products=True,
+                        **kwargs)
+        if type(products) is not tuple:
+            products = (products, None)
+        moment_map, error_map = products
+
+        moment_array[yslc, xslc] = moment_map.value
+        moment_unit = moment_map.unit
+        if error_map is not None:
+            if error_array is None:
+                error_array = np.full(cube.shape[1:], np.nan)
+            error_array[yslc, xslc] = u.Quantity(error_map).value
+            error_unit = u.Quantity(error_map).unit
+
+    # Attach the assembled maps to the celestial WCS of the full cube
+    # and write them with the same metadata as the whole-cube path.
+
+    moment_proj = scdr.projection_from_array(moment_array, cube,
+                                             unit=moment_unit)
+    error_proj = None
+    if error_array is not None:
+        error_proj = scdr.projection_from_array(error_array, cube,
+                                                unit=error_unit)
+
+    if outfile is not None:
+        moment_proj = scdr.update_metadata(moment_proj, cube,
+                                           calling_name=func.__name__)
+        scdr.writer(moment_proj, outfile, overwrite=overwrite)
+
+    if errorfile is not None and error_proj is not None:
+        error_proj = scdr.update_metadata(error_proj, cube, error=True,
+                                          calling_name=func.__name__)
+        scdr.writer(error_proj, errorfile, overwrite=overwrite)
+
+    return(moment_proj, error_proj)
+
+def _montecarlo_error_map(func, moment, cube, kwargs, analytic_map=None,
+                          maskcube=None, noisecube=None,
+                          chunk_shape=None, max_memory=None,
+                          channel_correlation=None, errorfile=None,
+                          mc_kwargs=None):
+    """
+    Replace an analytic error map with a Monte Carlo estimate where
+    the moment has masked signal, then convert and write it.
+    """
+
+    mckw = {}
+    if mc_kwargs is not None:
+        mckw.update(mc_kwargs)
+    if max_memory is not None:
+        mckw.setdefault('max_memory', max_memory)
+    mckw.setdefault('chunk_shape', chunk_shape)
+
+    # Match the peak finding of write_tmax / write_vmax
+    spectral_range = kwargs.get('spectral_range', None)
+    if moment == 'tpeak' and spectral_range is None and maskcube is not None:
+        if chunk_shape is None:
+            chunk_shape = cube.shape[1:]
+        spectral_range = _mask_spectral_range(maskcube, chunk_shape)
+
+    mc_error = montecarlo_error(
+        cube, rms=noisecube, mask=maskcube, moment=moment,
+        channel_correlation=channel_correlation,
+        window=kwargs.get('window', None),
+        spectral_range=spectral_range, **mckw)
+
+    unit = kwargs.get('unit', None)
+    if unit is not None:
+        mc_error = mc_error.to(unit)
+
+    error_array = mc_error.value
+    if analytic_map is not None:
+        analytic = u.Quantity(analytic_map).to(mc_error.unit).value
+        fill = ~np.isfinite(error_array)
+        error_array[fill] = analytic[fill]
+
+    error_proj = scdr.projection_from_array(error_array, cube,
+                                            unit=mc_error.unit)
+    if errorfile is not None:
+        error_proj = scdr.update_metadata(error_proj, cube, error=True,
+                                          calling_name=func.__name__)
+        scdr.writer(error_proj, errorfile,
+                    overwrite=kwargs.get('overwrite', True))
+
+    return(error_proj)
+
 def moment_tag_known(moment_tag=None):
     """
     Test whether the programs know about a moment tag.
@@ -63,10 +213,35 @@ def moment_generator(
         moment=None, momkwargs=None,
         outfile=None, errorfile=None,
         channel_correlation=None,
-        context=None):
+        context=None,
+        sparse=False,
+        chunk_shape=None,
+        max_memory=None,
+        error_mode='analytic',
+        mc_kwargs=None):
 
     """
     Generate one moment map from input cube, noise, and masks.
+
+    If sparse is True and the moment supports it, the masked voxels
+    are first gathered into a RayList (see scRayList) in one pass
+    over the cube and the moment is computed with segmented
+    reductions. This keeps memory proportional to the masked volume.
+    Moments smoothed with a spectral window (momkwargs 'window') always
+    use the full cube.
+
+    If chunk_shape (ny, nx) or max_memory (bytes, or a string like
+    '4 GB') is set, the cube, mask, and noise are instead processed in
+    spatial tiles that span the full spectral axis and the output maps
+    are assembled tile by tile. With memory-mapped FITS inputs this
+    bounds the peak memory independent of the cube size.
+
+    If error_mode is 'montecarlo' the error map is instead estimated by
+    resampling the noise cube (see scMonteCarlo.montecarlo_error).
+    mc_kwargs is a dictionary passed on to montecarlo_error (e.g.,
+    n_realizations, seed, n_workers, percentiles). Lines of sight
+    without masked signal keep their analytic error (e.g., the moment 0
+    limits).
     """
 
     # &%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%
@@ -88,6 +263,51 @@ def moment_generator(
         for this_kwarg in momkwargs:
             kwargs[this_kwarg] = momkwargs[this_kwarg]
 
+    montecarlo = (error_mode == 'montecarlo')
+    if montecarlo:
+        if moment not in montecarlo_moments or noise is None:
+            logging.warning("No Monte Carlo error for moment "+str(moment)
+                            +" without a noise cube. Using analytic errors.")
+            montecarlo = False
+        elif mc_kwargs is not None and type(mc_kwargs) != type({}):
+            logging.error("Type of mc_kwargs should be dictionary.")
+            raise NotImplementedError
+    elif error_mode != 'analytic':
+        logging.error("Error mode not recognized: "+str(error_mode))
+        raise NotImplementedError
+
+    # Monte Carlo errors are written here after the moment is made
+    mc_errorfile = None
+    if montecarlo:
+        mc_errorfile = errorfile
+        errorfile = None
+
+    # &%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%
+    # Sparse (ray list) path
+    # &%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%
+
+    if sparse and montecarlo:
+        logging.info("Monte Carlo errors read the full cube. "
+                     "Not using sparse mode.")
+    elif sparse and kwargs.get('window', None) is not None:
+        # The ray list holds only the masked voxels, so it cannot be
+        # smoothed spectrally (e.g., the vpeak window).
+        logging.info("Spectral smoothing (window) needs the full cube. "
+                     "Not using sparse mode.")
+    elif sparse:
+        if moment in _raylist_moments:
+            raylist = build_raylist(cubein, mask=mask, noise=noise)
+            products = func(
+                raylist, outfile=outfile, errorfile=errorfile,
+                channel_correlation=channel_correlation,
+                **kwargs)
+            # ... a single map comes back when there is no noise cube
+            if type(products) is not tuple:
+                products = (products, None)
+            return(products)
+        logging.warning("Moment "+str(moment)+" does not support sparse "
+                        "mode. Using the full cube.")
+
     # &%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%
     # Read in the data
     # &%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%
@@ -103,10 +323,16 @@ def moment_generator(
 
     cube.allow_huge_operations = True
 
-    # Force Kelvin. We will be unit agnostic later.
-    cube = cube.to(u.K)
+    tiled = ((chunk_shape is not None or max_memory is not None)
+             and moment not in _untiled_moments)
+
+    # Force Kelvin. We will be unit agnostic later. In tiled mode this
+    # happens tile by tile to avoid a full copy of the cube.
+    if not tiled:
+        cube = cube.to(u.K)
     
     # Attach a mask if needed
+    maskcube = None
     if mask is not None:
         if type(mask) is str:
             mask = SpectralCube.read(mask)
@@ -115,16 +341,19 @@ def moment_generator(
         else:
             logging.error('Unrecognized input type for mask')
             raise NotImplementedError
+        maskcube = mask
 
         # Ensure the mask is booleans and attach it to the cube. This
         # just assumes a match in astrometry. Could add reprojection
         # here or (better) build a masking routine to apply masks with
         # arbitrary astrometry.
 
-        mask = np.array(mask.filled_data[:].value, dtype=np.bool)
-        cube = cube.with_mask(mask, inherit_mask=False)
+        if not tiled:
+            mask = np.array(mask.filled_data[:].value, dtype=bool)
+            cube = cube.with_mask(mask, inherit_mask=False)
 
     # Read in the noise (if present)
+    noisecube = None
     if noise is not None:        
         if type(noise) is str:
             noisecube = SpectralCube.read(noise)
@@ -136,6 +365,31 @@ def moment_generator(
 
         noisecube.allow_huge_operations = True
 
+    # &%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%
+    # Tiled, memory-bounded moment generation
+    # &%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%
+
+    if tiled:
+        if chunk_shape is None:
+            chunk_shape = chunk_shape_for_memory(
+                cube.shape, max_memory=max_memory)
+        logging.info("Calculating moment in tiles of shape "
+                     +str(tuple(chunk_shape)))
+        moment_map, error_map = _tiled_moment(
+            func, cube, maskcube=maskcube, noisecube=noisecube,
+            chunk_shape=chunk_shape,
+            outfile=outfile, errorfile=errorfile,
+            channel_correlation=channel_correlation,
+            **kwargs)
+        if montecarlo:
+            error_map = _montecarlo_error_map(
+                func, moment, cube, kwargs, error_map,
+                maskcube=maskcube, noisecube=noisecube,
+                chunk_shape=chunk_shape, max_memory=max_memory,
+                channel_correlation=channel_correlation,
+                errorfile=mc_errorfile, mc_kwargs=mc_kwargs)
+        return(moment_map, error_map)
+
     # &%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%
     # Call the moment generation
     # &%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%
@@ -143,19 +397,35 @@ def moment_generator(
     theseargs = (inspect.getfullargspec(func)).args
 
     if 'context' in theseargs:
-        moment_map, error_map = func(
+        products = func(
             cube, rms=noisecube,
             outfile=outfile, errorfile=errorfile,
             channel_correlation=channel_correlation,
             #context=context,
             **kwargs)
     else:
-        moment_map, error_map = func(
+        products = func(
             cube, rms=noisecube,
             outfile=outfile, errorfile=errorfile,
             channel_correlation=channel_correlation,
             **kwargs)
-        
+
+    # Without a noise cube the writers return only the moment map
+    if type(products) is not tuple:
+        products = (products, None)
+    moment_map, error_map = products
+
+    if montecarlo:
+        if chunk_shape is None and max_memory is not None:
+            chunk_shape = chunk_shape_for_memory(
+                cube.shape, max_memory=max_memory)
+        error_map = _montecarlo_error_map(
+            func, moment, cube, kwargs, error_map,
+            maskcube=maskcube, noisecube=noisecube,
+            chunk_shape=chunk_shape, max_memory=max_memory,
+            channel_correlation=channel_correlation,
+            errorfile=mc_errorfile, mc_kwargs=mc_kwargs)
+
     return(moment_map, error_map)
     
 
@@ -0,0 +1,332 @@
+import numpy as np
+import astropy.units as u
+from concurrent.futures import ThreadPoolExecutor
+from scDerivativeRoutines import (channel_width, build_covariance,
+                                  boxcar_smooth, _window_in_channels)
+
+import logging
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.DEBUG)
+
+# &%&%&&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%
+# Monte Carlo moment uncertainties
+# &%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%
+
+# Moments that have a Monte Carlo error estimate
+montecarlo_moments = ['mom0', 'mom1', 'mom2', 'ew', 'tpeak', 'vpeak']
+
+# Approximate number of (nchan, nreal, npix) float64 temporaries held
+# at once while resampling a batch of spectra.
+_mc_temporaries = 6
+
+def noise_factor(nchan, channel_correlation=None):
+    """
+    Return (factor, bandwidth) such that factor @ white has unit
+    variance and the channel-to-channel correlation given by
+    channel_correlation. For a valid correlation the factor is the
+    Cholesky factor of the banded correlation matrix, which is itself
+    banded, and bandwidth is the number of sub-diagonals to apply. If
+    the correlation vector does not give a positive definite matrix the
+    factor comes from an eigendecomposition with negative eigenvalues
+    clipped and bandwidth is None (apply as a dense matrix).
+
+    Returns (None, 0) for uncorrelated noise.
+    """
+    if channel_correlation is None or len(channel_correlation) <= 1:
+        return(None, 0)
+
+    corr = build_covariance(rms=np.ones(nchan),
+                            channel_correlation=np.asarray(
+                                channel_correlation, dtype=np.float64),
+                            index=np.arange(nchan))
+    try:
+        factor = np.linalg.cholesky(corr)
+        bandwidth = min(len(channel_correlation) - 1, nchan - 1)
+    except np.linalg.LinAlgError:
+        logger.warning("Channel correlation is not positive definite. "
+                       "Clipping negative eigenvalues.")
+        evals, evecs = np.linalg.eigh(corr)
+        factor = evecs * np.sqrt(np.clip(evals, 0, None))[np.newaxis, :]
+        bandwidth = None
+    return(factor, bandwidth)
+
+def correlated_noise(rng, shape, factor=None, bandwidth=0):
+    """
+    Draw unit-variance Gaussian noise of shape (nchan, ...) correlated
+    along the first axis according to a factor from noise_factor.
+    """
+    return(correlate_noise(rng.standard_normal(shape), factor=factor,
+                           bandwidth=bandwidth))
+
+def correlate_noise(white, factor=None, bandwidth=0):
+    """
+    Correlate unit-variance white noise of shape (nchan, ...) along
+    the first axis according to a factor from noise_factor.
+    """
+    shape = white.shape
+    if factor is None:
+        return(white)
+    if bandwidth is None:
+        return(np.tensordot(factor, white, axes=(1, 0)))
+    extra = (np.newaxis,) * (len(shape) - 1)
+    noise = np.diagonal(factor)[(slice(None),) + extra] * white
+    for lag in range(1, bandwidth + 1):
+        band = np.diagonal(factor, -lag)[(slice(None),) + extra]
+        noise[lag:] += band * white[:-lag]
+    return(noise)
+
+def pixel_noise(seed, pixels, nchan, n_realizations):
+    """
+    Draw white noise of shape (nchan, n_realizations, len(pixels)).
+    Each pixel has its own stream, the child of SeedSequence(seed)
+    keyed by its (flattened) index in the full image, so the noise a
+    pixel gets does not depend on how the image is tiled or batched.
+    """
+    white = np.empty((len(pixels), nchan, n_realizations))
+    for i, pixel in enumerate(pixels):
+        rng = np.random.Generator(np.random.PCG64(
+            np.random.SeedSequence(seed, spawn_key=(int(pixel),))))
+        rng.standard_normal((nchan, n_realizations), out=white[i])
+    return(np.moveaxis(white, 0, -1))
+
+def _realization_moment(realizations, mask, spaxis, dv,
+                        moment='mom0', nchan_window=None):
+    """
+    Calculate a moment for a stack of realizations with shape
+    (nchan, nreal, npix) and a mask of shape (nchan, npix). Returns an
+    (nreal, npix) array, NaN where the moment is undefined.
+    """
+    mask = mask[:, np.newaxis, :]
+    vel = spaxis[:, np.newaxis, np.newaxis]
+
+    if moment in ['tpeak', 'vpeak']:
+        if nchan_window is not None:
+            realizations = boxcar_smooth(
+                np.where(mask, realizations, np.nan), nchan_window)
+        peak_data = np.where(mask, realizations, -np.inf)
+        argmax = np.argmax(peak_data, axis=0)
+        tmax = np.take_along_axis(peak_data, argmax[np.newaxis], 0)[0]
+        tmax[~np.isfinite(tmax)] = np.nan
+        if moment == 'tpeak':
+            return(tmax)
+        vmax = spaxis[argmax]
+        vmax[np.isnan(tmax)] = np.nan
+        return(vmax)
+
+    weighted = np.where(mask, realizations, 0.0)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        sum0 = weighted.sum(axis=0)
+        sum0 = np.where(np.any(mask, axis=0), sum0, np.nan)
+        if moment == 'mom0':
+            return(sum0 * dv)
+        if moment == 'ew':
+            tmax = np.where(mask, realizations, -np.inf).max(axis=0)
+            return(sum0 * dv / tmax / np.sqrt(2 * np.pi))
+
+        # Work relative to a reference velocity to keep the second
+        # moment well conditioned.
+        vref = np.mean(spaxis)
+        mom1 = (weighted * (vel - vref)).sum(axis=0) / sum0
+        if moment == 'mom1':
+            return(mom1 + vref)
+        var = ((weighted * (vel - vref)**2).sum(axis=0) / sum0
+               - mom1**2)
+        var[var < 0] = np.nan
+        return(np.sqrt(var))
+
+def _montecarlo_tile(cube, rms, mask, view, moment='mom0',
+                     n_realizations=100, percentiles=(16, 84),
+                     seed=None, factor=None, bandwidth=0,
+                     spectral_range=None, nchan_window=None,
+                     max_memory=None, image_nx=None):
+    """
+    Monte Carlo error for one spatial tile (full spectral axis).
+    image_nx is the width of the full image (see pixel_noise).
+    """
+    data = np.asarray(cube.unmasked_data[view].value, dtype=np.float64)
+    noise = np.asarray(rms.unmasked_data[view].value, dtype=np.float64)
+    if mask is None:
+        inmask = np.asarray(cube.mask.include(view=view), dtype=bool)
+    else:
+        inmask = np.asarray(mask.unmasked_data[view].value > 0)
+
+    nchan, ny, nx = data.shape
+    data = data.reshape(nchan, ny * nx)
+    noise = noise.reshape(nchan, ny * nx)
+    inmask = inmask.reshape(nchan, ny * nx)
+
+    # Peak intensity spans the spectral range of the whole mask, with
+    # the same lo:hi slice as write_tmax
+    if spectral_range is not None:
+        spanned = np.zeros(nchan, dtype=bool)
+        spanned[spectral_range[0]:spectral_range[1]] = True
+        observed = np.any(np.isfinite(data), axis=0)
+        inmask = spanned[:, np.newaxis] & observed[np.newaxis, :]
+
+    inmask &= np.isfinite(data)
+    noise[~np.isfinite(noise)] = 0.0
+
+    spaxis = cube.spectral_axis.value
+    dv = channel_width(cube).value
+
+    error = np.full(ny * nx, np.nan)
+    pixels = np.where(np.any(inmask, axis=0))[0]
+    if len(pixels) == 0:
+        return(error.reshape(ny, nx))
+
+    # Index of each pixel in the full image, which keys its noise
+    yy, xx = np.unravel_index(np.arange(ny * nx), (ny, nx))
+    image_index = ((yy + (view[1].start or 0)) * image_nx
+                   + xx + (view[2].start or 0))
+
+    bytes_per_pixel = float(nchan) * n_realizations * 8.0 * _mc_temporaries
+    batch = int(max(max_memory // bytes_per_pixel, 1))
+
+    for start in range(0, len(pixels), batch):
+        these = pixels[start:start + batch]
+        realizations = correlate_noise(
+            pixel_noise(seed, image_index[these], nchan, n_realizations),
+            factor=factor, bandwidth=bandwidth)
+        realizations *= noise[:, np.newaxis, these]
+        realizations += data[:, np.newaxis, these]
+        values = _realization_moment(realizations, inmask[:, these],
+                                     spaxis, dv, moment=moment,
+                                     nchan_window=nchan_window)
+        lo, hi = np.nanpercentile(values, percentiles, axis=0)
+        error[these] = 0.5 * (hi - lo)
+
+    return(error.reshape(ny, nx))
+
+def montecarlo_error(cube, rms=None, mask=None, moment='mom0',
+                     n_realizations=100, percentiles=(16, 84),
+                     channel_correlation=None, seed=0,
+                     n_workers=1, max_memory='1 GB',
+                     chunk_shape=None, window=None,
+                     spectral_range=None):
+    """
+    Estimate the uncertainty in a moment map by resampling the noise.
+
+    For each spatial tile (full spectral axis) n_realizations copies of
+    every masked spectrum are drawn with Gaussian noise from the noise
+    cube, correlated along the spectral axis by channel_correlation,
+    and the moment is recomputed for all of them in one vectorized
+    pass. The error is half the spread between the two percentiles
+    (16th to 84th by default, i.e. 1 sigma for a normal distribution).
+    The mask is held fixed.
+
+    Each pixel gets its own random stream spawned from seed (see
+    pixel_noise), so the result is reproducible for a given seed
+    whatever the tile shape, memory budget, and number of workers.
+
+    Keywords:
+    ---------
+
+    cube : SpectralCube
+        Spectral cube. If mask is None the mask attached to the cube
+        is used.
+
+    rms : SpectralCube
+        Noise cube matched to the cube.
+
+    mask : SpectralCube
+        Optional mask cube (values > 0 are included).
+
+    moment : str
+        One of montecarlo_moments.
+
+    n_realizations : int
+        Number of noise realizations.
+
+    percentiles : tuple
+        Lower and upper percentiles used for the error.
+
+    channel_correlation : np.array
+        One-dimensional array containing the channel-to-channel
+        normalize correlation coefficients
+
+    seed : int
+        Seed for the random number generator. None draws fresh
+        entropy.
+
+    n_workers : int
+        Number of tiles processed at once (threads).
+
+    max_memory : float or str
+        Memory budget in bytes (or e.g. '2 GB') shared by the workers.
+        Bounds n_realizations times the number of spectra resampled
+        at once.
+
+    chunk_shape : tuple
+        Spatial tile shape (ny, nx). Defaults to strips of rows that
+        fit the budget.
+
+    window : astropy.Quantity
+        Spectral smoothing window for the peak products.
+
+    spectral_range : tuple
+        (lo, hi) channel range over which to find the peak for tpeak,
+        applied as the slice lo:hi as in write_tmax. Replaces the
+        mask.
+
+    Returns an astropy Quantity map in the native units of the moment.
+    """
+
+    if moment not in montecarlo_moments:
+        logger.error("No Monte Carlo error for moment: "+str(moment))
+        raise NotImplementedError
+    if rms is None:
+        logger.error("Monte Carlo error requested but no RMS provided")
+        raise ValueError("Monte Carlo error requires a noise cube.")
+
+    if type(max_memory) is str:
+        max_memory = u.Quantity(max_memory).to(u.byte).value
+    n_workers = int(max(n_workers, 1))
+    worker_memory = max_memory / n_workers
+
+    nchan, ny, nx = cube.shape
+    if chunk_shape is None:
+        rows = int(worker_memory // (float(nchan) * nx * 8.0 * 3))
+        chunk_shape = (int(min(max(rows, 1), ny)), nx)
+    tile_y, tile_x = chunk_shape
+    views = [(slice(None), slice(y0, min(y0 + tile_y, ny)),
+              slice(x0, min(x0 + tile_x, nx)))
+             for y0 in range(0, ny, tile_y)
+             for x0 in range(0, nx, tile_x)]
+    if seed is None:
+        seed = np.random.SeedSequence().entropy
+
+    factor, bandwidth = noise_factor(nchan, channel_correlation)
+    nchan_window = None
+    if moment in ['tpeak', 'vpeak']:
+        nchan_window = _window_in_channels(cube, window)
+
+    logger.info("Monte Carlo "+moment+" error with "+str(n_realizations)
+                +" realizations over "+str(len(views))+" tiles.")
+
+    def _run(view):
+        return(_montecarlo_tile(
+            cube, rms, mask, view, moment=moment,
+            n_realizations=n_realizations, percentiles=percentiles,
+            seed=seed, factor=factor, bandwidth=bandwidth,
+            spectral_range=spectral_range, nchan_window=nchan_window,
+            max_memory=worker_memory, image_nx=nx))
+
+    error = np.full((ny, nx), np.nan)
+    if n_workers == 1:
+        results = map(_run, views)
+    else:
+        pool = ThreadPoolExecutor(max_workers=n_workers)
+        results = pool.map(_run, views)
+    for view, tile_error in zip(views, results):
+        error[view[1:]] = tile_error
+    if n_workers > 1:
+        pool.shutdown()
+
+    spec_unit = cube.spectral_axis.unit
+    if moment == 'mom0':
+        error_unit = cube.unit * spec_unit
+    elif moment == 'tpeak':
+        error_unit = cube.unit
+    else:
+        error_unit = spec_unit
+    return(u.Quantity(error, error_unit, copy=False))
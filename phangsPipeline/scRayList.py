@@ -0,0 +1,532 @@
+import warnings
+import numpy as np
+import astropy.units as u
+from spectral_cube import SpectralCube, Projection
+from spectral_cube.utils import NoBeamError
+
+import logging
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.DEBUG)
+
+# &%&%&&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%
+# Ragged (CSR-like) storage of the masked voxels of a cube
+# &%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%
+
+class RayList(object):
+    """
+    Compact ragged representation of the masked voxels in a cube.
+
+    Only voxels inside the mask are stored. They are grouped by
+    spectrum ("ray") and ordered by channel within each ray, so that
+    the voxels of ray i are data[offsets[i]:offsets[i+1]]. Only rays
+    with at least one masked voxel are kept. Reductions along the
+    spectral axis become segmented reductions over the offsets
+    (np.add.reduceat and friends) and memory scales with the masked
+    volume rather than the full cube.
+
+    Attributes:
+    -----------
+
+    shape : tuple
+        Shape (nchan, ny, nx) of the parent cube.
+
+    y, x : np.array
+        Integer pixel coordinates of each ray.
+
+    offsets : np.array
+        Start index of each ray in the voxel arrays, length nray+1.
+
+    chan : np.array
+        Channel index of each stored voxel.
+
+    data : np.array
+        Value of each stored voxel (in unit).
+
+    noise : np.array
+        Noise estimate of each stored voxel, or None.
+
+    observed : np.array
+        Two-dimensional boolean map, True where the parent cube has
+        any finite data along the line of sight.
+
+    noise_median : np.array
+        Two-dimensional map of the median noise along each line of
+        sight of the parent cube (all channels), or None.
+    """
+
+    def __init__(self, shape=None, y=None, x=None, offsets=None,
+                 chan=None, data=None, noise=None,
+                 observed=None, noise_median=None,
+                 spectral_axis=None, unit=None,
+                 wcs=None, header=None, nowcs_header=None, beam=None):
+
+        self.shape = tuple(shape)
+        self.y = y
+        self.x = x
+        self.offsets = offsets
+        self.chan = chan
+        self.data = data
+        self.noise = noise
+        self.observed = observed
+        self.noise_median = noise_median
+        self.spectral_axis = spectral_axis
+        self.unit = unit
+        self.wcs = wcs
+        self.header = header
+        self._nowcs_header = nowcs_header
+        self.beam = beam
+
+    def __repr__(self):
+        return("RayList with {0} rays, {1} voxels, parent shape={2}".format(
+            self.nray, self.nvox, self.shape))
+
+    # &%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%
+    # Basic properties
+    # &%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%
+
+    @property
+    def nray(self):
+        return(len(self.y))
+
+    @property
+    def nvox(self):
+        return(len(self.chan))
+
+    @property
+    def counts(self):
+        """
+        Number of stored voxels in each ray.
+        """
+        return(np.diff(self.offsets))
+
+    @property
+    def ray_index(self):
+        """
+        Ray index of each stored voxel.
+        """
+        return(np.repeat(np.arange(self.nray), self.counts))
+
+    @property
+    def velocity(self):
+        """
+        Spectral coordinate (values only) of each stored voxel.
+        """
+        return(self.spectral_axis.value[self.chan])
+
+    def channel_width(self):
+        """
+        Median absolute channel width of the parent cube as a Quantity.
+        """
+        spaxis = self.spectral_axis
+        return(np.median(np.abs(spaxis[1:] - spaxis[0:-1])))
+
+    # &%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%
+    # Segmented reductions
+    # &%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%
+
+    # Every stored ray has at least one voxel, so reduceat over
+    # offsets[:-1] never sees an empty segment.
+
+    def segment_sum(self, values):
+        """
+        Sum a per-voxel array over each ray.
+        """
+        if self.nray == 0:
+            return(np.zeros(0))
+        return(np.add.reduceat(values, self.offsets[:-1]))
+
+    def segment_max(self, values):
+        """
+        Maximum of a per-voxel array over each ray.
+        """
+        if self.nray == 0:
+            return(np.zeros(0))
+        return(np.maximum.reduceat(values, self.offsets[:-1]))
+
+    def segment_argmax(self, values):
+        """
+        Index (into the voxel arrays) of the first maximum of a
+        per-voxel array in each ray.
+        """
+        if self.nray == 0:
+            return(np.zeros(0, dtype=np.int64))
+        peak = np.repeat(self.segment_max(values), self.counts)
+        candidate = np.where(values == peak, np.arange(self.nvox), self.nvox)
+        return(np.minimum.reduceat(candidate, self.offsets[:-1]))
+
+    def broadcast(self, ray_values):
+        """
+        Expand a per-ray array to a per-voxel array.
+        """
+        return(np.repeat(ray_values, self.counts))
+
+    def quadratic_form(self, weights, channel_correlation=None):
+        """
+        For each ray return sum_ij w_i w_j C_ij, where C is the noise
+        covariance built from the stored noise and the
+        channel_correlation vector (see build_covariance in
+        scDerivativeRoutines). Correlated pairs are found by
+        searching for the partner voxel at each channel lag, so this
+        stays vectorized over all rays.
+        """
+        if self.noise is None:
+            raise ValueError("RayList has no noise attached.")
+
+        a = np.nan_to_num(weights * self.noise.astype(np.float64))
+        if channel_correlation is None or len(channel_correlation) == 1:
+            return(self.segment_sum(a**2))
+
+        channel_correlation = np.asarray(channel_correlation, dtype=float)
+        result = channel_correlation[0] * self.segment_sum(a**2)
+
+        ray_index = self.ray_index
+        key = ray_index.astype(np.int64) * self.shape[0] + self.chan
+        for lag in range(1, len(channel_correlation)):
+            if channel_correlation[lag] == 0:
+                continue
+            partner = np.searchsorted(key, key + lag)
+            partner = np.clip(partner, 0, self.nvox - 1)
+            paired = key[partner] == (key + lag)
+            if not np.any(paired):
+                continue
+            result += 2 * channel_correlation[lag] * np.bincount(
+                ray_index[paired],
+                weights=a[paired] * a[partner[paired]],
+                minlength=self.nray)
+        return(result)
+
+    # &%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%
+    # Conversion back to dense
+    # &%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%
+
+    def to_map(self, ray_values, fill=np.nan):
+        """
+        Scatter a per-ray array into a two-dimensional map.
+        """
+        image = np.full(self.shape[1:], fill, dtype=float)
+        image[self.y, self.x] = ray_values
+        return(image)
+
+    def to_projection(self, image, unit=None):
+        """
+        Attach a two-dimensional map to the celestial WCS of the parent
+        cube, mirroring the output of spectral-cube's moment methods.
+        """
+        if unit is not None:
+            image = u.Quantity(image, unit, copy=False)
+        return(Projection(image, wcs=self.wcs.celestial,
+                          header=self._nowcs_header,
+                          meta={'moment_axis': 0},
+                          beam=self.beam))
+
+    def voxels_at(self, y, x):
+        """
+        Stored voxels of the rays at the requested pixels. Returns,
+        for each voxel, the position of its pixel in (y, x) and its
+        index into the voxel arrays, grouped by pixel and ordered by
+        channel. Pixels without a ray have no voxels.
+        """
+        y = np.atleast_1d(y)
+        x = np.atleast_1d(x)
+        nx = self.shape[2]
+
+        pix_key = self.y.astype(np.int64) * nx + self.x
+        want_key = y.astype(np.int64) * nx + x
+
+        # Ray keys are sorted because rays are built in raster order
+        ray = np.searchsorted(pix_key, want_key)
+        ray = np.clip(ray, 0, max(self.nray - 1, 0))
+        found = np.zeros(len(y), dtype=bool)
+        if self.nray > 0:
+            found = pix_key[ray] == want_key
+
+        # Gather the voxels of all found rays at once: repeat each
+        # column and ray start over the voxels of that ray.
+        column = np.where(found)[0]
+        if len(column) == 0:
+            return(np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64))
+        counts = self.counts[ray[column]]
+        first = np.cumsum(counts) - counts
+        voxel = (np.repeat(self.offsets[ray[column]] - first, counts)
+                 + np.arange(np.sum(counts)))
+        return(np.repeat(column, counts), voxel)
+
+    def spectra_at(self, y, x, values=None, fill=np.nan):
+        """
+        Return dense spectra of shape (nchan, len(y)) for the requested
+        pixels. Channels outside the mask are set to fill (NaN by
+        default, as in the filled_data of a masked SpectralCube).
+        """
+        if values is None:
+            values = self.data
+        y = np.atleast_1d(y)
+        spectra = np.full((self.shape[0], len(y)), fill, dtype=float)
+        column, voxel = self.voxels_at(y, x)
+        spectra[self.chan[voxel], column] = values[voxel]
+        return(spectra)
+
+    # &%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%
+    # Moments
+    # &%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%
+
+    def moments(self, channel_correlation=None):
+        """
+        Calculate the intensity-weighted moments, the peak, and the
+        analytic errors (when noise is attached) in one pass over the
+        stored voxels. Returns a dictionary of per-ray arrays in the
+        native units of the cube and spectral axis.
+
+        The errors follow the same analytic expressions as the dense
+        writers in scDerivativeRoutines.
+        """
+
+        dv = self.channel_width().value
+        vval = self.velocity
+        data = self.data.astype(np.float64)
+
+        sum_T = self.segment_sum(data)
+        sum_vT = self.segment_sum(data * vval)
+        mom1 = sum_vT / sum_T
+        dvel = vval - self.broadcast(mom1)
+        wtvdisp = self.segment_sum(data * dvel**2)
+        mom2 = np.sqrt(wtvdisp / sum_T)
+
+        peak_index = self.segment_argmax(data)
+        tmax = data[peak_index]
+        mom0 = sum_T * dv
+
+        products = {
+            'sum': sum_T,
+            'mom0': mom0,
+            'mom1': mom1,
+            'mom2': mom2,
+            'tmax': tmax,
+            'peak_chan': self.chan[peak_index],
+            'vmax': vval[peak_index],
+            'ew': mom0 / tmax / np.sqrt(2 * np.pi),
+            }
+
+        if self.noise is None:
+            return(products)
+
+        ones = np.ones_like(data)
+        sumsq = self.quadratic_form(ones, channel_correlation)
+        products['mom0err'] = np.sqrt(sumsq) * dv
+
+        jac1 = dvel / self.broadcast(sum_T)
+        products['mom1err'] = self.quadratic_form(
+            jac1, channel_correlation)**0.5
+
+        # Same fourth-root convention as write_moment2
+        jac2 = (dvel**2 - self.broadcast(mom2)**2) / self.broadcast(sum_T)
+        products['mom2err'] = self.quadratic_form(
+            jac2, channel_correlation)**0.25
+
+        rms_at_max = self.noise[peak_index]
+        products['tmaxerr'] = rms_at_max
+        products['vmaxerr'] = np.full(self.nray, dv)
+
+        ew = products['ew']
+        term1 = sumsq * dv**2 / (2 * np.pi * tmax**2)
+        term2 = (ew**2 - ew * dv / np.sqrt(2 * np.pi)) * rms_at_max**2
+        products['ewerr'] = (term1 + term2)**0.5
+
+        return(products)
+
+# &%&%&&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%
+# Construction
+# &%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%
+
+def _read_cube(cubein, name='cube'):
+    if type(cubein) is str:
+        return(SpectralCube.read(cubein))
+    elif isinstance(cubein, SpectralCube):
+        return(cubein)
+    logger.error('Unrecognized input type for '+name)
+    raise NotImplementedError
+
+
+def build_raylist(cubein, mask=None, noise=None, rows_per_chunk=16):
+    """
+    Build a RayList from a cube, an optional mask, and an optional
+    noise cube in a single pass over the data.
+
+    The cube is read in slabs of full spectral extent and
+    rows_per_chunk rows. For FITS files read with memory mapping only
+    one slab of the cube, mask, and noise is resident at any time, so
+    the peak memory scales with the slab plus the masked volume.
+
+    Keywords:
+    ---------
+
+    cubein : SpectralCube or str
+        Spectral cube or file name.
+
+    mask : SpectralCube, str, or np.array
+        Boolean mask (True = keep). If None, the mask attached to the
+        cube is used.
+
+    noise : SpectralCube or str
+        Noise cube on the same grid as the data.
+
+    rows_per_chunk : int
+        Number of image rows to read at once.
+    """
+
+    cube = _read_cube(cubein, name='cubein')
+    cube = cube.to(u.K)
+
+    maskcube = None
+    if mask is not None:
+        if type(mask) is np.ndarray:
+            maskcube = mask
+        else:
+            maskcube = _read_cube(mask, name='mask')
+
+    noisecube = None
+    if noise is not None:
+        noisecube = _read_cube(noise, name='noise')
+
+    nchan, ny, nx = cube.shape
+    rows_per_chunk = int(np.clip(rows_per_chunk, 1, ny))
+
+    y_list, x_list, count_list = [], [], []
+    chan_list, data_list, noise_list = [], [], []
+    observed = np.zeros((ny, nx), dtype=bool)
+    noise_median = None
+    if noisecube is not None:
+        noise_median = np.full((ny, nx), np.nan)
+
+    for y0 in range(0, ny, rows_per_chunk):
+        y1 = min(y0 + rows_per_chunk, ny)
+        view = (slice(None), slice(y0, y1), slice(None))
+
+        slab = np.asarray(cube.unmasked_data[view].value)
+        finite = np.isfinite(slab)
+        observed[y0:y1, :] = np.any(finite, axis=0)
+
+        if maskcube is None:
+            slabmask = cube.mask.include(view=view)
+        elif type(maskcube) is np.ndarray:
+            slabmask = maskcube[view].astype(bool)
+        else:
+            slabmask = np.asarray(maskcube.unmasked_data[view].value) > 0
+        slabmask = np.logical_and(slabmask, finite)
+
+        if noisecube is not None:
+            noiseslab = np.asarray(noisecube.unmasked_data[view].value)
+            noise_median[y0:y1, :] = np.nanmedian(noiseslab, axis=0)
+
+        # Transpose so voxels come out grouped by (y, x) and ordered
+        # by channel within each ray.
+        yy, xx, cc = np.nonzero(slabmask.transpose(1, 2, 0))
+        if len(cc) == 0:
+            continue
+
+        pix = yy.astype(np.int64) * nx + xx
+        starts = np.r_[0, np.flatnonzero(np.diff(pix)) + 1]
+        y_list.append(yy[starts] + y0)
+        x_list.append(xx[starts])
+        count_list.append(np.diff(np.r_[starts, len(pix)]))
+        chan_list.append(cc)
+        data_list.append(slab[cc, yy, xx])
+        if noisecube is not None:
+            noise_list.append(noiseslab[cc, yy, xx])
+
+    def _stack(pieces, dtype):
+        if len(pieces) == 0:
+            return(np.zeros(0, dtype=dtype))
+        return(np.concatenate(pieces).astype(dtype, copy=False))
+
+    counts = _stack(count_list, np.int64)
+    offsets = np.r_[0, np.cumsum(counts)].astype(np.int64)
+
+    # ... spectral-cube raises (rather than returning None) without a beam
+    try:
+        beam = cube.beam
+    except (AttributeError, NoBeamError):
+        beam = None
+
+    raylist = RayList(
+        shape=cube.shape,
+        y=_stack(y_list, np.int64),
+        x=_stack(x_list, np.int64),
+        offsets=offsets,
+        chan=_stack(chan_list, np.int64),
+        data=_stack(data_list, np.float32),
+        noise=(_stack(noise_list, np.float32)
+               if noisecube is not None else None),
+        observed=observed,
+        noise_median=noise_median,
+        spectral_axis=cube.spectral_axis,
+        unit=cube.unit,
+        wcs=cube.wcs,
+        header=cube.header,
+        nowcs_header=cube._nowcs_header,
+        beam=beam)
+
+    logger.info("Built "+str(raylist))
+    return(raylist)
+
+def raylist_from_spectra(spectra, spectral_axis, noise=None, include=None,
+                         unit=None):
+    """
+    Build a RayList from a dense stack of spectra (Nv x Nspec), e.g.
+    stacked spectra or the lines of sight of a shuffled cube, so the
+    vectorized moments can be applied to them. Spectrum i becomes the
+    ray at y=0, x=i of a (Nv, 1, Nspec) parent. Spectra without any
+    included channel are dropped (check the x attribute).
+
+    Keywords:
+    ---------
+
+    spectra : np.array
+        Spectra with the spectral axis first.
+
+    spectral_axis : astropy.Quantity
+        Spectral axis of the spectra.
+
+    noise : np.array
+        Noise (one sigma) matched to spectra.
+
+    include : np.array
+        Boolean array matched to spectra (True = keep). Non-finite
+        data are always excluded.
+
+    unit : astropy.Unit
+        Unit of the spectra.
+    """
+
+    spectra = np.asarray(spectra, dtype=np.float64)
+    nchan, nspec = spectra.shape
+    keep = np.isfinite(spectra)
+    if include is not None:
+        keep &= np.asarray(include, dtype=bool)
+
+    # Transpose so voxels come out grouped by spectrum and ordered by
+    # channel within each ray.
+    ss, cc = np.nonzero(keep.T)
+    starts = np.zeros(0, dtype=np.int64)
+    if len(ss) > 0:
+        starts = np.r_[0, np.flatnonzero(np.diff(ss)) + 1]
+    offsets = np.r_[starts, len(ss)].astype(np.int64)
+
+    noise_median = None
+    if noise is not None:
+        noise = np.asarray(noise, dtype=np.float64)
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore', RuntimeWarning)
+            noise_median = np.nanmedian(noise, axis=0)[np.newaxis, :]
+
+    return(RayList(
+        shape=(nchan, 1, nspec),
+        y=np.zeros(len(starts), dtype=np.int64),
+        x=ss[starts].astype(np.int64),
+        offsets=offsets,
+        chan=cc.astype(np.int64),
+        data=spectra[cc, ss],
+        noise=(noise[cc, ss] if noise is not None else None),
+        observed=np.any(np.isfinite(spectra), axis=0)[np.newaxis, :],
+        noise_median=noise_median,
+        spectral_axis=spectral_axis,
+        unit=unit))
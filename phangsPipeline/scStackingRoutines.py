@@ -1,26 +1,239 @@
+import os
+import time
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
 import scipy.ndimage as nd
 import astropy.units as u
 from spectral_cube import SpectralCube
 import astropy.wcs as wcs
+from astropy.io import fits
+from scRayList import RayList
 
-def channelShiftVec(x, ChanShift):
-    # Shift an array of spectra (x) by a set number of Channels (array)
-    ftx = np.fft.fft(x, axis=0)
-    m = np.fft.fftfreq(x.shape[0])
-    phase = np.exp(-2 * np.pi * m[:, np.newaxis]
-                   * 1j * ChanShift[np.newaxis, :])
-    x2 = np.real(np.fft.ifft(ftx * phase, axis=0))
+import logging
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.DEBUG)
+
+# &%&%&&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%
+# Channel shift engine
+# &%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%
+
+shift_modes = ['fft', 'integer', 'lanczos', 'auto']
+
+# Shifts closer than this (in channels) to a whole number count as
+# integer shifts for mode='auto'
+_integer_shift_tol = 1e-6
+
+# Half-width (in channels) of the Lanczos interpolation kernel
+_lanczos_a = 3
+
+def _resolve_shift_mode(ChanShift, mode='auto'):
+    # Pick the shift mode. 'auto' uses an exact index gather when all
+    # the shifts are whole channels and the FFT otherwise.
+    if mode not in shift_modes:
+        logger.error("Unknown channel shift mode: "+str(mode))
+        raise NotImplementedError
+    if mode != 'auto':
+        return(mode)
+    ChanShift = np.asarray(ChanShift)
+    finite = np.isfinite(ChanShift)
+    if np.all(np.abs(ChanShift[finite] - np.round(ChanShift[finite]))
+              < _integer_shift_tol):
+        return('integer')
+    return('fft')
+
+def _padded_index(x, offset, margin, fill=0.0):
+    # Lay the spectra out along rows (Nspec x Nv), padded with margin
+    # channels of fill on each side, and return the flattened array
+    # with the flat index of channel n - offset for each spectrum and
+    # output channel. Indices further than margin / 2 outside the band
+    # are clipped, so taps up to margin / 2 away from them still land
+    # in the padding. Gathering along rows keeps the reads contiguous.
+    nchan, nspec = x.shape
+    width = nchan + 2 * margin
+    padded = np.full((nspec, width), fill, dtype=x.dtype)
+    padded[:, margin:margin + nchan] = x.T
+    index = np.arange(nchan)[np.newaxis, :] - offset[:, np.newaxis]
+    index = np.clip(index, -(margin // 2), nchan - 1 + margin // 2) + margin
+    index += (np.arange(nspec) * width)[:, np.newaxis]
+    return(padded.ravel(), index)
+
+def _lanczos_weights(frac, a=_lanczos_a):
+    # Normalized Lanczos weights for taps k = -a+1 ... a at fractional
+    # offset frac, shape (2a, nspec).
+    taps = np.arange(-a + 1, a + 1)[:, np.newaxis] - frac[np.newaxis, :]
+    weights = np.sinc(taps) * np.sinc(taps / a)
+    return(weights / np.sum(weights, axis=0)[np.newaxis, :])
+
+def channelShiftVec(x, ChanShift, mode='auto', fill=0.0):
+    """
+    Shift an array of spectra (x, Nv x Nspec) by a set number of
+    channels (ChanShift, one per spectrum), so that the output at
+    channel n is the input at channel n - ChanShift.
+
+    Keywords:
+    ---------
+
+    mode : str
+        'fft' applies the shift as a phase gradient in the Fourier
+        domain (exact for band-limited data, wraps around the band).
+        'integer' rounds the shifts to whole channels and gathers them
+        by index. 'lanczos' interpolates fractional shifts with a short
+        Lanczos kernel. Neither of the latter wraps around. 'auto' uses
+        'integer' when all shifts are whole channels and 'fft'
+        otherwise.
+
+    fill : float
+        Value of channels shifted in from outside the band for the
+        'integer' and 'lanczos' modes.
+    """
+    ChanShift = np.atleast_1d(ChanShift)
+    mode = _resolve_shift_mode(ChanShift, mode=mode)
+
+    if mode == 'fft':
+        # The real transform matches the real part of the full complex
+        # shift, including the Nyquist channel.
+        nchan = x.shape[0]
+        ftx = np.fft.rfft(x, axis=0)
+        m = np.fft.rfftfreq(nchan)
+        phase = np.exp(-2 * np.pi * m[:, np.newaxis]
+                       * 1j * ChanShift[np.newaxis, :])
+        x2 = np.fft.irfft(ftx * phase, n=nchan, axis=0)
+        return(x2)
+
+    x = np.asarray(x, dtype=float)
+    finite = np.isfinite(ChanShift)
+    if mode == 'integer':
+        offset = np.where(finite, np.round(ChanShift), 0).astype(int)
+        padded, index = _padded_index(x, offset, 2, fill=fill)
+        x2 = padded[index]
+    else:
+        whole = np.where(finite, np.floor(ChanShift), 0)
+        weights = _lanczos_weights(np.where(finite, ChanShift - whole, 0))
+        padded, index = _padded_index(x, whole.astype(int),
+                                      2 * _lanczos_a + 2, fill=fill)
+        x2 = np.zeros(index.shape)
+        for tap, weight in zip(range(-_lanczos_a + 1, _lanczos_a + 1),
+                               weights):
+            x2 += weight[:, np.newaxis] * padded[index - tap]
+    x2 = x2.T
+    # Spectra without a defined shift are blank, as with the FFT
+    x2[:, ~finite] = np.nan
     return(x2)
 
-def ShuffleCube(DataCube, centroid_map, chunk=1000):
+def benchmark_channel_shift(nchan=256, nspec=10000, repeat=3, seed=0):
+    """
+    Time each channel shift mode on random spectra with random
+    fractional shifts. Returns a dictionary of the best time (s) per
+    mode, with 'auto' timed on whole-channel shifts.
+    """
+    rng = np.random.default_rng(seed)
+    spectra = rng.standard_normal((nchan, nspec))
+    shifts = rng.uniform(-nchan / 4., nchan / 4., nspec)
+    timings = {}
+    for mode in shift_modes:
+        these_shifts = np.round(shifts) if mode == 'auto' else shifts
+        best = np.inf
+        for ii in range(repeat):
+            start = time.time()
+            channelShiftVec(spectra, these_shifts, mode=mode)
+            best = min(best, time.time() - start)
+        timings[mode] = best
+        logger.info("Channel shift mode "+mode+": "+str(best)+" s for "
+                    +str(nspec)+" spectra of "+str(nchan)+" channels.")
+    return(timings)
+
+def _channel_shift(spectral_axis, centroids):
+    # Shift (in channels) that moves each centroid to the middle
+    # channel of the spectral axis.
+    spaxis = spectral_axis.value
+    relative_channel = np.arange(len(spaxis)) - (len(spaxis) // 2)
+    centroids = u.Quantity(centroids).to(spectral_axis.unit).value
+    sortindex = np.argsort(spaxis)
+    return(-1 * np.interp(centroids, spaxis[sortindex],
+                          np.array(relative_channel[sortindex], dtype=float)))
+
+def extract_spectra(DataCube, y, x):
+    # Return dense spectra (Nv x len(y)) from a SpectralCube or a
+    # RayList. Voxels outside the mask are NaN in both cases.
+    if isinstance(DataCube, RayList):
+        return(DataCube.spectra_at(y, x))
+    return(DataCube.filled_data[:, y, x].value)
+
+def _shuffle_tile(DataCube, centroid_map, view, output,
+                  blank_threshold=0.5, shift_mode='fft'):
+    """
+    Shuffle one spatial tile (full spectral axis) of DataCube into the
+    matching region of output.
+    """
+    ysl, xsl = view
+    tile_centroids = centroid_map[ysl, xsl]
+    ty, tx = np.where(np.isfinite(tile_centroids))
+    tile = np.full((output.shape[0],) + tile_centroids.shape, np.nan,
+                   dtype=output.dtype)
+    if len(ty) > 0:
+        if isinstance(DataCube, RayList):
+            spectrum = extract_spectra(DataCube, ty + ysl.start,
+                                       tx + xsl.start)
+        else:
+            spectrum = DataCube.filled_data[:, ysl, xsl].value[:, ty, tx]
+        channel_shift = _channel_shift(DataCube.spectral_axis,
+                                       tile_centroids[ty, tx])
+        baddata = ~np.isfinite(spectrum)
+        shifted_spectrum = channelShiftVec(np.nan_to_num(spectrum),
+                                           channel_shift, mode=shift_mode)
+        # Blank the channels that mostly came from blank input channels
+        # or, without wraparound, from outside the band
+        if np.any(baddata) or shift_mode != 'fft':
+            shifted_mask = channelShiftVec(baddata.astype(float),
+                                           channel_shift, mode=shift_mode,
+                                           fill=1.0)
+            shifted_spectrum[shifted_mask > blank_threshold] = np.nan
+        tile[:, ty, tx] = shifted_spectrum
+    output[:, ysl, xsl] = tile
+
+def _fits_memmap(outfile, header, shape, overwrite=False):
+    """
+    Create a float32 FITS file with the given header and shape without
+    holding the data in memory and return a writeable memmap of its
+    data section.
+    """
+    if os.path.isfile(outfile) and not overwrite:
+        raise IOError("File exists: "+outfile)
+    # A placeholder array fixes BITPIX and the order of the NAXISn
+    # cards, then the axis lengths are set to the real shape.
+    hdr = fits.PrimaryHDU(data=np.zeros((1,) * len(shape), dtype=np.float32),
+                          header=header).header
+    for ii, length in enumerate(shape[::-1]):
+        hdr['NAXIS'+str(ii + 1)] = length
+    header_bytes = hdr.tostring().encode('ascii')
+    nbytes = int(np.prod(shape)) * 4
+    padded = nbytes + (-nbytes % 2880)
+    with open(outfile, 'wb') as fobj:
+        fobj.write(header_bytes)
+        fobj.seek(len(header_bytes) + padded - 1)
+        fobj.write(b'\0')
+    return(np.memmap(outfile, dtype='>f4', mode='r+',
+                     offset=len(header_bytes), shape=shape))
+
+def ShuffleCube(DataCube, centroid_map, chunk=1000, n_workers=1,
+                outfile=None, overwrite=False, scratch_dir=None,
+                blank_threshold=0.5, shift_mode='auto'):
     """
     Shuffles cube so that the velocity appearing in the centroid_map is set 
     to the middle channel and velocity centroid.
+
+    The cube is read in contiguous spatial tiles of about chunk spectra,
+    shifted, and written into a memory-mapped float32 output, so the
+    shuffled cube never has to fit in memory alongside the original.
+    Tiles are processed by a pool of n_workers threads. An output
+    channel is blank where more than blank_threshold of it came from
+    blank input channels (after shifting the mask of blank channels
+    along with the data).
     
     Parameters
     ----------
-    DataCube : SpectralCube
+    DataCube : SpectralCube or RayList
         The original spectral cube with spatial dimensions Nx, Ny and spectral dimension Nv
     centroid_map : 2D numpy.ndarray
         A 2D map of the centroid velocities for the lines to stack of dimensions Nx, Ny.
@@ -31,51 +244,97 @@ def ShuffleCube(DataCube, centroid_map, chunk=1000):
     --------
     chunk : int
         Number of data points to include in a chunk for processing.
+
+    n_workers : int
+        Number of tiles processed at once (threads).
+
+    outfile : str
+        If set, the shuffled cube is written to this FITS file and read
+        back from it. Otherwise it lives in a temporary memory map in
+        scratch_dir (default: the system temporary directory).
+
+    overwrite : bool
+        Overwrite an existing outfile.
+
+    blank_threshold : float
+        Fraction of an output channel that may come from blank input
+        channels before it is blanked.
+
+    shift_mode : str
+        Channel shift mode (see channelShiftVec). 'auto' is resolved
+        once from the shifts of the whole map. For whole-channel shifts
+        it gathers by index, so unlike 'fft' nothing wraps around the
+        band edges.
     
     Returns
     -------
-    OutCube : np.array
+    OutCube : SpectralCube
         Output SpectralCube cube shuffled so that the emission is at 0.
  
     """
 
     spaxis = DataCube.spectral_axis
-    y, x = np.where(np.isfinite(centroid_map))
-    centroid_map = centroid_map.to(spaxis.unit)
-    v0 = spaxis[len(spaxis) // 2]
-    newspaxis = spaxis - v0
-    relative_channel = np.arange(len(spaxis)) - (len(spaxis) // 2)
-    centroids = centroid_map[y, x]
-    sortindex = np.argsort(spaxis)
-    channel_shift = -1 * np.interp(centroids, spaxis[sortindex],
-                                   np.array(relative_channel[sortindex], dtype=np.float))
-    NewCube = np.empty(DataCube.shape)
-    NewCube.fill(np.nan)
-    nchunk = (len(x) // chunk)
-    for thisx, thisy, thisshift in zip(np.array_split(x, nchunk), 
-                                       np.array_split(y, nchunk),
-                                       np.array_split(channel_shift, nchunk)):
-        spectrum = DataCube.filled_data[:, thisy, thisx].value
-        baddata = ~np.isfinite(spectrum)
-        shifted_spectrum = channelShiftVec(np.nan_to_num(spectrum),
-                                           np.atleast_1d(thisshift))
-        shifted_mask = channelShiftVec(baddata, np.atleast_1d(thisshift))
-        shifted_spectrum[baddata>0] = np.nan
-        NewCube[:, thisy, thisx] = shifted_spectrum
-    hdr = DataCube.header
+    centroid_map = u.Quantity(centroid_map).to(spaxis.unit)
+    nchan, ny, nx = DataCube.shape
+    shift_mode = _resolve_shift_mode(
+        _channel_shift(spaxis, centroid_map[np.isfinite(centroid_map)]),
+        mode=shift_mode)
+
+    hdr = DataCube.header.copy()
     hdr['CRVAL3'] = 0.0
     hdr['CRPIX3'] = len(spaxis) // 2 + 1
     newwcs = wcs.WCS(hdr)
+
+    if outfile is not None:
+        NewCube = _fits_memmap(outfile, hdr, DataCube.shape,
+                               overwrite=overwrite)
+    else:
+        scratch = tempfile.mkdtemp(dir=scratch_dir)
+        scratchfile = os.path.join(scratch, 'shuffle.dat')
+        NewCube = np.memmap(scratchfile, dtype=np.float32, mode='w+',
+                            shape=DataCube.shape)
+        # The buffer stays valid after its file is unlinked
+        os.remove(scratchfile)
+        os.rmdir(scratch)
+
+    # Strips of whole rows when they fit in a chunk, else row segments
+    tile_y = int(max(min(chunk // nx, ny), 1))
+    tile_x = int(min(max(chunk, 1), nx)) if tile_y == 1 else nx
+    views = [(slice(y0, min(y0 + tile_y, ny)), slice(x0, min(x0 + tile_x, nx)))
+             for y0 in range(0, ny, tile_y)
+             for x0 in range(0, nx, tile_x)]
+
+    def _run(view):
+        _shuffle_tile(DataCube, centroid_map, view, NewCube,
+                      blank_threshold=blank_threshold,
+                      shift_mode=shift_mode)
+
+    n_workers = int(max(n_workers, 1))
+    if n_workers == 1:
+        for view in views:
+            _run(view)
+    else:
+        with ThreadPoolExecutor(max_workers=n_workers) as pool:
+            list(pool.map(_run, views))
+    NewCube.flush()
+
+    if outfile is not None:
+        del NewCube
+        return(SpectralCube.read(outfile))
     return(SpectralCube(NewCube, newwcs, header=hdr))
 
 
-def BinByMask(DataCube, mask, centroid_map, weight_map=None):
+def BinByMask(DataCube, mask, centroid_map, weight_map=None,
+              shift_mode='auto'):
     """
     Bin a data cube by a label mask, aligning the data to a common centroid.  Returns an array.
 
+    This is BinByLabel with a single label: each channel of the
+    stack is the weighted mean of the spectra that have data there.
+
     Parameters
     ----------
-    DataCube : SpectralCube
+    DataCube : SpectralCube or RayList
         The original spectral cube with spatial dimensions Nx, Ny and spectral dimension Nv
     Mask : 2D numpy.ndarray
         A 2D map containing boolean values with True indicate where the spectra should be aggregated.
@@ -84,65 +343,346 @@ def BinByMask(DataCube, mask, centroid_map, weight_map=None):
         Note that DataCube and Centroid map must have equivalent spectral units (e.g., km/s)
     weight_map : 2D numpy.ndarray
         Map containing the weight values to be used in averaging
+    shift_mode : str
+        Channel shift mode (see channelShiftVec and BinByLabel). Note
+        that the default, 'auto', shifts whole-channel offsets by index
+        rather than with the FFT. Channels shifted in from beyond the
+        band then no longer wrap around: they are left out of the
+        stack, and channels that no spectrum covers are NaN. Pass
+        shift_mode='fft' for the FFT shifts of earlier versions (for a
+        SpectralCube; a RayList always uses 'integer' or 'lanczos').
     Returns
     -------
     Spectrum : np.array
         Spectrum of average over mask.
     """
-    spaxis = DataCube.spectral_axis.value
-    y, x = np.where(mask)
-    v0 = spaxis[len(spaxis) // 2] * DataCube.spectral_axis.unit
-    relative_channel = np.arange(len(spaxis)) - (len(spaxis) // 2)
-    centroids = centroid_map[y, x].to(DataCube.spectral_axis.unit).value
-    sortindex = np.argsort(spaxis)
-    channel_shift = -1 * np.interp(centroids, spaxis[sortindex],
-                                   np.array(relative_channel[sortindex], dtype=np.float))
-    spectra = DataCube.filled_data[:, y, x].value
-    shifted_spectra = channelShiftVec(spectra, channel_shift)
-    if weight_map is not None:
-        wts = weight_map[y, x]
+    output_list, labels = BinByLabel(DataCube, np.asarray(mask, dtype=bool).astype(int),
+                                     centroid_map, weight_map=weight_map,
+                                     background_labels=[0],
+                                     shift_mode=shift_mode)
+    spaxis = DataCube.spectral_axis
+    shifted_spaxis = spaxis - spaxis[len(spaxis) // 2]
+    if len(output_list) == 0:
+        return(np.full(len(spaxis), np.nan), shifted_spaxis)
+    return(output_list[0]['spectrum'], shifted_spaxis)
+
+
+def _shift_variance_factor(ChanShift, mode, channel_correlation=None):
+    # Ratio of the variance of a shifted noise channel to the variance
+    # of the input channels for each spectrum. The FFT and integer
+    # shifts preserve the variance of (stationary) noise; interpolation
+    # averages neighbouring channels and reduces it.
+    ChanShift = np.atleast_1d(ChanShift)
+    if mode != 'lanczos':
+        return(np.ones(len(ChanShift)))
+    finite = np.isfinite(ChanShift)
+    frac = np.where(finite, ChanShift - np.floor(np.where(finite, ChanShift, 0)), 0)
+    weights = _lanczos_weights(frac)
+    ntap = weights.shape[0]
+    lag = np.abs(np.arange(ntap)[:, np.newaxis] - np.arange(ntap)[np.newaxis, :])
+    rho = np.zeros(ntap)
+    rho[0] = 1.0
+    if channel_correlation is not None:
+        cc = np.asarray(channel_correlation, dtype=float)[:ntap]
+        rho[1:len(cc)] = cc[1:]
+    return(np.einsum('ks,kl,ls->s', weights, rho[lag], weights))
+
+def _shift_voxels(spec, chan, values, ChanShift, mode, nchan,
+                  variance=None, blank_threshold=0.5):
+    """
+    Shift the stored (valid) voxels of a set of spectra without
+    filling in the rest of the channels. spec and chan give the
+    spectrum (index into ChanShift) and channel of each voxel, sorted
+    by spectrum. Each voxel is scattered to the output channels that
+    the 'integer' or 'lanczos' shift of channelShiftVec would gather
+    it into. The summed tap weights are the coverage of each output
+    channel by valid input channels; channels with less than 1 -
+    blank_threshold coverage are dropped.
+
+    Returns the spectrum, output channel, shifted value, coverage and
+    (if variance is given) shifted variance of each kept channel.
+    """
+    ChanShift = np.atleast_1d(ChanShift)
+    finite = np.isfinite(ChanShift)
+    if mode == 'integer':
+        offset = np.where(finite, np.round(ChanShift), 0).astype(int)
+        taps = np.zeros(1, dtype=int)
+        weights = np.ones((1, len(ChanShift)))
     else:
-        wts = np.ones_like(channel_shift)
-    accum_spectrum = np.nansum(wts[np.newaxis, :]
-                               * shifted_spectra, axis=1) / np.nansum(wts)
-    shifted_spaxis = (DataCube.spectral_axis - v0)
-    return(accum_spectrum, shifted_spaxis)
+        whole = np.where(finite, np.floor(ChanShift), 0)
+        weights = _lanczos_weights(np.where(finite, ChanShift - whole, 0))
+        offset = whole.astype(int)
+        taps = np.arange(-_lanczos_a + 1, _lanczos_a + 1)
 
+    # Input channel c of a spectrum lands in c + offset + tap
+    out = (chan[np.newaxis, :] + offset[spec][np.newaxis, :]
+           + taps[:, np.newaxis])
+    use = (out >= 0) & (out < nchan) & finite[spec][np.newaxis, :]
+    key = (spec.astype(np.int64)[np.newaxis, :] * nchan + out)[use]
+    key, inverse = np.unique(key, return_inverse=True)
+    tapw = weights[:, spec][use]
+
+    def _scatter(these_values):
+        return(np.bincount(inverse, weights=tapw * np.broadcast_to(
+            these_values, out.shape)[use], minlength=len(key)))
+
+    shifted = _scatter(values)
+    cover = np.bincount(inverse, weights=tapw, minlength=len(key))
+    keep = (1.0 - cover) <= blank_threshold
+    shifted_var = None
+    if variance is not None:
+        shifted_var = np.clip(_scatter(variance), 0, None)[keep]
+    key = key[keep]
+    return(key // nchan, key % nchan, shifted[keep], cover[keep], shifted_var)
+
+def _voxel_noise(NoiseCube, voxel, y, x, chan):
+    # Noise of the stored voxels of a ray list from a ray list with
+    # the same voxels (noise attached) or a noise cube.
+    if isinstance(NoiseCube, RayList):
+        if NoiseCube.noise is None:
+            raise ValueError("RayList has no noise attached.")
+        return(NoiseCube.noise[voxel])
+    if len(voxel) == 0:
+        return(np.zeros(0))
+    pix, column = np.unique(np.stack([y, x]), axis=1, return_inverse=True)
+    noise = NoiseCube.filled_data[:, pix[0], pix[1]].value
+    return(noise[chan, np.ravel(column)])
+
+def extract_noise(NoiseCube, y, x):
+    # Return dense noise spectra (Nv x len(y)) from a SpectralCube or a
+    # RayList with noise attached. Unknown noise is NaN.
+    if isinstance(NoiseCube, RayList):
+        return(NoiseCube.spectra_at(y, x, values=NoiseCube.noise))
+    return(NoiseCube.filled_data[:, y, x].value)
 
 def BinByLabel(DataCube, LabelMap, centroid_map,
                weight_map=None,
-               background_labels=[0]):
+               background_labels=[0],
+               chunk=1000, shift_mode='auto',
+               noise_cube=None, channel_correlation=None,
+               weighting='uniform', blank_threshold=0.5):
     """
     Bin a data cube by a label mask, aligning the data to a common centroid.
 
+    All labels are stacked in a single pass over the cube. The channel
+    shift of every pixel is computed once, the spectra are shifted in
+    blocks of chunk pixels, and the weighted spectra are accumulated
+    into their label with np.bincount, so the cost does not depend on
+    the number of labels.
+
+    Blank (masked) channels are left out rather than filled: the
+    validity of each channel is shifted along with the data, and each
+    channel of a stack is the weighted mean over the spectra that have
+    data there (the sum of weight x data divided by the sum of weight
+    x coverage in that channel). A shifted channel is used where at
+    least 1 - blank_threshold of it comes from valid input channels.
+    Channels of a stack without any data are NaN. For a RayList only
+    the stored voxels are shifted and accumulated (a segmented
+    reduction), never the dense spectra.
+
+    If a noise cube is given, the noise variance is shifted alongside
+    the data and propagated through the weighted mean to give a formal
+    uncertainty per channel of each stack, assuming independent noise
+    in different spectra. The effective number of independent spectra
+    in each stack follows from the weights, (sum w)^2 / sum w^2.
+
     Parameters
     ----------
-    DataCube : SpectralCube
+    DataCube : SpectralCube or RayList
         The original spectral cube with spatial dimensions Nx, Ny and spectral dimension Nv
     LabelMap : 2D numpy.ndarray
         A 2D map containing integer labels for each pixel into objects defining the stacking.
     centroid_map : 2D numpy.ndarray
         A 2D map of the centroid velocities for the lines to stack of dimensions Nx, Ny.
         Note that DataCube and Centroid map must have equivalent spectral units to DataCube
+    weight_map : 2D numpy.ndarray
+        Map containing the weight values to be used in averaging
     background_labels : list
         List of values in the label map that correspond to background objects and should not
         be processed with the stacking. 
+    chunk : int
+        Number of spectra shifted at once.
+    shift_mode : str
+        Channel shift mode (see channelShiftVec). 'auto' is resolved
+        once from the shifts of all stacked pixels. The FFT needs
+        whole spectra, so a RayList uses 'lanczos' instead of 'fft'.
+    noise_cube : SpectralCube or RayList
+        Noise (one sigma) matched to DataCube, in the same units. A
+        RayList supplies its attached noise and must hold the same
+        voxels as a RayList DataCube.
+    channel_correlation : np.array
+        One-dimensional array containing the channel-to-channel
+        normalize correlation coefficients of the noise (e.g., from
+        scDerivativeRoutines.channel_correlation_from_header). Used
+        for the variance of interpolated shifts and passed on with
+        the stacks.
+    weighting : str
+        'uniform' averages with weight_map (or equal weights).
+        'inverse_variance' also weights each spectrum by the inverse
+        of its mean noise variance, which needs noise_cube.
+    blank_threshold : float
+        Fraction of a shifted channel that may come from blank input
+        channels (or from outside the band) before it is left out.
 
     Returns
     -------
     output_list : list of dict
         List of dict where each entry contains the stacked spectrum for a given label
+        (in the units of DataCube, given as unit), the number of spectra (n_spectra) and the effective number of independent
+        spectra (n_effective) in it, and, with a noise cube, the uncertainty of the
+        stacked spectrum (noise) and the channel_correlation.
     unique_labels = array of unique labels in same order as output list
     """
-    UniqLabels = np.unique(LabelMap)
+    if weighting not in ['uniform', 'inverse_variance']:
+        logger.error("Unknown stacking weighting: "+str(weighting))
+        raise NotImplementedError
+    if weighting == 'inverse_variance' and noise_cube is None:
+        logger.error("Inverse variance weighting requested but no noise provided")
+        raise ValueError("Inverse variance weighting requires a noise cube.")
+
+    LabelMap = np.asarray(LabelMap)
+    UniqLabels, inverse = np.unique(LabelMap, return_inverse=True)
+    inverse = inverse.reshape(LabelMap.shape)
+
+    # Row of the output stack for each label, -1 for background
+    stacked = ~np.isin(UniqLabels, background_labels)
+    stack_row = np.where(stacked, np.cumsum(stacked) - 1, -1)
+    nstack = int(np.sum(stacked))
+
+    inlabel = stacked[inverse]
+    if LabelMap.dtype.kind == 'f':
+        inlabel &= np.isfinite(LabelMap)
+    y, x = np.where(inlabel)
+    row = stack_row[inverse[y, x]]
+
+    ray_input = isinstance(DataCube, RayList)
+    channel_shift = _channel_shift(DataCube.spectral_axis, centroid_map[y, x])
+    shift_mode = _resolve_shift_mode(channel_shift, mode=shift_mode)
+    if ray_input and shift_mode == 'fft':
+        logger.info("A RayList holds only the masked channels. "
+                    "Using 'lanczos' instead of 'fft' channel shifts.")
+        shift_mode = 'lanczos'
+    if weight_map is not None:
+        wts = np.asarray(weight_map[y, x], dtype=float)
+    else:
+        wts = np.ones_like(channel_shift)
+    wts = np.where(np.isfinite(wts) & np.isfinite(channel_shift), wts, 0.0)
+
+    # Flat (stack x channel) accumulators of weight x data, weight x
+    # coverage and weight^2 x variance
+    nchan = DataCube.shape[0]
+    accum = np.zeros(nstack * nchan)
+    wtaccum = np.zeros(nstack * nchan)
+    if noise_cube is not None:
+        varsum = np.zeros(nstack * nchan)
+    wtsum = np.zeros(nstack)
+    wt2sum = np.zeros(nstack)
+    for start in range(0, len(y), chunk):
+        these = slice(start, start + chunk)
+        thisrow = row[these]
+        thisshift = channel_shift[these]
+        thiswts = wts[these]
+
+        # Valid voxels of each spectrum: spectrum index, channel,
+        # value and (with noise) variance
+        if ray_input:
+            spec, voxel = DataCube.voxels_at(y[these], x[these])
+            chan = DataCube.chan[voxel]
+            values = DataCube.data[voxel].astype(float)
+            variance = None
+            if noise_cube is not None:
+                variance = _voxel_noise(noise_cube, voxel, y[these][spec],
+                                        x[these][spec], chan)**2
+        else:
+            spectra = extract_spectra(DataCube, y[these], x[these])
+            valid = np.isfinite(spectra)
+            variance = None
+            if noise_cube is not None:
+                variance = extract_noise(noise_cube, y[these], x[these])**2
+                valid &= np.isfinite(variance)
+
+        if weighting == 'inverse_variance':
+            if ray_input:
+                good = np.isfinite(variance)
+                with np.errstate(invalid='ignore', divide='ignore'):
+                    meanvar = (np.bincount(spec[good], weights=variance[good],
+                                           minlength=len(thisrow))
+                               / np.bincount(spec[good], minlength=len(thisrow)))
+            else:
+                with np.errstate(invalid='ignore', divide='ignore'):
+                    meanvar = (np.where(valid, variance, 0).sum(axis=0)
+                               / valid.sum(axis=0))
+            with np.errstate(invalid='ignore', divide='ignore'):
+                thiswts = thiswts / meanvar
+            thiswts = np.where(np.isfinite(thiswts), thiswts, 0.0)
+
+        if ray_input:
+            good = np.isfinite(values)
+            if variance is not None:
+                good &= np.isfinite(variance)
+                variance = variance[good]
+            spec, chan, values = spec[good], chan[good], values[good]
+            spec, outchan, shifted, cover, shifted_var = _shift_voxels(
+                spec, chan, values, thisshift, shift_mode, nchan,
+                variance=variance, blank_threshold=blank_threshold)
+        else:
+            shifted = channelShiftVec(np.where(valid, spectra, 0.0),
+                                      thisshift, mode=shift_mode)
+            cover = channelShiftVec(valid.astype(float), thisshift,
+                                    mode=shift_mode)
+            keep = np.isfinite(cover) & ((1.0 - cover) <= blank_threshold)
+            outchan, spec = np.nonzero(keep)
+            shifted, cover = shifted[keep], cover[keep]
+            shifted_var = None
+            if variance is not None:
+                shifted_var = np.clip(channelShiftVec(
+                    np.where(valid, variance, 0.0), thisshift,
+                    mode=shift_mode), 0, None)[keep]
+
+        flat = thisrow[spec] * nchan + outchan
+        specwts = thiswts[spec]
+        accum += np.bincount(flat, weights=specwts * shifted,
+                             minlength=nstack * nchan)
+        wtaccum += np.bincount(flat, weights=specwts * cover,
+                               minlength=nstack * nchan)
+        if variance is not None:
+            var_factor = _shift_variance_factor(
+                thisshift, shift_mode,
+                channel_correlation=channel_correlation)
+            varsum += np.bincount(
+                flat, weights=(specwts**2 * var_factor[spec] * shifted_var),
+                minlength=nstack * nchan)
+
+        # Spectra that add to at least one channel
+        used = np.zeros(len(thisrow), dtype=bool)
+        used[spec] = True
+        wtsum += np.bincount(thisrow[used], weights=thiswts[used],
+                             minlength=nstack)
+        wt2sum += np.bincount(thisrow[used], weights=thiswts[used]**2,
+                              minlength=nstack)
+
+    accum = accum.reshape(nstack, nchan)
+    wtaccum = wtaccum.reshape(nstack, nchan)
+    n_spectra = np.bincount(row, minlength=nstack)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        spectrum = np.where(wtaccum > 0, accum / wtaccum, np.nan)
+        n_effective = wtsum**2 / wt2sum
+        if noise_cube is not None:
+            stack_noise = np.where(wtaccum > 0, np.sqrt(
+                varsum.reshape(nstack, nchan)) / wtaccum, np.nan)
+
+    spaxis = DataCube.spectral_axis
+    shifted_spaxis = spaxis - spaxis[len(spaxis) // 2]
     output_list = []
-    for ThisLabel in UniqLabels:
-        if ThisLabel not in background_labels:
-            thisspec, spaxis = BinByMask(DataCube,
-                                         (LabelMap == ThisLabel),
-                                         centroid_map,
-                                         weight_map=weight_map)
-            output_list += [{'label': ThisLabel,
-                             'spectrum': thisspec,
-                             'spectral_axis': spaxis}]
+    for ii, ThisLabel in enumerate(UniqLabels[stacked]):
+        thisdict = {'label': ThisLabel,
+                    'spectrum': spectrum[ii],
+                    'spectral_axis': shifted_spaxis,
+                    'unit': DataCube.unit,
+                    'n_spectra': n_spectra[ii],
+                    'n_effective': n_effective[ii]}
+        if noise_cube is not None:
+            thisdict['noise'] = stack_noise[ii]
+            thisdict['channel_correlation'] = channel_correlation
+        output_list += [thisdict]
     return(output_list, UniqLabels)
@@ -0,0 +1,347 @@
+"""
+Persistent run journal for checkpointed, resumable handler loops.
+
+The journal is an append-only JSON-lines file. Every task_* call of a
+journaled handler (see the journal_tasks class decorator) adds a line
+when it starts, a line for the outputs it announces (each task calls
+HandlerTemplate._journal_outputs before it writes) and a line when it
+finishes or fails. Replaying the file gives the state of each task
+call.
+
+Any loop_* method of a journaled handler accepts resume=True. Then:
+
+    - tasks that finished are skipped, unless they returned a value,
+      take an object argument without a journal_key, or are listed
+      in the handler's _journal_always_run (tasks that only set up
+      in-memory state, e.g. the scales on a clean call),
+    - tasks that started but never finished were interrupted; their
+      announced outputs, and any .touch flag directories (the
+      casaVisRoutines convention) next to them, are removed before
+      the task runs again,
+    - failed tasks run again, and a task that raises is retried up to
+      max_retries times with exponentially growing waits.
+
+A task call is identified by its name and the values of all its
+arguments, defaults included, so calls from the plain loops and from
+the task graph match. An object argument with a plain journal_key
+attribute (e.g. a CleanCall, keyed by target, config, product and
+imaging stage) enters the key as that value. Resume continues the
+run recorded in the journal; use a new journal file for a fresh run.
+Resume assumes that no other process is still working on the
+journaled run.
+
+Example:
+    this_pph.set_journal('postprocess_journal.jsonl')
+    this_pph.loop_postprocess(do_prep=True, ...)
+    ... node dies ...
+    this_pph.loop_postprocess(do_prep=True, ..., resume=True)
+"""
+
+import os
+import json
+import time
+import shutil
+import socket
+import hashlib
+import inspect
+import threading
+import functools
+
+import logging
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.DEBUG)
+
+def task_key(task, args=(), kwargs={}):
+    """
+    Identifier of a task call from its name and arguments.
+    """
+    text = json.dumps([task, list(args), kwargs], sort_keys=True, default=str)
+    return(task+':'+hashlib.sha1(text.encode('utf-8')).hexdigest()[:16])
+
+def is_plain(value):
+    """
+    True for values that a journal line fully captures: strings,
+    numbers, booleans, None, and lists and dictionaries of these.
+    """
+    if value is None or isinstance(value, (bool, int, float, str)):
+        return(True)
+    try:
+        if isinstance(value, unicode):
+            return(True)
+    except NameError:
+        pass
+    if isinstance(value, (list, tuple)):
+        return(all([is_plain(x) for x in value]))
+    if isinstance(value, dict):
+        return(all([is_plain(x) for x in value.values()]))
+    return(False)
+
+def key_value(value):
+    """
+    Value of a task argument as it enters the task key: the
+    journal_key of objects that carry one, else the value itself.
+    """
+    this_key = getattr(value, 'journal_key', None)
+    if this_key is not None:
+        return(this_key)
+    return(value)
+
+def remove_output(path):
+    """
+    Remove a (possibly partial) output file or CASA image and its
+    .touch flag directory.
+    """
+    for this_path in [path, path.rstrip(os.sep)+'.touch']:
+        if os.path.isdir(this_path) and not os.path.islink(this_path):
+            shutil.rmtree(this_path)
+            logger.info("Removed partial output "+this_path)
+        elif os.path.lexists(this_path):
+            os.remove(this_path)
+            logger.info("Removed partial output "+this_path)
+    return(None)
+
+class RunJournal(object):
+    """
+    Append-only JSON-lines record of task starts, outputs, finishes
+    and failures.
+    """
+
+    def __init__(self, filename):
+        self.filename = os.path.abspath(filename)
+        this_dir = os.path.dirname(self.filename)
+        if not os.path.isdir(this_dir):
+            os.makedirs(this_dir)
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    # The lock and thread state cannot be pickled (e.g., to send the
+    # handler to worker processes).
+
+    def __getstate__(self):
+        return({'filename': self.filename})
+
+    def __setstate__(self, state):
+        self.__init__(state['filename'])
+
+    def __repr__(self):
+        return("RunJournal("+self.filename+")")
+
+    def _append(self, entry):
+        entry['time'] = time.strftime('%Y-%m-%d %H:%M:%S')
+        entry['host'] = socket.gethostname()
+        entry['pid'] = os.getpid()
+        line = json.dumps(entry, sort_keys=True, default=str)+'\n'
+        with self._lock:
+            with open(self.filename, 'a') as f:
+                f.write(line)
+                f.flush()
+                os.fsync(f.fileno())
+        return(None)
+
+    def _stack(self):
+        if not hasattr(self._local, 'stack'):
+            self._local.stack = []
+        return(self._local.stack)
+
+    @property
+    def current(self):
+        """
+        Key of the innermost journaled task running in this thread.
+        """
+        stack = self._stack()
+        return(stack[-1] if len(stack) > 0 else None)
+
+    # &%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%
+    # Record
+    # &%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%
+
+    def start(self, key, task, kwargs=None, attempt=1):
+        self._stack().append(key)
+        self._append({'event': 'start', 'key': key, 'task': task,
+                      'kwargs': kwargs, 'attempt': attempt})
+        return(None)
+
+    def outputs(self, outputs, key=None):
+        """
+        Announce the outputs of the running task (or of key).
+        """
+        if key is None:
+            key = self.current
+        if key is None or len(outputs) == 0:
+            return(None)
+        self._append({'event': 'outputs', 'key': key,
+                      'outputs': [os.path.abspath(x) for x in outputs]})
+        return(None)
+
+    def _end(self, key):
+        stack = self._stack()
+        if len(stack) > 0 and stack[-1] == key:
+            stack.pop()
+
+    def finish(self, key, returned=False):
+        self._end(key)
+        self._append({'event': 'finish', 'key': key, 'returned': bool(returned)})
+        return(None)
+
+    def fail(self, key, error=None):
+        self._end(key)
+        self._append({'event': 'fail', 'key': key, 'error': error})
+        return(None)
+
+    # &%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%
+    # Replay
+    # &%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%
+
+    def state(self):
+        """
+        Dictionary of task key -> {'task', 'status' ('started',
+        'done' or 'failed'), 'outputs', 'attempts', 'returned'}.
+        """
+        states = {}
+        if not os.path.isfile(self.filename):
+            return(states)
+        with open(self.filename, 'r') as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    # ... a line cut short when the node died
+                    continue
+                this_state = states.setdefault(entry['key'], {
+                    'task': entry.get('task'), 'status': None, 'outputs': [],
+                    'attempts': 0, 'returned': False})
+                if entry['event'] == 'start':
+                    this_state['status'] = 'started'
+                    this_state['attempts'] += 1
+                elif entry['event'] == 'outputs':
+                    for this_output in entry['outputs']:
+                        if this_output not in this_state['outputs']:
+                            this_state['outputs'].append(this_output)
+                elif entry['event'] == 'finish':
+                    this_state['status'] = 'done'
+                    this_state['returned'] = entry.get('returned', False)
+                elif entry['event'] == 'fail':
+                    this_state['status'] = 'failed'
+        return(states)
+
+    def summary(self):
+        """
+        Number of task calls in each state.
+        """
+        counts = {}
+        for this_state in self.state().values():
+            counts[this_state['status']] = counts.get(this_state['status'], 0) + 1
+        return(counts)
+
+# &%&%&&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%
+# Decorators
+# &%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%
+
+def journal_task(method, name=None):
+    """
+    Wrap a task method so that calls are recorded in the handler's
+    journal, and skipped, cleaned up or retried when resuming. name
+    defaults to the name of the method.
+    """
+    if name is None:
+        name = method.__name__
+
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        journal = getattr(self, '_journal', None)
+        if journal is None or getattr(self, '_dry_run', False):
+            return(method(self, *args, **kwargs))
+
+        try:
+            call_args = inspect.getcallargs(getattr(method, '__wrapped__', method),
+                                            self, *args, **kwargs)
+            call_args.pop('self', None)
+        except TypeError:
+            call_args = dict(kwargs, args=list(args))
+        call_args = dict((k, key_value(v)) for k, v in call_args.items())
+        key = task_key(name, kwargs=call_args)
+        resume = getattr(self, '_resume', False)
+        attempts = 0
+
+        if resume:
+            this_state = self._journal_state.get(key)
+            if this_state is not None:
+                attempts = this_state['attempts']
+                if (this_state['status'] == 'done' and not this_state['returned']
+                    and is_plain(call_args)
+                    and name not in getattr(self, '_journal_always_run', [])):
+                    logger.info("Resume: already done, skipping "+name+" "
+                                +str(dict((k, v) for k, v in call_args.items()
+                                          if k in ['target', 'product', 'config',
+                                                   'res_tag', 'clean_call'])))
+                    return(None)
+                if this_state['status'] == 'started':
+                    logger.warning("Resume: "+name+" was interrupted. Removing its partial outputs.")
+                    for this_output in this_state['outputs']:
+                        remove_output(this_output)
+
+        max_retries = getattr(self, '_max_retries', 0) if resume else 0
+        backoff = getattr(self, '_retry_backoff', 30.)
+        for retry in range(max_retries+1):
+            journal.start(key, name, kwargs=kwargs, attempt=attempts+retry+1)
+            try:
+                result = method(self, *args, **kwargs)
+            except Exception as e:
+                journal.fail(key, error=repr(e))
+                if retry >= max_retries:
+                    raise
+                wait = backoff*2**retry
+                logger.exception("Task "+name+" failed. Retrying in "+str(wait)+" s.")
+                time.sleep(wait)
+                continue
+            returned = not (result is None or
+                            (isinstance(result, tuple) and len(result) == 0))
+            journal.finish(key, returned=returned)
+            return(result)
+
+    wrapper.__name__ = name
+    return(wrapper)
+
+def resumable_loop(method):
+    """
+    Wrap a loop method to accept resume (and max_retries,
+    retry_backoff) keywords.
+    """
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        resume = kwargs.pop('resume', None)
+        max_retries = kwargs.pop('max_retries', None)
+        retry_backoff = kwargs.pop('retry_backoff', None)
+        if resume is None:
+            return(method(self, *args, **kwargs))
+
+        saved = (self._resume, self._max_retries, self._retry_backoff,
+                 self._journal_state)
+        try:
+            if resume:
+                self._start_resume()
+            self._resume = resume
+            if max_retries is not None:
+                self._max_retries = max_retries
+            if retry_backoff is not None:
+                self._retry_backoff = retry_backoff
+            return(method(self, *args, **kwargs))
+        finally:
+            (self._resume, self._max_retries, self._retry_backoff,
+             self._journal_state) = saved
+    return(wrapper)
+
+def journal_tasks(cls):
+    """
+    Class decorator that journals every task_* method and makes every
+    loop_* method resumable.
+    """
+    for name in list(cls.__dict__.keys()):
+        method = cls.__dict__[name]
+        if not callable(method):
+            continue
+        if name.startswith('task_'):
+            setattr(cls, name, journal_task(method, name=name))
+        elif name.startswith('loop_'):
+            setattr(cls, name, resumable_loop(method))
+    return(cls)
@@ -0,0 +1,312 @@
+"""
+Build manifest for make-style incremental reruns.
+
+For every output file (or CASA image directory) a task writes, the
+manifest keeps a small JSON record next to it, in
+<outdir>/.manifest/<output name>.json. The record holds the content
+hash of each input, a hash of the key file entries and keywords used
+(e.g., the derived keywords, moment parameters and resolution) and
+the pipeline version. A task whose outputs all have a record matching
+the current inputs, parameters and version does not need to run
+again.
+
+Hashing a large cube is expensive, so each record also stores the
+size and modification time of the files. A file whose size and time
+still match a record is taken to have the recorded hash. When they
+differ the file is hashed again, so that an input rewritten with
+identical content (e.g., an upstream task rerun with the same result)
+does not force the downstream tasks to rerun.
+
+Example:
+    inputs = [cube_file]
+    outputs = [noise_file]
+    params = {'noise_kw':noise_kwargs}
+    if not is_up_to_date(outputs, inputs=inputs, params=params):
+        ... make noise_file ...
+        record_outputs(outputs, inputs=inputs, params=params)
+"""
+
+import os
+import json
+import time
+import hashlib
+import tempfile
+
+import logging
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.DEBUG)
+
+try:
+    from pipelineVersion import version, tableversion
+except ImportError:
+    version = None
+    tableversion = None
+
+# Directory, next to each output, that holds the records
+manifest_dirname = '.manifest'
+
+# Version of the record layout
+_record_format = 1
+
+_blocksize = 2**20
+
+# &%&%&&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%
+# Signatures and hashes
+# &%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%
+
+def _list_files(path):
+    """
+    Sorted list of the files under a directory (e.g., a CASA image).
+    """
+    file_list = []
+    for root, dirs, files in os.walk(path):
+        dirs.sort()
+        for this_file in sorted(files):
+            file_list.append(os.path.join(root, this_file))
+    return(file_list)
+
+def path_signature(path):
+    """
+    Cheap signature of a file or directory: [size in bytes, latest
+    modification time, number of files]. Returns None if the path
+    does not exist.
+    """
+    if os.path.isfile(path):
+        stat = os.stat(path)
+        return([int(stat.st_size), round(stat.st_mtime, 6), 1])
+    if os.path.isdir(path):
+        size = 0
+        mtime = os.stat(path).st_mtime
+        file_list = _list_files(path)
+        for this_file in file_list:
+            stat = os.stat(this_file)
+            size += stat.st_size
+            mtime = max(mtime, stat.st_mtime)
+        return([int(size), round(mtime, 6), len(file_list)])
+    return(None)
+
+def content_hash(path):
+    """
+    SHA1 of the contents of a file, or of the relative names and
+    contents of all files in a directory. Returns None if the path
+    does not exist.
+    """
+    if os.path.isfile(path):
+        file_list = [path]
+    elif os.path.isdir(path):
+        file_list = _list_files(path)
+    else:
+        return(None)
+
+    sha = hashlib.sha1()
+    for this_file in file_list:
+        if this_file != path:
+            sha.update(os.path.relpath(this_file, path).encode('utf-8'))
+        with open(this_file, 'rb') as f:
+            while True:
+                block = f.read(_blocksize)
+                if not block:
+                    break
+                sha.update(block)
+    return(sha.hexdigest())
+
+def params_digest(params):
+    """
+    Hash of a (nested) dictionary of parameters. Values that JSON
+    cannot represent (e.g., astropy quantities) enter through their
+    string form.
+    """
+    text = json.dumps(params, sort_keys=True, default=str)
+    return(hashlib.sha1(text.encode('utf-8')).hexdigest())
+
+# &%&%&&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%
+# Records
+# &%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%
+
+def _normpath(path):
+    return(os.path.abspath(path).rstrip(os.sep))
+
+def manifest_file(output):
+    """
+    Name of the record for an output file.
+    """
+    output = _normpath(output)
+    return(os.path.join(os.path.dirname(output), manifest_dirname,
+                        os.path.basename(output)+'.json'))
+
+def read_record(output):
+    """
+    Return the record for an output as a dictionary, or None if there
+    is no readable record.
+    """
+    this_file = manifest_file(output)
+    if not os.path.isfile(this_file):
+        return(None)
+    try:
+        with open(this_file, 'r') as f:
+            record = json.load(f)
+    except (IOError, OSError, ValueError):
+        logger.warning("Could not read manifest record "+this_file)
+        return(None)
+    if record.get('format') != _record_format:
+        return(None)
+    return(record)
+
+def _write_record(output, record):
+    """
+    Write a record atomically, so that concurrent workers never see a
+    partial file.
+    """
+    this_file = manifest_file(output)
+    this_dir = os.path.dirname(this_file)
+    if not os.path.isdir(this_dir):
+        try:
+            os.makedirs(this_dir)
+        except OSError:
+            if not os.path.isdir(this_dir):
+                raise
+    handle, temp_file = tempfile.mkstemp(dir=this_dir, suffix='.tmp')
+    try:
+        with os.fdopen(handle, 'w') as f:
+            json.dump(record, f, sort_keys=True, indent=1, default=str)
+        os.rename(temp_file, this_file)
+    except Exception:
+        if os.path.exists(temp_file):
+            os.remove(temp_file)
+        raise
+    return(None)
+
+def remove_record(output):
+    """
+    Forget an output, so that the task making it runs again.
+    """
+    this_file = manifest_file(output)
+    if os.path.isfile(this_file):
+        os.remove(this_file)
+    return(None)
+
+def _known_hash(path, signature):
+    """
+    Hash of path, reusing the hash in the record of the task that
+    wrote path if the signature still matches.
+    """
+    if signature is None:
+        return(None)
+    producer = read_record(path)
+    if producer is not None and producer.get('signature') == signature:
+        return(producer.get('hash'))
+    return(content_hash(path))
+
+# &%&%&&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%
+# Check and record
+# &%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%
+
+def is_up_to_date(outputs, inputs=None, params=None, check_version=True):
+    """
+    Return True if every output exists, is unchanged since it was
+    recorded, and was made from inputs with the same contents and the
+    same parameters (and pipeline version if check_version) as now.
+
+    Keywords:
+    ---------
+
+    outputs : list
+        Output files or directories of the task.
+
+    inputs : list
+        Input files or directories. Missing inputs are allowed and
+        recorded as missing, so that their later appearance triggers
+        a rerun.
+
+    params : dict
+        Everything else that determines the outputs, e.g., keywords
+        from the key files, resolution, moment parameters.
+
+    check_version : bool
+        Also require a matching pipeline version.
+    """
+    if inputs is None:
+        inputs = []
+    digest = params_digest(params)
+
+    for this_output in outputs:
+        record = read_record(this_output)
+        if record is None:
+            logger.debug("No manifest record for "+str(this_output))
+            return(False)
+
+        if record.get('signature') != path_signature(this_output):
+            logger.info("Output changed since it was recorded: "+str(this_output))
+            return(False)
+
+        if record.get('params_hash') != digest:
+            logger.info("Parameters changed for "+str(this_output))
+            return(False)
+
+        if check_version and record.get('version') != version:
+            logger.info("Pipeline version changed for "+str(this_output))
+            return(False)
+
+        recorded_inputs = record.get('inputs', {})
+        if sorted(recorded_inputs.keys()) != sorted(set(_normpath(x) for x in inputs)):
+            logger.info("List of inputs changed for "+str(this_output))
+            return(False)
+
+        # Inputs that were rewritten with the same contents get their
+        # new signature recorded so they are not hashed again.
+        refresh = False
+        for this_input in inputs:
+            known = recorded_inputs[_normpath(this_input)]
+            signature = path_signature(this_input)
+            if known.get('signature') == signature:
+                continue
+            if _known_hash(this_input, signature) != known.get('hash'):
+                logger.info("Input "+str(this_input)+" changed for "+str(this_output))
+                return(False)
+            known['signature'] = signature
+            refresh = True
+
+        if refresh:
+            _write_record(this_output, record)
+
+    return(True)
+
+def record_outputs(outputs, inputs=None, params=None):
+    """
+    Write the manifest records for the outputs of a task that just
+    ran. Outputs that were not written are skipped (and any old record
+    for them removed).
+    """
+    if inputs is None:
+        inputs = []
+
+    input_dict = {}
+    for this_input in inputs:
+        signature = path_signature(this_input)
+        input_dict[_normpath(this_input)] = {
+            'signature': signature,
+            'hash': _known_hash(this_input, signature),
+            }
+
+    digest = params_digest(params)
+    for this_output in outputs:
+        signature = path_signature(this_output)
+        if signature is None:
+            logger.debug("Not recording missing output "+str(this_output))
+            remove_record(this_output)
+            continue
+        record = {
+            'format': _record_format,
+            'output': _normpath(this_output),
+            'signature': signature,
+            'hash': content_hash(this_output),
+            'inputs': input_dict,
+            'params_hash': digest,
+            'params': params,
+            'version': version,
+            'tableversion': tableversion,
+            'created': time.strftime('%Y-%m-%d %H:%M:%S'),
+            }
+        _write_record(this_output, record)
+
+    return(None)
@@ -0,0 +1,212 @@
+"""
+Estimate the peak memory of handler tasks from the size of their
+input cubes.
+
+The estimate for a task is
+
+    baseline + factor[task] * n_voxels * 8 bytes
+
+where n_voxels is the size of the largest input cube (read from the
+FITS or CASA header, see utilsProfile.image_shape) and factor is the
+number of full-size double precision arrays the routine holds at its
+peak (the cube, the noise, masks, convolution buffers, ...). baseline
+covers the interpreter and libraries.
+
+The default factors are rough counts of the temporaries in each
+routine. calibrate() replaces them with the largest ratios seen in
+task profile records (see utilsProfile), so that a run with profiling
+on tunes the estimates for the next one.
+
+Example:
+    estimator = MemoryEstimator()
+    estimator.calibrate(this_der.get_profile_records())
+    estimator.save('memory_calibration.json')
+    nbytes = estimator.estimate('task_estimate_noise', [cube_file])
+"""
+
+import re
+import json
+
+import logging
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.DEBUG)
+
+import utilsProfile
+
+# Bytes per voxel of the working (double precision) arrays
+bytes_per_voxel = 8
+
+# Memory of a process before any cube is read
+default_baseline = 500e6
+
+# Full-size arrays held at the peak of each task. CASA tasks work
+# largely out of core and hold less.
+default_factors = {
+    # derived
+    'task_convolve': 4.0,
+    'task_convolve_ladder': 5.0,
+    'task_estimate_noise': 8.0,
+    'task_build_strict_mask': 6.0,
+    'task_build_broad_mask': 4.0,
+    'task_generate_moments': 5.0,
+    'task_generate_secondary_moments': 6.0,
+    'task_derive_chain': 10.0,
+    # postprocess
+    'task_stage_interf_data': 0.5,
+    'task_remove_degenerate_axes': 1.0,
+    'task_pbcorr': 1.5,
+    'task_round_beam': 2.0,
+    'task_stage_singledish': 2.0,
+    'task_make_interf_weight': 1.5,
+    'task_make_singledish_weight': 1.5,
+    'task_feather': 3.0,
+    'task_compress': 1.5,
+    'task_convert_units': 1.0,
+    'task_export_to_fits': 1.5,
+    'task_convolve_parts_for_mosaic': 2.0,
+    'task_align_for_mosaic': 2.0,
+    'task_linear_mosaic': 3.0,
+    }
+
+# For tasks not in the table
+default_factor = 4.0
+
+_memory_units = {'': 1., 'b': 1., 'kb': 1e3, 'mb': 1e6, 'gb': 1e9, 'tb': 1e12,
+                 'kib': 2.**10, 'mib': 2.**20, 'gib': 2.**30, 'tib': 2.**40}
+
+def parse_memory(value):
+    """
+    Number of bytes from a number or a string like '64 GB' (decimal
+    units, as in astropy; KiB, MiB, ... are binary).
+    """
+    if value is None:
+        return(None)
+    try:
+        return(float(value))
+    except (TypeError, ValueError):
+        pass
+    match = re.match(r'^\s*([0-9.eE+-]+)\s*([a-zA-Z]*)\s*$', value)
+    if match is None or match.group(2).lower() not in _memory_units:
+        logger.error("Could not parse memory size: "+value)
+        raise ValueError("Could not parse memory size: "+value)
+    return(float(match.group(1))*_memory_units[match.group(2).lower()])
+
+def format_memory(nbytes):
+    """
+    Human readable memory size.
+    """
+    if nbytes is None:
+        return('unknown')
+    for unit, scale in [('TB', 1e12), ('GB', 1e9), ('MB', 1e6)]:
+        if nbytes >= scale:
+            return('%.1f %s' % (nbytes/scale, unit))
+    return('%.0f B' % nbytes)
+
+def image_voxels(filename):
+    """
+    Number of elements in a FITS file or CASA image, or None.
+    """
+    shape = utilsProfile.image_shape(filename)
+    if shape is None or len(shape) == 0:
+        return(None)
+    n_voxels = 1
+    for n in shape:
+        n_voxels *= int(n)
+    return(n_voxels)
+
+class MemoryEstimator(object):
+    """
+    Predict the peak memory of tasks from their input cubes.
+    """
+
+    def __init__(self, factors=None, baseline=default_baseline):
+        self.factors = dict(default_factors)
+        if factors is not None:
+            self.factors.update(factors)
+        self.baseline = float(baseline)
+
+    def factor(self, task):
+        return(self.factors.get(task, default_factor))
+
+    def estimate(self, task, input_files=[]):
+        """
+        Estimated peak memory in bytes of task run on input_files (the
+        largest image among them sets the size). Inputs that do not
+        exist are ignored; with none, the baseline is returned.
+        """
+        n_voxels = 0
+        for this_file in input_files:
+            this_n = image_voxels(this_file)
+            if this_n is not None:
+                n_voxels = max(n_voxels, this_n)
+        return(self.estimate_voxels(task, n_voxels))
+
+    def estimate_voxels(self, task, n_voxels=0):
+        """
+        Estimated peak memory in bytes of task run on a cube of
+        n_voxels.
+        """
+        return(self.baseline + self.factor(task)*n_voxels*bytes_per_voxel)
+
+    def calibrate(self, records, min_calls=1):
+        """
+        Set the factors (and the baseline) from task profile records
+        that have a peak memory and an input shape. Each factor becomes
+        the largest (peak - baseline) / cube size seen for that task,
+        so the estimates stay on the safe side. Records whose peak was
+        shared with concurrent tasks (peak_shared) are skipped. Returns
+        the new factors of the calibrated tasks.
+        """
+        # ... peaks measured while other tasks ran in parallel threads
+        # include their memory
+        records = [r for r in records if not r.get('peak_shared')]
+        peaks = [r['peak_rss_mb'] for r in records if r.get('peak_rss_mb') is not None]
+        if len(peaks) == 0:
+            logger.warning("No memory records to calibrate from.")
+            return({})
+        # ... the smallest process seen bounds the baseline
+        self.baseline = min(self.baseline, min(peaks)*1e6)
+
+        ratios = {}
+        for record in records:
+            if record.get('peak_rss_mb') is None or not record.get('input_shape'):
+                continue
+            if record.get('status', 'ok') != 'ok':
+                continue
+            n_voxels = 1
+            for n in record['input_shape']:
+                n_voxels *= int(n)
+            if n_voxels == 0:
+                continue
+            ratio = (record['peak_rss_mb']*1e6 - self.baseline)/(n_voxels*bytes_per_voxel)
+            ratios.setdefault(record['task'], []).append(max(ratio, 0.))
+
+        calibrated = {}
+        for task, these_ratios in ratios.items():
+            if len(these_ratios) < min_calls:
+                continue
+            calibrated[task] = max(these_ratios)
+        self.factors.update(calibrated)
+        logger.info("Calibrated memory factors for "+str(len(calibrated))+" tasks.")
+        return(calibrated)
+
+    def save(self, filename):
+        with open(filename, 'w') as f:
+            json.dump({'baseline': self.baseline, 'factors': self.factors},
+                      f, sort_keys=True, indent=1)
+        return(None)
+
+    @classmethod
+    def load(cls, filename):
+        """
+        Read a calibration written by save(), or calibrate from a JSON
+        profile report (see utilsProfile.TaskProfiler.write_report).
+        """
+        with open(filename, 'r') as f:
+            content = json.load(f)
+        if 'tasks' in content:
+            estimator = cls()
+            estimator.calibrate(content['tasks'])
+            return(estimator)
+        return(cls(factors=content.get('factors'),
+                   baseline=content.get('baseline', default_baseline)))
@@ -0,0 +1,477 @@
+"""
+Plan a run before launching it: estimate the time, I/O and memory of
+every task and how long the run takes on N workers.
+
+HandlerTemplate.plan_loop walks a loop_* method in dry-run mode with
+task profiling on, so that every task call is recorded with its
+target, product, config and main input while nothing runs (the tasks
+read at most image headers). Each recorded task_* call is then sized
+and costed:
+
+    n_voxels     from the input header (FITS or CASA image) or, for
+                 measurement sets, the size on disk / 8. Tasks that
+                 do not note an input, or whose input does not exist
+                 yet (a product of an earlier step), take the largest
+                 input noted for the same target, product and config.
+    wall_s,      rate of the task * n_voxels (see CostModel)
+    cpu_s
+    read_bytes   size of the input on disk (or 4 bytes per voxel)
+    write_bytes  write rate of the task * n_voxels
+    memory       peak memory from the handler's MemoryEstimator (see
+                 utilsMemory)
+
+The calls are grouped as the work queue runs them (see
+HandlerTemplate.enqueue_loop): one item per stage and target, product
+and config, with its tasks run in order and each stage waiting for
+the previous one. The run time on N workers is the sum over stages of
+the time to run the items of the stage on N workers (longest first).
+The critical path is the sum of the longest item of each stage, the
+run time with unlimited workers.
+
+The default rates are order-of-magnitude guesses. Calibrate them with
+a profile report of an earlier run (see utilsProfile) before sizing
+an allocation.
+
+Example:
+    cost_model = utilsPlanner.CostModel.load('task_profile_derived.json')
+    plan = this_der.plan_derive_products(do_all=True, n_workers=16,
+                                         cost_model=cost_model)
+    plan.log_summary()
+    plan.write('derived_plan.json')
+"""
+
+import json
+import heapq
+from collections import OrderedDict
+
+import logging
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.DEBUG)
+
+import utilsMemory
+
+# Bytes per voxel of images on disk (single precision)
+disk_bytes_per_voxel = 4
+
+# Bytes per element of measurement sets (single precision complex)
+ms_bytes_per_element = 8
+
+# Seconds per input voxel of each task
+default_rates = {
+    # derived
+    'task_convolve': 2e-7,
+    'task_convolve_ladder': 6e-7,
+    'task_estimate_noise': 1e-6,
+    'task_build_strict_mask': 3e-7,
+    'task_build_broad_mask': 2e-7,
+    'task_generate_moments': 2e-7,
+    'task_generate_secondary_moments': 3e-7,
+    'task_derive_chain': 2e-6,
+    # postprocess
+    'task_stage_interf_data': 2e-8,
+    'task_remove_degenerate_axes': 5e-8,
+    'task_pbcorr': 1e-7,
+    'task_round_beam': 5e-7,
+    'task_stage_singledish': 5e-7,
+    'task_make_interf_weight': 1e-7,
+    'task_make_singledish_weight': 1e-7,
+    'task_feather': 5e-7,
+    'task_compress': 2e-7,
+    'task_convert_units': 1e-7,
+    'task_export_to_fits': 1e-7,
+    'task_convolve_parts_for_mosaic': 5e-7,
+    'task_align_for_mosaic': 5e-7,
+    'task_linear_mosaic': 5e-7,
+    # imaging (per visibility element)
+    'task_initialize_clean_call': 0.,
+    'task_pick_cell_and_imsize': 1e-8,
+    'task_assign_multiscales': 0.,
+    'task_revert_to_imaging': 1e-8,
+    'task_read_clean_mask': 1e-8,
+    'task_make_dirty_image': 5e-7,
+    'task_multiscale_clean': 1e-5,
+    'task_singlescale_mask': 1e-7,
+    'task_singlescale_clean': 5e-6,
+    }
+
+# Seconds per input voxel of tasks not in the table
+default_rate = 2e-7
+
+# Bytes written per input voxel of each task
+default_write_rates = {
+    'task_build_strict_mask': 1.,
+    'task_build_broad_mask': 0.1,
+    'task_generate_moments': 0.1,
+    'task_generate_secondary_moments': 0.1,
+    'task_derive_chain': 6.,
+    'task_feather': 8.,
+    'task_compress': 2.,
+    'task_make_dirty_image': 1.,
+    'task_multiscale_clean': 1.,
+    'task_singlescale_mask': 0.2,
+    'task_singlescale_clean': 1.,
+    'task_read_clean_mask': 0.,
+    'task_assign_multiscales': 0.,
+    'task_initialize_clean_call': 0.,
+    'task_pick_cell_and_imsize': 0.,
+    }
+
+# Bytes written per input voxel of tasks not in the table (one cube)
+default_write_rate = 4.
+
+def format_seconds(seconds):
+    """
+    Human readable duration.
+    """
+    if seconds is None:
+        return('unknown')
+    for unit, scale in [('d', 86400.), ('h', 3600.), ('min', 60.)]:
+        if seconds >= scale:
+            return('%.1f %s' % (seconds/scale, unit))
+    return('%.0f s' % seconds)
+
+def record_voxels(record):
+    """
+    Size of the main input of a profile record in voxels (image) or
+    elements (measurement set), or None if it was not noted.
+    """
+    shape = record.get('input_shape')
+    if shape:
+        n_voxels = 1
+        for n in shape:
+            n_voxels *= int(n)
+        return(n_voxels)
+    if record.get('input_bytes'):
+        return(record['input_bytes']//ms_bytes_per_element)
+    return(None)
+
+def record_contexts(records):
+    """
+    (target, product, config) of each record. Tasks called without a
+    target (e.g. the imaging tasks, which take a clean call) take it
+    from the recipe or task that called them.
+    """
+    # Records are stored when calls end, so a caller follows the
+    # calls it made. Walking backwards, the last record seen one level
+    # up is the caller.
+    contexts = [None]*len(records)
+    by_depth = {}
+    for ii in range(len(records)-1, -1, -1):
+        record = records[ii]
+        depth = record.get('depth') or 0
+        context = (record.get('target'), record.get('product'), record.get('config'))
+        if context[0] is None and depth > 0:
+            context = by_depth.get(depth-1, context)
+        by_depth[depth] = context
+        contexts[ii] = context
+    return(contexts)
+
+def context_sizes(records, known_sizes=None):
+    """
+    Largest input (n_voxels, input_bytes) noted in the records for
+    each (target, product, config). known_sizes, e.g. from earlier
+    stages, is updated in place and returned.
+    """
+    if known_sizes is None:
+        known_sizes = {}
+    for record, context in zip(records, record_contexts(records)):
+        n_voxels = record_voxels(record)
+        if not n_voxels:
+            continue
+        if n_voxels > known_sizes.get(context, (0, None))[0]:
+            known_sizes[context] = (n_voxels, record.get('input_bytes'))
+    return(known_sizes)
+
+def schedule(durations, n_workers=1):
+    """
+    Time to run jobs of the given durations on n_workers, each worker
+    taking the longest job left when it becomes free.
+    """
+    if len(durations) == 0:
+        return(0.)
+    loads = [0.]*max(int(n_workers), 1)
+    for this_duration in sorted(durations, reverse=True):
+        heapq.heapreplace(loads, loads[0]+this_duration)
+    return(max(loads))
+
+class CostModel(object):
+    """
+    Time and bytes written per input voxel of each task.
+    """
+
+    def __init__(self, rates=None, write_rates=None, overhead=0.0):
+        self.rates = {}
+        for task, rate in default_rates.items():
+            self.rates[task] = {'wall_s': rate, 'cpu_s': rate}
+        if rates is not None:
+            self.rates.update(rates)
+        self.write_rates = dict(default_write_rates)
+        if write_rates is not None:
+            self.write_rates.update(write_rates)
+        self.overhead = float(overhead)
+
+    def rate(self, task, kind='wall_s'):
+        return(self.rates.get(task, {}).get(kind, default_rate))
+
+    def write_rate(self, task):
+        return(self.write_rates.get(task, default_write_rate))
+
+    def estimate(self, task, n_voxels=None):
+        """
+        Dictionary of estimated wall_s, cpu_s and write_bytes of task
+        run on an input of n_voxels. Unknown sizes cost the per-task
+        overhead only.
+        """
+        n_voxels = n_voxels or 0
+        return({'wall_s': self.overhead + self.rate(task, 'wall_s')*n_voxels,
+                'cpu_s': self.overhead + self.rate(task, 'cpu_s')*n_voxels,
+                'write_bytes': self.write_rate(task)*n_voxels})
+
+    def calibrate(self, records):
+        """
+        Set the rates of the tasks found in task profile records from
+        the total time and bytes written over the total input size of
+        each task (sized as in plan_tasks). Returns the calibrated
+        tasks.
+        """
+        known_sizes = context_sizes(records)
+        totals = {}
+        for record, context in zip(records, record_contexts(records)):
+            if not record['task'].startswith('task_'):
+                continue
+            if record.get('status', 'ok') != 'ok':
+                continue
+            n_voxels = known_sizes.get(context, (None, None))[0]
+            if not n_voxels:
+                continue
+            this_total = totals.setdefault(record['task'], {
+                'n_voxels': 0, 'wall_s': 0., 'cpu_s': 0., 'write_bytes': 0.})
+            this_total['n_voxels'] += n_voxels
+            this_total['wall_s'] += max(record['wall_s'] - self.overhead, 0.)
+            this_total['cpu_s'] += max(record['cpu_s'] - self.overhead, 0.)
+            written = record.get('disk_write_bytes')
+            if written is None:
+                written = record.get('write_bytes')
+            this_total['write_bytes'] += written or 0.
+
+        for task, this_total in totals.items():
+            self.rates[task] = {
+                'wall_s': this_total['wall_s']/this_total['n_voxels'],
+                'cpu_s': this_total['cpu_s']/this_total['n_voxels']}
+            self.write_rates[task] = this_total['write_bytes']/this_total['n_voxels']
+        logger.info("Calibrated costs for "+str(len(totals))+" tasks.")
+        return(sorted(totals.keys()))
+
+    def save(self, filename):
+        with open(filename, 'w') as f:
+            json.dump({'rates': self.rates, 'write_rates': self.write_rates,
+                       'overhead': self.overhead}, f, sort_keys=True, indent=1)
+        return(None)
+
+    @classmethod
+    def load(cls, filename):
+        """
+        Read a model written by save(), or calibrate from a JSON
+        profile report (see utilsProfile.TaskProfiler.write_report).
+        """
+        with open(filename, 'r') as f:
+            content = json.load(f)
+        if 'tasks' in content:
+            cost_model = cls()
+            cost_model.calibrate(content['tasks'])
+            return(cost_model)
+        return(cls(rates=content.get('rates'), write_rates=content.get('write_rates'),
+                   overhead=content.get('overhead', 0.0)))
+
+# &%&%&&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%
+# Plan
+# &%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%
+
+def plan_tasks(records, stage=0, stage_name=None, cost_model=None,
+               memory_estimator=None, known_sizes=None):
+    """
+    Turn the profile records of a dry run of one stage into planned
+    tasks. known_sizes (target, product, config) -> (n_voxels,
+    input_bytes) carries the input sizes between stages and is
+    updated in place.
+    """
+    if cost_model is None:
+        cost_model = CostModel()
+    if memory_estimator is None:
+        memory_estimator = utilsMemory.MemoryEstimator()
+
+    known_sizes = context_sizes(records, known_sizes)
+
+    tasks = []
+    for record, context in zip(records, record_contexts(records)):
+
+        # Only the outermost tasks cost anything, recipes are
+        # accounted for by the tasks they call.
+        if not record['task'].startswith('task_'):
+            continue
+        if record.get('parent') is not None and record['parent'].startswith('task_'):
+            continue
+
+        n_voxels, input_bytes = known_sizes.get(context, (None, None))
+        if n_voxels and not input_bytes:
+            input_bytes = n_voxels*disk_bytes_per_voxel
+        this_task = OrderedDict([
+            ('stage', stage), ('stage_name', stage_name), ('task', record['task']),
+            ('target', context[0]), ('product', context[1]), ('config', context[2]),
+            ('res_tag', record.get('res_tag')), ('n_voxels', n_voxels),
+            ('read_bytes', input_bytes or 0)])
+        this_task.update(cost_model.estimate(record['task'], n_voxels))
+        this_task['memory_bytes'] = memory_estimator.estimate_voxels(
+            record['task'], n_voxels or 0)
+        tasks.append(this_task)
+    return(tasks)
+
+class RunPlan(object):
+    """
+    Planned tasks of a run with totals and run time estimates.
+    """
+
+    def __init__(self, tasks=[], n_workers=1):
+        self.tasks = list(tasks)
+        self.n_workers = n_workers
+
+    def __len__(self):
+        return(len(self.tasks))
+
+    def __repr__(self):
+        return("RunPlan with {0} tasks".format(len(self.tasks)))
+
+    def totals(self, by=None):
+        """
+        Sums of time and bytes, the largest task memory, and the
+        number of tasks (and of those of unknown size), overall or per
+        value of a task field (e.g. 'stage', 'target', 'task').
+        """
+        totals = OrderedDict()
+        for this_task in self.tasks:
+            this_key = 'all' if by is None else this_task[by]
+            this_total = totals.setdefault(this_key, OrderedDict([
+                ('n_tasks', 0), ('n_unsized', 0), ('wall_s', 0.), ('cpu_s', 0.),
+                ('read_bytes', 0.), ('write_bytes', 0.), ('max_memory_bytes', 0.)]))
+            this_total['n_tasks'] += 1
+            if not this_task['n_voxels']:
+                this_total['n_unsized'] += 1
+            for field in ['wall_s', 'cpu_s', 'read_bytes', 'write_bytes']:
+                this_total[field] += this_task[field]
+            this_total['max_memory_bytes'] = max(this_total['max_memory_bytes'],
+                                                 this_task['memory_bytes'])
+        if by is None:
+            return(totals.get('all'))
+        return(totals)
+
+    def items(self):
+        """
+        Work items (stage, target, product, config) with their wall
+        time (tasks run in order) and peak memory.
+        """
+        items = OrderedDict()
+        for this_task in self.tasks:
+            this_key = (this_task['stage'], this_task['target'],
+                        this_task['product'], this_task['config'])
+            this_item = items.setdefault(this_key, {'wall_s': 0., 'memory_bytes': 0.})
+            this_item['wall_s'] += this_task['wall_s']
+            this_item['memory_bytes'] = max(this_item['memory_bytes'],
+                                            this_task['memory_bytes'])
+        return(items)
+
+    def run_time(self, n_workers=None):
+        """
+        Estimated run time and critical path in seconds, and per stage
+        the time, critical path and peak memory (the n_workers largest
+        items running at once) on n_workers.
+        """
+        if n_workers is None:
+            n_workers = self.n_workers
+        stages = OrderedDict()
+        for this_key, this_item in self.items().items():
+            this_stage = stages.setdefault(this_key[0], {'durations': [], 'memories': []})
+            this_stage['durations'].append(this_item['wall_s'])
+            this_stage['memories'].append(this_item['memory_bytes'])
+
+        per_stage = OrderedDict()
+        for this_stage, these in stages.items():
+            per_stage[this_stage] = OrderedDict([
+                ('n_items', len(these['durations'])),
+                ('wall_s', schedule(these['durations'], n_workers)),
+                ('critical_path_s', max(these['durations'])),
+                ('peak_memory_bytes', sum(sorted(these['memories'], reverse=True)[:n_workers]))])
+
+        return(OrderedDict([
+            ('n_workers', n_workers),
+            ('wall_s', sum([x['wall_s'] for x in per_stage.values()])),
+            ('critical_path_s', sum([x['critical_path_s'] for x in per_stage.values()])),
+            ('peak_memory_bytes', max([x['peak_memory_bytes'] for x in per_stage.values()] or [0.])),
+            ('stages', per_stage)]))
+
+    def summary(self):
+        """
+        Dictionary with the totals, the totals per stage and target,
+        and the run time estimates.
+        """
+        return(OrderedDict([
+            ('totals', self.totals()),
+            ('stages', self.totals(by='stage')),
+            ('targets', self.totals(by='target')),
+            ('run_time', self.run_time())]))
+
+    def write(self, outfile):
+        """
+        Write the summary and the planned tasks to a JSON file.
+        """
+        content = self.summary()
+        content['tasks'] = self.tasks
+        with open(outfile, 'w') as f:
+            json.dump(content, f, indent=1, default=str)
+        logger.info("Wrote the run plan to "+outfile)
+        return(None)
+
+    def log_summary(self):
+        """
+        Log the totals per stage and target and the run time on
+        n_workers.
+        """
+        if len(self.tasks) == 0:
+            logger.info("Nothing to run.")
+            return(None)
+
+        def _line(label, this_total):
+            return('%-32s %6d tasks %10s cpu %10s read %10s written %10s max memory' % (
+                label, this_total['n_tasks'], format_seconds(this_total['cpu_s']),
+                utilsMemory.format_memory(this_total['read_bytes']),
+                utilsMemory.format_memory(this_total['write_bytes']),
+                utilsMemory.format_memory(this_total['max_memory_bytes'])))
+
+        stage_names = OrderedDict()
+        for this_task in self.tasks:
+            stage_names.setdefault(this_task['stage'], this_task['stage_name'])
+
+        logger.info("")
+        logger.info("&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%")
+        logger.info("Run plan")
+        logger.info("&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%")
+        logger.info("")
+        logger.info("Per stage:")
+        for this_stage, this_total in self.totals(by='stage').items():
+            logger.info(_line(str(this_stage)+' '+str(stage_names[this_stage] or ''), this_total))
+        logger.info("Per target:")
+        for this_target, this_total in self.totals(by='target').items():
+            logger.info(_line(str(this_target), this_total))
+        this_total = self.totals()
+        logger.info(_line('Total', this_total))
+        if this_total['n_unsized'] > 0:
+            logger.info(str(this_total['n_unsized'])+" tasks have no known input size "
+                        "(their inputs are missing) and are counted at the overhead only.")
+
+        run_time = self.run_time()
+        logger.info("")
+        logger.info("On "+str(run_time['n_workers'])+" workers: "
+                    +format_seconds(run_time['wall_s'])+", critical path "
+                    +format_seconds(run_time['critical_path_s'])+", peak memory "
+                    +utilsMemory.format_memory(run_time['peak_memory_bytes']))
+        logger.info("")
+        return(None)
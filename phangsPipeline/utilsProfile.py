@@ -0,0 +1,436 @@
+"""
+Per-task performance instrumentation for the handlers.
+
+The profile_tasks class decorator wraps every task_* and recipe_*
+method of a handler. When the handler has profiling turned on (see
+HandlerTemplate.set_profiling) each call adds a record to the
+handler's TaskProfiler with:
+
+    wall_s, cpu_s        wall clock and CPU (user+system, including
+                         child processes) time in seconds
+    peak_rss_mb          peak resident memory of the process during
+                         the call (see below)
+    peak_shared          True if other profiled tasks ran in other
+                         threads during the call, so that peak_rss_mb
+                         includes their memory
+    read_bytes,          bytes read and written through system calls
+    write_bytes          (includes the page cache)
+    disk_read_bytes,     bytes actually fetched from or sent to the
+    disk_write_bytes     storage layer (includes memory-mapped reads)
+    input_file,          main input of the task, its array shape and
+    input_shape,         its size on disk, where the task notes them
+    input_bytes
+
+plus the target, config, product and resolution keywords of the call,
+the nesting depth (a recipe calling tasks) and whether the call
+raised. The records can be written to a JSON or CSV report and the
+slowest tasks summarized in the log.
+
+Memory and IO are read from /proc on Linux. Elsewhere the peak memory
+falls back to getrusage and the IO counters are None. The counters
+belong to the whole process, so tasks running concurrently in threads
+share them. On Linux the peak memory is reset at the start of each
+top-level task, unless tasks are running in other threads; nested
+tasks report the peak since their outermost task began. Records of
+tasks that overlapped tasks in other threads are marked peak_shared
+(and are not used to calibrate memory estimates, see utilsMemory).
+
+Example:
+    @utilsProfile.profile_tasks
+    class MyHandler(handlerTemplate.HandlerTemplate):
+        def task_something(self, target=None):
+            ...
+
+    this_handler.set_profiling(True)
+    this_handler.task_something(target='ngc0628')
+    this_handler.write_profile_report('profile.json')
+    this_handler.log_profile_summary()
+"""
+
+import os
+import csv
+import json
+import time
+import threading
+import functools
+
+import logging
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.DEBUG)
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+# Keywords of a task call copied into its record
+_context_kwargs = ['target', 'config', 'product', 'res_tag']
+
+# Order of the columns in the CSV report
+report_columns = [
+    'task', 'handler', 'target', 'config', 'product', 'res_tag',
+    'depth', 'parent', 'status', 'start',
+    'wall_s', 'cpu_s', 'peak_rss_mb', 'peak_shared',
+    'read_bytes', 'write_bytes', 'disk_read_bytes', 'disk_write_bytes',
+    'input_file', 'input_shape', 'input_bytes',
+    ]
+
+# &%&%&&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%
+# Process counters
+# &%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%
+
+def cpu_seconds():
+    """
+    User plus system CPU time of this process and its children.
+    """
+    times = os.times()
+    return(times[0]+times[1]+times[2]+times[3])
+
+def io_counters():
+    """
+    Dictionary of IO byte counters of this process from /proc, or
+    None where that is not available.
+    """
+    try:
+        with open('/proc/self/io', 'r') as f:
+            lines = f.readlines()
+    except (IOError, OSError):
+        return(None)
+    values = {}
+    for line in lines:
+        key, sep, value = line.partition(':')
+        if sep:
+            values[key.strip()] = int(value)
+    return({'read_bytes': values.get('rchar'),
+            'write_bytes': values.get('wchar'),
+            'disk_read_bytes': values.get('read_bytes'),
+            'disk_write_bytes': values.get('write_bytes')})
+
+def peak_rss_mb():
+    """
+    Peak resident memory of the process in MB.
+    """
+    try:
+        with open('/proc/self/status', 'r') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return(int(line.split()[1])/1024.)
+    except (IOError, OSError):
+        pass
+    if resource is None:
+        return(None)
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ... kilobytes on Linux, bytes on Mac
+    if os.uname()[0] == 'Darwin':
+        return(maxrss/1024.**2)
+    return(maxrss/1024.)
+
+def reset_peak_rss():
+    """
+    Reset the peak resident memory to the current value (Linux only).
+    Returns True on success.
+    """
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+    except (IOError, OSError):
+        return(False)
+    return(True)
+
+def image_shape(filename):
+    """
+    Shape of a FITS file (read from the header only) or, inside CASA,
+    of a CASA image. Returns None if it cannot be read.
+    """
+    if filename is None:
+        return(None)
+    if os.path.isfile(filename):
+        try:
+            from astropy.io import fits
+            header = fits.getheader(filename)
+        except Exception:
+            return(None)
+        naxis = header.get('NAXIS', 0)
+        return([header.get('NAXIS'+str(ii)) for ii in range(naxis, 0, -1)])
+    if os.path.isdir(filename):
+        try:
+            import casaStuff
+            shape = casaStuff.imhead(imagename=filename, mode='get', hdkey='shape')
+        except Exception:
+            return(None)
+        return([int(x) for x in shape])
+    return(None)
+
+def path_bytes(path):
+    """
+    Size on disk of a file, or of everything under a directory (CASA
+    image or measurement set). Returns None if the path is missing.
+    """
+    if path is None or not os.path.exists(path):
+        return(None)
+    if os.path.isfile(path):
+        return(os.path.getsize(path))
+    total = 0
+    for this_root, these_dirs, these_files in os.walk(path):
+        for this_file in these_files:
+            try:
+                total += os.path.getsize(os.path.join(this_root, this_file))
+            except OSError:
+                pass
+    return(total)
+
+# &%&%&&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%
+# Profiler
+# &%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%
+
+class TaskProfiler(object):
+    """
+    Collects one record per profiled task call.
+    """
+
+    def __init__(self, enabled=True):
+        self.enabled = enabled
+        self._records = []
+        self._running = []
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    # The lock and thread state cannot be pickled. A copy sent to a
+    # worker process starts with no records of its own.
+
+    def __getstate__(self):
+        return({'enabled': self.enabled})
+
+    def __setstate__(self, state):
+        self.__init__(enabled=state.get('enabled', True))
+
+    def _stack(self):
+        if not hasattr(self._local, 'stack'):
+            self._local.stack = []
+        return(self._local.stack)
+
+    @property
+    def records(self):
+        return(list(self._records))
+
+    def add_records(self, records):
+        """
+        Add records made elsewhere (e.g., in a worker process).
+        """
+        with self._lock:
+            self._records.extend(records)
+        return(None)
+
+    def pop_records(self):
+        """
+        Return and forget all records.
+        """
+        with self._lock:
+            records = self._records
+            self._records = []
+        return(records)
+
+    def start(self, name, handler=None, context=None):
+        """
+        Begin a record for a task call. Returns the record, which is
+        finished with stop().
+        """
+        stack = self._stack()
+        record = dict((key, None) for key in report_columns)
+        record['task'] = name
+        record['handler'] = handler
+        record['depth'] = len(stack)
+        record['parent'] = stack[-1]['task'] if len(stack) > 0 else None
+        if context is not None:
+            record.update(context)
+
+        # The peak memory belongs to the whole process. Only reset it
+        # when no task is running in another thread, and mark the
+        # peaks of overlapping tasks as shared.
+        this_thread = threading.current_thread().ident
+        record['_thread'] = this_thread
+        record['peak_shared'] = len(stack) > 0 and stack[-1]['peak_shared']
+        with self._lock:
+            for other in self._running:
+                if other['_thread'] != this_thread:
+                    other['peak_shared'] = True
+                    record['peak_shared'] = True
+            if len(stack) == 0 and not record['peak_shared']:
+                reset_peak_rss()
+            self._running.append(record)
+
+        record['start'] = time.strftime('%Y-%m-%d %H:%M:%S')
+        record['_wall'] = time.time()
+        record['_cpu'] = cpu_seconds()
+        record['_io'] = io_counters()
+        stack.append(record)
+        return(record)
+
+    def note(self, **info):
+        """
+        Attach information (e.g., input_file, input_shape) to the
+        innermost running task.
+        """
+        stack = self._stack()
+        if len(stack) > 0:
+            stack[-1].update(info)
+        return(None)
+
+    def stop(self, record, status='ok'):
+        """
+        Finish a record and store it.
+        """
+        stack = self._stack()
+        if len(stack) > 0 and stack[-1] is record:
+            stack.pop()
+        with self._lock:
+            self._running = [x for x in self._running if x is not record]
+        record.pop('_thread', None)
+        record['status'] = status
+        record['wall_s'] = time.time() - record.pop('_wall')
+        record['cpu_s'] = cpu_seconds() - record.pop('_cpu')
+        record['peak_rss_mb'] = peak_rss_mb()
+        io_start = record.pop('_io')
+        io_stop = io_counters()
+        if io_start is not None and io_stop is not None:
+            for key in io_stop:
+                if io_start[key] is not None and io_stop[key] is not None:
+                    record[key] = io_stop[key] - io_start[key]
+        with self._lock:
+            self._records.append(record)
+        return(record)
+
+    # &%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%
+    # Reports
+    # &%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%
+
+    def write_report(self, outfile):
+        """
+        Write the records to a JSON file, or to a CSV file if the
+        name ends in .csv.
+        """
+        records = self.records
+        if outfile.lower().endswith('.csv'):
+            with open(outfile, 'w') as f:
+                writer = csv.DictWriter(f, fieldnames=report_columns,
+                                        extrasaction='ignore')
+                writer.writeheader()
+                for record in records:
+                    row = dict(record)
+                    if row['input_shape'] is not None:
+                        row['input_shape'] = 'x'.join([str(x) for x in row['input_shape']])
+                    writer.writerow(row)
+        else:
+            report = {'created': time.strftime('%Y-%m-%d %H:%M:%S'),
+                      'n_tasks': len(records),
+                      'summary': self.summarize(),
+                      'tasks': records}
+            with open(outfile, 'w') as f:
+                json.dump(report, f, indent=1, default=str)
+        logger.info("Wrote profile of "+str(len(records))+" task calls to "+outfile)
+        return(None)
+
+    def summarize(self):
+        """
+        Totals per task name: number of calls, total and maximum wall
+        time, total CPU time and maximum peak memory, slowest first.
+        """
+        totals = {}
+        for record in self._records:
+            this_total = totals.setdefault(record['task'], {
+                'task': record['task'], 'depth': record['depth'], 'calls': 0,
+                'wall_s': 0.0, 'max_wall_s': 0.0, 'cpu_s': 0.0,
+                'max_peak_rss_mb': None})
+            this_total['calls'] += 1
+            this_total['wall_s'] += record['wall_s']
+            this_total['max_wall_s'] = max(this_total['max_wall_s'], record['wall_s'])
+            this_total['cpu_s'] += record['cpu_s']
+            if record['peak_rss_mb'] is not None:
+                this_total['max_peak_rss_mb'] = max(
+                    this_total['max_peak_rss_mb'] or 0.0, record['peak_rss_mb'])
+        return(sorted(totals.values(), key=lambda x: -x['wall_s']))
+
+    def log_summary(self, n_slowest=10):
+        """
+        Log the task types with the most total time and the slowest
+        individual calls.
+        """
+        if len(self._records) == 0:
+            logger.info("No profiled tasks.")
+            return(None)
+
+        logger.info("")
+        logger.info("&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&")
+        logger.info("Task profile summary")
+        logger.info("&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&")
+        logger.info("")
+        logger.info("{0:40s} {1:>6s} {2:>10s} {3:>10s} {4:>10s}".format(
+            'task', 'calls', 'wall [s]', 'cpu [s]', 'peak [MB]'))
+        for this_total in self.summarize()[:n_slowest]:
+            logger.info("{0:40s} {1:6d} {2:10.1f} {3:10.1f} {4:>10s}".format(
+                '  '*this_total['depth']+this_total['task'], this_total['calls'],
+                this_total['wall_s'], this_total['cpu_s'],
+                '%.0f' % this_total['max_peak_rss_mb']
+                if this_total['max_peak_rss_mb'] is not None else '-'))
+
+        logger.info("")
+        logger.info("Slowest calls:")
+        slowest = sorted(self._records, key=lambda x: -x['wall_s'])[:n_slowest]
+        for record in slowest:
+            logger.info("{0:10.1f} s  {1} {2}".format(
+                record['wall_s'], record['task'],
+                ' , '.join([str(record[key]) for key in
+                            ['target', 'config', 'product', 'res_tag']
+                            if record.get(key) is not None])))
+        logger.info("")
+        return(None)
+
+# &%&%&&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%
+# Decorators
+# &%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%
+
+def profile_method(method, name=None):
+    """
+    Wrap a handler method so that each call is recorded by the
+    handler's profiler, if it has one. name defaults to the name of
+    the method.
+    """
+    if name is None:
+        name = method.__name__
+
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        profiler = getattr(self, '_profiler', None)
+        if profiler is None or not profiler.enabled:
+            return(method(self, *args, **kwargs))
+        context = {}
+        for key in _context_kwargs:
+            if key in kwargs and kwargs[key] is not None:
+                context[key] = str(kwargs[key])
+        record = profiler.start(name, handler=self.__class__.__name__,
+                                context=context)
+        try:
+            result = method(self, *args, **kwargs)
+        except BaseException:
+            profiler.stop(record, status='error')
+            raise
+        profiler.stop(record)
+        return(result)
+    # ... methods under other decorators (e.g. CleanCallFunctionDecorator)
+    # may not carry their own name
+    wrapper.__name__ = name
+    return(wrapper)
+
+def profile_tasks(cls):
+    """
+    Class decorator that profiles every task_* and recipe_* method
+    defined on the class.
+    """
+    for name in list(cls.__dict__.keys()):
+        if not (name.startswith('task_') or name.startswith('recipe_')):
+            continue
+        method = cls.__dict__[name]
+        if not callable(method):
+            continue
+        setattr(cls, name, profile_method(method, name=name))
+    return(cls)
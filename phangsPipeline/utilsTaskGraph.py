@@ -0,0 +1,271 @@
+"""
+Dependency graphs of handler tasks.
+
+A TaskGraph holds task nodes. Each node names a handler method, the
+keywords to call it with, and the files it reads and writes. The edges
+follow from the files: a node depends on every other node in the graph
+that writes one of its inputs (inputs that no node writes are taken to
+exist already). Nodes whose dependencies are done are run on a local
+process pool, so independent targets, configurations and resolutions
+proceed concurrently while the ordering constraints are kept.
+
+Example:
+    graph = TaskGraph()
+    graph.add_task('noise:ngc0628', 'task_estimate_noise',
+                   kwargs={'target':'ngc0628', ...},
+                   inputs=[cube_file], outputs=[noise_file])
+    ...
+    status = graph.run(handler, n_workers=8)
+"""
+
+import os
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+
+import logging
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.DEBUG)
+
+import utilsMemory
+
+class TaskNode(object):
+    """
+    One call of a handler method with its file-level inputs and
+    outputs. Explicit extra dependencies (node names) go in after.
+    """
+
+    def __init__(self, name, method, kwargs=None,
+                 inputs=None, outputs=None, after=None):
+        self.name = name
+        self.method = method
+        self.kwargs = dict(kwargs) if kwargs is not None else {}
+        self.inputs = [os.path.abspath(f) for f in (inputs or [])]
+        self.outputs = [os.path.abspath(f) for f in (outputs or [])]
+        self.after = list(after or [])
+
+    def __repr__(self):
+        return("TaskNode({0}, {1})".format(self.name, self.method))
+
+# &%&%&&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%
+# Worker process state
+# &%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%
+
+# The handler is handed to each worker process once, when the pool
+# starts, rather than with every task.
+
+_worker_handler = None
+
+def _init_worker(handler):
+    global _worker_handler
+    _worker_handler = handler
+
+def _run_node(method, kwargs):
+    getattr(_worker_handler, method)(**kwargs)
+    # Hand any task profile records back to the main process
+    profiler = getattr(_worker_handler, '_profiler', None)
+    if profiler is not None:
+        return(profiler.pop_records())
+    return(None)
+
+# &%&%&&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%
+# Graph
+# &%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%
+
+class TaskGraph(object):
+    """
+    Directed acyclic graph of TaskNodes with file-level dependencies.
+    """
+
+    def __init__(self):
+        self._nodes = OrderedDict()
+
+    def __len__(self):
+        return(len(self._nodes))
+
+    def __repr__(self):
+        return("TaskGraph with {0} tasks".format(len(self._nodes)))
+
+    @property
+    def nodes(self):
+        return(self._nodes)
+
+    def add_task(self, name, method, kwargs=None,
+                 inputs=None, outputs=None, after=None):
+        """
+        Add a node and return it. Adding a name twice keeps the first
+        node.
+        """
+        if name in self._nodes:
+            logger.debug("Task already in graph: "+name)
+            return(self._nodes[name])
+        node = TaskNode(name, method, kwargs=kwargs, inputs=inputs,
+                        outputs=outputs, after=after)
+        self._nodes[name] = node
+        return(node)
+
+    def dependencies(self):
+        """
+        Return a dictionary of node name -> set of names of the nodes
+        it depends on.
+        """
+        producers = {}
+        for node in self._nodes.values():
+            for this_file in node.outputs:
+                if this_file in producers and producers[this_file] != node.name:
+                    logger.warning("File "+this_file+" written by both "
+                                   +producers[this_file]+" and "+node.name)
+                    continue
+                producers[this_file] = node.name
+
+        deps = OrderedDict()
+        for node in self._nodes.values():
+            these_deps = set()
+            for this_file in node.inputs:
+                if this_file in producers and producers[this_file] != node.name:
+                    these_deps.add(producers[this_file])
+            for other in node.after:
+                if other in self._nodes and other != node.name:
+                    these_deps.add(other)
+            deps[node.name] = these_deps
+        return(deps)
+
+    def topological_order(self, deps=None):
+        """
+        Node names in dependency order, ties broken by the order in
+        which the nodes were added.
+        """
+        if deps is None:
+            deps = self.dependencies()
+        remaining = OrderedDict((name, set(these)) for name, these in deps.items())
+        order = []
+        while len(remaining) > 0:
+            ready = [name for name, these in remaining.items() if len(these) == 0]
+            if len(ready) == 0:
+                logger.error("Cycle in task graph among: "+str(list(remaining)))
+                raise ValueError("Task graph has a cycle.")
+            for name in ready:
+                del remaining[name]
+                order.append(name)
+            for these in remaining.values():
+                these.difference_update(ready)
+        return(order)
+
+    def run(self, handler, n_workers=1, memory_budget=None, estimate=None):
+        """
+        Run the graph by calling each node's method on handler. With
+        n_workers > 1 ready nodes run concurrently on a pool of that
+        many processes, each holding its own copy of handler.
+
+        With a memory_budget (bytes, or e.g. '64 GB') and an estimate
+        function (node -> predicted peak bytes, evaluated once the
+        node is ready so that its inputs exist), a node only starts
+        when the estimates of the running nodes plus its own fit in
+        the budget. Nodes start in dependency order, so a large node
+        is not overtaken indefinitely by small ones. A node larger
+        than the whole budget runs alone.
+
+        A node that raises is marked 'failed' and everything that
+        depends on it 'skipped'; the rest of the graph still runs.
+        Returns an ordered dictionary of node name -> 'done', 'failed'
+        or 'skipped'.
+        """
+        deps = self.dependencies()
+        order = self.topological_order(deps=deps)
+        rank = dict((name, ii) for ii, name in enumerate(order))
+        status = OrderedDict((name, None) for name in order)
+
+        logger.info("Running "+str(len(order))+" tasks on "
+                    +str(max(n_workers, 1))+" process(es).")
+
+        def _blocked(name):
+            return(any(status[dep] in ['failed', 'skipped'] for dep in deps[name]))
+
+        def _ready(name):
+            return(status[name] is None and
+                   all(status[dep] == 'done' for dep in deps[name]))
+
+        if n_workers <= 1:
+            for name in order:
+                if _blocked(name):
+                    status[name] = 'skipped'
+                    continue
+                node = self._nodes[name]
+                try:
+                    getattr(handler, node.method)(**node.kwargs)
+                    status[name] = 'done'
+                except Exception:
+                    logger.exception("Task failed: "+name)
+                    status[name] = 'failed'
+            self._report(status)
+            return(status)
+
+        budget = utilsMemory.parse_memory(memory_budget)
+        if budget is not None and estimate is None:
+            logger.warning("Memory budget set without an estimate. Ignoring the budget.")
+            budget = None
+        if budget is not None:
+            logger.info("Memory budget: "+utilsMemory.format_memory(budget))
+        need = {}
+
+        def _admit(name):
+            # True if the node fits next to the running ones
+            if budget is None:
+                return(True)
+            if name not in need:
+                need[name] = estimate(self._nodes[name])
+            in_use = sum([need[x] for x in running.values()])
+            if len(running) > 0:
+                if len(running) >= n_workers or in_use + need[name] > budget:
+                    return(False)
+            elif need[name] > budget:
+                logger.warning("Task "+name+" needs an estimated "
+                               +utilsMemory.format_memory(need[name])
+                               +", more than the budget. Running it alone.")
+            logger.debug("Starting "+name+" (estimated "
+                         +utilsMemory.format_memory(need[name])+", "
+                         +utilsMemory.format_memory(in_use)+" in use)")
+            return(True)
+
+        running = {}
+        with ProcessPoolExecutor(max_workers=n_workers,
+                                 initializer=_init_worker,
+                                 initargs=(handler,)) as pool:
+            while True:
+                # Propagate failures, then submit everything ready
+                # that fits
+                for name in order:
+                    if status[name] is None and _blocked(name):
+                        status[name] = 'skipped'
+                for name in order:
+                    if _ready(name):
+                        if not _admit(name):
+                            break
+                        node = self._nodes[name]
+                        future = pool.submit(_run_node, node.method, node.kwargs)
+                        running[future] = name
+                        status[name] = 'running'
+                if len(running) == 0:
+                    break
+                finished, _ = wait(list(running), return_when=FIRST_COMPLETED)
+                for future in sorted(finished, key=lambda f: rank[running[f]]):
+                    name = running.pop(future)
+                    try:
+                        records = future.result()
+                        if records and getattr(handler, '_profiler', None) is not None:
+                            handler._profiler.add_records(records)
+                        status[name] = 'done'
+                    except Exception:
+                        logger.exception("Task failed: "+name)
+                        status[name] = 'failed'
+
+        self._report(status)
+        return(status)
+
+    def _report(self, status):
+        counts = OrderedDict()
+        for this_status in status.values():
+            counts[this_status] = counts.get(this_status, 0) + 1
+        logger.info("Task graph finished: "+str(dict(counts)))
+        for name, this_status in status.items():
+            if this_status == 'failed':
+                logger.warning("... failed: "+name)
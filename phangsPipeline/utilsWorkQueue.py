@@ -0,0 +1,426 @@
+"""
+Work queue on a shared file system for running handler loops on
+many nodes.
+
+A coordinator adds work items (a handler method and its keywords, in
+practice a loop restricted to one target, product and configuration)
+to a queue directory. Any number of worker processes, on any node that
+sees the directory, then claim and run the items. Nothing but POSIX
+file semantics is needed:
+
+    <queue>/items/<id>.json     item definitions, written once
+    <queue>/leases/<id>.lease   claims, created with O_CREAT|O_EXCL so
+                                that exactly one worker wins
+    <queue>/done/<id>.json      finished items
+    <queue>/failed/<id>.json    failed attempts (retried up to
+                                max_attempts)
+
+A worker refreshes the modification time of its lease every heartbeat
+seconds while the item runs. A lease that has not been refreshed for
+lease_time seconds belongs to a worker that died; another worker breaks
+it (by an atomic rename) and runs the item again. Ages are measured
+against the file system clock, so the nodes' clocks need not agree.
+
+Items carry a stage number. No item is claimed while an item of an
+earlier stage is unfinished, so steps that combine the results of
+several items (e.g., the broad masks across linked configurations)
+wait for all of them. Failed items with no attempts left count as
+finished.
+
+Example:
+    queue = WorkQueue('/shared/queue')
+    queue.add('s00_ngc0628_co21_7m', 'run_work_item',
+              kwargs={...}, stage=0)
+    ...
+    # on each node, any number of times:
+    queue.run_worker(handler)
+"""
+
+import os
+import json
+import time
+import errno
+import socket
+import tempfile
+import threading
+
+import logging
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.DEBUG)
+
+_subdirs = ['items', 'leases', 'done', 'failed']
+
+def item_id(*parts):
+    """
+    File-system safe item name from its parts (stage, target, ...).
+    """
+    text = '_'.join([str(x) for x in parts if x is not None])
+    return(''.join([c if (c.isalnum() or c in '-+.') else '_' for c in text]))
+
+def default_worker_id():
+    return(socket.gethostname()+'-'+str(os.getpid()))
+
+def _write_json(filename, content):
+    """
+    Write a JSON file atomically (temporary file plus rename).
+    """
+    handle, temp_file = tempfile.mkstemp(dir=os.path.dirname(filename),
+                                         prefix='.tmp_')
+    try:
+        with os.fdopen(handle, 'w') as f:
+            json.dump(content, f, sort_keys=True, indent=1, default=str)
+        os.rename(temp_file, filename)
+    except Exception:
+        if os.path.exists(temp_file):
+            os.remove(temp_file)
+        raise
+    return(None)
+
+def _read_json(filename):
+    try:
+        with open(filename, 'r') as f:
+            return(json.load(f))
+    except (IOError, OSError, ValueError):
+        return(None)
+
+def _remove(filename):
+    try:
+        os.remove(filename)
+    except OSError as e:
+        if e.errno != errno.ENOENT:
+            raise
+    return(None)
+
+class WorkQueue(object):
+    """
+    Work queue in a shared directory. See the module docstring.
+    """
+
+    def __init__(self, queue_dir, lease_time=600., heartbeat=60.,
+                 max_attempts=2, poll=10.):
+        self.queue_dir = os.path.abspath(queue_dir)
+        self.lease_time = float(lease_time)
+        self.heartbeat = float(heartbeat)
+        self.max_attempts = int(max_attempts)
+        self.poll = float(poll)
+        if self.heartbeat >= self.lease_time:
+            logger.warning("Heartbeat is not shorter than the lease time. "
+                           "Live workers may lose their leases.")
+        for this_dir in _subdirs:
+            this_path = os.path.join(self.queue_dir, this_dir)
+            if not os.path.isdir(this_path):
+                try:
+                    os.makedirs(this_path)
+                except OSError:
+                    if not os.path.isdir(this_path):
+                        raise
+
+    def __repr__(self):
+        return("WorkQueue("+self.queue_dir+")")
+
+    def _file(self, subdir, this_id):
+        ext = '.lease' if subdir == 'leases' else '.json'
+        return(os.path.join(self.queue_dir, subdir, this_id+ext))
+
+    def _fs_now(self, worker_id):
+        """
+        Current time on the file system clock, read from the
+        modification time of a file this worker touches.
+        """
+        clock_file = os.path.join(self.queue_dir, 'leases', '.clock_'+item_id(worker_id))
+        with open(clock_file, 'a'):
+            os.utime(clock_file, None)
+        return(os.stat(clock_file).st_mtime)
+
+    # &%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%
+    # Coordinator side
+    # &%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%
+
+    def add(self, this_id, method, kwargs=None, stage=0):
+        """
+        Add an item. An item already in the queue (pending, running or
+        finished) is left alone. Returns True if the item was added.
+        """
+        filename = self._file('items', this_id)
+        if os.path.isfile(filename):
+            return(False)
+        _write_json(filename, {'id': this_id, 'method': method,
+                               'kwargs': kwargs if kwargs is not None else {},
+                               'stage': int(stage),
+                               'created': time.strftime('%Y-%m-%d %H:%M:%S')})
+        return(True)
+
+    def items(self):
+        """
+        All item definitions, ordered by stage and then name.
+        """
+        item_list = []
+        for this_file in sorted(os.listdir(os.path.join(self.queue_dir, 'items'))):
+            if not this_file.endswith('.json') or this_file.startswith('.'):
+                continue
+            item = _read_json(os.path.join(self.queue_dir, 'items', this_file))
+            if item is not None:
+                item_list.append(item)
+        return(sorted(item_list, key=lambda x: (x['stage'], x['id'])))
+
+    def attempts(self, this_id):
+        record = _read_json(self._file('failed', this_id))
+        if record is None:
+            return(0)
+        return(int(record.get('attempts', 0)))
+
+    def item_status(self, this_id):
+        """
+        'done', 'failed' (no attempts left), 'running' or 'pending'.
+        """
+        if os.path.isfile(self._file('done', this_id)):
+            return('done')
+        if self.attempts(this_id) >= self.max_attempts:
+            return('failed')
+        if os.path.exists(self._file('leases', this_id)):
+            return('running')
+        return('pending')
+
+    def status(self):
+        """
+        Dictionary of item id -> status.
+        """
+        return(dict((item['id'], self.item_status(item['id'])) for item in self.items()))
+
+    def summary(self):
+        """
+        Number of items in each status.
+        """
+        counts = {'pending': 0, 'running': 0, 'done': 0, 'failed': 0}
+        for this_status in self.status().values():
+            counts[this_status] += 1
+        return(counts)
+
+    def requeue_failed(self):
+        """
+        Give failed items a fresh set of attempts.
+        """
+        for this_file in os.listdir(os.path.join(self.queue_dir, 'failed')):
+            if this_file.endswith('.json'):
+                _remove(os.path.join(self.queue_dir, 'failed', this_file))
+        return(None)
+
+    # &%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%
+    # Leases
+    # &%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%
+
+    def _try_lease(self, this_id, worker_id):
+        """
+        Atomically create the lease for an item. True if this worker
+        now holds it.
+        """
+        lease_file = self._file('leases', this_id)
+        try:
+            handle = os.open(lease_file, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except OSError as e:
+            if e.errno == errno.EEXIST:
+                return(False)
+            raise
+        with os.fdopen(handle, 'w') as f:
+            json.dump({'worker': worker_id, 'host': socket.gethostname(),
+                       'pid': os.getpid(),
+                       'claimed': time.strftime('%Y-%m-%d %H:%M:%S')}, f)
+        return(True)
+
+    def _holds_lease(self, this_id, worker_id):
+        lease = _read_json(self._file('leases', this_id))
+        return(lease is not None and lease.get('worker') == worker_id)
+
+    def _release(self, this_id, worker_id):
+        if self._holds_lease(this_id, worker_id):
+            _remove(self._file('leases', this_id))
+        return(None)
+
+    def _break_stale_lease(self, this_id, worker_id, now):
+        """
+        Remove a lease that has not had a heartbeat for lease_time.
+        Returns True if the lease is gone.
+        """
+        lease_file = self._file('leases', this_id)
+        try:
+            age = now - os.stat(lease_file).st_mtime
+        except OSError:
+            return(True)
+        if age < self.lease_time:
+            return(False)
+
+        # Rename first so that only one worker breaks the lease
+        broken_file = lease_file+'.broken_'+item_id(worker_id)
+        try:
+            os.rename(lease_file, broken_file)
+        except OSError:
+            return(not os.path.exists(lease_file))
+
+        # ... in case the lease was renewed or replaced in between,
+        # put it back
+        try:
+            fresh = (now - os.stat(broken_file).st_mtime) < self.lease_time
+        except OSError:
+            fresh = False
+        if fresh:
+            try:
+                os.link(broken_file, lease_file)
+            except OSError:
+                pass
+            _remove(broken_file)
+            return(False)
+
+        lease = _read_json(broken_file)
+        logger.warning("Lease on "+this_id+" expired ("
+                       +str(lease.get('worker') if lease else 'unknown worker')
+                       +", "+str(int(age))+" s). Requeueing.")
+        _remove(broken_file)
+        return(True)
+
+    def _heartbeat(self, this_id, worker_id, stop_event):
+        lease_file = self._file('leases', this_id)
+        while not stop_event.wait(self.heartbeat):
+            try:
+                os.utime(lease_file, None)
+            except OSError:
+                pass
+            if not self._holds_lease(this_id, worker_id):
+                logger.warning("Lost the lease on "+this_id+". Another worker may rerun it.")
+                return(None)
+        return(None)
+
+    # &%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%
+    # Worker side
+    # &%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%
+
+    def claim(self, worker_id=None):
+        """
+        Claim the next runnable item. Returns the item, or None if
+        nothing can be claimed now. Also returns None once everything
+        is finished, which finished() tells apart.
+        """
+        if worker_id is None:
+            worker_id = default_worker_id()
+        now = self._fs_now(worker_id)
+
+        unfinished = [item for item in self.items()
+                      if self.item_status(item['id']) in ['pending', 'running']]
+        if len(unfinished) == 0:
+            return(None)
+        current_stage = unfinished[0]['stage']
+
+        for item in unfinished:
+            if item['stage'] != current_stage:
+                break
+            this_id = item['id']
+            if os.path.exists(self._file('leases', this_id)):
+                if not self._break_stale_lease(this_id, worker_id, now):
+                    continue
+            if not self._try_lease(this_id, worker_id):
+                continue
+            # ... it may have finished just before the lease was taken
+            if self.item_status(this_id) in ['done', 'failed']:
+                _remove(self._file('leases', this_id))
+                continue
+            return(item)
+
+        return(None)
+
+    def finished(self):
+        """
+        True if no item is pending or running.
+        """
+        for this_status in self.status().values():
+            if this_status in ['pending', 'running']:
+                return(False)
+        return(True)
+
+    def run_item(self, handler, item, worker_id=None):
+        """
+        Run a claimed item on handler, keeping its lease alive, and
+        mark it done or failed. Returns True on success.
+        """
+        if worker_id is None:
+            worker_id = default_worker_id()
+        this_id = item['id']
+
+        stop_event = threading.Event()
+        beat = threading.Thread(target=self._heartbeat,
+                                args=(this_id, worker_id, stop_event))
+        beat.daemon = True
+        beat.start()
+
+        logger.info("Worker "+worker_id+" running "+this_id)
+        started = time.strftime('%Y-%m-%d %H:%M:%S')
+        start = time.time()
+        success = True
+        error = None
+        try:
+            getattr(handler, item['method'])(**item['kwargs'])
+        except Exception as e:
+            logger.exception("Item failed: "+this_id)
+            success = False
+            error = repr(e)
+        finally:
+            stop_event.set()
+            beat.join()
+
+        record = {'worker': worker_id, 'host': socket.gethostname(),
+                  'wall_s': time.time() - start, 'started': started,
+                  'finished': time.strftime('%Y-%m-%d %H:%M:%S')}
+        if success:
+            record['status'] = 'done'
+            _write_json(self._file('done', this_id), record)
+        else:
+            record['status'] = 'failed'
+            record['error'] = error
+            record['attempts'] = self.attempts(this_id) + 1
+            _write_json(self._file('failed', this_id), record)
+            if record['attempts'] < self.max_attempts:
+                logger.warning("Requeueing "+this_id+" (attempt "
+                               +str(record['attempts'])+" of "+str(self.max_attempts)+").")
+        self._release(this_id, worker_id)
+        return(success)
+
+    def run_worker(self, handler, worker_id=None, max_items=None, wait=True):
+        """
+        Claim and run items until the queue is finished (or max_items
+        have run). If wait is False, stop as soon as nothing can be
+        claimed instead of waiting for other workers. Returns the
+        number of items run.
+        """
+        if worker_id is None:
+            worker_id = default_worker_id()
+        n_run = 0
+        while max_items is None or n_run < max_items:
+            item = self.claim(worker_id=worker_id)
+            if item is None:
+                if self.finished() or not wait:
+                    break
+                time.sleep(self.poll)
+                continue
+            self.run_item(handler, item, worker_id=worker_id)
+            n_run += 1
+        logger.info("Worker "+worker_id+" ran "+str(n_run)+" item(s). Queue: "
+                    +str(self.summary()))
+        return(n_run)
+
+# &%&%&&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%
+# Local workers
+# &%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%&%
+
+def _local_worker(handler, queue_dir, queue_kwargs, worker_id):
+    queue = WorkQueue(queue_dir, **queue_kwargs)
+    return(queue.run_worker(handler, worker_id=worker_id))
+
+def run_local_workers(handler, queue_dir, n_workers=2, **queue_kwargs):
+    """
+    Run n_workers worker processes on this node until the queue is
+    finished. Returns the number of items each ran.
+    """
+    from concurrent.futures import ProcessPoolExecutor
+    worker_ids = [default_worker_id()+'-'+str(ii) for ii in range(n_workers)]
+    with ProcessPoolExecutor(max_workers=n_workers) as pool:
+        futures = [pool.submit(_local_worker, handler, queue_dir, queue_kwargs, this_id)
+                   for this_id in worker_ids]
+        return([f.result() for f in futures])
@@ -0,0 +1,85 @@
+"""
+Write products to disk on a background thread.
+
+A BackgroundWriter takes write calls (any function plus its
+arguments) and runs them in order on one thread, so that a chain of
+calculations that passes cubes along in memory can keep working
+while the intermediate products are saved. At most max_pending writes
+are queued; a further write blocks until one finishes, which bounds
+the number of products held in memory only for writing.
+
+Errors raised by a write are logged and re-raised from wait() or
+close(), so a failed write is never silently lost.
+
+Example:
+    writer = BackgroundWriter()
+    writer.submit(cube.write, 'cube.fits', overwrite=True)
+    ... keep working with cube ...
+    writer.close()
+"""
+
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import logging
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.DEBUG)
+
+class BackgroundWriter(object):
+    """
+    Run write calls in submission order on a single background thread.
+    """
+
+    def __init__(self, max_pending=4):
+        self._pool = ThreadPoolExecutor(max_workers=1)
+        self._slots = threading.BoundedSemaphore(max(int(max_pending), 1))
+        self._pending = []
+
+    def __enter__(self):
+        return(self)
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        # Don't mask an exception from the body with a write error
+        self.close(raise_errors=(exc_type is None))
+        return(False)
+
+    def submit(self, func, *args, **kwargs):
+        """
+        Queue func(*args, **kwargs). Returns a future.
+        """
+        self._slots.acquire()
+        try:
+            future = self._pool.submit(func, *args, **kwargs)
+        except Exception:
+            self._slots.release()
+            raise
+        future.add_done_callback(lambda f: self._slots.release())
+        self._pending.append(future)
+        return(future)
+
+    def wait(self, raise_errors=True):
+        """
+        Block until every queued write has finished. Raises the first
+        error if raise_errors.
+        """
+        first_error = None
+        for future in self._pending:
+            error = future.exception()
+            if error is not None:
+                logger.error("Background write failed: "+str(error))
+                if first_error is None:
+                    first_error = error
+        self._pending = []
+        if raise_errors and first_error is not None:
+            raise first_error
+        return(None)
+
+    def close(self, raise_errors=True):
+        """
+        Wait for all writes and stop the thread.
+        """
+        try:
+            self.wait(raise_errors=raise_errors)
+        finally:
+            self._pool.shutdown(wait=True)
+        return(None)
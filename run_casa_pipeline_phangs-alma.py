@@ -66,7 +66,15 @@ from phangsPipeline import handlerPostprocess as pph
 # PostProcessHandler), which run the actual pipeline using the project
 # definitions from the KeyHandler.
 
-this_kh = kh.KeyHandler(master_key=key_file)
+# With use_key_cache, the parsed keys are kept in a cache file next to
+# the master key (rebuilt whenever a key changes), and files are only
+# checked for existence when they are used. This makes startup fast,
+# e.g. for each job of a cluster run.
+
+use_key_cache = False
+
+this_kh = kh.KeyHandler(master_key=key_file, use_cache=use_key_cache,
+                        lazy_checks=use_key_cache)
 this_uvh = uvh.VisHandler(key_handler=this_kh)
 this_imh = imh.ImagingHandler(key_handler=this_kh)
 this_pph = pph.PostProcessHandler(key_handler=this_kh)
@@ -127,6 +135,38 @@ this_pph.set_targets()
 this_pph.set_interf_configs(only=['12m+7m'])
 this_pph.set_feather_configs(only=['12m+7m+tp'])
 
+# Set incremental reruns to skip imaging and postprocessing whose
+# outputs are up to date with their inputs, keys, and the pipeline
+# version (recorded in a .manifest directory next to the outputs), and
+# to redo only what changed.
+
+this_imh.set_incremental(False)
+this_pph.set_incremental(False)
+
+# Set profile_tasks to record the time, memory and IO of every task and
+# write one report per handler (profile_root+'_imaging.json', etc.;
+# set profile_ext to '.csv' for tables) at the end.
+
+profile_tasks = False
+profile_root = 'task_profile'
+profile_ext = '.json'
+
+for this_handler in [this_uvh, this_imh, this_pph]:
+    this_handler.set_profiling(profile_tasks)
+
+# Set journal_root to record the start, end, and failures of every
+# task in a journal per handler (journal_root+'_imaging.jsonl',
+# etc.). If a run is interrupted, rerun with resume = True to skip the
+# finished tasks, clean up after interrupted ones, and retry failures.
+
+journal_root = None
+resume = False
+
+if journal_root is not None:
+    for this_handler, this_name in [(this_uvh, 'staging'), (this_imh, 'imaging'),
+                                    (this_pph, 'postprocess')]:
+        this_handler.set_journal(journal_root+'_'+this_name+'.jsonl')
+
 # Use boolean flags to set the steps to be performed when the pipeline
 # is called. See descriptions below (but only edit here).
 
@@ -135,6 +175,32 @@ do_imaging = True
 do_postprocess = True
 do_stats = True
 
+# Set plan_only to estimate the time, I/O and memory of imaging and
+# postprocessing on plan_workers workers instead of running them
+# (staging must have been run, since the estimates start from the
+# visibilities and images on disk). plan_cost_model can be a profile
+# report from an earlier run (see profile_tasks above).
+
+plan_only = False
+plan_workers = 1
+plan_cost_model = None
+
+if plan_only:
+    this_plan = this_imh.plan_loop(
+        loop='loop_imaging', n_workers=plan_workers, cost_model=plan_cost_model,
+        outfile='imaging_plan.json', do_all=True)
+    this_plan.log_summary()
+    this_plan = this_pph.plan_loop(
+        loop='loop_postprocess', n_workers=plan_workers, cost_model=plan_cost_model,
+        outfile='postprocess_plan.json',
+        stages=[{'do_prep':True}, {'do_feather':True}, {'do_mosaic':True},
+                {'do_cleanup':True}])
+    this_plan.log_summary()
+    do_staging = False
+    do_imaging = False
+    do_postprocess = False
+    do_stats = False
+
 ##############################################################################
 # Run staging
 ##############################################################################
@@ -148,19 +214,23 @@ do_stats = True
 if do_staging:
     this_uvh.loop_stage_uvdata(do_copy=True, do_contsub=True,
                                do_extract_line=False, do_extract_cont=False,
-                               do_remove_staging=False, overwrite=True)
+                               do_remove_staging=False, overwrite=True,
+                               resume=resume)
 
     this_uvh.loop_stage_uvdata(do_copy=False, do_contsub=False,
                                do_extract_line=True, do_extract_cont=False,
-                               do_remove_staging=False, overwrite=True)
+                               do_remove_staging=False, overwrite=True,
+                               resume=resume)
 
     this_uvh.loop_stage_uvdata(do_copy=False, do_contsub=False,
                                do_extract_line=False, do_extract_cont=True,
-                               do_remove_staging=False, overwrite=True)
+                               do_remove_staging=False, overwrite=True,
+                               resume=resume)
 
     this_uvh.loop_stage_uvdata(do_copy=False, do_contsub=False,
                                do_extract_line=False, do_extract_cont=False,
-                               do_remove_staging=True, overwrite=True)
+                               do_remove_staging=True, overwrite=True,
+                               resume=resume)
 
 ##############################################################################
 # Step through imaging
@@ -173,7 +243,7 @@ if do_staging:
 # the imaging loop call but this call does everything.
 
 if do_imaging:
-    this_imh.loop_imaging(do_all=True)
+    this_imh.loop_imaging(do_all=True, resume=resume)
 
 ##############################################################################
 # Step through postprocessing
@@ -185,4 +255,15 @@ if do_imaging:
 
 if do_postprocess:
     this_pph.loop_postprocess(do_prep=True, do_feather=True,
-                              do_mosaic=True, do_cleanup=True)
+                              do_mosaic=True, do_cleanup=True,
+                              resume=resume)
+
+##############################################################################
+# Report the task profile
+##############################################################################
+
+if profile_tasks:
+    for this_handler, this_name in [(this_uvh, 'staging'), (this_imh, 'imaging'),
+                                    (this_pph, 'postprocess')]:
+        this_handler.write_profile_report(profile_root+'_'+this_name+profile_ext)
+        this_handler.log_profile_summary()
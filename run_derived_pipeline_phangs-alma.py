@@ -50,7 +50,15 @@ importlib.reload(der)
 # data, into the other handlers (here DerivedHandler), which run the
 # actual pipeline using the project definitions from the KeyHandler.
 
-this_kh = kh.KeyHandler(master_key=key_file)
+# With use_key_cache, the parsed keys are kept in a cache file next to
+# the master key (rebuilt whenever a key changes), and files are only
+# checked for existence when they are used. This makes startup fast,
+# e.g. for each job of a cluster run.
+
+use_key_cache = False
+
+this_kh = kh.KeyHandler(master_key=key_file, use_cache=use_key_cache,
+                        lazy_checks=use_key_cache)
 this_der = der.DerivedHandler(key_handler=this_kh)
 
 # Make missing directories
@@ -91,6 +99,31 @@ this_der.set_feather_configs(only=['12m+7m+tp'])
 this_der.set_line_products(only=['co21'])
 this_der.set_no_cont_products(True)
 
+# Set incremental reruns to skip products that are up to date with
+# their inputs, keys, and the pipeline version (recorded in a
+# .manifest directory next to the outputs), and to remake only what
+# changed.
+
+this_der.set_incremental(False)
+
+# Set profile_tasks to record the time, memory and IO of every task and
+# write a report (JSON, or CSV if the name ends in .csv) at the end.
+
+profile_tasks = False
+profile_report = 'task_profile_derived.json'
+
+this_der.set_profiling(profile_tasks)
+
+# Set journal_file to record the start, end, and failures of every
+# task. If a run is interrupted, rerun with resume = True to skip the
+# finished tasks, clean up after interrupted ones, and retry failures.
+
+journal_file = None
+resume = False
+
+if journal_file is not None:
+    this_der.set_journal(journal_file)
+
 # Use boolean flags to set the steps to be performed when the pipeline
 # is called. See descriptions below (but only edit here).
 
@@ -101,10 +134,115 @@ do_broadmask = True
 do_moments = True
 do_secondary = True
 
+# Set use_graph to run all of the requested steps in one pass as a
+# dependency graph on n_processes local processes. Different targets
+# and resolutions then run concurrently, with each step waiting only
+# for the files it needs.
+
+use_graph = False
+n_processes = 1
+
+# memory_budget (e.g. '64 GB') limits the total estimated memory of
+# the tasks running at once, with use_graph or convolve_cores. The
+# estimates come from the cube sizes and can be calibrated with a
+# profile report from an earlier run (see profile_tasks above).
+
+memory_budget = None
+memory_calibration = None
+
+# Set convolve_cores to convolve the resolutions of each cube
+# concurrently on that many cores (without use_graph). Every concurrent
+# resolution holds its own copy of the native cube, so memory grows
+# with the number running at once. Set memory_budget to cap it.
+
+convolve_cores = 1
+
+this_der.set_memory_calibration(memory_calibration)
+
+# Set use_chain to convolve, estimate the noise, build the strict mask
+# and make the strict mask moments for each cube and resolution in one
+# pass that keeps the cubes in memory and writes the products in the
+# background.
+
+use_chain = False
+
+# Set use_queue to run the requested steps through a work queue in
+# queue_dir, a directory on a file system shared by all nodes. Every
+# job of a cluster run can run this same script: the work is enqueued
+# once and each job then claims items (one target, product, config at
+# a time) until the queue is done. n_processes workers run per job.
+
+use_queue = False
+queue_dir = '/path/to/shared/queue/'
+
+# Set plan_only to estimate the time, I/O and memory of the requested
+# steps on n_processes workers instead of running them. The estimate
+# is logged and written to plan_file. plan_cost_model can be a profile
+# report from an earlier run (see profile_tasks above) to calibrate
+# the task costs.
+
+plan_only = False
+plan_file = 'derived_plan.json'
+plan_cost_model = None
+
 ##############################################################################
 # Step through derived product creation
 ##############################################################################
 
+if plan_only:
+    this_plan = this_der.plan_derive_products(
+        do_convolve=do_convolve, do_noise=do_noise, do_strictmask=do_strictmask,
+        do_broadmask=do_broadmask, do_moments=do_moments, do_secondary=do_secondary,
+        n_workers=n_processes, cost_model=plan_cost_model, outfile=plan_file)
+    this_plan.log_summary()
+    use_graph = False
+    use_queue = False
+    use_chain = False
+    do_convolve = False
+    do_noise = False
+    do_strictmask = False
+    do_broadmask = False
+    do_moments = False
+    do_secondary = False
+
+if use_graph:
+    this_der.loop_derive_products(do_convolve=do_convolve, do_noise=do_noise,
+                                  do_strictmask=do_strictmask, do_broadmask=do_broadmask,
+                                  do_moments=do_moments, do_secondary=do_secondary,
+                                  use_graph=True, n_processes=n_processes,
+                                  memory_budget=memory_budget, resume=resume)
+    do_convolve = False
+    do_noise = False
+    do_strictmask = False
+    do_broadmask = False
+    do_moments = False
+    do_secondary = False
+
+if use_queue:
+    this_der.enqueue_derive_products(queue_dir=queue_dir, do_convolve=do_convolve,
+                                     do_noise=do_noise, do_strictmask=do_strictmask,
+                                     do_broadmask=do_broadmask, do_moments=do_moments,
+                                     do_secondary=do_secondary)
+    this_der.run_queue_worker(queue_dir=queue_dir, n_workers=n_processes)
+    do_convolve = False
+    do_noise = False
+    do_strictmask = False
+    do_broadmask = False
+    do_moments = False
+    do_secondary = False
+
+if use_chain:
+    this_der.loop_derive_products(do_convolve=do_convolve, do_noise=do_noise,
+                                  do_strictmask=do_strictmask, do_broadmask=do_broadmask,
+                                  do_moments=do_moments, do_secondary=do_secondary,
+                                  chain=True, resume=resume)
+    do_convolve = False
+    do_noise = False
+    do_strictmask = False
+    do_broadmask = False
+    do_moments = False
+    do_secondary = False
+
 # Run the calculations requested by the user. The steps are annotated
 # here, but in general, do not change anything below this line. Just
 # use the flags above to steer the calculation.
@@ -115,7 +253,9 @@ do_secondary = True
 if do_convolve:
     this_der.loop_derive_products(do_convolve=True, do_noise=False,
                                   do_strictmask=False, do_broadmask=False,
-                                  do_moments=False, do_secondary=False)
+                                  do_moments=False, do_secondary=False,
+                                  convolve_cores=convolve_cores,
+                                  memory_budget=memory_budget, resume=resume)
 
 # Estimate the noise from the signal-free regions of the data to
 # produce a three-dimensional noise model for each cube.
@@ -123,14 +263,16 @@ if do_convolve:
 if do_noise:
     this_der.loop_derive_products(do_convolve=False, do_noise=True,
                                   do_strictmask=False, do_broadmask=False,
-                                  do_moments=False, do_secondary=False)
+                                  do_moments=False, do_secondary=False,
+                                  resume=resume)
 
 # Construct "strict masks" for each cube at each resolution.
 
 if do_strictmask:
     this_der.loop_derive_products(do_convolve=False, do_noise=False,
                                   do_strictmask=True, do_broadmask=False,
-                                  do_moments=False, do_secondary=False)
+                                  do_moments=False, do_secondary=False,
+                                  resume=resume)
 
 # Combine the strict masks across all linked resolutions to form
 # "broad masks" that have high completeness.
@@ -138,7 +280,8 @@ if do_strictmask:
 if do_broadmask:
     this_der.loop_derive_products(do_convolve=False, do_noise=False,
                                   do_strictmask=False, do_broadmask=True,
-                                  do_moments=False, do_secondary=False)
+                                  do_moments=False, do_secondary=False,
+                                  resume=resume)
 
 # Apply the masks and use the cubes and noise models to produce moment
 # maps with associated uncertainty.
@@ -146,7 +289,8 @@ if do_broadmask:
 if do_moments:
     this_der.loop_derive_products(do_convolve=False, do_noise=False,
                                   do_strictmask=False, do_broadmask=False,
-                                  do_moments=True, do_secondary=False)
+                                  do_moments=True, do_secondary=False,
+                                  resume=resume)
 
 # Run a second round of moment calculations. This enables claculation
 # of moments that depend on other, earlier moment map calculations
@@ -154,4 +298,11 @@ if do_moments:
 if do_secondary:
     this_der.loop_derive_products(do_convolve=False, do_noise=False,
                                   do_strictmask=False, do_broadmask=False,
-                                  do_moments=False, do_secondary=True)
+                                  do_moments=False, do_secondary=True,
+                                  resume=resume)
+
+# Report the time, memory and IO of the tasks, slowest first.
+
+if profile_tasks:
+    this_der.write_profile_report(profile_report)
+    this_der.log_profile_summary()
@@ -0,0 +1,129 @@
+"""
+Compare the resolution ladder in scConvolution (smooth_cube_ladder)
+with direct convolutions of the input cube (smooth_cube).
+"""
+
+import os
+import sys
+
+import numpy as np
+import pytest
+import astropy.units as u
+from astropy.io import fits
+from astropy.wcs import WCS
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..', 'phangsPipeline'))
+
+import scConvolution
+
+def make_cube(outdir, nchan=12, ny=40, nx=36, seed=2):
+    """
+    Noise cube with a 3 arcsec beam on 1 arcsec pixels, with blanked
+    corners (outside the footprint) and a few blanked pixels inside
+    it, written to FITS in outdir.
+    """
+    rng = np.random.default_rng(seed)
+    wcs = WCS(naxis=3)
+    wcs.wcs.ctype = ['RA---SIN', 'DEC--SIN', 'VRAD']
+    wcs.wcs.cunit = ['deg', 'deg', 'm/s']
+    wcs.wcs.cdelt = [-1. / 3600, 1. / 3600, 2500.]
+    wcs.wcs.crpix = [nx / 2., ny / 2., 1]
+    wcs.wcs.crval = [10., 10., 0.]
+    header = wcs.to_header()
+    header['BUNIT'] = 'K'
+    header['BMAJ'] = 3. / 3600
+    header['BMIN'] = 3. / 3600
+    header['BPA'] = 0.
+
+    data = rng.standard_normal((nchan, ny, nx)).astype(np.float32)
+    data[:, :6, :8] = np.nan
+    data[:, -4:, -5:] = np.nan
+    data[3, 20:22, 10:13] = np.nan
+
+    filename = str(outdir.join('cube.fits'))
+    fits.PrimaryHDU(data=data, header=header).writeto(filename)
+    return(filename)
+
+@pytest.fixture(scope='module')
+def infile(tmpdir_factory):
+    return(make_cube(tmpdir_factory.mktemp('cubes')))
+
+def direct_files(infile, outdir, tag, **kwargs):
+    outfile = str(outdir.join(tag+'_direct.fits'))
+    coveragefile = str(outdir.join(tag+'_direct_coverage.fits'))
+    scConvolution.smooth_cube(infile, outfile=outfile,
+                              make_coverage_cube=True,
+                              coveragefile=coveragefile, **kwargs)
+    return(outfile, coveragefile)
+
+def ladder_rungs(outdir, resolutions):
+    rungs = []
+    for resolution in resolutions:
+        tag = str(int(resolution.value))
+        rungs.append({'angular_resolution': resolution,
+                      'outfile': str(outdir.join(tag+'_ladder.fits')),
+                      'coveragefile': str(outdir.join(tag+'_ladder_coverage.fits'))})
+    return(rungs)
+
+def assert_files_match(ladder_file, direct_file, atol=1e-5):
+    ladder = fits.open(ladder_file)[0]
+    direct = fits.open(direct_file)[0]
+    assert ladder.data.shape == direct.data.shape
+    np.testing.assert_array_equal(np.isnan(ladder.data), np.isnan(direct.data))
+    np.testing.assert_allclose(ladder.data, direct.data, rtol=0, atol=atol,
+                               equal_nan=True)
+    for key in ['BMAJ', 'BMIN', 'DIST_MPC', 'CHCORR1', 'CHCORR2']:
+        assert ladder.header.get(key) == direct.header.get(key)
+
+@pytest.mark.parametrize('spectral_rebin', [False, True])
+def test_ladder_smooths_spectrally(infile, tmpdir, spectral_rebin):
+    resolutions = [5 * u.arcsec, 8 * u.arcsec]
+    rungs = ladder_rungs(tmpdir, resolutions)
+    scConvolution.smooth_cube_ladder(infile, rungs=rungs,
+                                     make_coverage_cube=True,
+                                     velocity_resolution='7.5 km/s',
+                                     spectral_rebin=spectral_rebin)
+    for rung, resolution in zip(rungs, resolutions):
+        outfile, coveragefile = direct_files(
+            infile, tmpdir, str(int(resolution.value)),
+            angular_resolution=resolution, velocity_resolution='7.5 km/s', spectral_rebin=spectral_rebin)
+        assert_files_match(rung['outfile'], outfile)
+        assert_files_match(rung['coveragefile'], coveragefile)
+        nchan = fits.getdata(outfile).shape[0]
+        assert nchan == (4 if spectral_rebin else 12)
+
+@pytest.mark.parametrize('nan_treatment', ['interpolate', 'fill'])
+def test_ladder_matches_direct(infile, tmpdir, nan_treatment):
+    # ... given out of order, with one physical rung (~6" at 10 Mpc)
+    resolutions = [7 * u.arcsec, 4 * u.arcsec, 10 * u.arcsec]
+    rungs = ladder_rungs(tmpdir, resolutions)
+    physical = {'linear_resolution': 300 * u.pc,
+                'distance': 10e6 * u.pc,
+                'outfile': str(tmpdir.join('phys_ladder.fits')),
+                'coveragefile': str(tmpdir.join('phys_ladder_coverage.fits'))}
+    rungs.append(physical)
+
+    results, accuracy = scConvolution.smooth_cube_ladder(
+        infile, rungs=rungs, make_coverage_cube=True,
+        nan_treatment=nan_treatment, check_accuracy=True)
+    assert [written for rung, res, written in results] == [True] * 4
+    np.testing.assert_allclose(
+        [res.to(u.arcsec).value for rung, res, written in results],
+        [4, 6.19, 7, 10], rtol=1e-3)
+    assert accuracy < 1e-5
+
+    for rung in rungs:
+        if rung is physical:
+            tag = 'phys'
+            kwargs = {'linear_resolution': rung['linear_resolution'],
+                      'distance': rung['distance']}
+        else:
+            tag = str(int(rung['angular_resolution'].value))
+            kwargs = {'angular_resolution': rung['angular_resolution']}
+        outfile, coveragefile = direct_files(
+            infile, tmpdir, tag, nan_treatment=nan_treatment, **kwargs)
+        # ... data, NaN footprint, and coverage to float32 rounding
+        assert_files_match(rung['outfile'], outfile)
+        assert_files_match(rung['coveragefile'], coveragefile)
+        assert np.any(np.isnan(fits.getdata(outfile)))
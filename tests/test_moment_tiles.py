@@ -0,0 +1,154 @@
+"""
+Compare the tiled (chunk_shape / max_memory) and sparse (ray list)
+modes of scMoments.moment_generator with the whole-cube path on a
+small synthetic cube.
+"""
+
+import os
+import sys
+
+import numpy as np
+import pytest
+import astropy.units as u
+from astropy.io import fits
+from astropy.wcs import WCS
+from spectral_cube import SpectralCube
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..', 'phangsPipeline'))
+
+import scMoments
+import scDerivativeRoutines as scdr
+
+# Tiles that do not divide the 13 x 11 image evenly
+tile_shapes = [(4, 5), (13, 3), (1, 11)]
+
+moments = ['mom0', 'mom1', 'mom2', 'ew', 'vquad', 'vpeak', 'tpeak']
+
+def make_cubes(outdir, nchan=40, ny=13, nx=11, seed=1):
+    """
+    Gaussian lines with a velocity gradient, plus noise, on a small
+    grid. The cube, a mask cube, and a noise cube are written to FITS
+    files in outdir and read back, as in the pipeline.
+    """
+    rng = np.random.default_rng(seed)
+    wcs = WCS(naxis=3)
+    wcs.wcs.ctype = ['RA---SIN', 'DEC--SIN', 'VRAD']
+    wcs.wcs.cunit = ['deg', 'deg', 'm/s']
+    wcs.wcs.cdelt = [-1e-4, 1e-4, 2500.]
+    wcs.wcs.crpix = [nx / 2., ny / 2., 1]
+    wcs.wcs.crval = [10., 10., -50000.]
+    header = wcs.to_header()
+    header['BUNIT'] = 'K'
+    header['BMAJ'] = 3e-4
+    header['BMIN'] = 3e-4
+    header['BPA'] = 0.
+
+    vaxis = np.arange(nchan) * 2.5 - 50.
+    yy, xx = np.mgrid[:ny, :nx]
+    vcen = -10. + 2. * xx + 1.5 * yy
+    amp = 1. + 0.3 * yy
+    data = (amp[np.newaxis] * np.exp(
+        -0.5 * ((vaxis[:, np.newaxis, np.newaxis] - vcen[np.newaxis]) / 6.)**2)
+        + 0.1 * rng.standard_normal((nchan, ny, nx)))
+
+    cubes = []
+    for name, values in [('cube', data),
+                         ('mask', (data > 0.3).astype(float)),
+                         ('noise', np.full(data.shape, 0.1))]:
+        filename = str(outdir.join(name+'.fits'))
+        fits.PrimaryHDU(data=values, header=header).writeto(filename)
+        cubes.append(SpectralCube.read(filename))
+    return(tuple(cubes))
+
+@pytest.fixture(scope='module')
+def cubes(tmpdir_factory):
+    return(make_cubes(tmpdir_factory.mktemp('cubes')))
+
+def assert_maps_match(whole, tiled, rtol=1e-6):
+    if whole is None:
+        assert tiled is None
+        return
+    whole = u.Quantity(whole)
+    tiled = u.Quantity(tiled).to(whole.unit)
+    np.testing.assert_array_equal(np.isfinite(whole.value),
+                                  np.isfinite(tiled.value))
+    np.testing.assert_allclose(tiled.value, whole.value,
+                               rtol=rtol, atol=1e-10, equal_nan=True)
+
+@pytest.mark.parametrize('moment', moments)
+@pytest.mark.parametrize('use_mask', [True, False])
+@pytest.mark.parametrize('use_noise', [True, False])
+def test_tiles_match_whole_cube(cubes, moment, use_mask, use_noise):
+    cube, mask, noise = cubes
+    if not use_mask:
+        mask = None
+    if not use_noise:
+        noise = None
+
+    whole = scMoments.moment_generator(cube, mask=mask, noise=noise,
+                                       moment=moment)
+    for chunk_shape in tile_shapes:
+        tiled = scMoments.moment_generator(cube, mask=mask, noise=noise,
+                                           moment=moment,
+                                           chunk_shape=chunk_shape)
+        assert_maps_match(whole[0], tiled[0])
+        assert_maps_match(whole[1], tiled[1])
+
+@pytest.mark.parametrize('moment', moments)
+def test_tiles_match_whole_cube_correlated(cubes, moment):
+    cube, mask, noise = cubes
+    channel_correlation = np.array([1., 0.4, 0.1])
+
+    whole = scMoments.moment_generator(
+        cube, mask=mask, noise=noise, moment=moment,
+        channel_correlation=channel_correlation)
+    tiled = scMoments.moment_generator(
+        cube, mask=mask, noise=noise, moment=moment,
+        channel_correlation=channel_correlation, chunk_shape=(4, 5))
+    assert_maps_match(whole[0], tiled[0])
+    assert_maps_match(whole[1], tiled[1])
+
+def test_max_memory_tiles_match_whole_cube(cubes):
+    cube, mask, noise = cubes
+    # ... small enough to force several tiles
+    max_memory = 40 * 8 * scMoments._tile_temporaries * 20
+    assert scMoments.chunk_shape_for_memory(cube.shape, max_memory) != cube.shape[1:]
+
+    whole = scMoments.moment_generator(cube, mask=mask, noise=noise,
+                                       moment='mom1')
+    tiled = scMoments.moment_generator(cube, mask=mask, noise=noise,
+                                       moment='mom1', max_memory=max_memory)
+    assert_maps_match(whole[0], tiled[0])
+    assert_maps_match(whole[1], tiled[1])
+
+@pytest.mark.parametrize('moment', scMoments._raylist_moments)
+@pytest.mark.parametrize('use_noise', [True, False])
+def test_sparse_matches_whole_cube(cubes, moment, use_noise):
+    cube, mask, noise = cubes
+    if not use_noise:
+        noise = None
+
+    whole = scMoments.moment_generator(cube, mask=mask, noise=noise,
+                                       moment=moment)
+    sparse = scMoments.moment_generator(cube, mask=mask, noise=noise,
+                                        moment=moment, sparse=True)
+    # ... the ray list sums in a different order
+    assert_maps_match(whole[0], sparse[0], rtol=1e-5)
+    assert_maps_match(whole[1], sparse[1], rtol=1e-5)
+
+@pytest.mark.parametrize('span_mask', [True, False])
+@pytest.mark.parametrize('window', [None, '12.5 km/s'])
+def test_peak_products_tiles_match_whole_image(cubes, span_mask, window):
+    cube, mask, noise = cubes
+    cube = cube.with_mask(mask.unmasked_data[:].value > 0)
+    kwargs = dict(rms=noise, window=window, span_mask=span_mask,
+                  channel_correlation=np.array([1., 0.4, 0.1]))
+
+    whole = scdr.peak_products(cube, **kwargs)
+    for chunk_shape in tile_shapes:
+        tiled = scdr.peak_products(cube, chunk_shape=chunk_shape,
+                                   **kwargs)
+        assert sorted(tiled) == sorted(whole)
+        for key in whole:
+            np.testing.assert_array_equal(tiled[key], whole[key])
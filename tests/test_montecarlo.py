@@ -0,0 +1,96 @@
+"""
+Check the Monte Carlo moment errors in scMonteCarlo: reproducible for
+a seed whatever the tiling and number of workers, and consistent with
+the analytic errors for white noise.
+"""
+
+import os
+import sys
+
+import numpy as np
+import pytest
+import astropy.units as u
+from astropy.io import fits
+from astropy.wcs import WCS
+from spectral_cube import SpectralCube
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..', 'phangsPipeline'))
+
+import scDerivativeRoutines as scdr
+from scMonteCarlo import montecarlo_error
+
+def make_cubes(outdir, nchan=30, ny=13, nx=11, seed=3):
+    """
+    Gaussian lines plus white noise (0.1 K), a mask of the lines, and
+    a noise cube, written to FITS in outdir and read back.
+    """
+    rng = np.random.default_rng(seed)
+    wcs = WCS(naxis=3)
+    wcs.wcs.ctype = ['RA---SIN', 'DEC--SIN', 'VRAD']
+    wcs.wcs.cunit = ['deg', 'deg', 'm/s']
+    wcs.wcs.cdelt = [-1e-4, 1e-4, 2500.]
+    wcs.wcs.crpix = [nx / 2., ny / 2., 1]
+    wcs.wcs.crval = [10., 10., -37500.]
+    header = wcs.to_header()
+    header['BUNIT'] = 'K'
+
+    vaxis = np.arange(nchan) * 2.5 - 37.5
+    yy, xx = np.mgrid[:ny, :nx]
+    vcen = -8. + 1.5 * xx + 0.5 * yy
+    model = (1. + 0.2 * yy)[np.newaxis] * np.exp(
+        -0.5 * ((vaxis[:, np.newaxis, np.newaxis] - vcen[np.newaxis]) / 6.)**2)
+    data = model + 0.1 * rng.standard_normal((nchan, ny, nx))
+    mask = model > 0.2
+    mask[:, :2, :3] = False
+
+    cubes = []
+    for name, values in [('cube', data), ('mask', mask.astype(float)),
+                         ('noise', np.full(data.shape, 0.1))]:
+        filename = str(outdir.join(name+'.fits'))
+        fits.PrimaryHDU(data=values, header=header).writeto(filename)
+        cubes.append(SpectralCube.read(filename))
+    return(tuple(cubes))
+
+@pytest.fixture(scope='module')
+def cubes(tmpdir_factory):
+    return(make_cubes(tmpdir_factory.mktemp('cubes')))
+
+@pytest.mark.parametrize('moment', ['mom0', 'mom1', 'tpeak'])
+@pytest.mark.parametrize('channel_correlation', [None, np.array([1., 0.3])])
+def test_same_seed_same_map(cubes, moment, channel_correlation):
+    cube, mask, noise = cubes
+    kwargs = dict(rms=noise, mask=mask, moment=moment, n_realizations=20,
+                  channel_correlation=channel_correlation, seed=42)
+
+    reference = montecarlo_error(cube, **kwargs)
+    assert np.sum(np.isfinite(reference)) > 50
+
+    # ... tiles, workers, and a budget small enough to batch the pixels
+    for n_workers, chunk_shape, max_memory in [
+            (3, None, '1 GB'), (1, (4, 5), '1 GB'), (4, (1, 11), '1 GB'),
+            (2, (13, 3), 30 * 20 * 8 * 6 * 3)]:
+        this = montecarlo_error(cube, n_workers=n_workers,
+                                chunk_shape=chunk_shape,
+                                max_memory=max_memory, **kwargs)
+        np.testing.assert_array_equal(this.value, reference.value)
+
+    other = montecarlo_error(cube, **dict(kwargs, seed=43))
+    assert not np.array_equal(other.value, reference.value)
+
+def test_mom0_matches_analytic_white_noise(cubes):
+    cube, mask, noise = cubes
+    masked = cube.with_mask(mask.unmasked_data[:].value > 0)
+
+    _, analytic = scdr.write_moment0(masked, rms=noise, return_products=True)
+    mc = montecarlo_error(cube, rms=noise, mask=mask, moment='mom0',
+                          n_realizations=400, seed=1)
+    analytic = u.Quantity(analytic).to(mc.unit).value
+
+    # ... the Monte Carlo map is only defined under the mask
+    finite = np.isfinite(mc.value)
+    assert np.sum(finite) > 50
+    ratio = mc.value[finite] / analytic[finite]
+    # ... 400 realizations give each pixel a ~5% scatter
+    np.testing.assert_allclose(np.median(ratio), 1.0, atol=0.02)
+    assert np.all(np.abs(ratio - 1) < 0.25)
@@ -0,0 +1,178 @@
+"""
+Check the stacking routines in scStackingRoutines on a small
+synthetic cube of noiseless Gaussian lines, comparing stacks of a
+RayList (masked voxels only) and a masked cube with stacks of the
+unmasked cube.
+"""
+
+import os
+import sys
+
+import numpy as np
+import pytest
+import astropy.units as u
+from astropy.io import fits
+from astropy.wcs import WCS
+from spectral_cube import SpectralCube
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..', 'phangsPipeline'))
+
+import scStackingRoutines as ssr
+from scRayList import build_raylist
+
+def make_cubes(outdir, frac=0.0, nchan=60, ny=12, nx=10):
+    """
+    Gaussian lines (peak 1 K) whose centroids are whole channels
+    (frac=0) or fractional channels apart, a mask of the line cores,
+    a noise cube, and labels: 1 and 2 in the two halves of the image
+    and 3 in two columns where the mask is empty.
+    """
+    wcs = WCS(naxis=3)
+    wcs.wcs.ctype = ['RA---SIN', 'DEC--SIN', 'VRAD']
+    wcs.wcs.cunit = ['deg', 'deg', 'm/s']
+    wcs.wcs.cdelt = [-1e-4, 1e-4, 2500.]
+    wcs.wcs.crpix = [nx / 2., ny / 2., 1]
+    wcs.wcs.crval = [10., 10., -75000.]
+    header = wcs.to_header()
+    header['BUNIT'] = 'K'
+
+    vaxis = np.arange(nchan) * 2.5 - 75.
+    yy, xx = np.mgrid[:ny, :nx]
+    vcen = 2.5 * ((xx + yy) % 9 - 4) + frac * 2.5 * ((3 * xx + yy) % 4) / 4.
+    data = np.exp(-0.5 * ((vaxis[:, np.newaxis, np.newaxis]
+                           - vcen[np.newaxis]) / 5.)**2)
+    mask = data > 0.2
+    mask[:, :, :2] = False
+
+    cubes = []
+    for name, values in [('cube', data), ('mask', mask.astype(float)),
+                         ('noise', np.full(data.shape, 0.1))]:
+        filename = str(outdir.join(name+'.fits'))
+        fits.PrimaryHDU(data=values, header=header).writeto(filename)
+        cubes.append(SpectralCube.read(filename))
+    labels = np.where(xx < 2, 3, 1 + (yy >= ny // 2))
+    return(tuple(cubes) + (labels, vcen * u.km / u.s))
+
+@pytest.fixture(scope='module', params=[0.0, 1.0], ids=['whole', 'fractional'])
+def cubes(request, tmpdir_factory):
+    return(make_cubes(tmpdir_factory.mktemp('cubes'), frac=request.param))
+
+def masked_cube(cube, mask):
+    return(cube.with_mask(mask.unmasked_data[:].value > 0.5))
+
+def test_raylist_stack_matches_unmasked_cube(cubes):
+    cube, mask, noise, labels, centroids = cubes
+    raylist = build_raylist(cube, mask=mask)
+
+    whole, _ = ssr.BinByLabel(cube, labels, centroids)
+    sparse, _ = ssr.BinByLabel(raylist, labels, centroids)
+
+    for this_whole, this_sparse in zip(whole, sparse):
+        if this_whole['label'] == 3:
+            # ... no masked voxels under this label
+            assert np.all(np.isnan(this_sparse['spectrum']))
+            continue
+        velocity = this_whole['spectral_axis'].to(u.km / u.s).value
+        core = np.abs(velocity) <= 5.
+        assert np.all(np.isfinite(this_sparse['spectrum'][core]))
+        assert np.all(np.isnan(this_sparse['spectrum'][np.abs(velocity) > 15.]))
+        np.testing.assert_allclose(this_sparse['spectrum'][core],
+                                   this_whole['spectrum'][core],
+                                   rtol=0, atol=5e-3)
+        np.testing.assert_allclose(np.nanmax(this_sparse['spectrum']), 1.0,
+                                   atol=5e-3)
+
+def test_raylist_stack_whole_channels_exact(cubes):
+    cube, mask, noise, labels, centroids = cubes
+    if not np.allclose(centroids.value % 2.5, 0):
+        pytest.skip("fractional shifts")
+    raylist = build_raylist(cube, mask=mask)
+
+    whole, _ = ssr.BinByLabel(cube, labels, centroids)
+    sparse, _ = ssr.BinByLabel(raylist, labels, centroids)
+    for this_whole, this_sparse in zip(whole[:2], sparse[:2]):
+        valid = np.isfinite(this_sparse['spectrum'])
+        np.testing.assert_allclose(this_sparse['spectrum'][valid],
+                                   this_whole['spectrum'][valid], rtol=1e-6)
+
+@pytest.mark.parametrize('weighting', ['uniform', 'inverse_variance'])
+def test_raylist_stack_matches_masked_cube(cubes, weighting):
+    cube, mask, noise, labels, centroids = cubes
+    raylist = build_raylist(cube, mask=mask, noise=noise)
+
+    # The same shifts on both, since a ray list cannot use the FFT
+    dense, _ = ssr.BinByLabel(masked_cube(cube, mask), labels, centroids,
+                              noise_cube=noise, weighting=weighting,
+                              shift_mode='lanczos')
+    sparse, _ = ssr.BinByLabel(raylist, labels, centroids,
+                               noise_cube=raylist, weighting=weighting)
+    for this_dense, this_sparse in zip(dense, sparse):
+        for key in ['spectrum', 'noise']:
+            np.testing.assert_array_equal(np.isfinite(this_dense[key]),
+                                          np.isfinite(this_sparse[key]))
+            np.testing.assert_allclose(this_sparse[key], this_dense[key],
+                                       rtol=1e-6, atol=1e-7, equal_nan=True)
+    # 48 spectra with 0.1 K noise in the line core
+    np.testing.assert_allclose(np.nanmin(sparse[0]['noise']), 0.1 / np.sqrt(48),
+                               rtol=0.1)
+
+def test_binbymask_raylist(cubes):
+    cube, mask, noise, labels, centroids = cubes
+    raylist = build_raylist(cube, mask=mask)
+
+    spectrum, spaxis = ssr.BinByMask(raylist, labels == 1, centroids)
+    stacks, _ = ssr.BinByLabel(raylist, labels, centroids)
+    np.testing.assert_array_equal(spectrum, stacks[0]['spectrum'])
+    np.testing.assert_allclose(np.nanmax(spectrum), 1.0, atol=5e-3)
+
+def test_integer_shift_matches_roll():
+    rng = np.random.default_rng(4)
+    spectra = rng.standard_normal((64, 20))
+    shifts = rng.integers(-6, 7, 20).astype(float)
+
+    for mode in ['integer', 'auto', 'fft']:
+        shifted = ssr.channelShiftVec(spectra, shifts, mode=mode)
+        for ii, shift in enumerate(shifts):
+            rolled = np.roll(spectra[:, ii], int(shift))
+            # ... away from the band edges (the FFT wraps exactly)
+            np.testing.assert_allclose(shifted[8:-8, ii], rolled[8:-8],
+                                       atol=1e-12)
+
+def test_lanczos_matches_fft_band_limited():
+    channel = np.arange(80)[:, np.newaxis]
+    centre = np.linspace(30, 50, 15)[np.newaxis, :]
+    spectra = np.exp(-0.5 * ((channel - centre) / 4.)**2)
+    shifts = np.linspace(-7.9, 7.9, 15)
+
+    fft = ssr.channelShiftVec(spectra, shifts, mode='fft')
+    lanczos = ssr.channelShiftVec(spectra, shifts, mode='lanczos')
+    assert np.max(np.abs(lanczos - fft)) < 5e-3
+    # ... the true shifted profile
+    expected = np.exp(-0.5 * ((channel - centre - shifts) / 4.)**2)
+    np.testing.assert_allclose(fft, expected, atol=1e-6)
+
+@pytest.mark.parametrize('mode', ['integer', 'lanczos'])
+def test_edge_channels_filled(mode):
+    rng = np.random.default_rng(5)
+    spectra = rng.uniform(1, 2, (32, 3))
+    shifts = np.array([5., -5., np.nan])
+    if mode == 'lanczos':
+        shifts[:2] += 0.4
+
+    shifted = ssr.channelShiftVec(spectra, shifts, mode=mode, fill=-7.)
+    # Channels shifted in from beyond the band take the fill value
+    # rather than wrapping around. The Lanczos taps (-2 ... 3 channels
+    # from floor(shift)) make fewer of them pure fill.
+    nlow, nhigh = (5, 5) if mode == 'integer' else (3, 2)
+    np.testing.assert_allclose(shifted[:nlow, 0], -7.)
+    np.testing.assert_allclose(shifted[-nhigh:, 1], -7.)
+    assert np.all(shifted[8:, 0] > 0)
+    assert np.all(shifted[:-8, 1] > 0)
+    # ... and spectra without a shift are blank
+    assert np.all(np.isnan(shifted[:, 2]))
+
+def test_benchmark_channel_shift():
+    timings = ssr.benchmark_channel_shift(nchan=32, nspec=50, repeat=1)
+    assert sorted(timings) == sorted(ssr.shift_modes)
+    assert all(np.isfinite(list(timings.values())))
@@ -0,0 +1,159 @@
+"""
+Check the shared-directory work queue in utilsWorkQueue: items run
+exactly once across several worker processes, failures are contained
+and retried, stages are respected, and expired leases are broken and
+their items run again.
+"""
+
+import os
+import sys
+import time
+import threading
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..', 'phangsPipeline'))
+
+import utilsWorkQueue
+from utilsWorkQueue import WorkQueue, run_local_workers
+
+class RecordingHandler(object):
+    """
+    Stand-in for a handler: each call appends a line (pid and time)
+    to a file named after the item, and can be told to fail.
+    """
+
+    def __init__(self, outdir):
+        self.outdir = str(outdir)
+
+    def work(self, name=None, fail=False, sleep=0.05):
+        with open(os.path.join(self.outdir, name+'.log'), 'a') as f:
+            f.write(str(os.getpid())+' '+repr(time.time())+'\n')
+        time.sleep(sleep)
+        if fail:
+            raise RuntimeError("failing on purpose: "+name)
+
+def runs(outdir, name):
+    filename = os.path.join(str(outdir), name+'.log')
+    if not os.path.isfile(filename):
+        return([])
+    with open(filename) as f:
+        return([line.split() for line in f.read().splitlines()])
+
+def test_local_workers_run_each_item_once(tmpdir):
+    queue_dir = str(tmpdir.join('queue'))
+    outdir = tmpdir.mkdir('out')
+    queue_kwargs = dict(lease_time=30., heartbeat=0.2, max_attempts=2,
+                        poll=0.02)
+    queue = WorkQueue(queue_dir, **queue_kwargs)
+
+    # Six items in stage 0 (one of which always fails) and two in
+    # stage 1
+    for ii in range(6):
+        queue.add('s0_item'+str(ii), 'work',
+                  kwargs={'name': 's0_item'+str(ii), 'fail': ii == 3}, stage=0)
+    for ii in range(2):
+        queue.add('s1_item'+str(ii), 'work',
+                  kwargs={'name': 's1_item'+str(ii)}, stage=1)
+    # ... adding again leaves the item alone
+    assert not queue.add('s0_item0', 'work', kwargs={'name': 'other'})
+
+    counts = run_local_workers(RecordingHandler(outdir), queue_dir,
+                               n_workers=3, **queue_kwargs)
+
+    # The failing item runs max_attempts times, every other item once
+    assert len(counts) == 3
+    assert sum(counts) == 7 + 2
+    status = queue.status()
+    for ii in range(6):
+        this_id = 's0_item'+str(ii)
+        if ii == 3:
+            assert status[this_id] == 'failed'
+            assert len(runs(outdir, this_id)) == 2
+        else:
+            assert status[this_id] == 'done'
+            assert len(runs(outdir, this_id)) == 1
+    assert queue.summary() == {'pending': 0, 'running': 0, 'done': 7,
+                               'failed': 1}
+    assert queue.finished()
+
+    # More than one process did the work
+    pids = set(run[0] for item in queue.items()
+               for run in runs(outdir, item['id']))
+    assert len(pids) > 1
+
+    # Stage 1 started only after stage 0 (including the failed retries)
+    # had finished
+    stage0_end = max(float(run[1]) for ii in range(6)
+                     for run in runs(outdir, 's0_item'+str(ii)))
+    stage1_start = min(float(run[1]) for ii in range(2)
+                       for run in runs(outdir, 's1_item'+str(ii)))
+    assert stage1_start > stage0_end
+
+    # Failed items can be given a fresh set of attempts
+    queue.requeue_failed()
+    assert queue.item_status('s0_item3') == 'pending'
+    assert queue.run_worker(RecordingHandler(outdir), worker_id='again') == 2
+    assert queue.item_status('s0_item3') == 'failed'
+    assert len(runs(outdir, 's0_item0')) == 1
+
+def test_expired_lease_is_requeued(tmpdir):
+    queue = WorkQueue(str(tmpdir.join('queue')), lease_time=5., heartbeat=1.,
+                      poll=0.01)
+    outdir = tmpdir.mkdir('out')
+    queue.add('item', 'work', kwargs={'name': 'item'})
+
+    # Worker A claims the item and dies without running it
+    item = queue.claim(worker_id='A')
+    assert item['id'] == 'item'
+    assert queue.item_status('item') == 'running'
+
+    # While the lease is fresh nobody else can claim it
+    assert queue.claim(worker_id='B') is None
+    assert not queue.finished()
+
+    # Age the lease past lease_time: B breaks it and runs the item
+    lease_file = queue._file('leases', 'item')
+    old = os.stat(lease_file).st_mtime - 60.
+    os.utime(lease_file, (old, old))
+    item = queue.claim(worker_id='B')
+    assert item is not None and item['id'] == 'item'
+    assert queue._holds_lease('item', 'B')
+    assert not queue._holds_lease('item', 'A')
+
+    assert queue.run_item(RecordingHandler(outdir), item, worker_id='B')
+    assert queue.item_status('item') == 'done'
+    assert not os.path.exists(lease_file)
+    assert len(runs(outdir, 'item')) == 1
+
+    # ... and a finished item is never claimed again
+    assert queue.claim(worker_id='C') is None
+    assert queue.finished()
+
+def test_heartbeat_keeps_lease(tmpdir):
+    queue = WorkQueue(str(tmpdir.join('queue')), lease_time=0.5,
+                      heartbeat=0.05, poll=0.01)
+    outdir = tmpdir.mkdir('out')
+    queue.add('slow', 'work', kwargs={'name': 'slow', 'sleep': 1.5})
+
+    item = queue.claim(worker_id='A')
+    runner = threading.Thread(target=queue.run_item,
+                              args=(RecordingHandler(outdir), item),
+                              kwargs={'worker_id': 'A'})
+    runner.start()
+    try:
+        # Well past lease_time the heartbeat still keeps B out
+        time.sleep(1.0)
+        assert queue.claim(worker_id='B') is None
+        assert queue._holds_lease('slow', 'A')
+    finally:
+        runner.join()
+
+    assert queue.item_status('slow') == 'done'
+    assert len(runs(outdir, 'slow')) == 1
+
+def test_item_id_is_file_system_safe():
+    assert utilsWorkQueue.item_id(0, 'ngc0628', 'co21', None, '7m+tp') \
+        == '0_ngc0628_co21_7m+tp'
+    assert utilsWorkQueue.item_id('a/b c') == 'a_b_c'